@@ -0,0 +1,140 @@
+#! /usr/bin/python2
+
+"""
+Command line interface to the survey catalogue of apersharp
+
+Ingest the master tables and candidate tables of runs into the catalogue:
+    apersharp_catalogue.py catalogue.sqlite ingest <directory> [<directory> ...]
+
+Get candidates across all taskids:
+    apersharp_catalogue.py catalogue.sqlite query --max_negative_snr -7
+
+List the ingested cubes:
+    apersharp_catalogue.py catalogue.sqlite list
+"""
+
+import os
+import sys
+import logging
+import argparse
+import tempfile
+
+from lib.setup_logger import setup_logger
+from lib.survey_catalogue import SurveyCatalogue, find_cube_tables, CATALOGUE_TABLES, CATALOGUE_CANDIDATES_TABLE
+
+logger = logging.getLogger(__name__)
+
+
+def ingest_directories(catalogue_file, dir_list):
+    """
+    Function to ingest the tables of all cubes in directories into the survey catalogue
+
+    Return:
+    -------
+    (int): Number of ingested cubes
+    """
+
+    catalogue = SurveyCatalogue(catalogue_file)
+
+    n_cubes = 0
+    for base_dir in dir_list:
+        cube_table_list = find_cube_tables(base_dir)
+        if len(cube_table_list) == 0:
+            logger.warning(
+                "Could not find any master tables in {}".format(base_dir))
+        for taskid, cube, src_cat_file, candidate_file, master_table_engine in cube_table_list:
+            try:
+                catalogue.ingest_cube(taskid, cube, src_cat_file, candidate_file=candidate_file,
+                                      master_table_engine=master_table_engine)
+            except Exception as e:
+                logger.error("Ingesting cube {0} of taskid {1} ... Failed".format(
+                    cube, taskid))
+                logger.exception(e)
+            else:
+                n_cubes += 1
+
+    logger.info("Ingested {0} cubes into {1}".format(n_cubes, catalogue_file))
+
+    return n_cubes
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description='Ingest tables of apersharp into the survey catalogue and query it')
+
+    parser.add_argument("catalogue_file", type=str,
+                        help='Database file of the survey catalogue')
+
+    parser.add_argument("--log_level", type=str, default="WARNING",
+                        help='Level of the messages printed to the command line')
+
+    subparsers = parser.add_subparsers(dest="command")
+
+    ingest_parser = subparsers.add_parser(
+        "ingest", help='Ingest the tables of all cubes in directories')
+
+    ingest_parser.add_argument("directories", type=str, nargs="+",
+                               help='Directories of runs, taskids or cubes')
+
+    query_parser = subparsers.add_parser(
+        "query", help='Get the rows of a table of the catalogue')
+
+    query_parser.add_argument("--table", type=str, default=CATALOGUE_CANDIDATES_TABLE, choices=CATALOGUE_TABLES,
+                              help='Table of the catalogue')
+
+    query_parser.add_argument("--taskid", type=str, default=None,
+                              help='Only rows of this taskid')
+
+    query_parser.add_argument("--cube", type=int, default=None,
+                              help='Only rows of this cube')
+
+    query_parser.add_argument("--beam", type=int, default=None,
+                              help='Only rows of this beam')
+
+    query_parser.add_argument("--max_negative_snr", type=float, default=None,
+                              help='Only rows with Max_Negative_SNR below or equal this value')
+
+    query_parser.add_argument("--max_positive_snr", type=float, default=None,
+                              help='Only rows with Max_Positive_SNR below or equal this value')
+
+    query_parser.add_argument("--ra", type=float, default=None,
+                              help='Right ascension in degrees of the centre of a region')
+
+    query_parser.add_argument("--dec", type=float, default=None,
+                              help='Declination in degrees of the centre of a region')
+
+    query_parser.add_argument("--radius", type=float, default=None,
+                              help='Radius in degrees of a region')
+
+    query_parser.add_argument("--where", type=str, default=None,
+                              help='Additional SQL condition, e.g., "Max_Flux > 0.01"')
+
+    query_parser.add_argument("--limit", type=int, default=None,
+                              help='Maximum number of rows')
+
+    query_parser.add_argument("--output", type=str, default=None,
+                              help='Csv file for the rows. Default is to print them')
+
+    subparsers.add_parser("list", help='List the ingested cubes')
+
+    args = parser.parse_args()
+
+    setup_logger(args.log_level, logfile=os.path.join(
+        tempfile.gettempdir(), "apersharp_catalogue.log"), new_logfile=False)
+
+    if args.command == "ingest":
+        ingest_directories(args.catalogue_file, args.directories)
+    elif args.command == "query":
+        src_data = SurveyCatalogue(args.catalogue_file).query(table_name=args.table, taskid=args.taskid, cube=args.cube, beam=args.beam,
+                                                               max_negative_snr=args.max_negative_snr, max_positive_snr=args.max_positive_snr,
+                                                               ra=args.ra, dec=args.dec, radius=args.radius, where=args.where, limit=args.limit)
+        if args.output is None:
+            src_data.write(sys.stdout, format="ascii.csv")
+        else:
+            src_data.write(args.output, format="ascii.csv", overwrite=True)
+            logger.info("Wrote {0} rows to {1}".format(
+                len(src_data), args.output))
+    elif args.command == "list":
+        SurveyCatalogue(args.catalogue_file).get_ingested_cubes().write(
+            sys.stdout, format="ascii.fixed_width_two_line")
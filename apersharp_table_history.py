@@ -0,0 +1,119 @@
+#! /usr/bin/python2
+
+"""
+Command line interface to the versions of the master table and the candidate table of a cube
+
+List the versions of the master table of a cube:
+    apersharp_table_history.py <cube directory> list
+
+Restore version 3 of the candidate table:
+    apersharp_table_history.py <cube directory> restore 3 --table candidates
+"""
+
+import os
+import sys
+import glob
+import logging
+import argparse
+import tempfile
+import datetime
+from astropy.table import Table
+
+from lib.setup_logger import setup_logger
+from lib.table_history import TableHistory
+from lib.master_table_store import MasterTableStore, get_master_table_store_file
+
+logger = logging.getLogger(__name__)
+
+# backup directory and file pattern of the tables in the directory of a cube
+TABLE_HISTORY_DIRS = {'master': ("master_table_backup", "*_master_table.csv"),
+                      'candidates': ("candidate_table_backup", "*_snr_candidates.csv")}
+
+
+def get_table_file(cube_dir, table):
+    """
+    Function to find the file of a table in the directory of a cube
+
+    Return:
+    -------
+    (str): File of the table
+    """
+
+    history_dir_name, table_pattern = TABLE_HISTORY_DIRS[table]
+
+    table_file_list = glob.glob(os.path.join(cube_dir, table_pattern))
+    if len(table_file_list) != 1:
+        error = "Could not find a single {0} table in {1}. Use --table_file".format(
+            table, cube_dir)
+        logger.error(error)
+        raise RuntimeError(error)
+
+    return table_file_list[0]
+
+
+def restore_table(cube_dir, version, table="master", table_file=None, master_table_engine="csv"):
+    """
+    Function to restore a version of a table of a cube
+
+    With master_table_engine="sqlite", the version of the master table
+    replaces the content of the master table store.
+    """
+
+    if table_file is None:
+        table_file = get_table_file(cube_dir, table)
+
+    TableHistory(os.path.join(
+        cube_dir, TABLE_HISTORY_DIRS[table][0]), table_file).restore(version)
+
+    if table == "master" and master_table_engine == "sqlite":
+        MasterTableStore(get_master_table_store_file(table_file)).overwrite(
+            Table.read(table_file, format="ascii.csv"))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description='List and restore versions of the tables of a cube')
+
+    parser.add_argument("cube_dir", type=str,
+                        help='Directory of the cube')
+
+    parser.add_argument("--table", type=str, default="master", choices=sorted(TABLE_HISTORY_DIRS),
+                        help='Master table or candidate table')
+
+    parser.add_argument("--table_file", type=str, default=None,
+                        help='File of the table. Default is the table of the cube')
+
+    parser.add_argument("--log_level", type=str, default="INFO",
+                        help='Level of the messages printed to the command line')
+
+    subparsers = parser.add_subparsers(dest="command")
+
+    subparsers.add_parser("list", help='List the versions of the table')
+
+    restore_parser = subparsers.add_parser(
+        "restore", help='Replace the table with a version')
+
+    restore_parser.add_argument("version", type=int,
+                                help='Number of the version')
+
+    restore_parser.add_argument("--master_table_engine", type=str, default="csv", choices=["csv", "sqlite"],
+                                help='Also replace the master table store ("sqlite")')
+
+    args = parser.parse_args()
+
+    setup_logger(args.log_level, logfile=os.path.join(
+        tempfile.gettempdir(), "apersharp_table_history.log"), new_logfile=False)
+
+    if args.table_file is None:
+        table_file = get_table_file(args.cube_dir, args.table)
+    else:
+        table_file = args.table_file
+
+    if args.command == "list":
+        for version_entry in TableHistory(os.path.join(args.cube_dir, TABLE_HISTORY_DIRS[args.table][0]), table_file).get_versions():
+            sys.stdout.write("{0:5d}  {1}  {2:12d}  {3}\n".format(version_entry['version'], datetime.datetime.fromtimestamp(
+                version_entry['time']).strftime("%Y-%m-%d %H:%M:%S"), version_entry['size'], version_entry['file']))
+    elif args.command == "restore":
+        restore_table(args.cube_dir, args.version, table=args.table,
+                      table_file=table_file, master_table_engine=args.master_table_engine)
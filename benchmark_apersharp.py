@@ -0,0 +1,564 @@
+#! /usr/bin/python2
+
+"""
+Benchmarks for apersharp
+
+The benchmarks use synthetic data in a temporary directory and
+do not need access to ALTA.
+"""
+
+import os
+import sys
+import glob
+import json
+import shutil
+import logging
+import argparse
+import tempfile
+import datetime
+import pkgutil
+import multiprocessing as mp
+from time import time
+import numpy as np
+from astropy.table import Table, vstack, hstack, Column
+
+from lib.setup_logger import setup_logger
+from lib.extract_spectra import extract_spectra
+from lib.read_spectra import read_beam_spectra, get_beam_spectrum_files, SPECTRUM_COLUMNS
+from lib.get_master_table import get_all_sources_of_cube
+from modules.apersharp import apersharp
+
+# the generators of synthetic data are shared with the tests
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests"))
+from conftest import create_synthetic_beam, create_synthetic_spectra, create_synthetic_sources
+
+logger = logging.getLogger(__name__)
+
+
+def create_synthetic_taskid(data_basedir, taskid, n_beams, cube_list, cube_size):
+    """
+    Function to create files with the size of cubes and continuum images
+    in the directory layout of the local data source
+
+    Args:
+    -----
+    data_basedir (str): Directory for the taskid
+    taskid (str): Name of the taskid
+    n_beams (int): Number of beams
+    cube_list (list): List of cubes
+    cube_size (float): Size of a cube in MB
+    """
+
+    chunk = np.zeros(1024**2, dtype=np.uint8).tostring()
+
+    for beam in range(n_beams):
+        beam_dir = os.path.join(data_basedir, taskid, str(beam).zfill(2))
+        os.makedirs(os.path.join(beam_dir, "line/cubes"))
+        os.makedirs(os.path.join(beam_dir, "continuum"))
+        for cube in cube_list:
+            with open(os.path.join(beam_dir, "line/cubes/HI_image_cube{}.fits".format(cube)), 'wb') as stream:
+                for k in range(int(cube_size)):
+                    stream.write(chunk)
+        with open(os.path.join(beam_dir, "continuum/image_mf_00.fits"), 'wb') as stream:
+            stream.write(chunk)
+
+
+def extract_spectra_sharpener_beams(beam_dir_list):
+    """
+    Function to extract the spectra of beams with sharpener
+
+    Return:
+    -------
+    (float): Time in seconds
+    """
+
+    import sharpener.sharpener as sharpy
+    from sharpener.sharp_modules import spec_ex
+
+    sharpener_configfilename = os.path.join(os.path.dirname(
+        os.path.abspath(__file__)), "sharpener_config/sharpener_default.yml")
+
+    # sharpener expects to be run in the directory of the beam
+    start_time = time()
+    for beam_dir in beam_dir_list:
+        os.chdir(beam_dir)
+        shutil.copy2(sharpener_configfilename, "sharpener_settings.yml")
+        spec_ex.abs_ex(sharpy.sharpener("sharpener_settings.yml").cfg_par)
+
+    return time() - start_time
+
+
+def benchmark_extraction(n_beams=40, n_chan=1218, n_pix=512, n_sources=50, chunk_size=64, baseline_file=None):
+    """
+    Function to measure the time to extract the spectra of all beams of a cube
+    with apersharp and with sharpener
+
+    Without sharpener, the time of sharpener is taken from a baseline file
+    saved by an earlier run with sharpener for the same parameters.
+
+    Args:
+    -----
+    baseline_file (str): Json file to save the time of sharpener to or to read it from if sharpener is not available. Default None
+
+    Return:
+    -------
+    (dict): Name of the extraction engine and time in seconds
+    """
+
+    parameters = {"n_beams": n_beams, "n_chan": n_chan,
+                  "n_pix": n_pix, "n_sources": n_sources}
+
+    has_sharpener = pkgutil.find_loader("sharpener") is not None
+    if not has_sharpener:
+        if baseline_file is None or not os.path.exists(baseline_file):
+            error = "Could not import sharpener and no baseline file to compare the extraction against"
+            logger.error(error)
+            raise RuntimeError(error)
+        with open(baseline_file, "r") as stream:
+            baseline = json.load(stream)
+        if baseline["parameters"] != parameters:
+            error = "Baseline file {0} was saved for different parameters: {1}".format(
+                baseline_file, baseline["parameters"])
+            logger.error(error)
+            raise RuntimeError(error)
+
+    benchmark_dir = tempfile.mkdtemp(prefix="apersharp_benchmark_")
+
+    try:
+        beam_dir_list = [os.path.join(benchmark_dir, str(beam).zfill(2))
+                         for beam in range(n_beams)]
+        for beam_dir in beam_dir_list:
+            create_synthetic_beam(beam_dir, n_chan, n_pix, n_sources)
+
+        results = {}
+
+        start_time = time()
+        for beam_dir in beam_dir_list:
+            extract_spectra(os.path.join(beam_dir, "HI_image_cube0.fits"), os.path.join(beam_dir, "sharpOut/abs/mir_src_sharp.csv"),
+                            os.path.join(beam_dir, "sharpOut/spec/"), cont_file=os.path.join(beam_dir, "image_mf.fits"), chunk_size=chunk_size)
+        results["apersharp"] = time() - start_time
+
+        if not has_sharpener:
+            results["sharpener"] = baseline["sharpener"]
+            logger.info("Using time of sharpener from {}".format(baseline_file))
+        else:
+            # sharpener reloads the logging module and changes the working directory
+            sharpener_pool = mp.Pool(1)
+            try:
+                results["sharpener"] = sharpener_pool.apply(
+                    extract_spectra_sharpener_beams, (beam_dir_list,))
+            finally:
+                sharpener_pool.terminate()
+                sharpener_pool.join()
+
+            if baseline_file is not None:
+                with open(baseline_file, "w") as stream:
+                    json.dump({"parameters": parameters,
+                               "sharpener": results["sharpener"]}, stream)
+                logger.info(
+                    "Saved time of sharpener to {}".format(baseline_file))
+
+        logger.info("#### Benchmark: extracting spectra of {0} sources from {1} beams ({2} channels, {3}x{3} pixels)".format(
+            n_sources, n_beams, n_chan, n_pix))
+        for engine in sorted(results):
+            logger.info("# {0}: {1:.1f}s".format(engine, results[engine]))
+        logger.info("# speedup: {0:.1f}".format(
+            results["sharpener"] / results["apersharp"]))
+    finally:
+        shutil.rmtree(benchmark_dir, ignore_errors=True)
+
+    return results
+
+
+def benchmark_spectra_reading(n_beams=40, n_chan=1218, n_sources=50, n_threads=8):
+    """
+    Function to measure the time to read the text files of the spectra of all beams of a cube
+    with astropy (Table.read for every file) and with the reader of apersharp
+
+    Return:
+    -------
+    (dict): Name of the reader and time in seconds
+    """
+
+    benchmark_dir = tempfile.mkdtemp(prefix="apersharp_benchmark_")
+
+    try:
+        beam_dir_list = [os.path.join(benchmark_dir, str(beam).zfill(2))
+                         for beam in range(n_beams)]
+        for beam_dir in beam_dir_list:
+            create_synthetic_spectra(beam_dir, n_chan, n_sources)
+
+        results = {}
+
+        start_time = time()
+        astropy_spectra = []
+        for beam_dir in beam_dir_list:
+            for src_nr, src_name, spec_file in get_beam_spectrum_files(beam_dir):
+                spec_data = Table.read(spec_file, format="ascii")
+                astropy_spectra.append(
+                    [np.array(spec_data[column]) for column in SPECTRUM_COLUMNS])
+        results["astropy"] = time() - start_time
+
+        start_time = time()
+        apersharp_spectra = []
+        for beam_dir in beam_dir_list:
+            apersharp_spectra.extend(read_beam_spectra(
+                beam_dir, n_threads=n_threads)[2])
+        results["apersharp"] = time() - start_time
+
+        if not np.allclose(np.array(astropy_spectra), np.array(apersharp_spectra), rtol=1.e-12, atol=0.):
+            logger.error("Spectra read by astropy and apersharp are different")
+
+        logger.info("#### Benchmark: reading spectra of {0} sources from {1} beams ({2} channels, {3} threads)".format(
+            n_sources, n_beams, n_chan, n_threads))
+        for reader in sorted(results):
+            logger.info("# {0}: {1:.1f}s".format(reader, results[reader]))
+        logger.info("# Speed-up: {0:.1f}".format(
+            results["astropy"] / results["apersharp"]))
+    finally:
+        shutil.rmtree(benchmark_dir, ignore_errors=True)
+
+    return results
+
+
+# copy of get_all_sources_of_cube before the master table was built with a single concatenation
+def get_all_sources_of_cube_baseline(output_file_name, cube_dir, taskid=None, cube_nr=None, beam_list=None, src_file="radio_sdss_src_match.csv", alt_src_file="mir_src_sharp.csv", overwrite_master_table=False, create_master_table_backup=True, allow_multiple_source_entries=False):
+    """
+    Function to collect the information from all sources in one file
+
+    Use the radio-SDSS source file or the source file without SDSS,
+    but then add SDSS columns.
+    """
+
+    # if the cube number was not given, try to get from the name
+    if cube_nr is None:
+        cube_nr = os.path.basename(cube_dir).split("_")[-1]
+
+    # if taskid was not given, try to get from the directory
+    if taskid is None:
+        taskid = os.path.dirname(cube_dir).split("/")[-1]
+
+    logger.info("Collecting source information from beams")
+
+    logger.debug("Processing cube {0} of taskid {1}".format(cube_nr, taskid))
+
+    # get a list of beams
+    if beam_list is None:
+        beam_list = glob.glob(os.path.join(cube_dir, "??"))
+        if len(beam_list) == 0:
+            error = "Did not find any beams in {}. Abort".format(cube_dir)
+            logger.error(error)
+            raise RuntimeError(error)
+        beam_list.sort()
+        beam_list = np.array([os.path.basename(beam) for beam in beam_list])
+
+    # for storing the full list:
+    full_list = []
+
+    # go through the list of beams
+    for beam in beam_list:
+
+        logger.debug("Processing beam {}".format(beam))
+
+        # set the file name for this beam
+        csv_file_name = os.path.join(
+            cube_dir, "{0}/sharpOut/abs/{1}".format(beam, src_file))
+
+        # make sure the file exists
+        if not os.path.exists(csv_file_name):
+            logger.warning(
+                "Could not find source file {} from radio-sdss cross-match by SHARPener.".format(csv_file_name))
+            # alternative source file
+            alt_csv_file_name = os.path.join(
+                cube_dir, "{0}/sharpOut/abs/{1}".format(beam, alt_src_file))
+            logger.warning("Checking alternative source file {} and adding emtpy SDSS columns".format(
+                alt_csv_file_name))
+            if not os.path.exists(alt_csv_file_name):
+                logger.error(
+                    "Did not find alternative source file. No source information available for beam {}".format(beam))
+                continue
+            # read in file
+            src_data = Table.read(alt_csv_file_name, format="ascii.csv")
+            # get number of sources
+            n_src = np.size(src_data['ID'])
+            # add sdss columns
+            src_data['sdss_id'] = Column(np.zeros(n_src), dtype=int)
+            src_data['sdss_ra'] = Column(np.zeros(n_src))
+            src_data['sdss_dec'] = Column(np.zeros(n_src))
+            src_data['sdss_radio_sep'] = Column(np.zeros(n_src))
+            src_data['sdss_redshift'] = Column(np.zeros(n_src))
+        else:
+            # read the data
+            src_data = Table.read(csv_file_name, format="ascii.csv")
+            # number of sources
+            n_src = np.size(src_data['ID'])
+
+        logger.debug("Found {} sources".format(n_src))
+
+        # rename the ID column
+        src_data.rename_column('ID', 'Beam_Source_ID')
+
+        # fix the column type
+        src_data['FFLAG'] = np.array(["{}".format(flag)
+                                      for flag in src_data['FFLAG']], dtype=str)
+
+        # create a new columns for ID, taskid, beam and cube
+        src_id = np.array(["{0}_C{1}_B{2}_{3}_J{4}".format(
+            taskid, cube_nr, beam.zfill(2), str(src_data['Beam_Source_ID'][k]).zfill(3), src_data['J2000'][k]) for k in range(n_src)])
+        src_beam = np.array([int(beam) for i in range(n_src)])
+        src_cube = np.array([int(cube_nr) for i in range(n_src)])
+
+        # create a new table with these three columns
+        new_table = Table([src_id, src_cube, src_beam],
+                          names=["Source_ID", "Cube", "Beam"])
+
+        # merge with source table
+        new_src_table = hstack([new_table, src_data])
+
+        # merge with full list
+        if np.size(full_list) == 0:
+            full_list = new_src_table
+        else:
+            full_list = vstack([full_list, new_src_table])
+
+        logger.debug("Processing beam {} ... Done".format(beam))
+
+    # check if master table already exists
+    if os.path.exists(output_file_name):
+        logger.info("Master table already exists.")
+
+        # create a copy in the backup directory
+        if create_master_table_backup:
+            table_backup_dir = os.path.join(
+                cube_dir, "master_table_backup")
+            if not os.path.exists(table_backup_dir):
+                os.mkdir(table_backup_dir)
+            table_backup_name = os.path.join(table_backup_dir, os.path.basename(output_file_name).replace(
+                ".csv", "_{}.csv".format(datetime.datetime.now().strftime("%Y%m%d_%H%M%S"))))
+            logger.info("Creating a copy of current master table in {}".format(
+                table_backup_name))
+            shutil.copy2(output_file_name, table_backup_name)
+
+        # overwrite existing master table or add new data
+        if overwrite_master_table:
+            logger.warning("Existing master table will be overwritten")
+        else:
+            logger.info("Adding new sources to existing master table")
+            # read current master table
+            master_table = Table.read(output_file_name, format="ascii.csv")
+            # add new sources
+            # add without checking if they exists
+            if allow_multiple_source_entries:
+                logger.warning(
+                    "Adding new sources without checking if they already exists. Source ID may not be unique any more.")
+                full_list = vstack([master_table, full_list])
+            # check for existing entry and remove if found, then add
+            else:
+                # get list of unique beams from new table
+                new_beam_list = np.unique(full_list["Beam"])
+
+                # go through the list of beams
+                for new_beam in new_beam_list:
+                    new_beam_in_master_indices = np.where(
+                        (master_table["Cube"] == int(cube_nr)) & (master_table["Beam"] == new_beam))[0]
+                    # remove all entries of this beam from master table
+                    if np.size(new_beam_in_master_indices) != 0:
+                        logger.warning(
+                            "Found data for beam {}. Will be replaced".format(new_beam))
+                        master_table.remove_rows(new_beam_in_master_indices)
+                    else:
+                        continue
+
+                # fix the column type
+                master_table['FFLAG'] = np.array(
+                    ["{}".format(flag) for flag in master_table['FFLAG']], dtype=str)
+                # combine master table with new data
+                full_list = vstack([master_table, full_list])
+
+            # sort by source id to easily spot multiple entries
+            full_list.sort("Source_ID")
+
+    # save the file if there is something to save
+    if np.size(full_list) != 0:
+        full_list.write(output_file_name, format="ascii.csv", overwrite=True)
+        logger.info("Collecting source information from beams ... Done")
+    else:
+        error = "Table with all sources is emtpy. Abort"
+        logger.error(error)
+        logger.error("Collecting source information from beams ... Failed")
+        raise RuntimeError(error)
+
+
+def benchmark_master_table(n_beams=40, n_sources=5000, n_threads=8):
+    """
+    Function to measure the time to build the master table of a cube
+    with the baseline builder beam by beam and with the builder of apersharp
+
+    Return:
+    -------
+    (dict): Name of the builder and time in seconds
+    """
+
+    benchmark_dir = tempfile.mkdtemp(prefix="apersharp_benchmark_")
+
+    try:
+        taskid = "000000000"
+        cube_nr = "0"
+        cube_dir = os.path.join(benchmark_dir, taskid, "cube_{}".format(cube_nr))
+        beam_list = [str(beam).zfill(2) for beam in range(n_beams)]
+        for beam in beam_list:
+            create_synthetic_sources(os.path.join(
+                cube_dir, beam), int(np.ceil(float(n_sources) / n_beams)))
+
+        results = {}
+
+        per_beam_file = os.path.join(benchmark_dir, "master_table_per_beam.csv")
+        start_time = time()
+        get_all_sources_of_cube_baseline(per_beam_file, cube_dir, beam_list=beam_list,
+                                         create_master_table_backup=False)
+        results["per beam"] = time() - start_time
+
+        apersharp_file = os.path.join(benchmark_dir, "master_table.csv")
+        start_time = time()
+        get_all_sources_of_cube(apersharp_file, cube_dir, beam_list=beam_list,
+                                create_master_table_backup=False, n_threads=n_threads)
+        results["apersharp"] = time() - start_time
+
+        with open(per_beam_file) as per_beam_stream, open(apersharp_file) as apersharp_stream:
+            if per_beam_stream.read() != apersharp_stream.read():
+                logger.error(
+                    "Master tables built beam by beam and by apersharp are different")
+
+        logger.info("#### Benchmark: building the master table of {0} sources from {1} beams ({2} threads)".format(
+            n_sources, n_beams, n_threads))
+        for builder in sorted(results):
+            logger.info("# {0}: {1:.2f}s".format(builder, results[builder]))
+        logger.info("# Speed-up: {0:.1f}".format(
+            results["per beam"] / results["apersharp"]))
+    finally:
+        shutil.rmtree(benchmark_dir, ignore_errors=True)
+
+    return results
+
+
+def benchmark_transfers(n_beams=40, cube_list=['0'], cube_size=50., n_transfers_list=[1, 2, 4, 8, 16], latency=1., bandwidth=200., transfer_bandwidth=20.):
+    """
+    Function to measure the time to get the data of a taskid
+    from the simulated data source for different numbers of concurrent transfers
+
+    Return:
+    -------
+    (dict): Number of concurrent transfers and time in seconds
+    """
+
+    benchmark_dir = tempfile.mkdtemp(prefix="apersharp_benchmark_")
+
+    try:
+        taskid = "000000000"
+        data_basedir = os.path.join(benchmark_dir, "data")
+        create_synthetic_taskid(data_basedir, taskid,
+                                n_beams, cube_list, cube_size)
+
+        results = {}
+        for n_transfers in n_transfers_list:
+            sharpener_basedir = os.path.join(
+                benchmark_dir, "run_{}".format(n_transfers), taskid)
+            os.makedirs(sharpener_basedir)
+
+            p = apersharp()
+            p.taskid = taskid
+            p.sharpener_basedir = sharpener_basedir
+            p.beam_list = np.array([str(beam).zfill(2)
+                                    for beam in range(n_beams)])
+            p.cube_list = cube_list
+            p.data_source = "simulated"
+            p.data_basedir = data_basedir
+            p.apersharp_n_transfers = n_transfers
+            p.apersharp_simulated_latency = latency
+            p.apersharp_simulated_bandwidth = bandwidth
+            p.apersharp_simulated_transfer_bandwidth = transfer_bandwidth
+
+            start_time = time()
+            for cube in cube_list:
+                p.set_directories(cube=cube)
+            p.get_data(cube_list=cube_list)
+            results[n_transfers] = time() - start_time
+
+            shutil.rmtree(sharpener_basedir)
+
+        logger.info("#### Benchmark: getting {0} beams of {1} cubes ({2:.0f} MB each)".format(
+            n_beams, len(cube_list), cube_size))
+        for n_transfers in n_transfers_list:
+            logger.info("# {0:3d} concurrent transfers: {1:.1f}s".format(
+                n_transfers, results[n_transfers]))
+    finally:
+        shutil.rmtree(benchmark_dir, ignore_errors=True)
+
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description='Run benchmarks for apersharp on synthetic data')
+
+    parser.add_argument("benchmark", type=str, choices=["transfers", "extraction", "spectra_reading", "master_table"],
+                        help='Name of the benchmark')
+
+    parser.add_argument("--n_beams", type=int, default=40,
+                        help='Number of beams')
+
+    parser.add_argument("--cube_size", type=float, default=50.,
+                        help='Size of a cube in MB')
+
+    parser.add_argument("--n_transfers", type=str, default="1,2,4,8,16",
+                        help='Comma-separated list of the number of concurrent transfers')
+
+    parser.add_argument("--latency", type=float, default=1.,
+                        help='Latency of the simulated data source in seconds')
+
+    parser.add_argument("--bandwidth", type=float, default=200.,
+                        help='Bandwidth of the simulated data source in MB/s')
+
+    parser.add_argument("--transfer_bandwidth", type=float, default=20.,
+                        help='Bandwidth of a single transfer from the simulated data source in MB/s')
+
+    parser.add_argument("--n_chan", type=int, default=1218,
+                        help='Number of channels of a cube for the extraction benchmark')
+
+    parser.add_argument("--n_pix", type=int, default=512,
+                        help='Number of pixels along each spatial axis of a cube for the extraction benchmark')
+
+    parser.add_argument("--n_sources", type=int, default=50,
+                        help='Number of sources in a beam for the extraction benchmark')
+
+    parser.add_argument("--chunk_size", type=int, default=64,
+                        help='Number of channels read at once for the extraction benchmark')
+
+    parser.add_argument("--baseline_file", type=str, default=None,
+                        help='Json file to save the time of sharpener in the extraction benchmark to or to read it from if sharpener is not available')
+
+    parser.add_argument("--n_threads", type=int, default=8,
+                        help='Number of files read at the same time for the benchmarks of reading spectra and building the master table')
+
+    parser.add_argument("--n_master_table_sources", type=int, default=5000,
+                        help='Number of sources in all beams for the benchmark of building the master table')
+
+    args = parser.parse_args()
+
+    setup_logger('INFO', logfile=os.path.join(
+        tempfile.gettempdir(), "apersharp_benchmark.log"))
+
+    if args.benchmark == "transfers":
+        benchmark_transfers(n_beams=args.n_beams, cube_size=args.cube_size,
+                            n_transfers_list=[int(n) for n in args.n_transfers.split(",")],
+                            latency=args.latency, bandwidth=args.bandwidth, transfer_bandwidth=args.transfer_bandwidth)
+    elif args.benchmark == "extraction":
+        benchmark_extraction(n_beams=args.n_beams, n_chan=args.n_chan, n_pix=args.n_pix,
+                             n_sources=args.n_sources, chunk_size=args.chunk_size, baseline_file=args.baseline_file)
+    elif args.benchmark == "spectra_reading":
+        benchmark_spectra_reading(n_beams=args.n_beams, n_chan=args.n_chan,
+                                  n_sources=args.n_sources, n_threads=args.n_threads)
+    elif args.benchmark == "master_table":
+        benchmark_master_table(n_beams=args.n_beams, n_sources=args.n_master_table_sources,
+                               n_threads=args.n_threads)
@@ -0,0 +1,349 @@
+"""
+Functionality to look up which files of a taskid are available on ALTA
+
+Instead of probing every path with a separate ils call, the content of
+all beam collections of a taskid is listed once (with a single iquest
+query or with one ils call per beam collection as fallback). The listing
+is kept in memory and in a json file so that all existence checks,
+file sizes, checksums and the search for the continuum image are answered from the listing.
+"""
+
+import os
+import json
+import logging
+import subprocess
+import threading
+from time import time
+
+logger = logging.getLogger(__name__)
+
+FNULL = open(os.devnull, 'w')
+
+ALTA_BASEDIR = "/altaZone/archive/apertif_main/visibilities_default"
+
+
+def has_files(listing):
+    """
+    Function to check whether any collection of a listing exists
+
+    Return:
+    -------
+    (bool): True if at least one collection was found
+    """
+
+    return any([file_list is not None for file_list in listing.values()])
+
+
+class AltaCatalogue(object):
+    """
+    Class to list the content of the beam collections of a taskid on ALTA
+
+    Args:
+    -----
+    taskid (str): The taskid
+    cache_file (str): Json file to store the listing. Default None (only in memory)
+    cache_max_age (float): Maximum age of the cache file in seconds before
+        it is ignored. Default 86400.
+    alta_basedir (str): Directory on ALTA with the taskids
+    """
+
+    def __init__(self, taskid, cache_file=None, cache_max_age=86400., alta_basedir=ALTA_BASEDIR):
+        self.taskid = taskid
+        self.cache_file = cache_file
+        self.cache_max_age = cache_max_age
+        self.alta_basedir = alta_basedir
+
+        # name of the collection and the files in it with their size
+        # None is used for collections that do not exist
+        self.listing = None
+
+        # checksum of every file with a known checksum
+        self.checksums = None
+
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+
+        # the lock cannot be passed to other processes
+        state = self.__dict__.copy()
+        del state['_lock']
+
+        return state
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def get_beam_collection(self, beam):
+        """
+        Function to return the path of the collection of a beam on ALTA
+        """
+
+        return "{0}/{1}_AP_B{2}".format(self.alta_basedir, self.taskid, str(beam).zfill(3))
+
+    def load(self):
+        """
+        Function to get the listing either from the cache file or from ALTA
+        """
+
+        with self._lock:
+            if self.listing is not None:
+                return
+
+            if self.cache_file is not None and os.path.exists(self.cache_file):
+                if time() - os.path.getmtime(self.cache_file) < self.cache_max_age:
+                    logger.info(
+                        "Reading ALTA listing of taskid {0} from {1}".format(self.taskid, self.cache_file))
+                    with open(self.cache_file) as stream:
+                        cache = json.load(stream)
+                    # listings written without checksums
+                    if set(cache.keys()) == set(["listing", "checksums"]):
+                        listing = cache['listing']
+                        checksums = cache['checksums']
+                    else:
+                        listing = cache
+                        checksums = {}
+                    # data may have arrived since an empty listing was written
+                    if has_files(listing):
+                        self.listing = listing
+                        self.checksums = checksums
+                        return
+                    logger.info(
+                        "ALTA listing in {} is empty".format(self.cache_file))
+                else:
+                    logger.info(
+                        "ALTA listing in {} is outdated".format(self.cache_file))
+
+            self.listing, self.checksums = self.list_taskid()
+
+            self.save()
+
+    def save(self):
+        """
+        Function to write the listing to the cache file
+        """
+
+        if self.cache_file is None or self.listing is None:
+            return
+
+        # the data of the taskid may not be archived yet
+        if not has_files(self.listing):
+            logger.info(
+                "Not storing empty ALTA listing of taskid {}".format(self.taskid))
+            return
+
+        # write to temporary file first to avoid partial files
+        tmp_file = "{}.tmp".format(self.cache_file)
+        with open(tmp_file, "w") as stream:
+            json.dump({'listing': self.listing, 'checksums': self.checksums},
+                      stream, indent=1, sort_keys=True)
+        os.rename(tmp_file, self.cache_file)
+
+    def list_taskid(self):
+        """
+        Function to list all beam collections of the taskid with a single query
+
+        Return:
+        -------
+        (tuple): Collection name and files with their size for every collection
+            of the taskid and the checksum of every file with a checksum
+        """
+
+        logger.info("Listing taskid {} on ALTA".format(self.taskid))
+
+        collection_pattern = "{0}/{1}_AP_B%".format(
+            self.alta_basedir, self.taskid)
+        alta_cmd = "iquest --no-page \"%s/%s|%s|%s\" \"SELECT COLL_NAME, DATA_NAME, DATA_SIZE, DATA_CHECKSUM WHERE COLL_NAME like '{}'\"".format(
+            collection_pattern)
+        logger.debug(alta_cmd)
+
+        try:
+            output = subprocess.check_output(
+                alta_cmd, shell=True, stderr=FNULL)
+        except subprocess.CalledProcessError as e:
+            # iquest fails if there are no rows
+            if e.output is not None and "CAT_NO_ROWS_FOUND" in e.output:
+                logger.warning(
+                    "Did not find any data for taskid {} on ALTA".format(self.taskid))
+                return {}, {}
+            logger.warning(
+                "Listing taskid {} with iquest failed. Listing beams separately".format(self.taskid))
+            return self.list_beams(), {}
+
+        listing = {}
+        checksums = {}
+        for line in output.splitlines():
+            line = line.strip()
+            if line == '' or "CAT_NO_ROWS_FOUND" in line:
+                continue
+            file_path, file_size, file_checksum = line.rsplit("|", 2)
+            collection, file_name = os.path.split(file_path)
+            listing.setdefault(collection, {})[file_name] = int(file_size)
+            if file_checksum != '':
+                checksums[file_path] = file_checksum
+
+        logger.info("Listing taskid {0} on ALTA ... Done ({1} collections)".format(
+            self.taskid, len(listing)))
+
+        return listing, checksums
+
+    def list_beams(self, n_beams=40):
+        """
+        Function to list the beam collections of the taskid with one ils call each
+
+        Return:
+        -------
+        (dict): Collection name and files with their size (None if the collection does not exist)
+        """
+
+        listing = {}
+        for beam in range(n_beams):
+            collection = self.get_beam_collection(beam)
+            listing[collection] = self.list_collection(collection)
+
+        return listing
+
+    def list_collection(self, collection):
+        """
+        Function to list a single collection on ALTA with ils
+
+        Return:
+        -------
+        (dict): Files and sub-collections with their size (None for sub-collections
+            and if the size could not be determined). None if the collection does not exist
+        """
+
+        alta_cmd = "ils -l {}".format(collection)
+        logger.debug(alta_cmd)
+
+        try:
+            output = subprocess.check_output(
+                alta_cmd, shell=True, stderr=FNULL)
+        except subprocess.CalledProcessError:
+            return None
+
+        file_list = {}
+        for line in output.splitlines():
+            line = line.strip()
+            # skip the name of the collection itself
+            if line == '' or line.endswith(":"):
+                continue
+            # sub-collections are listed as "C- <path>"
+            if line.startswith("C- "):
+                file_list[os.path.basename(line[3:])] = None
+                continue
+            # files are listed as "<owner> <replica> <resource> <size> <date> & <name>"
+            if " & " in line:
+                file_info, file_name = line.split(" & ", 1)
+                try:
+                    file_size = int(file_info.split()[3])
+                except (IndexError, ValueError):
+                    file_size = None
+            else:
+                file_name = line
+                file_size = None
+            file_list[file_name] = file_size
+
+        return file_list
+
+    def list_beam(self, beam):
+        """
+        Function to return the files in the collection of a beam
+
+        Return:
+        -------
+        (list): List of files. None if the beam does not exist on ALTA
+        """
+
+        self.load()
+
+        file_list = self.listing.get(self.get_beam_collection(beam))
+
+        if file_list is None:
+            return None
+
+        return sorted(file_list.keys())
+
+    def exists(self, alta_path):
+        """
+        Function to check whether a collection or a file exists on ALTA
+
+        Args:
+        -----
+        alta_path (str): Path on ALTA
+
+        Return:
+        -------
+        (bool): True if the path was found in the listing
+        """
+
+        self.load()
+
+        alta_path = alta_path.rstrip("/")
+
+        # path of a collection
+        if alta_path in self.listing:
+            return self.listing[alta_path] is not None
+
+        # path of a file
+        collection, file_name = os.path.split(alta_path)
+        file_list = self.listing.get(collection)
+
+        return file_list is not None and file_name in file_list
+
+    def get_file_size(self, alta_path):
+        """
+        Function to return the size of a file on ALTA in bytes
+
+        Return:
+        -------
+        (int): Size of the file. None if the file or its size are unknown
+        """
+
+        self.load()
+
+        collection, file_name = os.path.split(alta_path.rstrip("/"))
+        file_list = self.listing.get(collection)
+
+        if file_list is None:
+            return None
+
+        return file_list.get(file_name)
+
+    def get_file_checksum(self, alta_path):
+        """
+        Function to return the checksum of a file on ALTA
+
+        Return:
+        -------
+        (str): Checksum of the file. None if the file or its checksum are unknown
+        """
+
+        self.load()
+
+        return self.checksums.get(alta_path.rstrip("/"))
+
+    def get_continuum_image_name(self, beam, n_images=10):
+        """
+        Function to get the name of the continuum image of a beam
+
+        Apercal stores the continuum image as image_mf_XX.fits
+        with XX being the number of the last self-calibration cycle.
+
+        Return:
+        -------
+        (str): Name of the continuum image. None if no image was found
+        """
+
+        file_list = self.list_beam(beam)
+
+        if file_list is None:
+            return None
+
+        for k in range(n_images):
+            continuum_image_name = "image_mf_{0:02d}.fits".format(k)
+            if continuum_image_name in file_list:
+                return continuum_image_name
+
+        return None
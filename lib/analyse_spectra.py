@@ -11,10 +11,20 @@ import os
 import numpy as np
 import glob
 import logging
-import datetime
-import shutil
+import functools
+import multiprocessing as mp
 from astropy.table import Table, hstack, vstack
 
+from lib.cube_noise import read_cube_noise
+from lib.spectra_store import SpectraStore, has_spectra_store
+from lib.read_spectra import read_spectrum
+from lib.metrics_cache import MetricsCache, get_file_signature, METRICS_CACHE_FILE
+from lib.cube_noise import CUBE_NOISE_FILE
+from lib.spectra_store import get_spectra_store_dir, SPECTRA_STORE_DATA, SPECTRA_STORE_INDEX
+from lib.master_table_store import master_table_exists, read_master_table, write_master_table_columns
+from lib.table_history import TableHistory, write_table_file
+from lib.pool_results import PoolResults
+
 logger = logging.getLogger(__name__)
 
 
@@ -37,6 +47,47 @@ def get_source_spec_file(src_name, src_nr, beam, cube_dir):
     return os.path.join(cube_dir, "{0}/sharpOut/spec/{1}_J{2}.txt".format(str(beam).zfill(2), src_nr, src_name))
 
 
+def get_source_spectrum(src_name, src_nr, beam, cube_dir, spectra_stores=None):
+    """
+    Function to get the spectrum of a given source
+
+    The spectrum is read from the spectra store of the beam if it exists
+    and otherwise from the spectrum file of the source.
+
+    Args:
+    -----
+    src_name (str): Name of the source (J2000 coordinates)
+    src_nr (int): Number of the source in the beam
+    beam (int): Number of the beam
+    cube_dir (int): Directory of the cube that contains the beam and the source
+    spectra_stores (dict): Spectra stores of the beams that were already opened.
+        Will be updated. None to only use the spectrum files
+
+    Return:
+    -------
+    (Table): Spectrum of the source. None if it was not found
+    """
+
+    if spectra_stores is not None:
+        if beam not in spectra_stores:
+            beam_dir = os.path.join(cube_dir, str(beam).zfill(2))
+            if has_spectra_store(beam_dir):
+                spectra_stores[beam] = SpectraStore(beam_dir)
+            else:
+                spectra_stores[beam] = None
+        if spectra_stores[beam] is not None:
+            spec_data = spectra_stores[beam].get_spectrum(src_nr, src_name)
+            if spec_data is not None:
+                return spec_data
+
+    src_spec_file = get_source_spec_file(src_name, src_nr, beam, cube_dir)
+
+    if not os.path.exists(src_spec_file):
+        return None
+
+    return read_spectrum(src_spec_file)
+
+
 def find_candidate(src_data, output_file_name_candidates,  negative_snr_threshold=-5, positive_snr_threshold=5):
     """
     Function to check the snr results for candidates
@@ -77,8 +128,8 @@ def find_candidate(src_data, output_file_name_candidates,  negative_snr_threshol
     # writing file
     logger.info("Writing candidates to file {}".format(
         output_file_name_candidates))
-    src_data_neg_snr_below_pos_snr.write(
-        output_file_name_candidates, format="ascii.csv", overwrite=True)
+    write_table_file(src_data_neg_snr_below_pos_snr,
+                     output_file_name_candidates)
 
     return snr_candidates
 
@@ -153,39 +204,179 @@ def get_max_positive_snr(spec_data, src_name, rms=None):
     return max_positive_snr, max_positive_snr_ch, max_positive_snr_freq
 
 
-def analyse_spectra(src_cat_file, output_file_name_candidates, cube_dir, do_subtract_median=True, do_subtract_mean=False, use_rms=True,  negative_snr_threshold=-5, positive_snr_threshold=5, create_candidate_table_backup=True):
+def get_spectrum_signature(src_name, src_nr, beam, cube_dir, use_spectra_store=False, use_cube_noise=False):
     """
-    Function to run quality check and find candidates for absorption
+    Function to get the signature of the files the spectrum of a source is read from
+
+    Args:
+    -----
+    src_name (str): Name of the source (J2000 coordinates)
+    src_nr (int): Number of the source in the beam
+    beam (int): Number of the beam
+    cube_dir (int): Directory of the cube that contains the beam and the source
+    use_spectra_store (bool): The spectra store of the beam is used
+    use_cube_noise (bool): The noise of the cube is used
+
+    Return:
+    -------
+    (list): Size and modification time of the spectrum file, the spectra store and the noise of the cube
     """
 
-    logger.info("#### Searching for candidates")
+    beam_dir = os.path.join(cube_dir, str(beam).zfill(2))
 
-    # check for existing candidate table
-    if create_candidate_table_backup and os.path.exists(output_file_name_candidates):
-        table_backup_dir = os.path.join(
-            cube_dir, "candidate_table_backup")
-        if not os.path.exists(table_backup_dir):
-            os.mkdir(table_backup_dir)
-        table_backup_name = os.path.join(table_backup_dir, os.path.basename(output_file_name_candidates).replace(
-            ".csv", "_{}.csv".format(datetime.datetime.now().strftime("%Y%m%d_%H%M%S"))))
-        logger.info("Creating a copy of current candidate table in {0}".format(
-            table_backup_name))
-        shutil.copy2(output_file_name_candidates, table_backup_name)
+    signature = [get_file_signature(
+        get_source_spec_file(src_name, src_nr, beam, cube_dir))]
 
-    # get the source data
-    if not os.path.exists(src_cat_file):
-        error = "Could not find src file {}".format(src_cat_file)
-        logger.error(error)
-        raise RuntimeError(error)
-    else:
-        src_data = Table.read(src_cat_file, format="ascii.csv")
+    if use_spectra_store:
+        signature.append(get_file_signature(os.path.join(
+            get_spectra_store_dir(beam_dir), SPECTRA_STORE_DATA)))
+        signature.append(get_file_signature(os.path.join(
+            get_spectra_store_dir(beam_dir), SPECTRA_STORE_INDEX)))
 
-    # number of sources
-    n_src = np.size(src_data['Source_ID'])
-    logger.info("Found {} sources to analyse".format(n_src))
+    if use_cube_noise:
+        signature.append(get_file_signature(
+            os.path.join(beam_dir, CUBE_NOISE_FILE)))
 
-    # get a list of beams
-    beam_list = np.unique(src_data['Beam'])
+    return signature
+
+
+def get_analysis_spectrum(src_data, src_index, cube_dir, spectra_stores, cube_noise, use_cube_noise):
+    """
+    Function to get the spectrum of a source for the analysis
+
+    Args:
+    -----
+    src_data (Table): The source catalogue
+    src_index (int): Row of the source in the catalogue
+    cube_dir (str): Directory of the cube
+    spectra_stores (dict): Spectra stores of the beams. None to only use the spectrum files
+    cube_noise (dict): Noise of the cube for the beams. Will be updated
+    use_cube_noise (bool): Replace the noise of the spectrum by the noise of the cube
+
+    Return:
+    -------
+    (Table): Spectrum of the source. None if it was not found
+    """
+
+    src_id = src_data['Source_ID'][src_index]
+
+    # read in the spectrum of the source
+    spec_data = get_source_spectrum(
+        src_data['J2000'][src_index], src_data['Beam_Source_ID'][src_index] - 1, src_data['Beam'][src_index], cube_dir, spectra_stores=spectra_stores)
+
+    if spec_data is None:
+        logger.warning("Did not find spectrum for source {0} in {1}".format(
+            src_id, get_source_spec_file(src_data['J2000'][src_index], src_data['Beam_Source_ID'][src_index] - 1, src_data['Beam'][src_index], cube_dir)))
+        return None
+
+    # use the noise of the cube
+    if use_cube_noise:
+        beam = src_data['Beam'][src_index]
+        if beam not in cube_noise:
+            cube_noise[beam] = read_cube_noise(
+                os.path.join(cube_dir, str(beam).zfill(2)))
+            if cube_noise[beam] is None:
+                logger.warning(
+                    "Did not find noise of the cube for beam {}. Using noise of the spectra".format(beam))
+        if cube_noise[beam] is not None:
+            if len(cube_noise[beam]) == len(spec_data):
+                spec_data['Noise [Jy]'] = cube_noise[beam]['Noise [Jy]']
+            else:
+                logger.warning("Number of channels of the noise of the cube and of the spectrum of {} are different. Using noise of the spectrum".format(
+                    src_id))
+
+    return spec_data
+
+
+def get_spectra_metrics(frequency, flux, noise, do_subtract_median=True, do_subtract_mean=False, use_rms=True, src_names=None):
+    """
+    Function to get the metrics of many spectra with the same number of channels at once
+
+    The results are the same as for processing the spectra one by one.
+
+    Args:
+    -----
+    frequency (ndarray): Frequency of the spectra (sources x channels)
+    flux (ndarray): Flux of the spectra (sources x channels)
+    noise (ndarray): Noise of the spectra (sources x channels)
+    do_subtract_median (bool): Subtract the median flux before the SNR is calculated. Default True
+    do_subtract_mean (bool): Subtract the mean flux before the SNR is calculated. Default False
+    use_rms (bool): Use the rms instead of the noise for the SNR. Default True
+    src_names (list): Names of the sources for the log. Default None
+
+    Return:
+    -------
+    (tuple): Mean noise, median noise, rms, min flux, max flux, mean flux, median flux,
+        max negative SNR with channel and frequency and max positive SNR with channel and frequency
+    """
+
+    src_range = np.arange(np.shape(flux)[0])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_noise = np.nanmean(noise, axis=1)
+        median_noise = np.nanmedian(noise, axis=1)
+        mean_flux = np.nanmean(flux, axis=1)
+        median_flux = np.nanmedian(flux, axis=1)
+
+        # the values are subtracted with the precision of the spectra
+        if do_subtract_median:
+            flux = flux - median_flux.astype(flux.dtype)[:, np.newaxis]
+        elif do_subtract_mean:
+            flux = flux - mean_flux.astype(flux.dtype)[:, np.newaxis]
+
+        max_flux = np.nanmax(flux, axis=1)
+        min_flux = np.nanmin(flux, axis=1)
+        rms = np.nanstd(flux, axis=1)
+
+        if use_rms:
+            max_negative_snr = min_flux.astype(np.float64) / rms
+            max_negative_snr_ch = np.argmax(
+                flux == min_flux[:, np.newaxis], axis=1)
+            max_positive_snr = max_flux.astype(np.float64) / rms
+            max_positive_snr_ch = np.argmax(
+                flux == max_flux[:, np.newaxis], axis=1)
+        else:
+            ratio = flux / noise
+            max_negative_snr = np.nanmin(ratio, axis=1)
+            max_negative_snr_ch = np.argmax(
+                ratio == max_negative_snr[:, np.newaxis], axis=1)
+            max_positive_snr = np.nanmax(ratio, axis=1)
+            max_positive_snr_ch = np.argmax(
+                ratio == max_positive_snr[:, np.newaxis], axis=1)
+
+    max_negative_snr_freq = frequency[src_range, max_negative_snr_ch]
+    max_positive_snr_freq = frequency[src_range, max_positive_snr_ch]
+
+    if not use_rms:
+        # no snr without noise information
+        no_noise = np.nanmin(noise, axis=1) == 0
+        for src_index in np.where(no_noise)[0]:
+            logger.warning(
+                "Calculating SNR failed for {0}. No noise information".format(src_index if src_names is None else src_names[src_index]))
+        for metric in [max_negative_snr, max_negative_snr_ch, max_negative_snr_freq, max_positive_snr, max_positive_snr_ch, max_positive_snr_freq]:
+            metric[no_noise] = 0
+
+    return mean_noise, median_noise, rms, min_flux, max_flux, mean_flux, median_flux, max_negative_snr, max_negative_snr_ch, max_negative_snr_freq, max_positive_snr, max_positive_snr_ch, max_positive_snr_freq
+
+
+def get_source_metrics(src_data, cube_dir, do_subtract_median=True, do_subtract_mean=False, use_rms=True, use_cube_noise=False, use_spectra_store=False, analysis_engine="loop"):
+    """
+    Function to get the metrics of the spectra of sources
+
+    Args:
+    -----
+    src_data (Table): Sources with Source_ID, J2000, Beam_Source_ID and Beam
+    cube_dir (str): Directory of the cube
+    See analyse_spectra for the other arguments
+
+    Return:
+    -------
+    (list): Mean noise, median noise, rms, min flux, max flux, mean flux, median flux,
+        max negative SNR with channel and frequency and max positive SNR with channel and frequency
+        of every source
+    """
+
+    n_src = len(src_data)
 
     # new columns
     mean_noise = np.zeros(n_src)
@@ -195,7 +386,6 @@ def analyse_spectra(src_cat_file, output_file_name_candidates, cube_dir, do_subt
     max_flux = np.zeros(n_src)
     mean_flux = np.zeros(n_src)
     median_flux = np.zeros(n_src)
-    snr_candidates = np.zeros(n_src)
     max_negative_snr = np.zeros(n_src)
     max_negative_snr_ch = np.zeros(n_src)
     max_negative_snr_freq = np.zeros(n_src)
@@ -203,102 +393,281 @@ def analyse_spectra(src_cat_file, output_file_name_candidates, cube_dir, do_subt
     max_positive_snr_ch = np.zeros(n_src)
     max_positive_snr_freq = np.zeros(n_src)
 
-    # names of table columns
-    new_col_names = ["Mean_Noise", "Median_Noise", "RMS", "Min_Flux", "Max_Flux", "Mean_Flux", "Median_Flux", "Candidate_SNR", "Max_Negative_SNR",
-                     "Max_Negative_SNR_Channel", "Max_Negative_SNR_Frequency", "Max_Positive_SNR", "Max_Positive_SNR_Channel", "Max_Positive_SNR_Frequency"]
-    # removes these if they exists
-    try:
-        src_data.remove_columns(new_col_names)
-    except Exception as e:
-        pass
-    else:
-        logger.debug("Removed table entries from previous analysis run")
-
-    # The following test will not work with astropy 4.0 and higher
-    # but this will only matter if Apersharp is upgraded to Python3
-    if src_data.masked:
-        logger.debug("Found masked table")
-        src_data = src_data.filled()
-        logger.debug("Table umasked")
+    # noise of the cube for each beam
+    cube_noise = {}
 
-    # go through the each source files
-    for src_index in range(n_src):
+    # spectra store for each beam
+    if use_spectra_store:
+        spectra_stores = {}
+    else:
+        spectra_stores = None
+
+    # the metrics of all sources
+    metric_list = [mean_noise, median_noise, rms, min_flux, max_flux, mean_flux, median_flux, max_negative_snr,
+                   max_negative_snr_ch, max_negative_snr_freq, max_positive_snr, max_positive_snr_ch, max_positive_snr_freq]
+
+    if analysis_engine == "batch":
+        # spectra of all sources grouped by their number of channels and their precision
+        # so that spectra from a store (float32) and from text files (float64) give the same results as the loop
+        spectra_groups = {}
+        for src_index in range(n_src):
+            spec_data = get_analysis_spectrum(
+                src_data, src_index, cube_dir, spectra_stores, cube_noise, use_cube_noise)
+            if spec_data is not None:
+                spectra_groups.setdefault((len(spec_data), spec_data['Flux [Jy]'].dtype.str), []).append(
+                    (src_index, spec_data))
+
+        for n_chan, flux_dtype in sorted(spectra_groups):
+            group = spectra_groups[(n_chan, flux_dtype)]
+            group_index = np.array(
+                [src_index for src_index, spec_data in group])
+
+            logger.info("## Processing {0} sources with {1} channels".format(
+                np.size(group_index), n_chan))
+
+            group_metrics = get_spectra_metrics(np.array([spec_data['Frequency [Hz]'] for src_index, spec_data in group]),
+                                                np.array([spec_data['Flux [Jy]'] for src_index, spec_data in group]),
+                                                np.array([spec_data['Noise [Jy]'] for src_index, spec_data in group]),
+                                                do_subtract_median=do_subtract_median, do_subtract_mean=do_subtract_mean, use_rms=use_rms,
+                                                src_names=[src_data['Source_ID'][src_index] for src_index in group_index])
+
+            for metric, group_metric in zip(metric_list, group_metrics):
+                metric[group_index] = group_metric
+
+            logger.info("## Processing {0} sources with {1} channels ... Done".format(
+                np.size(group_index), n_chan))
+    elif analysis_engine == "loop":
+        # go through the each source files
+        for src_index in range(n_src):
+
+            src_id = src_data['Source_ID'][src_index]
+
+            logger.info("## Processing {}".format(src_id))
+
+            # read in the spectrum of the source
+            spec_data = get_analysis_spectrum(
+                src_data, src_index, cube_dir, spectra_stores, cube_noise, use_cube_noise)
+
+            if spec_data is None:
+                continue
+
+            # get mean noise
+            mean_noise[src_index] = np.nanmean(spec_data['Noise [Jy]'])
+
+            # get the median noise
+            median_noise[src_index] = np.nanmedian(spec_data['Noise [Jy]'])
+
+            # get mean flux
+            mean_flux[src_index] = np.nanmean(spec_data['Flux [Jy]'])
+
+            # get the median flux
+            median_flux[src_index] = np.nanmedian(spec_data['Flux [Jy]'])
+
+            # subtracting mean or median
+            if do_subtract_median:
+                logger.debug(
+                    "Subtracting median: {} mJy/beam".format(median_flux[src_index] * 1.e3))
+                spec_data['Flux [Jy]'] = spec_data['Flux [Jy]'] - \
+                    median_flux[src_index]
+            elif do_subtract_mean:
+                logger.debug(
+                    "Subtracting mean: {} mJy/beam".format(median_flux[src_index] * 1.e3))
+                spec_data['Flux [Jy]'] = spec_data['Flux [Jy]'] - \
+                    mean_flux[src_index]
+
+            # get max flux
+            max_flux[src_index] = np.nanmax(spec_data['Flux [Jy]'])
+
+            # get min flux
+            min_flux[src_index] = np.nanmin(spec_data['Flux [Jy]'])
+
+            # get the rms
+            rms[src_index] = np.nanstd(spec_data['Flux [Jy]'])
+
+            if use_rms:
+                # get maximum negative snr values
+                max_negative_snr[src_index], max_negative_snr_ch[src_index], max_negative_snr_freq[src_index] = get_max_negative_snr(
+                    spec_data, src_id, rms=rms[src_index])
+
+                # get maximum positive snr values
+                max_positive_snr[src_index], max_positive_snr_ch[src_index], max_positive_snr_freq[src_index] = get_max_positive_snr(
+                    spec_data, src_id, rms=rms[src_index])
+            else:
+                # get maximum negative snr values
+                max_negative_snr[src_index], max_negative_snr_ch[src_index], max_negative_snr_freq[src_index] = get_max_negative_snr(
+                    spec_data, src_id)
+
+                # get maximum positive snr values
+                max_positive_snr[src_index], max_positive_snr_ch[src_index], max_positive_snr_freq[src_index] = get_max_positive_snr(
+                    spec_data, src_id)
+
+            # if snr_candidate[src_index] == 1:
+            #     logger.debug("Found candidate for absorption (SNR = {0})".format(
+            #         max_negative_snr[src_index]))
+            # else:
+            #     logger.debug("Not a candidate for absorption")
+
+            logger.info("## Processing {} ... Done".format(src_id))
+    else:
+        error = "Unknown analysis engine {}".format(analysis_engine)
+        logger.error(error)
+        raise RuntimeError(error)
 
-        src_id = src_data['Source_ID'][src_index]
+    return metric_list
 
-        logger.info("## Processing {}".format(src_id))
 
-        # get the spectrum file for the source
-        src_spec_file = get_source_spec_file(
-            src_data['J2000'][src_index], src_data['Beam_Source_ID'][src_index] - 1, src_data['Beam'][src_index], cube_dir)
+def analyse_spectra(src_cat_file, output_file_name_candidates, cube_dir, do_subtract_median=True, do_subtract_mean=False, use_rms=True, use_cube_noise=False, negative_snr_threshold=-5, positive_snr_threshold=5, create_candidate_table_backup=True, use_spectra_store=False, analysis_engine="loop", n_cores=1, core_semaphore=None, use_metrics_cache=False, master_table_engine="csv", table_history_max_versions=None):
+    """
+    Function to run quality check and find candidates for absorption
 
-        if not os.path.exists(src_spec_file):
-            logger.warning("Did not find spectrum for source {0} in {1}".format(
-                src_id, src_spec_file))
-            continue
-        else:
-            pass
+    The spectra are processed one by one (analysis_engine="loop") or all spectra with
+    the same number of channels are processed at once (analysis_engine="batch").
 
-        # read in the file
-        spec_data = Table.read(src_spec_file, format="ascii")
+    With more than one core, the sources of the different beams are analysed in a pool of processes.
+    If the cores are shared with other taskids, a beam is only passed to the pool once
+    one of the cores of core_semaphore is available.
 
-        # get mean noise
-        mean_noise[src_index] = np.nanmean(spec_data['Noise [Jy]'])
+    With use_metrics_cache, the metrics of spectra that did not change since the
+    previous run with the same settings are taken from the metrics cache of the cube.
 
-        # get the median noise
-        median_noise[src_index] = np.nanmedian(spec_data['Noise [Jy]'])
+    With use_cube_noise, the noise of every channel estimated from the cube of
+    the beam is used instead of the noise of the spectrum if it is available.
+    With use_spectra_store, the spectra are read from the spectra stores of the beams if they exist.
 
-        # get mean flux
-        mean_flux[src_index] = np.nanmean(spec_data['Flux [Jy]'])
+    With master_table_engine="sqlite", the master table is read from the store
+    and only the columns of the analysis are updated.
 
-        # get the median flux
-        median_flux[src_index] = np.nanmedian(spec_data['Flux [Jy]'])
+    With create_candidate_table_backup, the current candidate table is added to
+    the history of the candidate table that keeps table_history_max_versions versions.
+    """
 
-        # subtracting mean or median
-        if do_subtract_median:
-            logger.debug(
-                "Subtracting median: {} mJy/beam".format(median_flux[src_index] * 1.e3))
-            spec_data['Flux [Jy]'] = spec_data['Flux [Jy]'] - \
-                median_flux[src_index]
-        elif do_subtract_mean:
-            logger.debug(
-                "Subtracting mean: {} mJy/beam".format(median_flux[src_index] * 1.e3))
-            spec_data['Flux [Jy]'] = spec_data['Flux [Jy]'] - \
-                mean_flux[src_index]
+    logger.info("#### Searching for candidates")
 
-        # get max flux
-        max_flux[src_index] = np.nanmax(spec_data['Flux [Jy]'])
+    # add the current candidate table to its history
+    if create_candidate_table_backup and os.path.exists(output_file_name_candidates):
+        TableHistory(os.path.join(cube_dir, "candidate_table_backup"), output_file_name_candidates,
+                     max_versions=table_history_max_versions).add_version()
 
-        # get min flux
-        min_flux[src_index] = np.nanmin(spec_data['Flux [Jy]'])
+    # get the source data
+    if not master_table_exists(src_cat_file, master_table_engine=master_table_engine):
+        error = "Could not find src file {}".format(src_cat_file)
+        logger.error(error)
+        raise RuntimeError(error)
+    else:
+        src_data = read_master_table(
+            src_cat_file, master_table_engine=master_table_engine)
 
-        # get the rms
-        rms[src_index] = np.nanstd(spec_data['Flux [Jy]'])
+    # number of sources
+    n_src = np.size(src_data['Source_ID'])
+    logger.info("Found {} sources to analyse".format(n_src))
 
-        if use_rms:
-            # get maximum negative snr values
-            max_negative_snr[src_index], max_negative_snr_ch[src_index], max_negative_snr_freq[src_index] = get_max_negative_snr(
-                spec_data, src_id, rms=rms[src_index])
+    # get a list of beams
+    beam_list = np.unique(src_data['Beam'])
 
-            # get maximum positive snr values
-            max_positive_snr[src_index], max_positive_snr_ch[src_index], max_positive_snr_freq[src_index] = get_max_positive_snr(
-                spec_data, src_id, rms=rms[src_index])
-        else:
-            # get maximum negative snr values
-            max_negative_snr[src_index], max_negative_snr_ch[src_index], max_negative_snr_freq[src_index] = get_max_negative_snr(
-                spec_data, src_id)
+    # new columns
+    snr_candidates = np.zeros(n_src)
 
-            # get maximum positive snr values
-            max_positive_snr[src_index], max_positive_snr_ch[src_index], max_positive_snr_freq[src_index] = get_max_positive_snr(
-                spec_data, src_id)
+    # names of table columns
+    new_col_names = ["Mean_Noise", "Median_Noise", "RMS", "Min_Flux", "Max_Flux", "Mean_Flux", "Median_Flux", "Candidate_SNR", "Max_Negative_SNR",
+                     "Max_Negative_SNR_Channel", "Max_Negative_SNR_Frequency", "Max_Positive_SNR", "Max_Positive_SNR_Channel", "Max_Positive_SNR_Frequency"]
+    # removes these if they exists
+    try:
+        src_data.remove_columns(new_col_names)
+    except Exception as e:
+        pass
+    else:
+        logger.debug("Removed table entries from previous analysis run")
 
-        # if snr_candidate[src_index] == 1:
-        #     logger.debug("Found candidate for absorption (SNR = {0})".format(
-        #         max_negative_snr[src_index]))
-        # else:
-        #     logger.debug("Not a candidate for absorption")
+    # The following test will not work with astropy 4.0 and higher
+    # but this will only matter if Apersharp is upgraded to Python3
+    if src_data.masked:
+        logger.debug("Found masked table")
+        src_data = src_data.filled()
+        logger.debug("Table umasked")
 
-        logger.info("## Processing {} ... Done".format(src_id))
+    src_data_columns = src_data['Source_ID', 'J2000', 'Beam_Source_ID', 'Beam']
+
+    # only spectra without cached metrics are analysed
+    if use_metrics_cache:
+        metrics_cache = MetricsCache(os.path.join(cube_dir, METRICS_CACHE_FILE), {'do_subtract_median': do_subtract_median, 'do_subtract_mean': do_subtract_mean,
+                                                                                  'use_rms': use_rms, 'use_cube_noise': use_cube_noise, 'use_spectra_store': use_spectra_store})
+        src_key_list = ["{0}_{1}_J{2}".format(src_data['Beam'][src_index], src_data['Beam_Source_ID'][src_index] - 1, src_data['J2000'][src_index])
+                        for src_index in range(n_src)]
+        src_signature_list = [get_spectrum_signature(src_data['J2000'][src_index], src_data['Beam_Source_ID'][src_index] - 1, src_data['Beam'][src_index], cube_dir,
+                                                     use_spectra_store=use_spectra_store, use_cube_noise=use_cube_noise) for src_index in range(n_src)]
+        cached_metric_list = [metrics_cache.get(src_key, src_signature) for src_key, src_signature in zip(
+            src_key_list, src_signature_list)]
+        analyse_index = np.array([src_index for src_index in range(
+            n_src) if cached_metric_list[src_index] is None], dtype=int)
+        logger.info("Using cached metrics of {0} sources. Analysing {1} sources".format(
+            n_src - np.size(analyse_index), np.size(analyse_index)))
+    else:
+        analyse_index = np.arange(n_src)
+
+    analyse_data = src_data_columns[analyse_index]
+    analyse_beam_list = np.unique(analyse_data['Beam'])
+
+    # the beams are analysed in parallel
+    fct_partial = functools.partial(get_source_metrics, cube_dir=cube_dir, do_subtract_median=do_subtract_median, do_subtract_mean=do_subtract_mean,
+                                    use_rms=use_rms, use_cube_noise=use_cube_noise, use_spectra_store=use_spectra_store, analysis_engine=analysis_engine)
+
+    # processes of a pool cannot create their own pool
+    if n_cores > 1 and mp.current_process().daemon:
+        logger.warning(
+            "Analysing the spectra in a process of a pool. Using one core")
+        n_cores = 1
+
+    if n_cores > 1 and np.size(analyse_beam_list) > 1:
+        logger.info("Analysing {0} beams on {1} cores".format(
+            np.size(analyse_beam_list), min(n_cores, np.size(analyse_beam_list))))
+
+        beam_index_list = [np.where(analyse_data['Beam'] == beam)[0]
+                           for beam in analyse_beam_list]
+
+        pool = mp.Pool(processes=min(n_cores, np.size(analyse_beam_list)))
+        pool_results = PoolResults(pool, core_semaphore=core_semaphore)
+        beam_metric_lists = [None] * len(beam_index_list)
+        try:
+            for beam_count, beam_index in enumerate(beam_index_list):
+                pool_results.acquire_core()
+                pool_results.add(beam_count, pool.apply_async(
+                    fct_partial, (analyse_data[beam_index],)))
+            while len(pool_results) != 0:
+                beam_count, beam_metric_list, error = pool_results.get()
+                if error is not None:
+                    error = "Analysing the spectra of beam {0} failed. {1}".format(
+                        analyse_beam_list[beam_count], error)
+                    logger.error(error)
+                    raise RuntimeError(error)
+                beam_metric_lists[beam_count] = beam_metric_list
+        finally:
+            pool_results.close_pool()
+
+        # merge the beams in the order of the source catalogue
+        metric_list = [np.zeros(len(analyse_data))
+                       for k in range(len(beam_metric_lists[0]))]
+        for beam_index, beam_metric_list in zip(beam_index_list, beam_metric_lists):
+            for metric, beam_metric in zip(metric_list, beam_metric_list):
+                metric[beam_index] = beam_metric
+    else:
+        metric_list = fct_partial(analyse_data)
+
+    # combine the cached and the new metrics
+    if use_metrics_cache:
+        analysed_metric_list = metric_list
+        metric_list = [np.zeros(n_src) for k in range(len(analysed_metric_list))]
+        for src_index in range(n_src):
+            if cached_metric_list[src_index] is not None:
+                for metric, cached_metric in zip(metric_list, cached_metric_list[src_index]):
+                    metric[src_index] = cached_metric
+        for analysed_index, src_index in enumerate(analyse_index):
+            for metric, analysed_metric in zip(metric_list, analysed_metric_list):
+                metric[src_index] = analysed_metric[analysed_index]
+            metrics_cache.set(src_key_list[src_index], src_signature_list[src_index], [
+                              metric[src_index] for metric in metric_list])
+        metrics_cache.write()
+
+    mean_noise, median_noise, rms, min_flux, max_flux, mean_flux, median_flux, max_negative_snr, max_negative_snr_ch, max_negative_snr_freq, max_positive_snr, max_positive_snr_ch, max_positive_snr_freq = metric_list
 
     # for storing new table later
     metrics_table = Table([mean_noise, median_noise, rms, min_flux, max_flux, mean_flux, median_flux, snr_candidates,
@@ -320,6 +689,7 @@ def analyse_spectra(src_cat_file, output_file_name_candidates, cube_dir, do_subt
     # write out table
     logger.info(
         "Updating source catalogue {}".format(src_cat_file))
-    new_data_table.write(src_cat_file, format="ascii.csv", overwrite=True)
+    write_master_table_columns(src_cat_file, new_data_table,
+                               new_col_names, master_table_engine=master_table_engine)
 
     logger.info("#### Searching for candidates ... Done")
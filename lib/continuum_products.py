@@ -0,0 +1,204 @@
+"""
+Functionality to share the continuum products of a beam between the cubes
+
+The continuum image of a beam is the same for all cubes. Therefore, the
+sources found in the continuum image and the SDSS sources only need to be
+obtained for the first cube. The files created by sharpener for these steps
+are stored in a directory for the beam (e.g., "<taskid>/continuum/<beam>")
+and copied into the directories of the other cubes.
+
+A lock file makes sure that only one process runs these steps for a beam
+while processes working on the other cubes of the beam wait and reuse the result.
+
+The products are only reused if they were created with the same settings
+(source finding engine, settings of sharpener for the source finding and
+the SDSS match) from the same continuum image.
+"""
+
+import os
+import json
+import fcntl
+import hashlib
+import logging
+import contextlib
+from astropy.io import fits
+
+from lib.stage_file import stage_file
+
+logger = logging.getLogger(__name__)
+
+# directories with the products of the source finding and SDSS match relative to the beam directory
+CONTINUUM_PRODUCT_DIRS = ["sharpOut/abs", "sharpOut/plot"]
+
+# file listing the stored products and the steps they were created by
+CONTINUUM_PRODUCT_INDEX = "continuum_products.json"
+
+# the products are small and copied so that changes in one cube cannot affect the others
+CONTINUUM_STAGING_METHODS = ["copy"]
+
+# sections of the settings of sharpener that the continuum products depend on
+CONTINUUM_SETTINGS_SECTIONS = ["source_finder", "source_catalog", "sdss_match"]
+
+
+def get_continuum_settings(cfg_par, source_finding_engine="sharpener"):
+    """
+    Function to get the settings that the continuum products of a beam depend on
+
+    Args:
+    -----
+    cfg_par (dict): Settings of sharpener with the paths relative to the beam directory
+    source_finding_engine (str): Engine used to find the sources. Default sharpener
+
+    Return:
+    -------
+    (dict): The settings and the size and a hash of the header of the continuum image
+    """
+
+    continuum_settings = dict([(section, cfg_par.get(section))
+                               for section in CONTINUUM_SETTINGS_SECTIONS])
+    continuum_settings['source_finding_engine'] = source_finding_engine
+
+    cont_file = os.path.join(
+        cfg_par['general']['workdir'], cfg_par['general']['contname'])
+    if os.path.exists(cont_file):
+        continuum_settings['continuum_image'] = {'size': os.path.getsize(cont_file),
+                                                 'header_hash': hashlib.sha1(fits.getheader(cont_file).tostring()).hexdigest()}
+    else:
+        continuum_settings['continuum_image'] = None
+
+    # the settings are compared after they were stored as json
+    return json.loads(json.dumps(continuum_settings))
+
+
+@contextlib.contextmanager
+def lock_continuum_products(continuum_dir):
+    """
+    Function to lock the continuum products of a beam for other processes
+    """
+
+    if not os.path.exists(continuum_dir):
+        try:
+            os.makedirs(continuum_dir)
+        except OSError:
+            # another process may have created it at the same time
+            if not os.path.isdir(continuum_dir):
+                raise
+
+    with open(os.path.join(continuum_dir, "continuum_products.lock"), 'a') as lock_stream:
+        fcntl.flock(lock_stream.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_stream.fileno(), fcntl.LOCK_UN)
+
+
+def list_continuum_products(beam_dir):
+    """
+    Function to list the files in the directories of the continuum products
+
+    Return:
+    -------
+    (dict): Path relative to the beam directory and modification time of every file
+    """
+
+    product_list = {}
+
+    for product_dir in CONTINUUM_PRODUCT_DIRS:
+        if not os.path.isdir(os.path.join(beam_dir, product_dir)):
+            continue
+        for file_name in os.listdir(os.path.join(beam_dir, product_dir)):
+            file_path = os.path.join(beam_dir, product_dir, file_name)
+            # miriad datasets are directories and are not shared
+            if os.path.isfile(file_path):
+                product_list[os.path.join(product_dir, file_name)] = os.path.getmtime(
+                    file_path)
+
+    return product_list
+
+
+def store_continuum_products(continuum_dir, beam_dir, previous_product_list, do_source_finding, do_sdss, continuum_settings=None):
+    """
+    Function to store the files created by the source finding and the SDSS match of a beam
+
+    Args:
+    -----
+    continuum_dir (str): Directory for the continuum products of the beam
+    beam_dir (str): Directory of the beam in the cube
+    previous_product_list (dict): Files before the steps were run from list_continuum_products
+    do_source_finding (bool): The sources were found
+    do_sdss (bool): The SDSS sources were matched
+    continuum_settings (dict): Settings the products were created with from get_continuum_settings. Default None
+    """
+
+    product_list = list_continuum_products(beam_dir)
+
+    # new or updated files
+    product_file_list = sorted([product_file for product_file in product_list
+                                if previous_product_list.get(product_file) != product_list[product_file]])
+
+    for product_file in product_file_list:
+        output_file = os.path.join(continuum_dir, product_file)
+        if not os.path.exists(os.path.dirname(output_file)):
+            os.makedirs(os.path.dirname(output_file))
+        stage_file(os.path.join(beam_dir, product_file), output_file,
+                   methods=CONTINUUM_STAGING_METHODS)
+
+    with open(os.path.join(continuum_dir, CONTINUUM_PRODUCT_INDEX), 'w') as stream:
+        json.dump({'do_source_finding': do_source_finding, 'do_sdss': do_sdss,
+                   'settings': continuum_settings, 'files': product_file_list}, stream, indent=1, sort_keys=True)
+
+    logger.info("Stored {0} continuum products in {1}".format(
+        len(product_file_list), continuum_dir))
+
+
+def get_continuum_products(continuum_dir, beam_dir, do_source_finding, do_sdss, continuum_settings=None):
+    """
+    Function to copy the stored continuum products of a beam into the directory of the beam
+
+    Args:
+    -----
+    continuum_dir (str): Directory for the continuum products of the beam
+    beam_dir (str): Directory of the beam in the cube
+    do_source_finding (bool): The sources are required
+    do_sdss (bool): The SDSS sources are required
+    continuum_settings (dict): Settings the products must have been created with from get_continuum_settings. Default None
+
+    Return:
+    -------
+    (bool): True if the products are available and were copied
+    """
+
+    index_file = os.path.join(continuum_dir, CONTINUUM_PRODUCT_INDEX)
+
+    if not os.path.exists(index_file):
+        return False
+
+    with open(index_file) as stream:
+        product_index = json.load(stream)
+
+    # the products must have been created by the same steps
+    if (do_source_finding and not product_index['do_source_finding']) or (do_sdss and not product_index['do_sdss']):
+        return False
+
+    if product_index.get('settings') != continuum_settings:
+        logger.info("Continuum products in {} were created with different settings".format(
+            continuum_dir))
+        return False
+
+    for product_file in product_index['files']:
+        if not os.path.exists(os.path.join(continuum_dir, product_file)):
+            logger.warning("Continuum product {0} is missing in {1}".format(
+                product_file, continuum_dir))
+            return False
+
+    for product_file in product_index['files']:
+        output_file = os.path.join(beam_dir, product_file)
+        if not os.path.exists(os.path.dirname(output_file)):
+            os.makedirs(os.path.dirname(output_file))
+        stage_file(os.path.join(continuum_dir, product_file), output_file,
+                   methods=CONTINUUM_STAGING_METHODS)
+
+    logger.info("Using {0} continuum products from {1}".format(
+        len(product_index['files']), continuum_dir))
+
+    return True
@@ -25,6 +25,8 @@ from astropy.table import Table, vstack, hstack, Column, MaskedColumn
 import astropy.units as units
 from astropy.coordinates import SkyCoord
 
+from lib.master_table_store import read_master_table, write_master_table_columns
+
 logger = logging.getLogger(__name__)
 
 
@@ -139,9 +141,12 @@ def get_beam_overlap_matrix():
     return overlap_matrix
 
 
-def match_sources_of_beams(src_table_file, max_sep=3):
+def match_sources_of_beams(src_table_file, max_sep=3, master_table_engine="csv"):
     """
     Function to create a new table with sources match across beams
+
+    With master_table_engine="sqlite", the master table is read from the store
+    and only the column with the matches is updated.
     """
 
     logger.info("Matching sources from different beams")
@@ -150,7 +155,8 @@ def match_sources_of_beams(src_table_file, max_sep=3):
     beam_matrix = get_beam_overlap_matrix()
 
     # reading in file
-    src_data = Table.read(src_table_file, format="ascii.csv")
+    src_data = read_master_table(
+        src_table_file, master_table_engine=master_table_engine)
 
     # try to remove column created by this function
     # in case it was executed already on this table
@@ -286,4 +292,5 @@ def match_sources_of_beams(src_table_file, max_sep=3):
     src_data_expanded = hstack([src_data, matched_src_table])
 
     # save the file
-    src_data_expanded.write(src_table_file, format="ascii.csv", overwrite=True)
+    write_master_table_columns(src_table_file, src_data_expanded,
+                               new_col_names, master_table_engine=master_table_engine)
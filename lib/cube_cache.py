@@ -0,0 +1,274 @@
+"""
+Functionality to keep retrieved cubes and continuum images in a shared cache
+
+Files are stored in the cache under a key created from the taskid, beam,
+file name, size and checksum (if known). Runs that need a file that is already
+in the cache get a hard link (or a copy if that is not possible) instead of
+retrieving the file again. The size of the cache is limited by a quota and the
+least recently used files are removed first. Files that are still linked
+into a working directory are never removed.
+
+The index of the cache is a json file that is locked during every
+update so that several runs can use the same cache at the same time.
+Files are only linked or copied while the index is not locked so that
+runs do not wait for each other's transfers.
+"""
+
+import os
+import json
+import fcntl
+import hashlib
+import logging
+import threading
+from time import time
+
+from lib.stage_file import stage_file
+
+logger = logging.getLogger(__name__)
+
+# symbolic links are not used as they would break when files are removed from the cache
+CACHE_STAGING_METHODS = ["hardlink", "reflink", "copy"]
+
+
+class CubeCache(object):
+    """
+    Class to manage a cache directory for cubes and continuum images
+
+    Args:
+    -----
+    cache_dir (str): Directory of the cache
+    quota (float): Maximum size of the cache in GB. Default None (no limit)
+    """
+
+    def __init__(self, cache_dir, quota=None):
+        self.cache_dir = cache_dir
+        self.quota = quota
+
+        self.object_dir = os.path.join(cache_dir, "objects")
+        self.index_file = os.path.join(cache_dir, "index.json")
+        self.lock_file = os.path.join(cache_dir, "index.lock")
+
+        if not os.path.exists(self.object_dir):
+            try:
+                os.makedirs(self.object_dir)
+            except OSError:
+                # another run may have created it at the same time
+                if not os.path.isdir(self.object_dir):
+                    raise
+
+        self._lock = threading.Lock()
+
+    def get_key(self, taskid, beam, file_name, size, checksum=None):
+        """
+        Function to create the key of a file in the cache
+        """
+
+        key_string = "{0}/{1}/{2}/{3}/{4}".format(
+            taskid, str(beam).zfill(2), file_name, size, checksum)
+
+        return hashlib.sha1(key_string).hexdigest()
+
+    def get_object_path(self, key):
+        """
+        Function to return the path of a file in the cache
+        """
+
+        return os.path.join(self.object_dir, key)
+
+    def _update_index(self, update_function):
+        """
+        Function to read, update and write the index while it is locked
+
+        Args:
+        -----
+        update_function (function): Function that gets the index as argument and changes it
+
+        Return:
+        -------
+        Return value of update_function
+        """
+
+        with self._lock:
+            with open(self.lock_file, 'a') as lock_stream:
+                fcntl.flock(lock_stream.fileno(), fcntl.LOCK_EX)
+                try:
+                    if os.path.exists(self.index_file):
+                        with open(self.index_file) as stream:
+                            index = json.load(stream)
+                    else:
+                        index = {}
+
+                    result = update_function(index)
+
+                    tmp_file = "{}.tmp".format(self.index_file)
+                    with open(tmp_file, 'w') as stream:
+                        json.dump(index, stream, indent=1, sort_keys=True)
+                    os.rename(tmp_file, self.index_file)
+                finally:
+                    fcntl.flock(lock_stream.fileno(), fcntl.LOCK_UN)
+
+        return result
+
+    def lookup(self, key, output_file, size=None):
+        """
+        Function to link a file from the cache if it is available
+
+        Only the check of the index is done while it is locked. If the file is
+        evicted before it is linked, it is treated as not in the cache.
+
+        Return:
+        -------
+        (bool): True if the file was found in the cache and linked
+        """
+
+        object_path = self.get_object_path(key)
+
+        def update(index):
+            if key not in index:
+                return False
+            # remove entries of files that are missing or incomplete
+            if not os.path.exists(object_path) or (size is not None and os.path.getsize(object_path) != size):
+                logger.warning(
+                    "Removing invalid entry {} from cache".format(key))
+                if os.path.exists(object_path):
+                    os.remove(object_path)
+                del index[key]
+                return False
+            index[key]['last_access'] = time()
+            return True
+
+        if not self._update_index(update):
+            return False
+
+        try:
+            self.link(object_path, output_file)
+        except (IOError, OSError) as e:
+            logger.warning(
+                "Could not link {0} from cache. It may have been evicted".format(key))
+            logger.warning(e)
+            return False
+
+        return True
+
+    def link(self, object_path, output_file):
+        """
+        Function to link a file of the cache to output_file
+
+        The file is linked or copied to a temporary name first
+        so that output_file is either complete or missing.
+        """
+
+        tmp_file = "{0}.{1}_{2}.part".format(
+            output_file, os.getpid(), threading.current_thread().ident)
+        try:
+            stage_file(object_path, tmp_file,
+                       methods=CACHE_STAGING_METHODS)
+            os.rename(tmp_file, output_file)
+        finally:
+            if os.path.lexists(tmp_file):
+                os.remove(tmp_file)
+
+    def insert(self, key, file_path, taskid, beam, file_name):
+        """
+        Function to move a file into the cache
+        """
+
+        object_path = self.get_object_path(key)
+
+        def update(index):
+            os.rename(file_path, object_path)
+            index[key] = {'taskid': taskid,
+                          'beam': str(beam).zfill(2),
+                          'file_name': file_name,
+                          'size': os.path.getsize(object_path),
+                          'last_access': time()}
+
+        self._update_index(update)
+
+    def fetch(self, taskid, beam, file_name, size, checksum, fetch_function, output_file):
+        """
+        Function to get a file through the cache
+
+        If the file is not in the cache, it is retrieved with fetch_function into the cache.
+        The file is then linked to output_file.
+
+        Args:
+        -----
+        taskid (str): The taskid
+        beam (str): The beam
+        file_name (str): Name of the file in the data source
+        size (int): Size of the file in bytes
+        checksum (str): Checksum of the file provided by the data source. Can be None
+        fetch_function (function): Function with the output file as argument to retrieve the file
+        output_file (str): Path where the file is needed
+        """
+
+        key = self.get_key(taskid, beam, file_name, size, checksum)
+
+        if self.lookup(key, output_file, size=size):
+            logger.info("Beam {0}: Found {1} in cache".format(beam, file_name))
+            return
+
+        logger.info("Beam {0}: {1} not in cache. Getting it".format(
+            beam, file_name))
+
+        # use a unique name while the file is retrieved
+        tmp_path = "{0}.{1}_{2}.part".format(
+            self.get_object_path(key), os.getpid(), threading.current_thread().ident)
+        try:
+            fetch_function(tmp_path)
+            # the link keeps the file from being evicted once it is in the cache
+            self.link(tmp_path, output_file)
+            self.insert(key, tmp_path, taskid, beam, file_name)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        # make room for the new file
+        self.evict()
+
+    def release(self, file_path):
+        """
+        Function to release a file that was linked from the cache
+
+        Only the link is removed. The file stays in the cache until it is evicted.
+        """
+
+        if os.path.lexists(file_path):
+            logger.debug("Releasing {}".format(file_path))
+            os.remove(file_path)
+
+    def evict(self):
+        """
+        Function to remove the least recently used files until the cache fits into the quota
+
+        Files that are linked in a working directory are kept.
+        """
+
+        if self.quota is None:
+            return
+
+        quota_bytes = self.quota * 1024.**3
+
+        def update(index):
+            total_size = sum([entry['size'] for entry in index.values()])
+
+            for key in sorted(index.keys(), key=lambda k: index[k]['last_access']):
+                if total_size <= quota_bytes:
+                    break
+                object_path = self.get_object_path(key)
+                if os.path.exists(object_path):
+                    # file is still in use
+                    if os.stat(object_path).st_nlink > 1:
+                        continue
+                    os.remove(object_path)
+                logger.info("Removing {0} of beam {1} of taskid {2} from cache".format(
+                    index[key]['file_name'], index[key]['beam'], index[key]['taskid']))
+                total_size -= index[key]['size']
+                del index[key]
+
+            if total_size > quota_bytes:
+                logger.warning("Cache in {0} uses {1:.1f} GB and exceeds the quota of {2:.1f} GB because files are still in use".format(
+                    self.cache_dir, total_size / 1024.**3, self.quota))
+
+        self._update_index(update)
@@ -0,0 +1,121 @@
+"""
+Functionality to estimate the noise of every channel of a cube in one pass
+
+The cube is memory-mapped and read in chunks of channels so that only a
+few channels are in memory at the same time. The pixels around the continuum
+sources are masked. For every channel, the noise is estimated with the MADFM
+and the rms of the remaining pixels. The result is stored for each beam and
+can be used by the spectra extraction and the analysis of the spectra
+instead of the noise estimated around every source.
+"""
+
+import os
+import logging
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+from astropy.table import Table
+
+from lib.sparse_cube import get_pixel_mask
+
+logger = logging.getLogger(__name__)
+
+# file with the noise of the cube relative to the beam directory
+CUBE_NOISE_FILE = "sharpOut/abs/cube_noise.csv"
+
+# conversion from MADFM to standard deviation
+MADFM_TO_STD = 1.4826
+
+
+def get_cube_noise(cube_file, src_file=None, mask_size=6, chunk_size=16):
+    """
+    Function to estimate the noise of every channel of a cube
+
+    Args:
+    -----
+    cube_file (str): Path of the cube
+    src_file (str): Csv file with the continuum sources from SHARPener. Default None (no mask)
+    mask_size (int): Half of the size of the box masked around each source in pixels. Default 6
+    chunk_size (int): Number of channels read at once. Default 16
+
+    Return:
+    -------
+    (Table): Channel, frequency, noise from MADFM and rms of every channel
+    """
+
+    logger.info("Estimating the noise of every channel of {}".format(cube_file))
+
+    with fits.open(cube_file, memmap=True) as hdul:
+        header = hdul[0].header
+        n_x = header['NAXIS1']
+        n_y = header['NAXIS2']
+        n_chan = header['NAXIS3']
+
+        # the first plane in any other axis, e.g., stokes
+        cube_data = hdul[0].data.reshape(-1, n_chan, n_y, n_x)[0]
+
+        frequency = WCS(header).sub([3]).wcs_pix2world(
+            np.arange(n_chan), 0)[0]
+
+        if src_file is not None and os.path.exists(src_file):
+            pixel_mask = ~get_pixel_mask(src_file, header, mask_size)
+        else:
+            logger.warning(
+                "No sources available. Estimating noise of {} without mask".format(cube_file))
+            pixel_mask = np.ones((n_y, n_x), dtype=bool)
+
+        noise = np.zeros(n_chan)
+        rms = np.zeros(n_chan)
+
+        for chan_start in range(0, n_chan, chunk_size):
+            chan_end = min(chan_start + chunk_size, n_chan)
+
+            chunk_data = np.array(
+                cube_data[chan_start:chan_end], dtype=np.float64)[:, pixel_mask]
+
+            median = np.nanmedian(chunk_data, axis=1)
+            noise[chan_start:chan_end] = MADFM_TO_STD * np.nanmedian(
+                np.abs(chunk_data - median[:, np.newaxis]), axis=1)
+            rms[chan_start:chan_end] = np.nanstd(chunk_data, axis=1)
+
+    logger.info(
+        "Estimating the noise of every channel of {} ... Done".format(cube_file))
+
+    return Table([np.arange(n_chan), frequency, noise, rms], names=['Channel', 'Frequency [Hz]', 'Noise [Jy]', 'RMS [Jy]'])
+
+
+def write_cube_noise(beam_dir, cube_file, src_file=None, mask_size=6, chunk_size=16):
+    """
+    Function to estimate the noise of every channel of a cube and write it to the beam directory
+
+    See get_cube_noise for the arguments
+
+    Return:
+    -------
+    (Table): The noise of the cube
+    """
+
+    cube_noise = get_cube_noise(
+        cube_file, src_file=src_file, mask_size=mask_size, chunk_size=chunk_size)
+
+    cube_noise.write(os.path.join(beam_dir, CUBE_NOISE_FILE),
+                     format="ascii.csv", overwrite=True)
+
+    return cube_noise
+
+
+def read_cube_noise(beam_dir):
+    """
+    Function to read the noise of every channel of the cube of a beam
+
+    Return:
+    -------
+    (Table): The noise of the cube. None if the noise was not estimated
+    """
+
+    noise_file = os.path.join(beam_dir, CUBE_NOISE_FILE)
+
+    if not os.path.exists(noise_file):
+        return None
+
+    return Table.read(noise_file, format="ascii.csv")
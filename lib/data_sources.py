@@ -0,0 +1,545 @@
+"""
+Data sources for the cubes and continuum images
+
+Every data source implements the same small interface to find the files
+of a beam, get their size, fetch them to the working directory and,
+if supported, read a range of bytes from them. The pipeline only uses
+this interface and new data sources only need to be added to DATA_SOURCES.
+
+Available data sources:
+- ALTA: the Apertif long-term archive accessed with the iRODS commands
+- local: a local directory with the data of the taskids
+- simulated: a local directory, but with the latency and bandwidth
+  of a remote archive, e.g., to tune the number of concurrent transfers
+"""
+
+import os
+import glob
+import logging
+import subprocess
+import threading
+from abc import ABCMeta, abstractmethod
+from time import time, sleep
+
+from lib.alta_catalogue import AltaCatalogue
+from lib.stage_file import stage_file, STAGING_METHODS
+
+logger = logging.getLogger(__name__)
+
+FNULL = open(os.devnull, 'w')
+
+
+def fetch_to_part_file(fetch_function, output_file, size=None):
+    """
+    Function to fetch a file under a temporary name and rename it once it is complete
+
+    A transfer that fails or is interrupted does not leave a partial
+    file under the final name that would be taken for a complete one.
+
+    Args:
+    -----
+    fetch_function (function): Function with the output file as argument to get the file
+    output_file (str): Path of the file once it is complete
+    size (int): Expected size of the file in bytes. Default None to not check the size
+    """
+
+    # unique name as the same file can be fetched by several processes and threads
+    tmp_file = "{0}.{1}_{2}.part".format(
+        output_file, os.getpid(), threading.current_thread().ident)
+    try:
+        fetch_function(tmp_file)
+        if size is not None and os.path.getsize(tmp_file) != size:
+            error = "Size of {0} is {1} bytes instead of {2} bytes".format(
+                output_file, os.path.getsize(tmp_file), size)
+            logger.error(error)
+            raise IOError(error)
+        os.rename(tmp_file, output_file)
+    finally:
+        if os.path.lexists(tmp_file):
+            os.remove(tmp_file)
+
+
+class DataSource(object):
+    """
+    Base class for the data sources
+
+    Args:
+    -----
+    taskid (str): The taskid
+    """
+
+    __metaclass__ = ABCMeta
+
+    name = None
+
+    # set to True if read_range is implemented
+    supports_read_range = False
+
+    def __init__(self, taskid):
+        self.taskid = taskid
+
+    @abstractmethod
+    def list_beam(self, beam):
+        """
+        Function to list the files of a beam
+
+        Return:
+        -------
+        (list): List of file names. None if the beam is not available
+        """
+        pass
+
+    @abstractmethod
+    def get_cube_location(self, beam, cube):
+        """
+        Function to return the location of a cube
+
+        Return:
+        -------
+        (str): Location of the cube. None if the cube is not available
+        """
+        pass
+
+    @abstractmethod
+    def get_continuum_image_location(self, beam):
+        """
+        Function to return the location of the continuum image of a beam
+
+        Return:
+        -------
+        (str): Location of the continuum image. None if the image is not available
+        """
+        pass
+
+    @abstractmethod
+    def stat(self, location):
+        """
+        Function to return the size of a file in bytes
+
+        Return:
+        -------
+        (int): Size of the file. None if it is not known
+        """
+        pass
+
+    def checksum(self, location):
+        """
+        Function to return the checksum of a file provided by the data source
+
+        Return:
+        -------
+        (str): Checksum of the file. None if it is not known
+        """
+
+        return None
+
+    @abstractmethod
+    def fetch(self, location, output_file):
+        """
+        Function to get a file and store it as output_file
+
+        Raises an exception if the file could not be retrieved
+        """
+        pass
+
+    def read_range(self, location, offset, n_bytes):
+        """
+        Function to read a range of bytes from a file
+
+        Return:
+        -------
+        (str): The bytes that were read
+        """
+
+        raise NotImplementedError(
+            "Reading a range of bytes is not supported by data source {}".format(self.name))
+
+    def read_ranges(self, location, range_list):
+        """
+        Function to read several ranges of bytes from a file
+
+        Args:
+        -----
+        location (str): Location of the file
+        range_list (list): List of offset and number of bytes for every range
+
+        Return:
+        -------
+        (generator): Offset and the bytes that were read for every range
+        """
+
+        for offset, n_bytes in range_list:
+            yield offset, self.read_range(location, offset, n_bytes)
+
+
+class AltaDataSource(DataSource):
+    """
+    Data source for ALTA
+
+    Args:
+    -----
+    taskid (str): The taskid
+    cache_file (str): Json file to store the listing of the taskid. Default None
+    cache_max_age (float): Maximum age of the listing in seconds. Default 86400.
+    """
+
+    name = "ALTA"
+
+    def __init__(self, taskid, cache_file=None, cache_max_age=86400.):
+        super(AltaDataSource, self).__init__(taskid)
+
+        self.catalogue = AltaCatalogue(
+            taskid, cache_file=cache_file, cache_max_age=cache_max_age)
+
+    def list_beam(self, beam):
+
+        return self.catalogue.list_beam(beam)
+
+    def get_cube_location(self, beam, cube):
+
+        # /altaZone/archive/apertif_main/visibilities_default/<taskid>_AP_B0XY
+        alta_taskid_beam_dir = self.catalogue.get_beam_collection(beam)
+
+        alta_beam_cube_path = os.path.join(
+            alta_taskid_beam_dir, "HI_image_cube{}.fits".format(cube))
+
+        if self.catalogue.exists(alta_beam_cube_path):
+            return alta_beam_cube_path
+        else:
+            return None
+
+    def get_continuum_image_location(self, beam):
+
+        continuum_image_name = self.catalogue.get_continuum_image_name(beam)
+
+        if continuum_image_name is None:
+            return None
+        else:
+            return os.path.join(self.catalogue.get_beam_collection(beam), continuum_image_name)
+
+    def stat(self, location):
+
+        return self.catalogue.get_file_size(location)
+
+    def checksum(self, location):
+
+        return self.catalogue.get_file_checksum(location)
+
+    def fetch(self, location, output_file):
+        """
+        Function to get files from ALTA
+
+        Could be done by getdata_alta package, too.
+        """
+
+        # iget does not restart failed transfers (-X, --lfrestart, --retries)
+        # because every attempt gets a new temporary file. They are repeated by the transfer engine
+
+        # let iget verify the checksum if ALTA has one
+        if self.checksum(location) is not None:
+            iget_options = "-fPITK"
+        else:
+            iget_options = "-fPIT"
+
+        def iget(tmp_file):
+            alta_cmd = "iget {0} {1} {2}".format(
+                iget_options, location, tmp_file)
+            logger.debug(alta_cmd)
+            subprocess.check_call(
+                alta_cmd, shell=True, stdout=FNULL, stderr=FNULL)
+
+        # get the file from alta and store it under the new name once it is complete
+        fetch_to_part_file(iget, output_file, size=self.stat(location))
+
+
+class LocalDataSource(DataSource):
+    """
+    Data source for a local directory
+
+    Args:
+    -----
+    taskid (str): The taskid
+    data_basedir (str): Directory with the taskids
+    cube_pattern (str): Location of a cube in the taskid directory
+    continuum_pattern (str): Location of the continuum image in the
+        taskid directory (can contain wildcards)
+    staging_methods (list): Methods to stage the files (see stage_file)
+    """
+
+    name = "local"
+
+    supports_read_range = True
+
+    def __init__(self, taskid, data_basedir, cube_pattern="{beam}/line/cubes/HI_image_cube{cube}.fits",
+                 continuum_pattern="{beam}/continuum/image_mf_??.fits", staging_methods=None):
+        super(LocalDataSource, self).__init__(taskid)
+
+        # the locations do not depend on the working directory
+        self.taskid_dir = os.path.abspath(os.path.join(data_basedir, taskid))
+        self.cube_pattern = cube_pattern
+        self.continuum_pattern = continuum_pattern
+        if staging_methods is None:
+            self.staging_methods = STAGING_METHODS
+        else:
+            self.staging_methods = staging_methods
+
+        if not os.path.exists(self.taskid_dir):
+            error = "Could not find local directory for data {}. Abort".format(
+                self.taskid_dir)
+            logger.error(error)
+            raise RuntimeError(error)
+
+        # the files of every beam are only listed once
+        self._beam_file_lists = {}
+        self._beam_file_lists_lock = threading.Lock()
+
+    def get_beam_dir(self, beam):
+        """
+        Function to return the directory of a beam
+        """
+
+        return os.path.join(self.taskid_dir, str(beam).zfill(2))
+
+    def list_beam(self, beam):
+        """
+        Function to list the cubes and continuum images of a beam
+
+        Only the files matching the cube and continuum patterns are listed.
+        The listing of a beam is kept for the following calls.
+
+        Return:
+        -------
+        (list): File names relative to the beam directory. None if the beam is not available
+        """
+
+        beam = str(beam).zfill(2)
+
+        with self._beam_file_lists_lock:
+            if beam in self._beam_file_lists:
+                return self._beam_file_lists[beam]
+
+        beam_dir = self.get_beam_dir(beam)
+
+        if not os.path.isdir(beam_dir):
+            file_list = None
+        else:
+            file_list = []
+            for pattern in [self.cube_pattern.format(beam=beam, cube="*"), self.continuum_pattern.format(beam=beam)]:
+                file_list.extend([os.path.relpath(file_path, beam_dir)
+                                  for file_path in glob.glob(os.path.join(self.taskid_dir, pattern))])
+            file_list = sorted(set(file_list))
+
+        with self._beam_file_lists_lock:
+            self._beam_file_lists[beam] = file_list
+
+        return file_list
+
+    def get_cube_location(self, beam, cube):
+
+        cube_path = os.path.join(self.taskid_dir, self.cube_pattern.format(
+            beam=str(beam).zfill(2), cube=cube))
+
+        if os.path.exists(cube_path):
+            return cube_path
+        else:
+            return None
+
+    def get_continuum_image_location(self, beam):
+
+        image_list = glob.glob(os.path.join(self.taskid_dir, self.continuum_pattern.format(
+            beam=str(beam).zfill(2))))
+
+        if len(image_list) == 0:
+            return None
+        else:
+            image_list.sort()
+            return image_list[0]
+
+    def stat(self, location):
+
+        if os.path.exists(location):
+            return os.path.getsize(location)
+        else:
+            return None
+
+    def fetch(self, location, output_file):
+
+        fetch_to_part_file(lambda tmp_file: stage_file(location, tmp_file, methods=self.staging_methods),
+                           output_file)
+
+    def read_range(self, location, offset, n_bytes):
+
+        with open(location, 'rb') as stream:
+            stream.seek(offset)
+            return stream.read(n_bytes)
+
+    def read_ranges(self, location, range_list):
+
+        with open(location, 'rb') as stream:
+            for offset, n_bytes in range_list:
+                stream.seek(offset)
+                yield offset, stream.read(n_bytes)
+
+    def __getstate__(self):
+
+        # the lock cannot be passed to other processes
+        state = self.__dict__.copy()
+        del state['_beam_file_lists_lock']
+
+        return state
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        self._beam_file_lists_lock = threading.Lock()
+
+
+class SimulatedDataSource(LocalDataSource):
+    """
+    Data source for a local directory that behaves like a remote archive
+
+    Every request is delayed by the latency and the files are copied
+    in chunks limited by the bandwidth of the (shared) connection and
+    of the single transfer. This makes it possible to test and tune
+    the transfers without access to the archive.
+
+    Args:
+    -----
+    taskid (str): The taskid
+    data_basedir (str): Directory with the taskids
+    latency (float): Delay of every request in seconds. Default 1.
+    bandwidth (float): Bandwidth of the connection in MB/s shared
+        by all transfers. Default 100.
+    transfer_bandwidth (float): Bandwidth of a single transfer in MB/s.
+        Default None (only limited by the connection)
+    chunk_size (int): Size of the chunks in bytes. Default 4 MB
+    **kwargs: Settings for the local data source
+    """
+
+    name = "simulated"
+
+    def __init__(self, taskid, data_basedir, latency=1., bandwidth=100., transfer_bandwidth=None, chunk_size=4 * 1024**2, **kwargs):
+        super(SimulatedDataSource, self).__init__(
+            taskid, data_basedir, **kwargs)
+
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.transfer_bandwidth = transfer_bandwidth
+        self.chunk_size = chunk_size
+
+        # time when the shared connection is available again
+        self._connection_free_time = time()
+        self._lock = threading.Lock()
+
+    def _wait_for_connection(self, n_bytes):
+        """
+        Function to wait for the time it takes to transfer n_bytes
+        """
+
+        start_time = time()
+
+        # time on the shared connection
+        if self.bandwidth is not None:
+            with self._lock:
+                transfer_start_time = max(
+                    start_time, self._connection_free_time)
+                self._connection_free_time = transfer_start_time + \
+                    n_bytes / (self.bandwidth * 1024.**2)
+                end_time = self._connection_free_time
+        else:
+            end_time = start_time
+
+        # time for a single transfer
+        if self.transfer_bandwidth is not None:
+            end_time = max(end_time, start_time + n_bytes /
+                           (self.transfer_bandwidth * 1024.**2))
+
+        if end_time > time():
+            sleep(end_time - time())
+
+    def list_beam(self, beam):
+
+        # a listing that is kept does not need a request
+        if str(beam).zfill(2) not in self._beam_file_lists:
+            sleep(self.latency)
+
+        return super(SimulatedDataSource, self).list_beam(beam)
+
+    def fetch(self, location, output_file):
+
+        sleep(self.latency)
+
+        def copy_file(tmp_file):
+            with open(location, 'rb') as source_stream:
+                with open(tmp_file, 'wb') as output_stream:
+                    while True:
+                        chunk = source_stream.read(self.chunk_size)
+                        if not chunk:
+                            break
+                        self._wait_for_connection(len(chunk))
+                        output_stream.write(chunk)
+
+        fetch_to_part_file(copy_file, output_file,
+                           size=os.path.getsize(location))
+
+    def read_range(self, location, offset, n_bytes):
+
+        sleep(self.latency)
+
+        self._wait_for_connection(n_bytes)
+
+        return super(SimulatedDataSource, self).read_range(location, offset, n_bytes)
+
+    def read_ranges(self, location, range_list):
+
+        # all ranges are requested at once
+        sleep(self.latency)
+
+        for offset, data in super(SimulatedDataSource, self).read_ranges(location, range_list):
+            self._wait_for_connection(len(data))
+            yield offset, data
+
+    def __getstate__(self):
+
+        # the locks cannot be passed to other processes
+        state = super(SimulatedDataSource, self).__getstate__()
+        del state['_lock']
+
+        return state
+
+    def __setstate__(self, state):
+
+        super(SimulatedDataSource, self).__setstate__(state)
+        self._lock = threading.Lock()
+
+
+# available data sources
+DATA_SOURCES = {
+    AltaDataSource.name: AltaDataSource,
+    LocalDataSource.name: LocalDataSource,
+    SimulatedDataSource.name: SimulatedDataSource
+}
+
+
+def get_data_source(data_source_name, taskid, **kwargs):
+    """
+    Function to create a data source
+
+    Args:
+    -----
+    data_source_name (str): Name of the data source
+    taskid (str): The taskid
+    **kwargs: Settings of the data source
+
+    Return:
+    -------
+    (DataSource): The data source
+    """
+
+    if data_source_name not in DATA_SOURCES:
+        error = "Did not recognize data source {0}. Available data sources are {1}. Abort".format(
+            data_source_name, str(sorted(DATA_SOURCES.keys())))
+        logger.error(error)
+        raise RuntimeError(error)
+
+    return DATA_SOURCES[data_source_name](taskid, **kwargs)
@@ -0,0 +1,293 @@
+"""
+Functionality to extract the spectra of all continuum sources of a beam at once
+
+This is an alternative to the spectra extraction of SHARPener (spec_ex.abs_ex)
+which goes through the sources one by one. Here, the cube is memory-mapped,
+the positions of all sources are converted to pixels with a single WCS call
+and the spectra and the noise around all sources are read in chunks of
+channels using the indices of the pixels. The spectra are written in the
+format of SHARPener so that the plots and the analysis of apersharp can be used.
+They can also be written to the spectra store of the beam instead of
+or in addition to the text files.
+
+The flux is the value of the pixel at the position of the source. The noise
+per channel is estimated with the MADFM of the pixels in a box around
+the source (excluding the inner box of size noise_delta_skip).
+"""
+
+import os
+import logging
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+from astropy.table import Table
+from astropy.coordinates import SkyCoord
+import astropy.units as units
+
+from lib.spectra_store import write_spectra_store
+
+logger = logging.getLogger(__name__)
+
+# conversion from MADFM to standard deviation
+MADFM_TO_STD = 1.4826
+
+
+def check_sharpener_settings(cfg_par):
+    """
+    Function to get the settings of SHARPener that are not supported
+
+    Args:
+    -----
+    cfg_par (dict): Settings of SHARPener
+
+    Return:
+    -------
+    (list): Names of the settings that are not supported
+    """
+
+    unsupported_settings = []
+
+    if cfg_par['spec_ex'].get('chrom_aberration', False):
+        unsupported_settings.append("spec_ex:chrom_aberration")
+    if cfg_par['spec_ex'].get('flag_chans', None) is not None:
+        unsupported_settings.append("spec_ex:flag_chans")
+    if cfg_par['spec_ex'].get('zunit', 'Hz') != 'Hz':
+        unsupported_settings.append("spec_ex:zunit")
+    if cfg_par.get('hanning', {}).get('enable', False):
+        unsupported_settings.append("hanning:enable")
+    if cfg_par.get('polynomial_subtraction', {}).get('enable', False):
+        unsupported_settings.append("polynomial_subtraction:enable")
+
+    return unsupported_settings
+
+
+def nan_median(data):
+    """
+    Function to get the median along the last axis ignoring NaN values
+
+    This is faster than np.nanmedian, which uses masked arrays for small arrays.
+    NaN is returned if all values are NaN.
+    """
+
+    # NaN values are sorted to the end
+    sorted_data = np.sort(data, axis=-1)
+    n_valid = np.sum(~np.isnan(data), axis=-1)
+
+    lower_index = np.maximum(n_valid - 1, 0) // 2
+    upper_index = n_valid // 2
+    upper_index[n_valid == 0] = 0
+
+    median = 0.5 * (np.take_along_axis(sorted_data, lower_index[..., np.newaxis], axis=-1)[..., 0] +
+                    np.take_along_axis(sorted_data, upper_index[..., np.newaxis], axis=-1)[..., 0])
+    median[n_valid == 0] = np.nan
+
+    return median
+
+
+def get_source_pixels(src_data, image_header):
+    """
+    Function to convert the positions of all sources to pixels in one go
+
+    Args:
+    -----
+    src_data (Table): Sources with ra (hourangle) and dec (deg)
+    image_header (Header): Header of the cube or image
+
+    Return:
+    -------
+    (tuple): Arrays with the x and y pixel of the sources
+    """
+
+    src_coord = SkyCoord(src_data['ra'], src_data['dec'], unit=(
+        units.hourangle, units.deg), frame='fk5')
+
+    pixel_x, pixel_y = WCS(image_header).celestial.wcs_world2pix(
+        src_coord.ra.deg, src_coord.dec.deg, 0)
+
+    return np.round(pixel_x).astype(int), np.round(pixel_y).astype(int)
+
+
+def get_noise_offsets(noise_delta_skip, noise_delta_pix):
+    """
+    Function to get the pixel offsets of the box used to estimate the noise around a source
+
+    Return:
+    -------
+    (tuple): Arrays with the offsets in x and y
+    """
+
+    box_size = noise_delta_skip + noise_delta_pix
+
+    offset_y, offset_x = np.mgrid[-box_size:box_size + 1, -box_size:box_size + 1]
+    in_box = np.maximum(np.abs(offset_x), np.abs(offset_y)) > noise_delta_skip
+
+    return offset_x[in_box], offset_y[in_box]
+
+
+def get_continuum_flux(cont_file, src_data):
+    """
+    Function to get the flux of the continuum image at the position of the sources
+
+    Return:
+    -------
+    (ndarray): Flux of every source. NaN for sources outside of the image
+    """
+
+    with fits.open(cont_file) as hdul:
+        cont_data = np.squeeze(hdul[0].data)
+        pixel_x, pixel_y = get_source_pixels(src_data, hdul[0].header)
+
+    cont_flux = np.full(len(src_data), np.nan)
+    in_image = (pixel_x >= 0) & (pixel_x < cont_data.shape[-1]) & (
+        pixel_y >= 0) & (pixel_y < cont_data.shape[-2])
+    cont_flux[in_image] = cont_data[pixel_y[in_image], pixel_x[in_image]]
+
+    return cont_flux
+
+
+def extract_spectra(cube_file, src_file, spec_dir, cont_file=None, noise_delta_skip=6, noise_delta_pix=6, chunk_size=64, cube_noise=None, store_beam_dir=None, write_text_files=True):
+    """
+    Function to extract the spectra of all sources from a cube
+
+    Args:
+    -----
+    cube_file (str): Path of the cube
+    src_file (str): Csv file with the continuum sources from SHARPener
+    spec_dir (str): Directory for the spectra
+    cont_file (str): Continuum image to get the optical depth. Default None
+    noise_delta_skip (int): Half size of the box around the source that is not used for the noise. Default 6
+    noise_delta_pix (int): Width of the box used for the noise. Default 6
+    chunk_size (int): Number of channels read at once. Default 64
+    cube_noise (ndarray): Noise of every channel of the cube used for all sources
+        instead of the noise around each source. Default None
+    store_beam_dir (str): Directory of the beam to write the spectra to the spectra store of the beam. Default None
+    write_text_files (bool): Write the spectra to text files. Default True
+
+    Return:
+    -------
+    (list): Text files of the spectra
+    """
+
+    src_data = Table.read(src_file, format="ascii.csv")
+    n_src = len(src_data)
+
+    logger.info("Extracting {0} spectra from {1}".format(n_src, cube_file))
+
+    if not os.path.exists(spec_dir):
+        os.makedirs(spec_dir)
+
+    if n_src == 0:
+        if store_beam_dir is not None:
+            write_spectra_store(store_beam_dir, np.zeros(0), np.zeros((0, 0)), np.zeros((0, 0)), [], [])
+        return []
+
+    with fits.open(cube_file, memmap=True) as hdul:
+        header = hdul[0].header
+        n_x = header['NAXIS1']
+        n_y = header['NAXIS2']
+        n_chan = header['NAXIS3']
+
+        # the first plane in any other axis, e.g., stokes
+        cube_data = hdul[0].data.reshape(-1, n_chan, n_y * n_x)[0]
+
+        frequency = WCS(header).sub([3]).wcs_pix2world(
+            np.arange(n_chan), 0)[0]
+
+        pixel_x, pixel_y = get_source_pixels(src_data, header)
+
+        # index of the source pixel and of the pixels for the noise
+        if cube_noise is None:
+            offset_x, offset_y = get_noise_offsets(
+                noise_delta_skip, noise_delta_pix)
+        else:
+            offset_x = offset_y = np.zeros(0, dtype=int)
+        noise_x = pixel_x[:, np.newaxis] + offset_x
+        noise_y = pixel_y[:, np.newaxis] + offset_y
+        noise_valid = (noise_x >= 0) & (noise_x < n_x) & (
+            noise_y >= 0) & (noise_y < n_y)
+        noise_index = np.where(noise_valid, noise_y * n_x + noise_x, 0)
+
+        src_valid = (pixel_x >= 0) & (pixel_x < n_x) & (
+            pixel_y >= 0) & (pixel_y < n_y)
+        src_index = np.where(src_valid, pixel_y * n_x + pixel_x, 0)
+
+        # only read each required pixel once
+        pixel_index, pixel_inverse = np.unique(
+            np.concatenate([src_index, noise_index.ravel()]), return_inverse=True)
+
+        flux = np.zeros((n_chan, n_src))
+        noise = np.zeros((n_chan, n_src))
+
+        for chan_start in range(0, n_chan, chunk_size):
+            chan_end = min(chan_start + chunk_size, n_chan)
+
+            pixel_data = np.array(
+                cube_data[chan_start:chan_end][:, pixel_index], dtype=np.float64)[:, pixel_inverse]
+
+            flux[chan_start:chan_end] = pixel_data[:, :n_src]
+
+            if cube_noise is not None:
+                noise[chan_start:chan_end] = np.array(
+                    cube_noise[chan_start:chan_end])[:, np.newaxis]
+                continue
+
+            noise_data = pixel_data[:, n_src:].reshape(
+                chan_end - chan_start, n_src, -1)
+            noise_data[:, ~noise_valid] = np.nan
+            noise_median = nan_median(noise_data)
+            noise[chan_start:chan_end] = MADFM_TO_STD * nan_median(
+                np.abs(noise_data - noise_median[:, :, np.newaxis]))
+
+    flux[:, ~src_valid] = np.nan
+    noise[:, ~src_valid] = np.nan
+    if np.any(~src_valid):
+        logger.warning("{0} sources are outside of {1}".format(
+            np.sum(~src_valid), cube_file))
+
+    if cont_file is not None and os.path.exists(cont_file):
+        cont_flux = get_continuum_flux(cont_file, src_data)
+    else:
+        cont_flux = np.full(n_src, np.nan)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        optical_depth = -np.log(1. + flux / cont_flux)
+        optical_depth_noise = noise / cont_flux
+
+    spec_file_list = []
+    for src_index in range(n_src if write_text_files else 0):
+        spec_file = os.path.join(spec_dir, "{0}_J{1}.txt".format(
+            src_data['ID'][src_index] - 1, src_data['J2000'][src_index]))
+        spec_table = Table([frequency, flux[:, src_index], noise[:, src_index], optical_depth[:, src_index], optical_depth_noise[:, src_index]],
+                           names=['Frequency [Hz]', 'Flux [Jy]', 'Noise [Jy]', 'Optical depth', 'Noise optical depth'])
+        spec_table.write(spec_file, format="ascii", overwrite=True)
+        spec_file_list.append(spec_file)
+
+    # the store is written after the text files so that it is not older than them
+    if store_beam_dir is not None:
+        write_spectra_store(store_beam_dir, frequency, flux.T, noise.T,
+                            np.array(src_data['ID']) - 1, np.array(src_data['J2000'], dtype=str))
+
+    logger.info("Extracting {0} spectra from {1} ... Done".format(
+        n_src, cube_file))
+
+    return spec_file_list
+
+
+def extract_spectra_sharpener(cfg_par, chunk_size=64, cube_noise=None, spectra_store=False, write_text_files=True):
+    """
+    Function to extract the spectra with the settings of SHARPener
+
+    The paths in the settings are relative to the current working directory.
+    With spectra_store, the spectra are written to the spectra store of the beam.
+    """
+
+    workdir = cfg_par['general']['workdir']
+
+    return extract_spectra(os.path.join(workdir, cfg_par['general']['cubename']),
+                           os.path.join(workdir, "sharpOut/abs/mir_src_sharp.csv"),
+                           os.path.join(workdir, "sharpOut/spec/"),
+                           cont_file=os.path.join(
+                               workdir, cfg_par['general']['contname']),
+                           noise_delta_skip=cfg_par['spec_ex']['noise_delta_skip'],
+                           noise_delta_pix=cfg_par['spec_ex']['noise_delta_pix'], chunk_size=chunk_size, cube_noise=cube_noise,
+                           store_beam_dir=workdir if spectra_store else None, write_text_files=write_text_files)
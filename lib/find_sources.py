@@ -0,0 +1,185 @@
+"""
+Functionality to find the continuum sources in an image without miriad
+
+This is an alternative to the source finding of SHARPener (cont_src.find_src_imsad)
+which converts the continuum image to a miriad dataset and runs imsad.
+Here, the memory-mapped fits image is clipped, the islands of connected
+pixels above the clip level are labelled and the peak of every island is measured.
+The sources are written in the format of the source file of SHARPener
+(sharpOut/abs/mir_src_sharp.csv), which is used for the following steps:
+the same columns in the same order, the coordinates in sexagesimal notation
+as written by imsad (ra in hours), the peak flux in Jy/beam, the integrated
+flux in Jy, the name from the coordinates without the colons, the sources
+sorted by their name and numbered from 1 and the position of the sources
+in pixels starting at 1. The deconvolved beam is not measured and the
+flags of imsad are not set, except for sources touching the edge of the image.
+
+The functions do not change the working directory and can be run in threads.
+"""
+
+import os
+import logging
+import numpy as np
+from scipy import ndimage
+from astropy.io import fits
+from astropy.wcs import WCS
+from astropy.table import Table
+from astropy.coordinates import SkyCoord
+import astropy.units as units
+
+logger = logging.getLogger(__name__)
+
+# flag of sources that touch the edge of the image
+EDGE_FLAG = "E"
+
+# flag of sources without problems
+NO_FLAG = "-"
+
+# columns of the source file of SHARPener
+SHARPENER_SOURCE_COLUMNS = ['ID', 'J2000', 'ra', 'dec', 'peak', 'flux_int',
+                            'beam_major_decon', 'beam_minor_decon', 'beam_pang_decon',
+                            'FLAG', 'DFLAG', 'FFLAG', 'pixel_ra', 'pixel_dec']
+
+
+def check_sharpener_settings(cfg_par):
+    """
+    Function to get the settings of SHARPener for the source finding that are not supported
+
+    Return:
+    -------
+    (list): Names of the settings that are not supported
+    """
+
+    unsupported_settings = []
+
+    if cfg_par['source_finder'].get('options', None) is not None:
+        unsupported_settings.append("source_finder:options")
+    if cfg_par['source_finder'].get('region', None) is not None:
+        unsupported_settings.append("source_finder:region")
+
+    return unsupported_settings
+
+
+def get_source_name(src_ra, src_dec):
+    """
+    Function to get the J2000 names of sources (without the leading J) from their sexagesimal coordinates
+    """
+
+    return np.array(["{0}{1}".format(ra.replace(':', ''), dec.replace(':', '')) for ra, dec in zip(src_ra, src_dec)])
+
+
+def find_sources(cont_file, clip=0.01):
+    """
+    Function to find the sources in a continuum image
+
+    Args:
+    -----
+    cont_file (str): Path of the continuum image
+    clip (float): Pixels above this flux density in Jy belong to sources. Default 0.01
+
+    Return:
+    -------
+    (Table): The sources in the format of SHARPener
+    """
+
+    logger.info("Finding sources in {}".format(cont_file))
+
+    with fits.open(cont_file, memmap=True) as hdul:
+        header = hdul[0].header
+        cont_data = np.squeeze(hdul[0].data)
+        if cont_data.ndim != 2:
+            error = "Continuum image {} has more than one plane".format(
+                cont_file)
+            logger.error(error)
+            raise RuntimeError(error)
+
+        # NaN values are not part of any source
+        with np.errstate(invalid='ignore'):
+            src_mask = cont_data > clip
+
+        island_label, n_src = ndimage.label(src_mask)
+
+        if n_src == 0:
+            logger.warning("Did not find any sources in {}".format(cont_file))
+            src_index = np.zeros(0, dtype=int)
+            peak_flux = flux_int = np.zeros(0)
+            pixel_x = pixel_y = np.zeros(0, dtype=int)
+            src_flag = np.zeros(0, dtype=str)
+        else:
+            src_index = np.arange(1, n_src + 1)
+
+            peak_flux = np.array(ndimage.maximum(
+                cont_data, island_label, src_index))
+            peak_position = np.array(ndimage.maximum_position(
+                cont_data, island_label, src_index))
+            pixel_y = peak_position[:, 0]
+            pixel_x = peak_position[:, 1]
+
+            # the integrated flux requires the size of the beam in pixels
+            island_sum = np.array(ndimage.sum(
+                cont_data, island_label, src_index))
+            if 'BMAJ' in header and 'BMIN' in header:
+                beam_area = np.pi / (4. * np.log(2.)) * header['BMAJ'] * header['BMIN'] / np.abs(
+                    header['CDELT1'] * header['CDELT2'])
+                flux_int = island_sum / beam_area
+            else:
+                logger.warning(
+                    "No beam information in {}. Integrated flux is not available".format(cont_file))
+                flux_int = np.full(n_src, np.nan)
+
+            # sources touching the edge of the image may be cut off
+            edge_label = np.unique(np.concatenate([island_label[0], island_label[-1],
+                                                   island_label[:, 0], island_label[:, -1]]))
+            src_flag = np.where(np.in1d(src_index, edge_label),
+                                EDGE_FLAG, NO_FLAG)
+
+        ra, dec = WCS(header).celestial.wcs_pix2world(pixel_x, pixel_y, 0)
+
+    src_coord = SkyCoord(ra, dec, unit=units.deg, frame='fk5')
+    src_ra = src_coord.ra.to_string(
+        unit=units.hourangle, sep=':', precision=3, pad=True)
+    src_dec = src_coord.dec.to_string(
+        sep=':', precision=2, alwayssign=True, pad=True)
+    src_name = get_source_name(src_ra, src_dec)
+
+    # sources are sorted by their name as by SHARPener
+    src_order = np.argsort(src_name, kind='mergesort')
+
+    src_table = Table([np.arange(1, n_src + 1), src_name[src_order], src_ra[src_order], src_dec[src_order],
+                       peak_flux[src_order], flux_int[src_order],
+                       np.full(n_src, np.nan), np.full(
+                           n_src, np.nan), np.full(n_src, np.nan),
+                       np.full(n_src, NO_FLAG), np.full(n_src, NO_FLAG), src_flag[src_order],
+                       pixel_x[src_order] + 1, pixel_y[src_order] + 1],
+                      names=SHARPENER_SOURCE_COLUMNS)
+
+    logger.info("Finding sources in {0} ... Done ({1} sources)".format(
+        cont_file, n_src))
+
+    return src_table
+
+
+def find_sources_sharpener(cfg_par):
+    """
+    Function to find the sources with the settings of SHARPener and write the source file
+
+    The paths in the settings are relative to the current working directory.
+
+    Return:
+    -------
+    (Table): The sources
+    """
+
+    workdir = cfg_par['general']['workdir']
+
+    src_table = find_sources(os.path.join(workdir, cfg_par['general']['contname']),
+                             clip=cfg_par['source_finder']['clip'])
+
+    abs_dir = os.path.join(workdir, "sharpOut/abs")
+    if not os.path.exists(abs_dir):
+        os.makedirs(abs_dir)
+
+    src_table.write(os.path.join(abs_dir, "mir_src_sharp.csv"),
+                    format="ascii.csv", overwrite=True)
+
+    return src_table
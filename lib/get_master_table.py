@@ -2,21 +2,156 @@ import os
 import numpy as np
 import glob
 import logging
-import datetime
-import shutil
 from astropy.table import Table, vstack, hstack, Column
 import astropy.units as units
 from astropy.coordinates import SkyCoord
+from multiprocessing.pool import ThreadPool
+
+from lib.master_table_store import MasterTableStore, get_master_table_store, get_master_table_store_file
+from lib.table_history import TableHistory, write_table_file
 
 logger = logging.getLogger(__name__)
 
 
-def get_all_sources_of_cube(output_file_name, cube_dir, taskid=None, cube_nr=None, beam_list=None, src_file="radio_sdss_src_match.csv", alt_src_file="mir_src_sharp.csv", overwrite_master_table=False, create_master_table_backup=True, allow_multiple_source_entries=False):
+def read_beam_sources(cube_dir, beam, src_file="radio_sdss_src_match.csv", alt_src_file="mir_src_sharp.csv"):
     """
-    Function to collect the information from all sources in one file
+    Function to read the sources of a beam
 
     Use the radio-SDSS source file or the source file without SDSS,
     but then add SDSS columns.
+
+    Return:
+    -------
+    (Table): The sources of the beam. None if there is no source file
+    """
+
+    logger.debug("Processing beam {}".format(beam))
+
+    # set the file name for this beam
+    csv_file_name = os.path.join(
+        cube_dir, "{0}/sharpOut/abs/{1}".format(beam, src_file))
+
+    # make sure the file exists
+    if not os.path.exists(csv_file_name):
+        logger.warning(
+            "Could not find source file {} from radio-sdss cross-match by SHARPener.".format(csv_file_name))
+        # alternative source file
+        alt_csv_file_name = os.path.join(
+            cube_dir, "{0}/sharpOut/abs/{1}".format(beam, alt_src_file))
+        logger.warning("Checking alternative source file {} and adding emtpy SDSS columns".format(
+            alt_csv_file_name))
+        if not os.path.exists(alt_csv_file_name):
+            logger.error(
+                "Did not find alternative source file. No source information available for beam {}".format(beam))
+            return None
+        # read in file
+        src_data = Table.read(alt_csv_file_name, format="ascii.csv")
+        # get number of sources
+        n_src = np.size(src_data['ID'])
+        # add sdss columns
+        src_data['sdss_id'] = Column(np.zeros(n_src), dtype=int)
+        src_data['sdss_ra'] = Column(np.zeros(n_src))
+        src_data['sdss_dec'] = Column(np.zeros(n_src))
+        src_data['sdss_radio_sep'] = Column(np.zeros(n_src))
+        src_data['sdss_redshift'] = Column(np.zeros(n_src))
+    else:
+        # read the data
+        src_data = Table.read(csv_file_name, format="ascii.csv")
+        # number of sources
+        n_src = np.size(src_data['ID'])
+
+    logger.debug("Found {} sources".format(n_src))
+
+    # rename the ID column
+    src_data.rename_column('ID', 'Beam_Source_ID')
+
+    # fix the column type
+    src_data['FFLAG'] = np.array(["{}".format(flag)
+                                  for flag in src_data['FFLAG']], dtype=str)
+
+    logger.debug("Processing beam {} ... Done".format(beam))
+
+    return src_data
+
+
+def get_source_ids(taskid, cube_nr, beam, src_data):
+    """
+    Function to create the IDs of the sources of a beam
+
+    Return:
+    -------
+    (ndarray): IDs of the form <taskid>_C<cube>_B<beam>_<nr>_J<J2000>
+    """
+
+    src_nr = np.char.zfill(
+        np.array(src_data['Beam_Source_ID']).astype(str), 3)
+
+    return np.char.add(np.char.add("{0}_C{1}_B{2}_".format(taskid, cube_nr, beam.zfill(2)), src_nr),
+                       np.char.add("_J", np.array(src_data['J2000']).astype(str)))
+
+
+def get_master_table_history(output_file_name, cube_dir, max_versions=None):
+    """
+    Function to get the history of the master table in the backup directory of the cube
+    """
+
+    return TableHistory(os.path.join(cube_dir, "master_table_backup"), output_file_name, max_versions=max_versions)
+
+
+def update_master_table_store(output_file_name, cube_dir, cube_nr, full_list, overwrite_master_table=False, allow_multiple_source_entries=False):
+    """
+    Function to add the sources of a cube to the master table store
+
+    Only the rows of the beams in the new table are replaced. A master table
+    that was only kept in the csv file so far is imported into the store first.
+    The versions of the master table are added to its history when the store
+    is exported to the csv file.
+    """
+
+    if np.size(full_list) == 0:
+        error = "Table with all sources is emtpy. Abort"
+        logger.error(error)
+        logger.error("Collecting source information from beams ... Failed")
+        raise RuntimeError(error)
+
+    if overwrite_master_table:
+        store = MasterTableStore(get_master_table_store_file(output_file_name))
+    else:
+        store = get_master_table_store(output_file_name)
+
+    # check if master table already exists
+    if store.exists():
+        logger.info("Master table already exists.")
+
+        # overwrite existing master table or add new data
+        if overwrite_master_table:
+            logger.warning("Existing master table will be overwritten")
+            store.overwrite(full_list)
+        elif allow_multiple_source_entries:
+            logger.warning(
+                "Adding new sources without checking if they already exists. Source ID may not be unique any more.")
+            store.append(full_list)
+        else:
+            logger.info("Adding new sources to existing master table")
+            store.replace_beams(cube_nr, full_list)
+    else:
+        store.overwrite(full_list)
+
+
+def get_all_sources_of_cube(output_file_name, cube_dir, taskid=None, cube_nr=None, beam_list=None, src_file="radio_sdss_src_match.csv", alt_src_file="mir_src_sharp.csv", overwrite_master_table=False, create_master_table_backup=True, allow_multiple_source_entries=False, n_threads=8, master_table_engine="csv", table_history_max_versions=None):
+    """
+    Function to collect the information from all sources in one file
+
+    Use the radio-SDSS source file or the source file without SDSS,
+    but then add SDSS columns. The source files of the beams are read
+    concurrently by n_threads threads and combined at once.
+
+    With master_table_engine="sqlite", the sources are kept in the master
+    table store instead of the csv file.
+
+    With create_master_table_backup, the current master table is added to the
+    history of the master table that keeps table_history_max_versions versions.
+    For the store, this is done when it is exported to the csv file.
     """
 
     # if the cube number was not given, try to get from the name
@@ -41,92 +176,57 @@ def get_all_sources_of_cube(output_file_name, cube_dir, taskid=None, cube_nr=Non
         beam_list.sort()
         beam_list = np.array([os.path.basename(beam) for beam in beam_list])
 
-    # for storing the full list:
-    full_list = []
-
-    # go through the list of beams
-    for beam in beam_list:
-
-        logger.debug("Processing beam {}".format(beam))
-
-        # set the file name for this beam
-        csv_file_name = os.path.join(
-            cube_dir, "{0}/sharpOut/abs/{1}".format(beam, src_file))
-
-        # make sure the file exists
-        if not os.path.exists(csv_file_name):
-            logger.warning(
-                "Could not find source file {} from radio-sdss cross-match by SHARPener.".format(csv_file_name))
-            # alternative source file
-            alt_csv_file_name = os.path.join(
-                cube_dir, "{0}/sharpOut/abs/{1}".format(beam, alt_src_file))
-            logger.warning("Checking alternative source file {} and adding emtpy SDSS columns".format(
-                alt_csv_file_name))
-            if not os.path.exists(alt_csv_file_name):
-                logger.error(
-                    "Did not find alternative source file. No source information available for beam {}".format(beam))
-                continue
-            # read in file
-            src_data = Table.read(alt_csv_file_name, format="ascii.csv")
-            # get number of sources
-            n_src = np.size(src_data['ID'])
-            # add sdss columns
-            src_data['sdss_id'] = Column(np.zeros(n_src), dtype=int)
-            src_data['sdss_ra'] = Column(np.zeros(n_src))
-            src_data['sdss_dec'] = Column(np.zeros(n_src))
-            src_data['sdss_radio_sep'] = Column(np.zeros(n_src))
-            src_data['sdss_redshift'] = Column(np.zeros(n_src))
-        else:
-            # read the data
-            src_data = Table.read(csv_file_name, format="ascii.csv")
-            # number of sources
-            n_src = np.size(src_data['ID'])
-
-        logger.debug("Found {} sources".format(n_src))
+    # read the source files of all beams concurrently
+    pool = ThreadPool(processes=max(min(n_threads, len(beam_list)), 1))
+    try:
+        src_data_list = pool.map(lambda beam: read_beam_sources(
+            cube_dir, beam, src_file, alt_src_file), beam_list)
+    finally:
+        pool.close()
+        pool.join()
 
-        # rename the ID column
-        src_data.rename_column('ID', 'Beam_Source_ID')
+    src_beam_list = [beam for beam, src_data in zip(
+        beam_list, src_data_list) if src_data is not None]
+    src_data_list = [
+        src_data for src_data in src_data_list if src_data is not None]
 
-        # fix the column type
-        src_data['FFLAG'] = np.array(["{}".format(flag)
-                                      for flag in src_data['FFLAG']], dtype=str)
+    # for storing the full list:
+    full_list = []
 
+    if len(src_data_list) != 0:
         # create a new columns for ID, taskid, beam and cube
-        src_id = np.array(["{0}_C{1}_B{2}_{3}_J{4}".format(
-            taskid, cube_nr, beam.zfill(2), str(src_data['Beam_Source_ID'][k]).zfill(3), src_data['J2000'][k]) for k in range(n_src)])
-        src_beam = np.array([int(beam) for i in range(n_src)])
-        src_cube = np.array([int(cube_nr) for i in range(n_src)])
+        src_id = np.concatenate([get_source_ids(taskid, cube_nr, beam, src_data)
+                                 for beam, src_data in zip(src_beam_list, src_data_list)])
+        src_beam = np.concatenate([np.full(len(src_data), int(beam), dtype=int)
+                                   for beam, src_data in zip(src_beam_list, src_data_list)])
+        src_cube = np.full(np.size(src_beam), int(cube_nr), dtype=int)
 
         # create a new table with these three columns
         new_table = Table([src_id, src_cube, src_beam],
                           names=["Source_ID", "Cube", "Beam"])
 
-        # merge with source table
-        new_src_table = hstack([new_table, src_data])
+        # merge all beams at once and with the new columns
+        full_list = hstack([new_table, vstack(src_data_list)])
 
-        # merge with full list
-        if np.size(full_list) == 0:
-            full_list = new_src_table
-        else:
-            full_list = vstack([full_list, new_src_table])
-
-        logger.debug("Processing beam {} ... Done".format(beam))
+    # the master table is kept in the store
+    if master_table_engine == "sqlite":
+        update_master_table_store(output_file_name, cube_dir, cube_nr, full_list, overwrite_master_table=overwrite_master_table,
+                                  allow_multiple_source_entries=allow_multiple_source_entries)
+        logger.info("Collecting source information from beams ... Done")
+        return
+    elif master_table_engine != "csv":
+        error = "Unknown master table engine {}".format(master_table_engine)
+        logger.error(error)
+        raise RuntimeError(error)
 
     # check if master table already exists
     if os.path.exists(output_file_name):
         logger.info("Master table already exists.")
 
-        # create a copy in the backup directory
+        # add the current master table to the history
         if create_master_table_backup:
-            table_backup_dir = os.path.join(
-                cube_dir, "master_table_backup")
-            if not os.path.exists(table_backup_dir):
-                os.mkdir(table_backup_dir)
-            table_backup_name = os.path.join(table_backup_dir, os.path.basename(output_file_name).replace(
-                ".csv", "_{}.csv".format(datetime.datetime.now().strftime("%Y%m%d_%H%M%S"))))
-            logger.info("Creating a copy of current master table in {}".format(
-                table_backup_name))
-            shutil.copy2(output_file_name, table_backup_name)
+            get_master_table_history(
+                output_file_name, cube_dir, max_versions=table_history_max_versions).add_version()
 
         # overwrite existing master table or add new data
         if overwrite_master_table:
@@ -169,7 +269,7 @@ def get_all_sources_of_cube(output_file_name, cube_dir, taskid=None, cube_nr=Non
 
     # save the file if there is something to save
     if np.size(full_list) != 0:
-        full_list.write(output_file_name, format="ascii.csv", overwrite=True)
+        write_table_file(full_list, output_file_name)
         logger.info("Collecting source information from beams ... Done")
     else:
         error = "Table with all sources is emtpy. Abort"
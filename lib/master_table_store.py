@@ -0,0 +1,486 @@
+"""
+Functionality to keep the master table of a cube in a SQLite database
+
+The master table in a csv file has to be read and written completely by every
+step (get_master_table, match_sources, analyse_sources). In the store
+(<taskid>_cube_<N>_master_table.sqlite next to the csv file), the sources are
+kept in a single table with indexes on Source_ID and on Cube and Beam.
+Replacing the sources of a beam only deletes and inserts the rows of the beam
+and the steps that add columns only update these columns.
+
+The rows are read in the order of Source_ID as in the merged csv file.
+The csv file is exported from the store on demand.
+"""
+
+import os
+import sqlite3
+import logging
+import contextlib
+import numpy as np
+from astropy.table import Table, MaskedColumn
+
+from lib.table_history import write_table_file
+
+logger = logging.getLogger(__name__)
+
+# name of the table with the sources in the database
+MASTER_TABLE_NAME = "sources"
+
+# key in the meta data of a table read from the store with the row of every source
+MASTER_TABLE_ROW_ID = "master_table_store_row_id"
+
+# seconds to wait for other processes writing to the store
+MASTER_TABLE_TIMEOUT = 600.
+
+
+def get_master_table_store_file(src_cat_file):
+    """
+    Function to return the path of the store for a master table csv file
+    """
+
+    return "{}.sqlite".format(os.path.splitext(src_cat_file)[0])
+
+
+def get_column_type(column):
+    """
+    Function to get the type of a column in the database for a table column
+    """
+
+    if column.dtype.kind in ['i', 'u', 'b']:
+        return "INTEGER"
+    elif column.dtype.kind == 'f':
+        return "REAL"
+    else:
+        return "TEXT"
+
+
+def get_column_values(column):
+    """
+    Function to convert a table column into a list of values for the database
+
+    Masked values are stored as NULL.
+    """
+
+    if column.dtype.kind in ['S', 'U']:
+        values = [str(value) for value in np.array(column)]
+    else:
+        values = np.array(column).tolist()
+
+    if hasattr(column, 'mask'):
+        return [None if masked else value for masked, value in zip(np.ma.getmaskarray(column), values)]
+
+    return values
+
+
+def quote(name):
+    """
+    Function to quote the name of a column for the database
+    """
+
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+@contextlib.contextmanager
+def connect_database(db_file, write=False, timeout=MASTER_TABLE_TIMEOUT):
+    """
+    Function to open a connection to a SQLite database for a transaction
+
+    The transaction is committed at the end of the context or rolled back on errors.
+    Changes of the columns are part of the transaction. A transaction that
+    writes locks the database from the start so that several processes can write
+    to the same database.
+
+    Args:
+    -----
+    db_file (str): Database file
+    write (bool): The transaction writes to the database. Default False
+    timeout (float): Seconds to wait for other processes writing to the database
+    """
+
+    connection = sqlite3.connect(
+        db_file, timeout=timeout, isolation_level=None)
+    try:
+        if write:
+            connection.execute("BEGIN IMMEDIATE")
+        else:
+            connection.execute("BEGIN")
+        try:
+            yield connection
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        else:
+            connection.execute("COMMIT")
+    finally:
+        connection.close()
+
+
+def get_table_columns(connection, table_name):
+    """
+    Function to get the names and types of the columns of a table in a database
+
+    Return:
+    -------
+    (list): Name and type of every column. Empty if there is no table
+    """
+
+    return [(str(column[1]), str(column[2])) for column in connection.execute(
+        "PRAGMA table_info({})".format(quote(table_name)))]
+
+
+def get_table_from_rows(db_columns, rows):
+    """
+    Function to convert rows of a database into a table
+
+    NULL values are masked.
+
+    Args:
+    -----
+    db_columns (list): Name and type of every column
+    rows (list): Values of the columns of every row
+
+    Return:
+    -------
+    (Table): The rows
+    """
+
+    if len(rows) == 0:
+        col_values = [[] for k in range(len(db_columns))]
+    else:
+        col_values = zip(*rows)
+
+    columns = []
+    for (col_name, col_type), values in zip(db_columns, col_values):
+        mask = np.array([value is None for value in values], dtype=bool)
+        try:
+            if col_type == "INTEGER":
+                data = np.array(
+                    [0 if value is None else value for value in values], dtype=int)
+            elif col_type == "REAL":
+                data = np.array(
+                    [0. if value is None else value for value in values], dtype=float)
+            else:
+                data = None
+        except (ValueError, TypeError):
+            # values that do not have the type of the column
+            data = None
+        if data is None:
+            data = np.array(["" if value is None else unicode(value).encode(
+                "utf-8") for value in values], dtype=str)
+        if np.any(mask):
+            columns.append(MaskedColumn(data, name=col_name, mask=mask))
+        else:
+            columns.append(data)
+
+    return Table(columns, names=[col_name for col_name, col_type in db_columns],
+                 masked=any([isinstance(column, MaskedColumn) for column in columns]))
+
+
+def add_table_columns(connection, table_name, src_data, col_names):
+    """
+    Function to add columns of a table to a table in a database
+
+    The table in the database is created if it does not exist. Columns
+    that the table in the database already has are not changed.
+    """
+
+    db_col_names = [col_name for col_name,
+                    col_type in get_table_columns(connection, table_name)]
+
+    if len(db_col_names) == 0:
+        connection.execute("CREATE TABLE {0} ({1})".format(quote(table_name), ", ".join(
+            ["{0} {1}".format(quote(col_name), get_column_type(src_data[col_name])) for col_name in col_names])))
+        return
+
+    for col_name in col_names:
+        if col_name not in db_col_names:
+            connection.execute("ALTER TABLE {0} ADD COLUMN {1} {2}".format(
+                quote(table_name), quote(col_name), get_column_type(src_data[col_name])))
+
+
+def create_table_index(connection, table_name, col_names):
+    """
+    Function to create an index on columns of a table in a database if it does not exist
+
+    The table needs to exist.
+    """
+
+    connection.execute("CREATE INDEX IF NOT EXISTS {0} ON {1} ({2})".format(quote("{0}_{1}".format(table_name, "_".join(col_names).lower())),
+                                                                          quote(table_name), ", ".join([quote(col_name) for col_name in col_names])))
+
+
+def insert_rows(connection, table_name, src_data):
+    """
+    Function to insert the rows of a table into a table in a database
+
+    Columns that the table in the database does not have yet are added.
+    """
+
+    add_table_columns(connection, table_name, src_data, src_data.colnames)
+
+    if len(src_data) == 0:
+        return
+
+    connection.executemany("INSERT INTO {0} ({1}) VALUES ({2})".format(quote(table_name), ", ".join([quote(col_name) for col_name in src_data.colnames]), ", ".join(["?" for col_name in src_data.colnames])),
+                           zip(*[get_column_values(src_data[col_name]) for col_name in src_data.colnames]))
+
+
+class MasterTableStore(object):
+    """
+    Class to read and update the master table of a cube in a SQLite database
+
+    Args:
+    -----
+    store_file (str): Database file of the master table
+    """
+
+    def __init__(self, store_file):
+        self.store_file = store_file
+
+    def exists(self):
+        """
+        Function to check if the store exists and has sources
+        """
+
+        if not os.path.exists(self.store_file):
+            return False
+
+        return len(self.get_columns()) != 0
+
+    def connect(self, write=False):
+        """
+        Function to open a connection to the database for a transaction
+        """
+
+        return connect_database(self.store_file, write=write)
+
+    def get_columns(self, connection=None):
+        """
+        Function to get the names and types of the columns of the master table
+
+        Return:
+        -------
+        (list): Name and type of every column. Empty if there is no table
+        """
+
+        if connection is None:
+            with self.connect() as connection:
+                return self.get_columns(connection=connection)
+
+        return get_table_columns(connection, MASTER_TABLE_NAME)
+
+    def insert(self, connection, src_data):
+        """
+        Function to insert the sources of a table into the master table
+
+        The master table and its indexes are created for the first sources.
+        """
+
+        insert_rows(connection, MASTER_TABLE_NAME, src_data)
+
+        create_table_index(connection, MASTER_TABLE_NAME, ["Source_ID"])
+        create_table_index(connection, MASTER_TABLE_NAME, ["Cube", "Beam"])
+
+    def replace_beams(self, cube_nr, src_data):
+        """
+        Function to replace the sources of the beams in a table
+
+        All sources of the cube from the beams in the table are removed
+        from the master table before the sources of the table are added.
+        """
+
+        with self.connect(write=True) as connection:
+            if len(self.get_columns(connection=connection)) != 0:
+                for beam in np.unique(src_data['Beam']):
+                    n_removed = connection.execute("DELETE FROM {0} WHERE {1} = ? AND {2} = ?".format(
+                        quote(MASTER_TABLE_NAME), quote("Cube"), quote("Beam")), (int(cube_nr), int(beam))).rowcount
+                    if n_removed != 0:
+                        logger.warning(
+                            "Found data for beam {}. Will be replaced".format(beam))
+            self.insert(connection, src_data)
+
+    def append(self, src_data):
+        """
+        Function to add the sources of a table without removing any sources
+        """
+
+        with self.connect(write=True) as connection:
+            self.insert(connection, src_data)
+
+    def overwrite(self, src_data):
+        """
+        Function to replace all sources and columns of the master table by a table
+        """
+
+        with self.connect(write=True) as connection:
+            connection.execute(
+                "DROP TABLE IF EXISTS {}".format(quote(MASTER_TABLE_NAME)))
+            self.insert(connection, src_data)
+
+    def import_csv(self, csv_file):
+        """
+        Function to create the master table from a csv file
+
+        Nothing is imported if the store has sources already.
+
+        Return:
+        -------
+        (bool): True if the csv file was imported
+        """
+
+        with self.connect(write=True) as connection:
+            if len(self.get_columns(connection=connection)) != 0:
+                return False
+
+            logger.info("Importing master table {0} into {1}".format(
+                csv_file, self.store_file))
+
+            self.insert(connection, Table.read(csv_file, format="ascii.csv"))
+
+        logger.info("Importing master table {0} into {1} ... Done".format(
+            csv_file, self.store_file))
+
+        return True
+
+    def read(self):
+        """
+        Function to read all sources of the master table ordered by Source_ID
+
+        The rows of the sources in the store are kept in the meta data
+        of the table so that columns can be updated later.
+
+        Return:
+        -------
+        (Table): The master table
+        """
+
+        with self.connect() as connection:
+            store_columns = self.get_columns(connection=connection)
+            if len(store_columns) == 0:
+                error = "Could not find master table in {}".format(
+                    self.store_file)
+                logger.error(error)
+                raise RuntimeError(error)
+            rows = connection.execute("SELECT rowid, {0} FROM {1} ORDER BY {2}, rowid".format(", ".join(
+                [quote(col_name) for col_name, col_type in store_columns]), quote(MASTER_TABLE_NAME), quote("Source_ID"))).fetchall()
+
+        src_data = get_table_from_rows(
+            store_columns, [row[1:] for row in rows])
+        src_data.meta[MASTER_TABLE_ROW_ID] = np.array(
+            [row[0] for row in rows], dtype=int)
+
+        return src_data
+
+    def update_columns(self, src_data, col_names):
+        """
+        Function to update columns of the sources of a table read from the store
+
+        Columns that the master table does not have yet are added.
+        """
+
+        row_id = src_data.meta.get(MASTER_TABLE_ROW_ID)
+        if row_id is None or len(row_id) != len(src_data):
+            error = "Table was not read from master table store {}".format(
+                self.store_file)
+            logger.error(error)
+            raise RuntimeError(error)
+
+        with self.connect(write=True) as connection:
+            add_table_columns(connection, MASTER_TABLE_NAME, src_data, col_names)
+            connection.executemany("UPDATE {0} SET {1} WHERE rowid = ?".format(quote(MASTER_TABLE_NAME), ", ".join(["{} = ?".format(quote(col_name)) for col_name in col_names])),
+                                   zip(*([get_column_values(src_data[col_name]) for col_name in col_names] + [row_id.tolist()])))
+
+    def export_csv(self, csv_file):
+        """
+        Function to write the master table to a csv file
+        """
+
+        logger.info("Exporting master table {0} to {1}".format(
+            self.store_file, csv_file))
+
+        write_table_file(self.read(), csv_file)
+
+        logger.info("Exporting master table {0} to {1} ... Done".format(
+            self.store_file, csv_file))
+
+
+def get_master_table_store(src_cat_file):
+    """
+    Function to get the master table store of a cube
+
+    A master table that was only kept in the csv file so far,
+    e.g., before switching to the store, is imported into the store.
+
+    Return:
+    -------
+    (MasterTableStore): The store of the master table
+    """
+
+    store = MasterTableStore(get_master_table_store_file(src_cat_file))
+
+    if not store.exists() and os.path.exists(src_cat_file):
+        store.import_csv(src_cat_file)
+
+    return store
+
+
+def master_table_exists(src_cat_file, master_table_engine="csv"):
+    """
+    Function to check if the master table of a cube exists
+
+    For the store, a csv file that is imported on the first read also counts.
+
+    Args:
+    -----
+    src_cat_file (str): Csv file of the master table
+    master_table_engine (str): Keep the master table in a csv file ("csv") or a SQLite store ("sqlite"). Default csv
+    """
+
+    if master_table_engine == "sqlite":
+        return MasterTableStore(get_master_table_store_file(src_cat_file)).exists() or os.path.exists(src_cat_file)
+
+    return os.path.exists(src_cat_file)
+
+
+def read_master_table(src_cat_file, master_table_engine="csv"):
+    """
+    Function to read the master table of a cube
+
+    Return:
+    -------
+    (Table): The master table
+    """
+
+    if master_table_engine == "sqlite":
+        return get_master_table_store(src_cat_file).read()
+    elif master_table_engine == "csv":
+        return Table.read(src_cat_file, format="ascii.csv")
+    else:
+        error = "Unknown master table engine {}".format(master_table_engine)
+        logger.error(error)
+        raise RuntimeError(error)
+
+
+def write_master_table_columns(src_cat_file, src_data, col_names, master_table_engine="csv"):
+    """
+    Function to write a master table that got new columns
+
+    The csv file is written completely. In the store, only the new columns are updated.
+
+    Args:
+    -----
+    src_cat_file (str): Csv file of the master table
+    src_data (Table): The master table as read by read_master_table with the new columns
+    col_names (list): Names of the new columns
+    master_table_engine (str): Keep the master table in a csv file ("csv") or a SQLite store ("sqlite"). Default csv
+    """
+
+    if master_table_engine == "sqlite":
+        MasterTableStore(get_master_table_store_file(
+            src_cat_file)).update_columns(src_data, col_names)
+    elif master_table_engine == "csv":
+        write_table_file(src_data, src_cat_file)
+    else:
+        error = "Unknown master table engine {}".format(master_table_engine)
+        logger.error(error)
+        raise RuntimeError(error)
@@ -0,0 +1,201 @@
+"""
+Functionality to estimate the memory needed by sharpener for a beam
+
+The peak memory of a beam is estimated from the size of its cube given
+by the header (NAXIS1-3 and BITPIX) as an overhead plus a multiple of the
+size of the cube in memory. The peak memory (resident set size) of every
+beam processed by sharpener in its own process is recorded in a json file.
+This is the peak memory of the process minus the memory of the process
+when it started the beam, which includes the memory of the parent process. Once there are
+records, the multiple of the cube size is taken from them so that the
+estimates adjust to the memory sharpener actually needs.
+
+The file is locked during every update so that several runs can use it at the same time.
+"""
+
+import os
+import json
+import fcntl
+import logging
+import resource
+from time import time
+import numpy as np
+from astropy.io import fits
+
+logger = logging.getLogger(__name__)
+
+# number of recent records used for the estimate
+MEMORY_USAGE_N_RECORDS = 100
+
+
+def get_cube_memory(cube_file):
+    """
+    Function to return the size of a cube in memory based on its header
+
+    Args:
+    -----
+    cube_file (str): Path of the cube
+
+    Return:
+    -------
+    (int): Size in bytes. 0 if the cube does not exist or the header cannot be read
+    """
+
+    if not os.path.exists(cube_file):
+        return 0
+
+    try:
+        header = fits.getheader(cube_file)
+    except Exception as e:
+        logger.warning(
+            "Could not read the header of {}. Size of cube is unknown".format(cube_file))
+        logger.warning(e)
+        return 0
+
+    n_pixels = np.prod([header.get('NAXIS{}'.format(k + 1), 1)
+                        for k in range(min(header['NAXIS'], 3))])
+
+    n_bytes_pixel = np.abs(header['BITPIX']) // 8
+
+    # scaled integers are converted to floats when the data is read
+    if header['BITPIX'] > 0 and ('BSCALE' in header or 'BZERO' in header):
+        n_bytes_pixel = max(n_bytes_pixel * 2, 4)
+
+    return int(n_pixels * n_bytes_pixel)
+
+
+def get_peak_memory():
+    """
+    Function to return the peak memory (resident set size) of the current process in bytes
+
+    A forked process starts with the memory of its parent.
+    """
+
+    # linux reports the size in kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_current_memory():
+    """
+    Function to return the current memory (resident set size) of the current process in bytes
+
+    Return:
+    -------
+    (int): The memory. 0 if it is not known (only available on linux)
+    """
+
+    try:
+        with open("/proc/self/statm") as stream:
+            return int(stream.read().split()[1]) * resource.getpagesize()
+    except (IOError, ValueError, IndexError):
+        return 0
+
+
+class MemoryEstimate(object):
+    """
+    Class to estimate the peak memory of a beam and to record the actual peak memory
+
+    Args:
+    -----
+    usage_file (str): Json file with the recorded peak memory. None to not record it
+    overhead (float): Memory needed by sharpener independent of the cube in GB. Default 0.5
+    factor (float): Multiple of the cube size needed by sharpener if
+        there are no records. Default 3.
+    """
+
+    def __init__(self, usage_file=None, overhead=0.5, factor=3.):
+        self.usage_file = usage_file
+        self.overhead = overhead * 1024.**3
+        self.factor = factor
+
+        self.record_list = []
+
+        if usage_file is not None and os.path.exists(usage_file):
+            try:
+                with open(usage_file) as stream:
+                    self.record_list = json.load(stream)
+            except Exception as e:
+                logger.warning(
+                    "Could not read recorded memory usage from {}".format(usage_file))
+                logger.warning(e)
+
+        self.factor = self.get_factor()
+
+    def get_factor(self):
+        """
+        Function to get the multiple of the cube size from the recorded memory usage
+
+        The largest multiple of the recent records is used to stay on the safe side.
+        """
+
+        factor_list = [(record['peak_memory'] - self.overhead) / float(record['cube_memory'])
+                       for record in self.record_list[-MEMORY_USAGE_N_RECORDS:] if record['cube_memory'] > 0]
+
+        if len(factor_list) == 0:
+            return self.factor
+
+        # at least the cube itself has to fit into memory
+        return max(np.max(factor_list), 1.)
+
+    def estimate(self, cube_file):
+        """
+        Function to estimate the peak memory of a beam in bytes
+
+        Args:
+        -----
+        cube_file (str): Path of the cube of the beam
+        """
+
+        return self.overhead + self.factor * get_cube_memory(cube_file)
+
+    def record(self, cube_file, peak_memory, estimated_memory=None):
+        """
+        Function to add the peak memory of a beam to the records
+
+        Args:
+        -----
+        cube_file (str): Path of the cube of the beam
+        peak_memory (int): Peak memory of the beam in bytes
+        estimated_memory (float): The estimate for the beam in bytes. Default None
+        """
+
+        record = {'cube_file': cube_file,
+                  'cube_memory': get_cube_memory(cube_file),
+                  'peak_memory': peak_memory,
+                  'estimated_memory': estimated_memory,
+                  'time': time()}
+
+        if estimated_memory is not None and peak_memory > estimated_memory:
+            logger.warning("Peak memory of {0:.2f} GB for {1} exceeded the estimate of {2:.2f} GB".format(
+                peak_memory / 1024.**3, cube_file, estimated_memory / 1024.**3))
+
+        if self.usage_file is None:
+            self.record_list.append(record)
+            self.factor = self.get_factor()
+            return
+
+        try:
+            with open("{}.lock".format(self.usage_file), 'a') as lock_stream:
+                fcntl.flock(lock_stream.fileno(), fcntl.LOCK_EX)
+                try:
+                    # other runs may have added records
+                    if os.path.exists(self.usage_file):
+                        with open(self.usage_file) as stream:
+                            self.record_list = json.load(stream)
+
+                    self.record_list.append(record)
+                    self.record_list = self.record_list[-MEMORY_USAGE_N_RECORDS:]
+
+                    tmp_file = "{}.tmp".format(self.usage_file)
+                    with open(tmp_file, 'w') as stream:
+                        json.dump(self.record_list, stream,
+                                  indent=1, sort_keys=True)
+                    os.rename(tmp_file, self.usage_file)
+                finally:
+                    fcntl.flock(lock_stream.fileno(), fcntl.LOCK_UN)
+        except Exception as e:
+            logger.warning(
+                "Could not record memory usage in {}".format(self.usage_file))
+            logger.warning(e)
+
+        self.factor = self.get_factor()
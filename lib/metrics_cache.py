@@ -0,0 +1,143 @@
+"""
+Functionality to keep the metrics of the spectra from previous analysis runs
+
+The metrics of every spectrum (noise, flux, SNR, ...) are stored in a json
+file together with a signature of the spectrum (e.g., size and modification
+time of the files it was read from) and the settings of the analysis.
+In the next run, only the spectra whose signature has changed are analysed
+again. If the settings change, all spectra are analysed again. The thresholds
+for the candidates are not part of the settings as they are applied to the metrics.
+
+When the cache is written, the spectra that were not part of the run and the
+spectra whose files no longer exist are dropped from the cache.
+"""
+
+import os
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# file with the metrics in the directory of the cube
+METRICS_CACHE_FILE = "analysis_metrics_cache.json"
+
+
+def get_file_signature(file_path):
+    """
+    Function to get the size and the modification time of a file
+
+    Return:
+    -------
+    (list): Size and modification time. None if the file does not exist
+    """
+
+    if not os.path.exists(file_path):
+        return None
+
+    file_stat = os.stat(file_path)
+
+    return [file_stat.st_size, file_stat.st_mtime]
+
+
+class MetricsCache(object):
+    """
+    Class to keep the metrics of the spectra between analysis runs
+
+    Args:
+    -----
+    cache_file (str): Json file with the metrics
+    settings (dict): Settings of the analysis that change the metrics
+    """
+
+    def __init__(self, cache_file, settings):
+        self.cache_file = cache_file
+        self.settings = settings
+
+        self.metrics = {}
+
+        # spectra looked up in this run
+        self.used_keys = set()
+
+        if os.path.exists(cache_file):
+            try:
+                with open(cache_file) as stream:
+                    cache_data = json.load(stream)
+            except Exception as e:
+                logger.warning(
+                    "Could not read metrics cache {}. Analysing all spectra".format(cache_file))
+                logger.warning(e)
+            else:
+                if cache_data['settings'] == settings:
+                    self.metrics = cache_data['metrics']
+                else:
+                    logger.info(
+                        "Settings of the analysis changed. Analysing all spectra")
+
+    def get(self, key, signature):
+        """
+        Function to get the metrics of a spectrum
+
+        Args:
+        -----
+        key (str): Key of the spectrum
+        signature (list): Signature of the spectrum
+
+        Return:
+        -------
+        (list): The metrics. None if they are not cached or the spectrum has changed
+        """
+
+        self.used_keys.add(key)
+
+        entry = self.metrics.get(key)
+
+        if entry is None or entry['signature'] != signature:
+            return None
+
+        # the files of the spectrum no longer exist
+        if not any([file_signature is not None for file_signature in signature]):
+            return None
+
+        return entry['metrics']
+
+    def set(self, key, signature, metrics):
+        """
+        Function to store the metrics of a spectrum
+        """
+
+        self.used_keys.add(key)
+
+        self.metrics[key] = {'signature': signature,
+                             'metrics': [float(metric) for metric in metrics]}
+
+    def prune(self):
+        """
+        Function to drop the spectra that were not looked up or whose files no longer exist
+
+        Return:
+        -------
+        (int): Number of spectra dropped from the cache
+        """
+
+        n_metrics = len(self.metrics)
+
+        self.metrics = dict([(key, entry) for key, entry in self.metrics.items()
+                             if key in self.used_keys and any([file_signature is not None for file_signature in entry['signature']])])
+
+        return n_metrics - len(self.metrics)
+
+    def write(self):
+        """
+        Function to write the metrics to the cache file
+        """
+
+        n_dropped = self.prune()
+        if n_dropped != 0:
+            logger.info("Dropped {0} spectra that no longer exist from metrics cache {1}".format(
+                n_dropped, self.cache_file))
+
+        tmp_file = "{}.tmp".format(self.cache_file)
+        with open(tmp_file, 'w') as stream:
+            json.dump({'settings': self.settings,
+                       'metrics': self.metrics}, stream, sort_keys=True)
+        os.rename(tmp_file, self.cache_file)
@@ -0,0 +1,222 @@
+"""
+Functionality to collect the results of tasks passed to a pool of processes
+
+The callbacks of apply_async are only called for tasks that were
+successful and Python 2 has no callback for failed tasks. Waiting for
+a callback would block forever if a task could not be pickled, raised
+an error or if its worker process was killed (e.g., by the OOM killer).
+Instead, the AsyncResult of every task is kept and polled. Failed tasks
+are reported with their error. The pool never finishes a task whose
+worker was killed, so once only as many tasks are left as workers were
+killed, these tasks are reported as failed, too.
+
+If the cores are shared with other processes (e.g., other taskids), a
+core is taken from the shared semaphore by the parent process before a
+task is added and given back once the task is finished, failed or was
+given up. A killed worker can therefore not take a core with it.
+"""
+
+import logging
+from time import time
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTask(object):
+    """
+    Class to describe a task passed to the pool
+
+    Args:
+    -----
+    key: Anything to identify the task
+    async_result (AsyncResult): Returned by apply_async for the task
+    has_core (bool): True if the task holds one of the shared cores
+    """
+
+    def __init__(self, key, async_result, has_core):
+        self.key = key
+        self.async_result = async_result
+        self.has_core = has_core
+
+        # set if the worker of the task was killed
+        self.lost = False
+
+
+class PoolResults(object):
+    """
+    Class to keep track of the tasks running in a pool of processes
+
+    Args:
+    -----
+    pool (Pool): The pool of processes
+    poll_interval (float): Time in seconds between checks of the tasks. Default 1.
+    core_semaphore (Semaphore): Semaphore of the cores shared with other processes.
+        Default None if the cores are not shared
+    """
+
+    def __init__(self, pool, poll_interval=1., core_semaphore=None):
+        self.pool = pool
+        self.poll_interval = poll_interval
+        self.core_semaphore = core_semaphore
+
+        # tasks that were not collected yet
+        self._tasks = []
+
+        # worker processes that were seen running
+        self._workers = set()
+
+        # worker processes that ended, as the pool keeps them in its list for a moment
+        self._ended_workers = set()
+
+        # number of killed workers whose task was not given up yet
+        self._n_killed_workers = 0
+
+        # number of tasks given up because their worker was killed
+        self.n_lost = 0
+
+    def __len__(self):
+
+        return len(self._tasks)
+
+    def acquire_core(self):
+        """
+        Function to wait for one of the shared cores before a task is added
+
+        The cores of the tasks that finished in the meantime are given back while waiting.
+        """
+
+        if self.core_semaphore is None:
+            return
+
+        while not self.core_semaphore.acquire(True, self.poll_interval):
+            self.check_tasks()
+
+    def add(self, key, async_result):
+        """
+        Function to add a task
+
+        If the cores are shared, a core must have been taken with acquire_core first.
+
+        Args:
+        -----
+        key: Anything to identify the task, returned with its result
+        async_result (AsyncResult): Returned by apply_async for the task
+        """
+
+        self._tasks.append(
+            PoolTask(key, async_result, self.core_semaphore is not None))
+
+    def release_core(self, task):
+        """
+        Function to give back the core of a task
+        """
+
+        if task.has_core:
+            self.core_semaphore.release()
+            task.has_core = False
+
+    def release_cores(self):
+        """
+        Function to give back the cores of all tasks that were not collected, e.g., after an error
+        """
+
+        for task in self._tasks:
+            self.release_core(task)
+
+    def check_workers(self):
+        """
+        Function to count the workers that were killed
+        """
+
+        # the pool removes finished workers from its list, so they are kept here
+        self._workers.update([worker for worker in self.pool._pool
+                              if worker not in self._ended_workers])
+
+        for worker in list(self._workers):
+            exitcode = worker.exitcode
+            if exitcode is None:
+                continue
+            self._workers.remove(worker)
+            self._ended_workers.add(worker)
+            # workers exit regularly with 0 after maxtasksperchild tasks
+            if exitcode != 0:
+                logger.error("Worker {0} of the pool ended with exit code {1}".format(
+                    worker.name, exitcode))
+                self._n_killed_workers += 1
+
+    def check_tasks(self):
+        """
+        Function to give back the cores of finished tasks and to give up the tasks of killed workers
+        """
+
+        for task in self._tasks:
+            if task.async_result.ready():
+                self.release_core(task)
+
+        self.check_workers()
+
+        # the remaining tasks will never be finished
+        unfinished_tasks = [task for task in self._tasks
+                            if not task.lost and not task.async_result.ready()]
+        while len(unfinished_tasks) != 0 and len(unfinished_tasks) <= self._n_killed_workers:
+            task = unfinished_tasks.pop(0)
+            task.lost = True
+            self.release_core(task)
+            self._n_killed_workers -= 1
+            self.n_lost += 1
+
+    def get(self, timeout=None):
+        """
+        Function to wait for the next finished task
+
+        Args:
+        -----
+        timeout (float): Maximum time in seconds to wait. Default None to wait until a task is finished
+
+        Return:
+        -------
+        (tuple): Key of the task, its result (None if it failed) and the error message
+            (None if it was successful). None if no task was finished within the timeout
+        """
+
+        start_time = time()
+
+        while len(self._tasks) != 0:
+            self.check_tasks()
+
+            for index, task in enumerate(self._tasks):
+                if task.lost:
+                    del self._tasks[index]
+                    return task.key, None, "Task failed in the pool: its worker process was killed"
+                if task.async_result.ready():
+                    del self._tasks[index]
+                    try:
+                        return task.key, task.async_result.get(), None
+                    except Exception as e:
+                        return task.key, None, "Task failed in the pool: {0}: {1}".format(type(e).__name__, str(e))
+
+            if timeout is not None:
+                wait_time = min(self.poll_interval,
+                                start_time + timeout - time())
+                if wait_time <= 0:
+                    return None
+            else:
+                wait_time = self.poll_interval
+            self._tasks[0].async_result.wait(wait_time)
+
+        return None
+
+    def close_pool(self):
+        """
+        Function to close the pool and wait for its workers
+
+        The pool is terminated if tasks were lost as it would otherwise wait for them forever.
+        """
+
+        if self.n_lost != 0:
+            self.pool.terminate()
+        else:
+            self.pool.close()
+        self.pool.join()
+
+        self.release_cores()
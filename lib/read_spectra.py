@@ -0,0 +1,222 @@
+"""
+Functionality to read the text files of the spectra written by SHARPener quickly
+
+The spectra of SHARPener have a fixed layout: a header line with the quoted
+names of the columns (e.g., "Frequency [Hz]" "Flux [Jy]" "Noise [Jy]" ...)
+followed by one line of numbers per channel. Instead of letting astropy guess
+the format of every file, the numbers are parsed directly into numpy arrays.
+Files without the header line get the names of the columns of SHARPener.
+Files that do not follow the layout are read with astropy.
+
+The spectra of a beam are read concurrently by a pool of threads.
+"""
+
+import os
+import re
+import glob
+import shlex
+import logging
+import numpy as np
+from multiprocessing.pool import ThreadPool
+from astropy.table import Table
+
+logger = logging.getLogger(__name__)
+
+# columns of the spectra used by apersharp
+SPECTRUM_COLUMNS = ['Frequency [Hz]', 'Flux [Jy]', 'Noise [Jy]']
+
+# columns of the spectra written by SHARPener in this order
+SHARPENER_SPECTRUM_COLUMNS = SPECTRUM_COLUMNS + \
+    ['Optical depth', 'Noise optical depth', 'Mean noise [Jy]']
+
+# values of masked channels
+MASKED_VALUE = "--"
+
+# name of the text files of the spectra written by SHARPener
+SPECTRUM_FILE_PATTERN = re.compile(r"^(\d+)_J(.+)\.txt$")
+
+
+def is_header(line_values):
+    """
+    Function to check if the values of the first line of a spectrum are the names of the columns
+    """
+
+    for value in line_values:
+        if value == MASKED_VALUE:
+            continue
+        try:
+            float(value)
+        except ValueError:
+            return True
+
+    return False
+
+
+def read_spectrum_data(spec_file):
+    """
+    Function to read the columns of a spectrum into a numpy array
+
+    Args:
+    -----
+    spec_file (str): Text file of the spectrum
+
+    Return:
+    -------
+    (tuple): Names of the columns and array with the data (channels x columns)
+    """
+
+    with open(spec_file) as stream:
+        header = stream.readline()
+        body = stream.read()
+
+    col_names = shlex.split(header.lstrip("#"))
+
+    # without a header line, the file starts with the first channel
+    has_header = is_header(col_names)
+    if not has_header:
+        if len(col_names) > len(SHARPENER_SPECTRUM_COLUMNS):
+            error = "Spectrum {0} has no header line and more than {1} columns".format(
+                spec_file, len(SHARPENER_SPECTRUM_COLUMNS))
+            logger.error(error)
+            raise RuntimeError(error)
+        body = header + body
+        col_names = SHARPENER_SPECTRUM_COLUMNS[:len(col_names)]
+
+    try:
+        spec_data = np.fromiter(map(float, body.split()), dtype=np.float64)
+    except ValueError:
+        spec_data = None
+
+    # e.g., masked values that are not written as numbers
+    if spec_data is None or len(col_names) == 0 or spec_data.size % len(col_names) != 0:
+        logger.debug(
+            "Unexpected layout of spectrum {}. Reading it with astropy".format(spec_file))
+        if has_header:
+            spec_table = Table.read(spec_file, format="ascii",
+                                    fill_values=[(MASKED_VALUE, "0")])
+        else:
+            spec_table = Table.read(spec_file, format="ascii.no_header", names=col_names,
+                                    fill_values=[(MASKED_VALUE, "0")])
+        # masked values become NaN for every column, as newer versions of astropy
+        # only mask single columns instead of the whole table
+        return spec_table.colnames, np.column_stack([np.ma.filled(np.ma.asarray(spec_table[col_name]).astype(np.float64), np.nan)
+                                                     for col_name in spec_table.colnames])
+
+    return col_names, spec_data.reshape(-1, len(col_names))
+
+
+def read_spectrum(spec_file):
+    """
+    Function to read a spectrum into a table
+
+    Return:
+    -------
+    (Table): The spectrum with the columns of the file
+    """
+
+    col_names, spec_data = read_spectrum_data(spec_file)
+
+    return Table(list(spec_data.T), names=col_names, copy=False)
+
+
+def get_spectrum_columns(spec_file, columns):
+    """
+    Function to read selected columns of a spectrum
+
+    Return:
+    -------
+    (ndarray): Data of the columns (columns x channels)
+    """
+
+    col_names, spec_data = read_spectrum_data(spec_file)
+
+    try:
+        col_index = [col_names.index(column) for column in columns]
+    except ValueError:
+        error = "Spectrum {0} does not have columns {1}".format(
+            spec_file, str(columns))
+        logger.error(error)
+        raise RuntimeError(error)
+
+    return spec_data[:, col_index].T
+
+
+def read_spectra(spec_file_list, columns=SPECTRUM_COLUMNS, n_threads=8):
+    """
+    Function to read the spectra of many sources with the same channels concurrently
+
+    Args:
+    -----
+    spec_file_list (list): Text files of the spectra
+    columns (list): Columns to read. Default frequency, flux and noise
+    n_threads (int): Number of files read at the same time. Default 8
+
+    Return:
+    -------
+    (ndarray): The spectra (sources x columns x channels)
+    """
+
+    if len(spec_file_list) == 0:
+        return np.zeros((0, len(columns), 0))
+
+    pool = ThreadPool(processes=max(min(n_threads, len(spec_file_list)), 1))
+    try:
+        spectra_list = pool.map(
+            lambda spec_file: get_spectrum_columns(spec_file, columns), spec_file_list)
+    finally:
+        pool.close()
+        pool.join()
+
+    n_chan = spectra_list[0].shape[1]
+    for spec_file, spectrum in zip(spec_file_list, spectra_list):
+        if spectrum.shape[1] != n_chan:
+            error = "Spectrum {0} has {1} channels instead of {2}".format(
+                spec_file, spectrum.shape[1], n_chan)
+            logger.error(error)
+            raise RuntimeError(error)
+
+    return np.stack(spectra_list)
+
+
+def get_beam_spectrum_files(beam_dir):
+    """
+    Function to get the text files of the spectra of a beam
+
+    Return:
+    -------
+    (list): Number of the source in the beam, name of the source and file of every spectrum
+    """
+
+    spec_file_list = []
+
+    for spec_file in sorted(glob.glob(os.path.join(beam_dir, "sharpOut/spec/*.txt"))):
+        file_match = SPECTRUM_FILE_PATTERN.match(os.path.basename(spec_file))
+        if file_match is not None:
+            spec_file_list.append(
+                (int(file_match.group(1)), file_match.group(2), spec_file))
+
+    return spec_file_list
+
+
+def read_beam_spectra(beam_dir, columns=SPECTRUM_COLUMNS, n_threads=8):
+    """
+    Function to read the spectra of all sources of a beam
+
+    Args:
+    -----
+    beam_dir (str): Directory of the beam
+    columns (list): Columns to read. Default frequency, flux and noise
+    n_threads (int): Number of files read at the same time. Default 8
+
+    Return:
+    -------
+    (tuple): Number of every source in the beam, name of every source
+        and the spectra (sources x columns x channels)
+    """
+
+    spec_file_list = get_beam_spectrum_files(beam_dir)
+
+    spectra = read_spectra([spec_file for src_nr, src_name, spec_file in spec_file_list],
+                           columns=columns, n_threads=n_threads)
+
+    return [src_nr for src_nr, src_name, spec_file in spec_file_list], [src_name for src_nr, src_name, spec_file in spec_file_list], spectra
@@ -0,0 +1,74 @@
+"""
+Functionality to limit the use of a resource like disk space or memory
+
+Consumers reserve an amount of the resource before they start and
+release it when they are done. A reservation waits until it fits into
+the limit. If nothing is reserved, a reservation is always accepted,
+even if it exceeds the limit on its own, so that processing cannot get stuck.
+"""
+
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class ResourceBudget(object):
+    """
+    Class to keep track of the reserved amount of a resource
+
+    Args:
+    -----
+    limit (float): Maximum amount that can be reserved. None for no limit
+    name (str): Name of the resource used for logging. Default "resource"
+    unit (float): Unit used for logging, e.g., 1024.**3 for GB. Default 1.
+    unit_name (str): Name of the unit used for logging. Default ""
+    """
+
+    def __init__(self, limit, name="resource", unit=1., unit_name=""):
+        self.limit = limit
+        self.name = name
+        self.unit = unit
+        self.unit_name = unit_name
+
+        self.used = 0.
+        self.peak = 0.
+
+        self._condition = threading.Condition()
+
+    def fits(self, amount):
+        """
+        Function to check whether an amount can be reserved right now
+        """
+
+        return self.limit is None or self.used == 0 or self.used + amount <= self.limit
+
+    def acquire(self, amount, block=True):
+        """
+        Function to reserve an amount of the resource
+
+        Args:
+        -----
+        amount (float): Amount to reserve
+        block (bool): Wait until the amount fits into the limit.
+            If False, the amount is reserved right away. Default True
+        """
+
+        with self._condition:
+            if block and not self.fits(amount):
+                logger.info("Waiting for {0:.2f}{1} of {2} ({3:.2f}{1} of {4:.2f}{1} in use)".format(
+                    amount / self.unit, self.unit_name, self.name, self.used / self.unit, self.limit / self.unit))
+                while not self.fits(amount):
+                    # use timeout to remain interruptible
+                    self._condition.wait(1.)
+            self.used += amount
+            self.peak = max(self.peak, self.used)
+
+    def release(self, amount):
+        """
+        Function to release an amount of the resource
+        """
+
+        with self._condition:
+            self.used = max(0., self.used - amount)
+            self._condition.notify_all()
@@ -0,0 +1,344 @@
+"""
+Functionality to cache the queries of SDSS sources on disk
+
+SHARPener gets the SDSS sources of a beam with a remote query
+(astroquery.sdss.SDSS.query_region) around the centre of the field. The cubes
+of a beam cover the same region and neighbouring taskids overlap. Therefore,
+the results of the queries are stored in a directory shared by all runs
+together with the centre, the radius and the other parameters of the query.
+A query is answered from the cache if a stored query with the same parameters
+covers the requested region. The sources outside of the requested region are removed.
+Stored queries older than the maximum age of the cache are sent to SDSS again and
+with refresh, all queries are sent to SDSS again and replace the stored ones.
+
+In offline mode, queries that are not in the cache are answered from a
+pre-downloaded catalogue (any table readable by astropy with ra and dec in degrees)
+instead of SDSS so that no network access is needed.
+
+The index of the cache is locked during every update so that several runs can use it at the same time.
+Every writer uses its own temporary files. Failures to read or update the cache are errors.
+"""
+
+import os
+import json
+import fcntl
+import tempfile
+import hashlib
+import logging
+import contextlib
+from time import time
+import numpy as np
+from astropy.table import Table
+from astropy.coordinates import SkyCoord, Angle
+import astropy.units as units
+
+logger = logging.getLogger(__name__)
+
+# file with the stored queries in the cache directory
+SDSS_CACHE_INDEX = "sdss_cache.json"
+
+# parameters of a query that do not change the result
+SDSS_IGNORED_PARAMETERS = ["timeout", "cache"]
+
+# tolerance in degrees for comparing the regions of queries
+SDSS_REGION_TOLERANCE = 1.e-6
+
+
+def get_query_parameters(kwargs):
+    """
+    Function to get the parameters of a query that define its result as a string
+    """
+
+    return json.dumps(dict([(key, kwargs[key]) for key in kwargs if key not in SDSS_IGNORED_PARAMETERS]),
+                      sort_keys=True, default=str)
+
+
+def select_region(src_data, coordinates, radius):
+    """
+    Function to select the sources of a table in a region
+
+    Args:
+    -----
+    src_data (Table): Sources with ra and dec in degrees
+    coordinates (SkyCoord): Centre of the region
+    radius (Angle): Radius of the region
+
+    Return:
+    -------
+    (Table): Sources in the region. None if there are none (as for SDSS queries)
+    """
+
+    if src_data is None or len(src_data) == 0:
+        return None
+
+    src_coord = SkyCoord(np.array(src_data['ra'], dtype=float),
+                         np.array(src_data['dec'], dtype=float), unit=units.deg)
+
+    src_data = src_data[src_coord.separation(coordinates).deg <= radius.deg]
+
+    if len(src_data) == 0:
+        return None
+
+    return src_data
+
+
+class SDSSCache(object):
+    """
+    Class to answer the queries of SDSS sources from a cache on disk
+
+    Args:
+    -----
+    cache_dir (str): Directory of the cache. None to not cache queries
+    offline (bool): Answer queries that are not in the cache from the catalogue. Default False
+    catalogue_file (str): Pre-downloaded catalogue of SDSS sources for offline mode. Default None
+    max_age (float): Maximum age of stored queries in days. None for no expiry. Default None
+    refresh (bool): Send all queries to SDSS again and replace the stored ones. Default False
+    """
+
+    def __init__(self, cache_dir=None, offline=False, catalogue_file=None, max_age=None, refresh=False):
+        self.cache_dir = cache_dir
+        self.offline = offline
+        self.catalogue_file = catalogue_file
+        self.max_age = max_age
+        self.refresh = refresh
+
+        if offline and cache_dir is None and catalogue_file is None:
+            error = "Offline mode for SDSS queries requires a cache or a catalogue"
+            logger.error(error)
+            raise RuntimeError(error)
+
+        if offline and refresh:
+            error = "Cannot refresh the SDSS cache in offline mode"
+            logger.error(error)
+            raise RuntimeError(error)
+
+    def get_index(self):
+        """
+        Function to read the stored queries
+
+        Return:
+        -------
+        (list): Centre, radius, parameters and file of every stored query
+        """
+
+        if self.cache_dir is None:
+            return []
+
+        index_file = os.path.join(self.cache_dir, SDSS_CACHE_INDEX)
+
+        if not os.path.exists(index_file):
+            return []
+
+        try:
+            with open(index_file) as stream:
+                return json.load(stream)
+        except Exception as e:
+            error = "Could not read the index of the SDSS cache {}".format(
+                index_file)
+            logger.error(error)
+            logger.error(e)
+            raise RuntimeError(error)
+
+    def is_expired(self, entry):
+        """
+        Function to check if a stored query is older than the maximum age
+        """
+
+        if self.max_age is None:
+            return False
+
+        return time() - entry['time'] > self.max_age * 86400.
+
+    def find_query(self, coordinates, radius, parameters):
+        """
+        Function to find a stored query that covers a region
+
+        Return:
+        -------
+        (dict): The smallest stored query covering the region. None if there is none
+        """
+
+        # expired queries are only used if SDSS cannot be queried
+        entry_list = [entry for entry in self.get_index() if entry['parameters'] == parameters and
+                      (self.offline or not self.is_expired(entry)) and
+                      coordinates.separation(SkyCoord(entry['ra'], entry['dec'], unit=units.deg)).deg + radius.deg <= entry['radius'] + SDSS_REGION_TOLERANCE]
+
+        if len(entry_list) == 0:
+            return None
+
+        return min(entry_list, key=lambda entry: entry['radius'])
+
+    def read_query(self, entry, coordinates, radius):
+        """
+        Function to read the result of a stored query for a region
+
+        Return:
+        -------
+        (Table): Sources in the region. None if there are none
+        """
+
+        if entry['file'] is None:
+            return None
+
+        src_data = Table.read(os.path.join(
+            self.cache_dir, entry['file']), format="ascii.ecsv")
+
+        return select_region(src_data, coordinates, radius)
+
+    def store_query(self, coordinates, radius, parameters, src_data):
+        """
+        Function to store the result of a query in the cache
+        """
+
+        if not os.path.exists(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                # another process may have created it at the same time
+                if not os.path.isdir(self.cache_dir):
+                    raise
+
+        entry = {'ra': coordinates.ra.deg,
+                 'dec': coordinates.dec.deg,
+                 'radius': radius.deg,
+                 'parameters': parameters,
+                 'file': None,
+                 'time': time()}
+
+        if src_data is not None:
+            entry['file'] = "sdss_{}.ecsv".format(hashlib.sha1("{0:.7f}_{1:.7f}_{2:.7f}_{3}".format(
+                entry['ra'], entry['dec'], entry['radius'], parameters)).hexdigest())
+            tmp_handle, tmp_file = tempfile.mkstemp(
+                prefix="{}.".format(entry['file']), suffix=".tmp", dir=self.cache_dir)
+            os.close(tmp_handle)
+            try:
+                src_data.write(tmp_file, format="ascii.ecsv", overwrite=True)
+                os.rename(tmp_file, os.path.join(
+                    self.cache_dir, entry['file']))
+            except Exception:
+                os.remove(tmp_file)
+                raise
+
+        index_file = os.path.join(self.cache_dir, SDSS_CACHE_INDEX)
+
+        with open("{}.lock".format(index_file), 'a') as lock_stream:
+            fcntl.flock(lock_stream.fileno(), fcntl.LOCK_EX)
+            try:
+                # other runs may have added queries
+                entry_list = [other_entry for other_entry in self.get_index() if other_entry['parameters'] != parameters or
+                              not np.allclose([other_entry['ra'], other_entry['dec'], other_entry['radius']],
+                                              [entry['ra'], entry['dec'], entry['radius']], rtol=0., atol=SDSS_REGION_TOLERANCE)]
+                entry_list.append(entry)
+
+                tmp_handle, tmp_file = tempfile.mkstemp(
+                    prefix="{}.".format(SDSS_CACHE_INDEX), suffix=".tmp", dir=self.cache_dir)
+                with os.fdopen(tmp_handle, 'w') as stream:
+                    json.dump(entry_list, stream, indent=1, sort_keys=True)
+                os.rename(tmp_file, index_file)
+            finally:
+                fcntl.flock(lock_stream.fileno(), fcntl.LOCK_UN)
+
+    def read_catalogue(self, coordinates, radius):
+        """
+        Function to get the sources in a region from the pre-downloaded catalogue
+
+        Return:
+        -------
+        (Table): Sources in the region. None if there are none
+        """
+
+        if self.catalogue_file is None or not os.path.exists(self.catalogue_file):
+            error = "Query of SDSS sources around {0} is not in the cache and catalogue {1} is not available".format(
+                coordinates.to_string(), self.catalogue_file)
+            logger.error(error)
+            raise RuntimeError(error)
+
+        logger.info("Getting SDSS sources around {0} from {1}".format(
+            coordinates.to_string(), self.catalogue_file))
+
+        # ecsv files are not identified automatically by all versions of astropy
+        if self.catalogue_file.endswith(".ecsv"):
+            catalogue_format = "ascii.ecsv"
+        else:
+            catalogue_format = None
+
+        return select_region(Table.read(self.catalogue_file, format=catalogue_format), coordinates, radius)
+
+    def query_region(self, query_function, coordinates, radius=2. * units.arcsec, **kwargs):
+        """
+        Function to answer a query of SDSS sources in a region from the cache
+
+        Queries that are not in the cache, have expired or are refreshed are
+        sent to SDSS and stored or, in offline mode, answered from the catalogue.
+
+        Args:
+        -----
+        query_function (function): Function to query SDSS (SDSS.query_region)
+        coordinates (SkyCoord or str): Centre of the region
+        radius (Quantity): Radius of the region. Default 2 arcsec as for SDSS.query_region
+        kwargs: Other parameters of the query
+
+        Return:
+        -------
+        (Table): Sources in the region. None if there are none
+        """
+
+        # only single positions are cached
+        if kwargs.get('get_query_payload', False) or np.size(coordinates) != 1:
+            return query_function(coordinates, radius=radius, **kwargs)
+
+        region_centre = SkyCoord(coordinates)
+        region_radius = Angle(radius, unit=units.deg)
+        parameters = get_query_parameters(kwargs)
+
+        if self.refresh:
+            entry = None
+        else:
+            entry = self.find_query(region_centre, region_radius, parameters)
+
+        if entry is not None:
+            logger.info("Getting SDSS sources around {0} from cache {1}".format(
+                region_centre.to_string(), self.cache_dir))
+            return self.read_query(entry, region_centre, region_radius)
+
+        if self.offline:
+            return self.read_catalogue(region_centre, region_radius)
+
+        src_data = query_function(coordinates, radius=radius, **kwargs)
+
+        if self.cache_dir is not None:
+            try:
+                self.store_query(region_centre, region_radius,
+                                 parameters, src_data)
+            except Exception as e:
+                error = "Could not store SDSS sources in cache {}".format(
+                    self.cache_dir)
+                logger.error(error)
+                logger.error(e)
+                raise RuntimeError(error)
+
+        return src_data
+
+    @contextlib.contextmanager
+    def use_cache(self):
+        """
+        Function to answer the queries of SDSS sources from the cache while in the context
+        """
+
+        from astroquery.sdss import SDSS
+
+        query_function = SDSS.query_region
+
+        def cached_query_region(coordinates, **kwargs):
+            """
+            Helper to use the cache instead of SDSS.query_region
+            """
+
+            return self.query_region(query_function, coordinates, **kwargs)
+
+        # the query of the instance takes precedence over the one of the class
+        SDSS.query_region = cached_query_region
+        try:
+            yield
+        finally:
+            del SDSS.query_region
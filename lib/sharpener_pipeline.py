@@ -10,20 +10,86 @@ import glob
 from PyPDF2 import PdfFileMerger
 import zipfile
 import logging
+import traceback
 logging.getLogger("matplotlib").setLevel(logging.WARNING)
 
 from setup_logger import setup_logger
+from memory_estimate import get_peak_memory, get_current_memory
+from extract_spectra import check_sharpener_settings, extract_spectra_sharpener
+from cube_noise import write_cube_noise
+from spectra_store import convert_spectra_to_store, remove_spectra_text_files
+from continuum_products import lock_continuum_products, list_continuum_products, store_continuum_products, get_continuum_products, get_continuum_settings
+import find_sources
 
 
-def sharpener_pipeline(beam_directory_list, do_source_finding, do_spectra_extraction, do_plots, do_sdss, beam_count):
+def run_continuum_steps(spar, proc, logger, do_source_finding, do_sdss, source_finding_engine="sharpener", sdss_cache=None):
+    """Function to find the continuum sources and the sdss sources with sharpener
+
+    If a cache is given, the queries of sdss sources are answered from it.
+    """
+
+    from sharpener.sharp_modules import cont_src as cont_src
+    from sharpener.sharp_modules import sdss_match
+
+    # Find continuum sources
+    # ++++++++++++++++++++++
+    if do_source_finding:
+
+        logger.info("(Pid {0:d}) ## Find continuum sources".format(proc))
+
+        # get sources in continuum image
+        if source_finding_engine == "apersharp":
+            unsupported_settings = find_sources.check_sharpener_settings(
+                spar.cfg_par)
+            if len(unsupported_settings) != 0:
+                logger.warning("(Pid {0:d}) Settings {1} are not supported by apersharp. Using sharpener to find sources".format(
+                    proc, str(unsupported_settings)))
+                sources = cont_src.find_src_imsad(spar.cfg_par)
+            else:
+                sources = find_sources.find_sources_sharpener(
+                    spar.cfg_par)
+        else:
+            sources = cont_src.find_src_imsad(spar.cfg_par)
+
+        logger.info(
+            "(Pid {0:d}) ## Find continuum sources ... Done".format(proc))
+
+    # Find sdss sources
+    # ++++++++++++++++++++++
+    if do_sdss:
+
+        logger.info("(Pid {0:d}) ## Find SDSS sources".format(proc))
+
+        # get sources in continuum image
+        if sdss_cache is not None:
+            with sdss_cache.use_cache():
+                sdss_match.get_sdss_sources(spar.cfg_par)
+        else:
+            sdss_match.get_sdss_sources(spar.cfg_par)
+
+        logger.info(
+            "(Pid {0:d}) ## Find SDSS sources ... Done".format(proc))
+
+
+def sharpener_pipeline(beam_directory_list, do_source_finding, do_spectra_extraction, do_plots, do_sdss, beam_count, spectra_extraction_engine="sharpener", do_cube_noise=False, use_cube_noise=False, source_finding_engine="sharpener", continuum_dir=None, sdss_cache=None, spectra_store=False, remove_text_files=False):
     """Function to run sharpener
+
+    The sources are found by sharpener using miriad or by apersharp (source_finding_engine="apersharp").
+    The spectra are extracted by sharpener or by apersharp (spectra_extraction_engine="apersharp").
+    With do_cube_noise, the noise of every channel is estimated from the whole cube
+    before the spectra are extracted if it is used for the spectra extracted by apersharp
+    or by the analysis of the spectra (use_cube_noise).
+    If a directory for the continuum products of the beam is given, the continuum and sdss
+    sources are only obtained once for all cubes of the beam. The queries of sdss sources
+    are answered from the sdss cache if one is given.
+    With spectra_store, the spectra are written to the spectra store of the beam,
+    directly by apersharp or converted from the text files of sharpener. With
+    remove_text_files, the text files are removed after plotting or not written at all.
     """
 
     import sharpener.sharpener as sharpy
-    from sharpener.sharp_modules import cont_src as cont_src
     from sharpener.sharp_modules import spec_ex as spec_ex
     from sharpener.sharp_modules import absorption_plot as abs_pl
-    from sharpener.sharp_modules import sdss_match
     # imp.reload(sharpy)
 
     # logger = logging.getLogger(__name__)
@@ -68,38 +134,64 @@ def sharpener_pipeline(beam_directory_list, do_source_finding, do_spectra_extrac
     # continue only if all files are available
     if os.path.exists(spar.cfg_par['general']['contname']) and os.path.exists(spar.cfg_par['general']['cubename']):
 
-        # Find continuum sources
-        # ++++++++++++++++++++++
-        if do_source_finding:
-
-            logger.info("(Pid {0:d}) ## Find continuum sources".format(proc))
-
-            # get sources in continuum image
-            sources = cont_src.find_src_imsad(spar.cfg_par)
+        # Find continuum and sdss sources
+        # ++++++++++++++++++++++++++++++++
+        if continuum_dir is not None and (do_source_finding or do_sdss):
+
+            # the products are shared with the other cubes of the beam
+            continuum_settings = get_continuum_settings(
+                spar.cfg_par, source_finding_engine)
+            with lock_continuum_products(continuum_dir):
+                if get_continuum_products(continuum_dir, "./", do_source_finding, do_sdss, continuum_settings=continuum_settings):
+                    logger.info(
+                        "(Pid {0:d}) ## Using continuum and SDSS sources from {1}".format(proc, continuum_dir))
+                else:
+                    product_list = list_continuum_products("./")
+                    run_continuum_steps(spar, proc, logger, do_source_finding,
+                                        do_sdss, source_finding_engine, sdss_cache)
+                    store_continuum_products(
+                        continuum_dir, "./", product_list, do_source_finding, do_sdss, continuum_settings=continuum_settings)
+        else:
+            run_continuum_steps(spar, proc, logger, do_source_finding,
+                                do_sdss, source_finding_engine, sdss_cache)
 
-            logger.info(
-                "(Pid {0:d}) ## Find continuum sources ... Done".format(proc))
+        # Extract spectra
+        # +++++++++++++++
+        if do_spectra_extraction:
 
-        # Find sdss sources
-        # ++++++++++++++++++++++
-        if do_sdss:
+            unsupported_settings = []
+            if spectra_extraction_engine == "apersharp":
+                unsupported_settings = check_sharpener_settings(spar.cfg_par)
 
-            logger.info("(Pid {0:d}) ## Find SDSS sources".format(proc))
+            cube_noise = None
+            if do_cube_noise and (use_cube_noise or (spectra_extraction_engine == "apersharp" and len(unsupported_settings) == 0)):
 
-            # get sources in continuum image
-            sdss_match.get_sdss_sources(spar.cfg_par)
+                logger.info(
+                    "(Pid {0:d}) ## Estimate noise of cube".format(proc))
 
-            logger.info(
-                "(Pid {0:d}) ## Find SDSS sources ... Done".format(proc))
+                cube_noise = write_cube_noise("./", spar.cfg_par['general']['cubename'], src_file="sharpOut/abs/mir_src_sharp.csv",
+                                              mask_size=spar.cfg_par['spec_ex']['noise_delta_skip'])['Noise [Jy]']
 
-        # Extract spectra
-        # +++++++++++++++
-        if do_spectra_extraction:
+                logger.info(
+                    "(Pid {0:d}) ## Estimate noise of cube ... Done".format(proc))
 
             logger.info(
                 "(Pid {0:d}) ## Extract HI spectra from cube".format(proc))
 
-            spectra = spec_ex.abs_ex(spar.cfg_par)
+            if spectra_extraction_engine == "apersharp":
+                if len(unsupported_settings) != 0:
+                    logger.warning("(Pid {0:d}) Settings {1} are not supported by apersharp. Using sharpener to extract spectra".format(
+                        proc, str(unsupported_settings)))
+                    spectra = spec_ex.abs_ex(spar.cfg_par)
+                else:
+                    spectra = extract_spectra_sharpener(
+                        spar.cfg_par, cube_noise=cube_noise, spectra_store=spectra_store,
+                        write_text_files=not (spectra_store and remove_text_files) or do_plots)
+            else:
+                spectra = spec_ex.abs_ex(spar.cfg_par)
+
+            if spectra_store and (spectra_extraction_engine != "apersharp" or len(unsupported_settings) != 0):
+                convert_spectra_to_store("./")
 
             logger.info(
                 "##(Pid {0:d}) Extract HI spectra from cube ... Done".format(proc))
@@ -124,6 +216,10 @@ def sharpener_pipeline(beam_directory_list, do_source_finding, do_spectra_extrac
             logger.info(
                 "(Pid {0:d}) ## Plotting spectra ... Done".format(proc))
 
+        if do_spectra_extraction and spectra_store and remove_text_files:
+            logger.info("(Pid {0:d}) Removed {1:d} text files of spectra".format(
+                proc, remove_spectra_text_files("./")))
+
         # Merge plots:
         # ++++++++++++
         if spar.cfg_par['abs_plot']['plot_format'] == "pdf":
@@ -217,3 +313,63 @@ def sharpener_pipeline(beam_directory_list, do_source_finding, do_spectra_extrac
     logger.info("PID {0:d}: Changing working directory back to {1}".format(
         proc, cwd))
     os.chdir(cwd)
+
+
+def run_sharpener_pipeline(beam_directory_list, do_source_finding, do_spectra_extraction, do_plots, do_sdss, beam_count, fill_cube_function_list=None, spectra_extraction_engine="sharpener", do_cube_noise=False, use_cube_noise=False, source_finding_engine="sharpener", continuum_directory_list=None, sdss_cache=None, spectra_store=False, remove_text_files=False):
+    """Function to run sharpener for a beam and report errors instead of raising them
+
+    This makes it possible to continue with the other beams and to
+    handle each beam as soon as it is finished.
+
+    If a list of directories for the continuum products is given, the continuum and
+    sdss sources of a beam are shared between the cubes. With an sdss cache (SDSSCache),
+    the queries of sdss sources are answered from the cache. With spectra_store,
+    the spectra are written to the spectra store of the beam.
+
+    If a function to fill the cube is given for the beam, sharpener is run
+    in two steps. First, the sources are found. Then, the cube is filled
+    with the data around the sources and the spectra are extracted and plotted.
+
+    Return:
+    -------
+    (tuple): Index of the beam, the error message (None if sharpener was successful)
+        and the peak memory of the process in bytes used for the beam
+    """
+
+    # a forked process starts with the memory of its parent
+    start_memory = get_current_memory()
+
+    # sharpener changes the working directory
+    cwd = os.getcwd()
+
+    if continuum_directory_list is None:
+        continuum_dir = None
+    else:
+        continuum_dir = continuum_directory_list[beam_count]
+
+    try:
+        if fill_cube_function_list is None or fill_cube_function_list[beam_count] is None:
+            sharpener_pipeline(beam_directory_list, do_source_finding,
+                               do_spectra_extraction, do_plots, do_sdss, beam_count,
+                               spectra_extraction_engine=spectra_extraction_engine, do_cube_noise=do_cube_noise, use_cube_noise=use_cube_noise,
+                               source_finding_engine=source_finding_engine, continuum_dir=continuum_dir, sdss_cache=sdss_cache,
+                               spectra_store=spectra_store, remove_text_files=remove_text_files)
+        else:
+            sharpener_pipeline(beam_directory_list, do_source_finding,
+                               False, False, do_sdss, beam_count,
+                               spectra_extraction_engine=spectra_extraction_engine, do_cube_noise=do_cube_noise, use_cube_noise=use_cube_noise,
+                               source_finding_engine=source_finding_engine, continuum_dir=continuum_dir, sdss_cache=sdss_cache,
+                               spectra_store=spectra_store, remove_text_files=remove_text_files)
+            os.chdir(cwd)
+            fill_cube_function_list[beam_count]()
+            sharpener_pipeline(beam_directory_list, False,
+                               do_spectra_extraction, do_plots, False, beam_count,
+                               spectra_extraction_engine=spectra_extraction_engine, do_cube_noise=do_cube_noise, use_cube_noise=use_cube_noise,
+                               source_finding_engine=source_finding_engine, continuum_dir=continuum_dir, sdss_cache=sdss_cache,
+                               spectra_store=spectra_store, remove_text_files=remove_text_files)
+    except Exception:
+        return beam_count, traceback.format_exc(), get_peak_memory() - start_memory
+    finally:
+        os.chdir(cwd)
+
+    return beam_count, None, get_peak_memory() - start_memory
@@ -0,0 +1,270 @@
+"""
+Functionality to read only the parts of a cube that are needed for the spectra
+
+SHARPener extracts the spectra at the positions of the continuum sources
+and estimates the noise in a box around them. Instead of getting the full
+cube, a sparse cube is created that has the same header and size, but
+only contains the data of the pixels in these boxes across all channels.
+All other pixels are blank (NaN), so that they cannot be mistaken for data.
+
+The sparse cube has its own file name (e.g., "HI_image_cube1_sparse.fits")
+so that it is never used as the full cube.
+
+The sparse cube is created in two steps:
+1. The header is read and the file is created with blank data so that
+   SHARPener can find the sources in the continuum image
+2. The pixels around the sources are read and written to the file
+"""
+
+import os
+import logging
+import functools
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+from astropy.table import Table
+from astropy.coordinates import SkyCoord
+import astropy.units as units
+
+logger = logging.getLogger(__name__)
+
+# size of a block in a fits file
+FITS_BLOCK_SIZE = 2880
+
+# data types of the floating point values in a fits file
+FITS_FLOAT_TYPES = {-32: '>f4', -64: '>f8'}
+
+# number of pixels written at once when blanking the data of a sparse cube
+BLANK_CHUNK_SIZE = 1024 * 1024
+
+
+def read_file_range(file_name, offset, n_bytes):
+    """
+    Function to read a range of bytes from a local file
+    """
+
+    with open(file_name, 'rb') as stream:
+        stream.seek(offset)
+        return stream.read(n_bytes)
+
+
+def read_fits_header(read_function):
+    """
+    Function to read the header of a fits file block by block
+
+    Args:
+    -----
+    read_function (function): Function with offset and number of bytes
+        as arguments returning the bytes of the fits file
+
+    Return:
+    -------
+    (tuple): The header and its size in bytes
+    """
+
+    header_string = ""
+    while True:
+        block = read_function(len(header_string), FITS_BLOCK_SIZE)
+        if len(block) != FITS_BLOCK_SIZE:
+            error = "Could not find the end of the fits header"
+            logger.error(error)
+            raise RuntimeError(error)
+        header_string += block
+        # the header ends with the END card
+        cards = [block[k:k + 80] for k in range(0, FITS_BLOCK_SIZE, 80)]
+        if "END" + " " * 77 in cards:
+            break
+
+    return fits.Header.fromstring(header_string), len(header_string)
+
+
+def get_data_size(header):
+    """
+    Function to return the size of the data in a fits file including the padding
+    """
+
+    n_bytes = np.abs(header['BITPIX']) // 8 * \
+        np.prod([header['NAXIS{}'.format(k + 1)] for k in range(header['NAXIS'])])
+
+    return int(np.ceil(n_bytes / float(FITS_BLOCK_SIZE)) * FITS_BLOCK_SIZE)
+
+
+def create_sparse_cube(data_source, location, output_file):
+    """
+    Function to create a cube with the header of the original cube, but without data
+
+    The pixels of a cube with floating point values are set to NaN.
+
+    Args:
+    -----
+    data_source (DataSource): Data source supporting read_range
+    location (str): Location of the cube
+    output_file (str): Path of the sparse cube
+    """
+
+    header, header_size = read_fits_header(
+        functools.partial(data_source.read_range, location))
+
+    n_pixels = int(np.prod([header['NAXIS{}'.format(k + 1)]
+                            for k in range(header['NAXIS'])]))
+
+    with open(output_file, 'wb') as stream:
+        stream.write(data_source.read_range(location, 0, header_size))
+        if header['BITPIX'] in FITS_FLOAT_TYPES:
+            blank_chunk = np.full(min(n_pixels, BLANK_CHUNK_SIZE), np.nan,
+                                  dtype=FITS_FLOAT_TYPES[header['BITPIX']])
+            for chunk_start in range(0, n_pixels, BLANK_CHUNK_SIZE):
+                stream.write(
+                    blank_chunk[:min(BLANK_CHUNK_SIZE, n_pixels - chunk_start)].tobytes())
+        else:
+            logger.warning(
+                "Cube {} does not have floating point values. Pixels outside the boxes are 0".format(location))
+        # the padding of the data is zero
+        stream.truncate(header_size + get_data_size(header))
+
+
+def get_pixel_mask(src_file, header, box_size):
+    """
+    Function to get the pixels in boxes around the sources
+
+    Args:
+    -----
+    src_file (str): Csv file with the continuum sources from SHARPener
+    header (Header): Header of the cube
+    box_size (int): Half of the box size in pixels
+
+    Return:
+    -------
+    (ndarray): Boolean array of the size of a channel. True for required pixels
+    """
+
+    n_x = header['NAXIS1']
+    n_y = header['NAXIS2']
+
+    mask = np.zeros((n_y, n_x), dtype=bool)
+
+    src_data = Table.read(src_file, format="ascii.csv")
+
+    if len(src_data) == 0:
+        return mask
+
+    src_coord = SkyCoord(src_data['ra'], src_data['dec'], unit=(
+        units.hourangle, units.deg), frame='fk5')
+
+    cube_wcs = WCS(header).celestial
+    pixel_x, pixel_y = cube_wcs.wcs_world2pix(
+        src_coord.ra.deg, src_coord.dec.deg, 0)
+
+    for x, y in zip(np.round(pixel_x).astype(int), np.round(pixel_y).astype(int)):
+        x_min = max(x - box_size, 0)
+        x_max = min(x + box_size + 1, n_x)
+        y_min = max(y - box_size, 0)
+        y_max = min(y + box_size + 1, n_y)
+        if x_min >= x_max or y_min >= y_max:
+            logger.warning(
+                "Source at pixel ({0}, {1}) is outside of the cube".format(x, y))
+            continue
+        mask[y_min:y_max, x_min:x_max] = True
+
+    return mask
+
+
+def get_byte_ranges(header, header_size, mask, max_gap=4096):
+    """
+    Function to get the ranges of bytes in the cube covering the required pixels of all channels
+
+    Ranges that are separated by less than max_gap bytes are combined.
+
+    Args:
+    -----
+    header (Header): Header of the cube
+    header_size (int): Size of the header in bytes
+    mask (ndarray): Boolean array of the size of a channel. True for required pixels
+    max_gap (int): Maximum number of bytes between two ranges to combine them
+
+    Return:
+    -------
+    (list): List of offset and number of bytes for every range
+    """
+
+    n_x = header['NAXIS1']
+    n_y = header['NAXIS2']
+    n_bytes_pixel = np.abs(header['BITPIX']) // 8
+
+    # channels and stokes
+    n_planes = int(np.prod([header['NAXIS{}'.format(k + 1)]
+                            for k in range(2, header['NAXIS'])]))
+
+    # runs of required pixels in every row of a plane
+    padded_mask = np.zeros((n_y, n_x + 2), dtype=np.int8)
+    padded_mask[:, 1:-1] = mask
+    mask_change = np.diff(padded_mask, axis=1)
+    run_y, run_x_start = np.where(mask_change == 1)
+    run_x_end = np.where(mask_change == -1)[1]
+
+    if np.size(run_y) == 0:
+        return []
+
+    # offsets of the runs in every plane
+    plane_offset = np.arange(n_planes, dtype=np.int64) * n_x * n_y
+    run_offset = (plane_offset[:, np.newaxis] + run_y * n_x +
+                  run_x_start).ravel() * n_bytes_pixel + header_size
+    run_length = np.tile((run_x_end - run_x_start) * n_bytes_pixel, n_planes)
+
+    # combine runs with small gaps
+    run_end = run_offset + run_length
+    new_range = (run_offset[1:] - run_end[:-1]) > max_gap
+    range_start_index = np.concatenate([[0], np.where(new_range)[0] + 1])
+    range_end_index = np.concatenate(
+        [range_start_index[1:] - 1, [np.size(run_offset) - 1]])
+
+    range_offset = run_offset[range_start_index]
+    range_length = run_end[range_end_index] - range_offset
+
+    return zip(range_offset.tolist(), range_length.tolist())
+
+
+def fill_sparse_cube(data_source, location, output_file, src_file, box_size, max_gap=4096):
+    """
+    Function to read the pixels around the sources and write them to the sparse cube
+
+    Args:
+    -----
+    data_source (DataSource): Data source supporting read_range
+    location (str): Location of the cube
+    output_file (str): Path of the sparse cube created by create_sparse_cube
+    src_file (str): Csv file with the continuum sources from SHARPener
+    box_size (int): Half of the box size around a source in pixels
+    max_gap (int): Maximum number of bytes between two ranges to read them together
+
+    Return:
+    -------
+    (int): Number of bytes read
+    """
+
+    header, header_size = read_fits_header(
+        functools.partial(read_file_range, output_file))
+
+    if not os.path.exists(src_file):
+        logger.warning(
+            "Did not find sources in {}. Sparse cube remains blank".format(src_file))
+        return 0
+
+    mask = get_pixel_mask(src_file, header, box_size)
+
+    range_list = get_byte_ranges(header, header_size, mask, max_gap=max_gap)
+
+    logger.info("Reading {0} pixels per channel in {1} ranges from {2}".format(
+        np.sum(mask), len(range_list), location))
+
+    n_bytes = 0
+    with open(output_file, 'r+b') as stream:
+        for offset, data in data_source.read_ranges(location, range_list):
+            stream.seek(offset)
+            stream.write(data)
+            n_bytes += len(data)
+
+    logger.info("Reading {0} pixels per channel in {1} ranges from {2} ... Done ({3:.1f} MB of {4:.1f} MB)".format(
+        np.sum(mask), len(range_list), location, n_bytes / 1024.**2, get_data_size(header) / 1024.**2))
+
+    return n_bytes
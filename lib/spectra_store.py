@@ -0,0 +1,216 @@
+"""
+Functionality to store the spectra of all sources of a beam in binary files
+
+SHARPener writes the spectrum of every source to a text file
+(sharpOut/spec/<nr>_J<name>.txt). For thousands of sources, reading these
+files is slow. The spectra store of a beam (sharpOut/spec_store) holds
+the flux and noise of all sources as a single float32 array
+(2 x sources x channels) in a npy file that is memory-mapped when read,
+the frequency axis shared by all sources and an index of the sources.
+
+The extraction engine of apersharp writes the store directly. The text files
+of SHARPener are converted to the store.
+"""
+
+import os
+import logging
+import numpy as np
+from astropy.table import Table
+
+from lib.read_spectra import read_beam_spectra, get_beam_spectrum_files, SPECTRUM_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+# directory of the store relative to the beam directory
+SPECTRA_STORE_DIR = "sharpOut/spec_store"
+
+# files of the store
+SPECTRA_STORE_DATA = "spectra.npy"
+SPECTRA_STORE_FREQUENCY = "frequency.npy"
+SPECTRA_STORE_INDEX = "index.csv"
+
+
+def get_spectra_store_dir(beam_dir):
+    """
+    Function to return the directory of the spectra store of a beam
+    """
+
+    return os.path.join(beam_dir, SPECTRA_STORE_DIR)
+
+
+def write_spectra_store(beam_dir, frequency, flux, noise, src_nr, src_name):
+    """
+    Function to write the spectra of the sources of a beam to the store
+
+    Args:
+    -----
+    beam_dir (str): Directory of the beam
+    frequency (ndarray): Frequency of every channel in Hz
+    flux (ndarray): Flux in Jy (sources x channels)
+    noise (ndarray): Noise in Jy (sources x channels)
+    src_nr (list): Number of every source in the beam (as in the name of the text file)
+    src_name (list): J2000 name of every source without the leading J
+    """
+
+    store_dir = get_spectra_store_dir(beam_dir)
+
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+
+    spectra = np.zeros((2, len(src_nr), np.size(frequency)), dtype=np.float32)
+    if len(src_nr) != 0:
+        spectra[0] = flux
+        spectra[1] = noise
+
+    # the index is written last and marks the store as complete
+    index_file = os.path.join(store_dir, SPECTRA_STORE_INDEX)
+    if os.path.exists(index_file):
+        os.remove(index_file)
+
+    np.save(os.path.join(store_dir, SPECTRA_STORE_DATA), spectra)
+    np.save(os.path.join(store_dir, SPECTRA_STORE_FREQUENCY),
+            np.asarray(frequency, dtype=np.float64))
+
+    Table([np.arange(len(src_nr)), np.array(src_nr, dtype=int), np.array(src_name, dtype=str)],
+          names=['Row', 'Source_Nr', 'J2000']).write(index_file, format="ascii.csv", overwrite=True)
+
+
+def remove_spectra_text_files(beam_dir):
+    """
+    Function to remove the text files of the spectra of a beam
+
+    Return:
+    -------
+    (int): Number of removed files
+    """
+
+    spec_file_list = get_beam_spectrum_files(beam_dir)
+
+    for src_nr, src_name, spec_file in spec_file_list:
+        os.remove(spec_file)
+
+    return len(spec_file_list)
+
+
+def convert_spectra_to_store(beam_dir, remove_text_files=False, n_threads=8):
+    """
+    Function to convert the text files of the spectra of a beam to the store
+
+    If there are no text files, e.g., because they were removed after a
+    previous conversion, an existing store is kept.
+
+    Args:
+    -----
+    beam_dir (str): Directory of the beam
+    remove_text_files (bool): Remove the text files after the conversion. Default False
+    n_threads (int): Number of text files read at the same time. Default 8
+
+    Return:
+    -------
+    (int): Number of spectra in the store
+    """
+
+    logger.info("Converting spectra of {} to store".format(beam_dir))
+
+    if len(get_beam_spectrum_files(beam_dir)) == 0 and has_spectra_store(beam_dir):
+        n_src = len(SpectraStore(beam_dir).row)
+        logger.info("Converting spectra of {0} to store ... Done. No text files, keeping the store with {1} spectra".format(
+            beam_dir, n_src))
+        return n_src
+
+    src_nr, src_name, spectra = read_beam_spectra(
+        beam_dir, columns=SPECTRUM_COLUMNS, n_threads=n_threads)
+
+    if len(src_nr) == 0:
+        frequency = np.zeros(0)
+    else:
+        frequency = spectra[0, 0]
+
+    write_spectra_store(
+        beam_dir, frequency, spectra[:, 1], spectra[:, 2], src_nr, src_name)
+
+    if remove_text_files:
+        remove_spectra_text_files(beam_dir)
+
+    logger.info("Converting {0} spectra of {1} to store ... Done".format(
+        len(src_nr), beam_dir))
+
+    return len(src_nr)
+
+
+class SpectraStore(object):
+    """
+    Class to read the spectra of a beam from the store
+
+    The spectra are memory-mapped so that only the spectra that are used are read.
+
+    Args:
+    -----
+    beam_dir (str): Directory of the beam
+    """
+
+    def __init__(self, beam_dir):
+        store_dir = get_spectra_store_dir(beam_dir)
+
+        index_file = os.path.join(store_dir, SPECTRA_STORE_INDEX)
+        if not os.path.exists(index_file):
+            error = "Could not find spectra store in {}".format(store_dir)
+            logger.error(error)
+            raise RuntimeError(error)
+
+        src_index = Table.read(index_file, format="ascii.csv")
+        self.row = dict([((int(src_nr), str(src_name)), int(row)) for row, src_nr, src_name in zip(
+            src_index['Row'], src_index['Source_Nr'], src_index['J2000'])])
+
+        self.spectra = np.load(os.path.join(
+            store_dir, SPECTRA_STORE_DATA), mmap_mode='r')
+        self.frequency = np.load(os.path.join(
+            store_dir, SPECTRA_STORE_FREQUENCY))
+
+    def get_spectrum(self, src_nr, src_name):
+        """
+        Function to get the spectrum of a source
+
+        Args:
+        -----
+        src_nr (int): Number of the source in the beam
+        src_name (str): J2000 name of the source without the leading J
+
+        Return:
+        -------
+        (Table): Frequency, flux and noise of the source. None if the source is not in the store
+        """
+
+        row = self.row.get((int(src_nr), str(src_name)))
+
+        if row is None:
+            return None
+
+        return Table([self.frequency, self.spectra[0, row], self.spectra[1, row]],
+                     names=['Frequency [Hz]', 'Flux [Jy]', 'Noise [Jy]'], copy=False)
+
+
+def has_spectra_store(beam_dir):
+    """
+    Function to check if the store of a beam exists and is complete
+    """
+
+    return os.path.exists(os.path.join(get_spectra_store_dir(beam_dir), SPECTRA_STORE_INDEX))
+
+
+def has_current_spectra_store(beam_dir):
+    """
+    Function to check if the store of a beam exists and is not older than the text files of the spectra
+    """
+
+    if not has_spectra_store(beam_dir):
+        return False
+
+    store_time = os.path.getmtime(os.path.join(
+        get_spectra_store_dir(beam_dir), SPECTRA_STORE_INDEX))
+
+    for src_nr, src_name, spec_file in get_beam_spectrum_files(beam_dir):
+        if os.path.getmtime(spec_file) > store_time:
+            return False
+
+    return True
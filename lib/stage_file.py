@@ -0,0 +1,99 @@
+"""
+Functionality to make a file available in another directory without copying it
+
+The methods are tried in the given order until one works:
+- hardlink: new name for the same file (same file system only)
+- reflink: copy-on-write clone of the file (e.g., btrfs, xfs)
+- symlink: symbolic link to the file
+- copy: copy of the file as fallback
+
+A hardlink or a symbolic link shares the data with the source file, e.g.,
+a file in the archive or in the cache. Nothing may therefore open a staged
+file for writing. Files that need to be changed have to be copied or
+replaced by a new file instead.
+"""
+
+import os
+import errno
+import fcntl
+import shutil
+import logging
+
+logger = logging.getLogger(__name__)
+
+# ioctl request to clone a file on Linux (FICLONE)
+FICLONE = 0x40049409
+
+STAGING_METHODS = ["hardlink", "reflink", "symlink", "copy"]
+
+
+def reflink_file(source_file, output_file):
+    """
+    Function to create a copy-on-write clone of a file
+
+    Raises an IOError if the file system does not support it
+    """
+
+    with open(source_file, 'rb') as source_stream:
+        with open(output_file, 'wb') as output_stream:
+            try:
+                fcntl.ioctl(output_stream.fileno(),
+                            FICLONE, source_stream.fileno())
+            except (IOError, OSError):
+                output_stream.close()
+                os.remove(output_file)
+                raise
+
+
+def stage_file(source_file, output_file, methods=None):
+    """
+    Function to make a file available under a new name
+
+    Args:
+    -----
+    source_file (str): Path of the existing file
+    output_file (str): Path of the new file
+    methods (list): List of methods to try in this order. Default is STAGING_METHODS
+
+    Return:
+    -------
+    (str): The method that was used
+    """
+
+    if methods is None:
+        methods = STAGING_METHODS
+
+    if not os.path.exists(source_file):
+        error = "Could not find file {}".format(source_file)
+        logger.error(error)
+        raise IOError(errno.ENOENT, error)
+
+    if os.path.lexists(output_file):
+        os.remove(output_file)
+
+    for method in methods:
+        try:
+            if method == "hardlink":
+                os.link(source_file, output_file)
+            elif method == "reflink":
+                reflink_file(source_file, output_file)
+            elif method == "symlink":
+                os.symlink(os.path.abspath(source_file), output_file)
+            elif method == "copy":
+                shutil.copyfile(source_file, output_file)
+            else:
+                logger.warning(
+                    "Unknown method {} to stage files. Skipping it".format(method))
+                continue
+        except (IOError, OSError) as e:
+            logger.debug("Staging {0} with {1} failed ({2})".format(
+                source_file, method, str(e)))
+        else:
+            logger.debug("Staged {0} as {1} with {2}".format(
+                source_file, output_file, method))
+            return method
+
+    error = "Could not stage {0} as {1} with any of {2}".format(
+        source_file, output_file, str(methods))
+    logger.error(error)
+    raise IOError(error)
@@ -0,0 +1,333 @@
+"""
+Functionality to collect the master tables and candidate tables of all runs in a single database
+
+Every cube of every taskid has its own master table and candidate table.
+The survey catalogue is a SQLite database with the sources of the master tables
+(table "sources") and the candidates (table "candidates") of all cubes with
+the taskid as an additional column. The position of every source in degrees
+(ra_deg, dec_deg) is added for searches on the sky.
+
+The tables have indexes on taskid, cube and beam, on the source ID, on the SNR
+columns and on the position. Ingesting a cube again replaces all its rows.
+Every ingestion is a single transaction that locks the database so that
+parallel runs can ingest their cubes into the same catalogue.
+"""
+
+import os
+import re
+import logging
+from time import time
+import numpy as np
+from astropy.table import Table, Column
+from astropy.coordinates import SkyCoord
+import astropy.units as units
+
+from lib.master_table_store import connect_database, get_table_columns, get_table_from_rows, insert_rows, create_table_index, quote, read_master_table, get_master_table_store_file
+
+logger = logging.getLogger(__name__)
+
+# tables in the catalogue
+CATALOGUE_SOURCES_TABLE = "sources"
+CATALOGUE_CANDIDATES_TABLE = "candidates"
+CATALOGUE_TABLES = [CATALOGUE_SOURCES_TABLE, CATALOGUE_CANDIDATES_TABLE]
+
+# table with the ingested cubes
+CATALOGUE_INGESTION_TABLE = "ingestion"
+
+# indexes of the tables if they have the columns
+CATALOGUE_INDEX_COLUMNS = [["taskid", "Cube", "Beam"], ["Source_ID"], [
+    "Max_Negative_SNR"], ["Max_Positive_SNR"], ["dec_deg", "ra_deg"]]
+
+# names of the master tables of the cubes in the directories of the runs
+MASTER_TABLE_FILE_PATTERN = re.compile(
+    r"^(.+)_cube_(\d+)_master_table\.(csv|sqlite)$")
+
+
+def get_source_positions(src_data):
+    """
+    Function to get the position of the sources of a table in degrees
+
+    The right ascension and declination of the master table are converted
+    as for matching the sources of different beams.
+
+    Return:
+    -------
+    (tuple): Right ascension and declination. NaN if they cannot be converted
+    """
+
+    n_src = len(src_data)
+
+    if n_src == 0 or 'ra' not in src_data.colnames or 'dec' not in src_data.colnames:
+        return np.full(n_src, np.nan), np.full(n_src, np.nan)
+
+    try:
+        src_coord = SkyCoord(np.array(src_data['ra']), np.array(src_data['dec']), unit=(
+            units.hourangle, units.deg), frame='fk5')
+    except Exception as e:
+        logger.warning(
+            "Could not convert the positions of the sources to degrees")
+        logger.warning(e)
+        return np.full(n_src, np.nan), np.full(n_src, np.nan)
+
+    return src_coord.ra.deg, src_coord.dec.deg
+
+
+def find_cube_tables(base_dir):
+    """
+    Function to find the master tables and candidate tables of all cubes in a directory
+
+    The directory can be the directory of a run, of a taskid or of a cube.
+    If a cube has a master table store and a csv file, the store is used.
+
+    Return:
+    -------
+    (list): Taskid, cube, master table csv file, candidate file and engine of the master table of every cube
+    """
+
+    cube_table_dict = {}
+
+    for dir_path, dir_names, file_names in os.walk(base_dir):
+        dir_names.sort()
+        for file_name in sorted(file_names):
+            file_match = MASTER_TABLE_FILE_PATTERN.match(file_name)
+            if file_match is None:
+                continue
+            taskid, cube, extension = file_match.groups()
+            src_cat_file = os.path.join(
+                dir_path, "{0}_cube_{1}_master_table.csv".format(taskid, cube))
+            if extension == "sqlite":
+                master_table_engine = "sqlite"
+            elif src_cat_file not in cube_table_dict:
+                master_table_engine = "csv"
+            else:
+                continue
+            cube_table_dict[src_cat_file] = (taskid, cube, src_cat_file, src_cat_file.replace(
+                "_master_table.csv", "_snr_candidates.csv"), master_table_engine)
+
+    return [cube_table_dict[src_cat_file] for src_cat_file in sorted(cube_table_dict)]
+
+
+class SurveyCatalogue(object):
+    """
+    Class to ingest the tables of cubes into the survey catalogue and query it
+
+    Args:
+    -----
+    catalogue_file (str): Database file of the catalogue
+    """
+
+    def __init__(self, catalogue_file):
+        self.catalogue_file = catalogue_file
+
+    def connect(self, write=False):
+        """
+        Function to open a connection to the catalogue for a transaction
+        """
+
+        return connect_database(self.catalogue_file, write=write)
+
+    def ingest_tables(self, taskid, cube, table_dict, file_dict=None):
+        """
+        Function to replace the rows of a cube in the tables of the catalogue
+
+        All tables of the cube are ingested in one transaction.
+
+        Args:
+        -----
+        taskid (str): Taskid of the cube
+        cube (int): Number of the cube
+        table_dict (dict): Table of the cube for every table of the catalogue
+        file_dict (dict): File of every table for the list of ingested cubes. Default None
+        """
+
+        catalogue_dir = os.path.dirname(os.path.abspath(self.catalogue_file))
+        if not os.path.exists(catalogue_dir):
+            os.makedirs(catalogue_dir)
+
+        with self.connect(write=True) as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS {0} (taskid TEXT, Cube INTEGER, table_name TEXT, n_rows INTEGER, file TEXT, time REAL, PRIMARY KEY (taskid, Cube, table_name))".format(
+                quote(CATALOGUE_INGESTION_TABLE)))
+
+            for table_name in sorted(table_dict):
+                if table_name not in CATALOGUE_TABLES:
+                    error = "Unknown table {0} of survey catalogue {1}".format(
+                        table_name, self.catalogue_file)
+                    logger.error(error)
+                    raise RuntimeError(error)
+
+                src_data = Table(table_dict[table_name], masked=table_dict[table_name].masked)
+                src_data.meta = {}
+
+                # the rows of the cube are identified by taskid and cube
+                src_data.add_column(Column(np.full(len(src_data), str(taskid), dtype="S{}".format(
+                    max(len(str(taskid)), 1))), name="taskid"), index=0)
+                if 'Cube' in src_data.colnames:
+                    src_data['Cube'] = np.full(len(src_data), int(cube), dtype=int)
+                else:
+                    src_data.add_column(Column(np.full(len(src_data), int(
+                        cube), dtype=int), name="Cube"), index=1)
+                src_data['ra_deg'], src_data['dec_deg'] = get_source_positions(
+                    src_data)
+
+                if len(get_table_columns(connection, table_name)) != 0:
+                    connection.execute("DELETE FROM {0} WHERE taskid = ? AND Cube = ?".format(
+                        quote(table_name)), (str(taskid), int(cube)))
+
+                insert_rows(connection, table_name, src_data)
+
+                for col_names in CATALOGUE_INDEX_COLUMNS:
+                    if set(col_names).issubset(src_data.colnames):
+                        create_table_index(connection, table_name, col_names)
+
+                if file_dict is not None and table_name in file_dict:
+                    table_file = file_dict[table_name]
+                else:
+                    table_file = None
+                connection.execute("INSERT OR REPLACE INTO {} VALUES (?, ?, ?, ?, ?, ?)".format(quote(CATALOGUE_INGESTION_TABLE)),
+                                   (str(taskid), int(cube), table_name, len(src_data), table_file, time()))
+
+                logger.debug("Ingested {0} rows of cube {1} of taskid {2} into {3}".format(
+                    len(src_data), cube, taskid, table_name))
+
+    def ingest_cube(self, taskid, cube, src_cat_file, candidate_file=None, master_table_engine="csv"):
+        """
+        Function to ingest the master table and the candidate table of a cube
+
+        Args:
+        -----
+        taskid (str): Taskid of the cube
+        cube (int): Number of the cube
+        src_cat_file (str): Csv file of the master table
+        candidate_file (str): Csv file of the candidates. Not ingested if it does not exist. Default None
+        master_table_engine (str): The master table is in the csv file ("csv") or in the store ("sqlite"). Default csv
+        """
+
+        logger.info("Ingesting cube {0} of taskid {1} into survey catalogue {2}".format(
+            cube, taskid, self.catalogue_file))
+
+        table_dict = {CATALOGUE_SOURCES_TABLE: read_master_table(
+            src_cat_file, master_table_engine=master_table_engine)}
+        file_dict = {CATALOGUE_SOURCES_TABLE: src_cat_file}
+        if master_table_engine == "sqlite":
+            file_dict[CATALOGUE_SOURCES_TABLE] = get_master_table_store_file(
+                src_cat_file)
+
+        if candidate_file is not None and os.path.exists(candidate_file):
+            table_dict[CATALOGUE_CANDIDATES_TABLE] = Table.read(
+                candidate_file, format="ascii.csv")
+            file_dict[CATALOGUE_CANDIDATES_TABLE] = candidate_file
+        else:
+            logger.warning(
+                "Could not find candidate table {}".format(candidate_file))
+
+        self.ingest_tables(taskid, cube, table_dict, file_dict=file_dict)
+
+        logger.info("Ingesting cube {0} of taskid {1} into survey catalogue {2} ... Done".format(
+            cube, taskid, self.catalogue_file))
+
+    def get_ingested_cubes(self):
+        """
+        Function to get the list of ingested cubes and tables
+
+        Return:
+        -------
+        (Table): Taskid, cube, table, number of rows, file and time of ingestion
+        """
+
+        if not os.path.exists(self.catalogue_file):
+            return Table(names=["taskid", "Cube", "table_name", "n_rows", "file", "time"], dtype=["S1", int, "S1", int, "S1", float])
+
+        with self.connect() as connection:
+            db_columns = get_table_columns(
+                connection, CATALOGUE_INGESTION_TABLE)
+            if len(db_columns) == 0:
+                rows = []
+                db_columns = [("taskid", "TEXT"), ("Cube", "INTEGER"), ("table_name", "TEXT"),
+                              ("n_rows", "INTEGER"), ("file", "TEXT"), ("time", "REAL")]
+            else:
+                rows = connection.execute("SELECT * FROM {} ORDER BY taskid, Cube, table_name".format(
+                    quote(CATALOGUE_INGESTION_TABLE))).fetchall()
+
+        return get_table_from_rows(db_columns, rows)
+
+    def query(self, table_name=CATALOGUE_CANDIDATES_TABLE, taskid=None, cube=None, beam=None, max_negative_snr=None, max_positive_snr=None, ra=None, dec=None, radius=None, where=None, limit=None):
+        """
+        Function to get the rows of a table of the catalogue
+
+        All conditions that are given must be fulfilled.
+
+        Args:
+        -----
+        table_name (str): Table of the catalogue ("sources" or "candidates"). Default candidates
+        taskid (str): Only rows of this taskid. Default None
+        cube (int): Only rows of this cube. Default None
+        beam (int): Only rows of this beam. Default None
+        max_negative_snr (float): Only rows with Max_Negative_SNR below or equal this value. Default None
+        max_positive_snr (float): Only rows with Max_Positive_SNR below or equal this value. Default None
+        ra (float): Right ascension in degrees of the centre of a region on the sky. Default None
+        dec (float): Declination in degrees of the centre of a region on the sky. Default None
+        radius (float): Radius in degrees of the region on the sky. Default None
+        where (str): Additional SQL condition on the columns of the table. Default None
+        limit (int): Maximum number of rows. Default None
+
+        Return:
+        -------
+        (Table): The rows ordered by taskid and source ID
+        """
+
+        if table_name not in CATALOGUE_TABLES:
+            error = "Unknown table {0} of survey catalogue {1}".format(
+                table_name, self.catalogue_file)
+            logger.error(error)
+            raise RuntimeError(error)
+
+        if not os.path.exists(self.catalogue_file):
+            error = "Could not find survey catalogue {}".format(
+                self.catalogue_file)
+            logger.error(error)
+            raise RuntimeError(error)
+
+        conditions = []
+        parameters = []
+        for col_name, operator, value in [("taskid", "=", None if taskid is None else str(taskid)), ("Cube", "=", None if cube is None else int(cube)),
+                                          ("Beam", "=", None if beam is None else int(beam)), ("Max_Negative_SNR", "<=", max_negative_snr), ("Max_Positive_SNR", "<=", max_positive_snr)]:
+            if value is not None:
+                conditions.append("{0} {1} ?".format(quote(col_name), operator))
+                parameters.append(value)
+
+        use_region = ra is not None and dec is not None and radius is not None
+        if use_region:
+            # the index on the declination narrows down the region
+            conditions.append("dec_deg BETWEEN ? AND ?")
+            parameters.extend([dec - radius, dec + radius])
+
+        if where is not None:
+            conditions.append("({})".format(where))
+
+        sql_query = "SELECT * FROM {}".format(quote(table_name))
+        if len(conditions) != 0:
+            sql_query += " WHERE {}".format(" AND ".join(conditions))
+        sql_query += " ORDER BY taskid, Source_ID"
+        if limit is not None and not use_region:
+            sql_query += " LIMIT {:d}".format(int(limit))
+
+        with self.connect() as connection:
+            db_columns = get_table_columns(connection, table_name)
+            if len(db_columns) == 0:
+                error = "Table {0} of survey catalogue {1} is empty".format(
+                    table_name, self.catalogue_file)
+                logger.error(error)
+                raise RuntimeError(error)
+            rows = connection.execute(sql_query, parameters).fetchall()
+
+        src_data = get_table_from_rows(db_columns, rows)
+
+        if use_region and len(src_data) != 0:
+            src_coord = SkyCoord(np.array(src_data['ra_deg']), np.array(
+                src_data['dec_deg']), unit=units.deg)
+            src_data = src_data[src_coord.separation(
+                SkyCoord(ra, dec, unit=units.deg)).deg <= radius]
+            if limit is not None:
+                src_data = src_data[:int(limit)]
+
+        return src_data
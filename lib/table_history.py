@@ -0,0 +1,287 @@
+"""
+Functionality to keep previous versions of the master table and the candidate table
+
+Instead of copying the full table into the backup directory in every run,
+every version is a snapshot of the table that is a hard link to the table file.
+Apersharp replaces table files (write to a temporary file and rename it)
+instead of writing into them, so the snapshot keeps the previous version
+without copying it. A version with the same content as the previous version
+uses the same snapshot.
+
+The versions are numbered and listed in <table>_history.json in the backup directory.
+Only the latest versions are kept if a maximum number of versions is given.
+Restoring a version links the snapshot back to the table file.
+"""
+
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+import logging
+import tempfile
+from time import time
+
+logger = logging.getLogger(__name__)
+
+# file with the versions of a table in the backup directory
+TABLE_HISTORY_FILE = "{}_history.json"
+
+
+def write_table_file(src_data, table_file, format="ascii.csv"):
+    """
+    Function to replace a table file with a table
+
+    The table is written to a temporary file that is renamed so that
+    snapshots of the previous version are not changed. Every writer uses
+    its own temporary file so that a left over temporary file is never
+    written into.
+    """
+
+    tmp_fd, tmp_file = tempfile.mkstemp(prefix="{}.".format(
+        os.path.basename(table_file)), suffix=".tmp", dir=os.path.dirname(os.path.abspath(table_file)))
+    os.close(tmp_fd)
+
+    try:
+        src_data.write(tmp_file, format=format, overwrite=True)
+        # mkstemp only allows the owner to read the file
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_file, 0o666 & ~umask)
+        os.rename(tmp_file, table_file)
+    except Exception:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+
+def link_file(file_path, output_file):
+    """
+    Function to create a hard link of a file or a copy if linking is not possible
+    """
+
+    try:
+        os.link(file_path, output_file)
+    except OSError:
+        shutil.copy2(file_path, output_file)
+
+
+def get_file_hash(file_path):
+    """
+    Function to get the SHA1 hash of the content of a file
+    """
+
+    file_hash = hashlib.sha1()
+
+    with open(file_path, 'rb') as stream:
+        for chunk in iter(lambda: stream.read(1024 * 1024), b''):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+
+class TableHistory(object):
+    """
+    Class to keep the versions of a table in a backup directory
+
+    Args:
+    -----
+    history_dir (str): Backup directory of the table
+    table_file (str): File of the table
+    max_versions (int): Number of versions that are kept. None to keep all versions. Default None
+    """
+
+    def __init__(self, history_dir, table_file, max_versions=None):
+        self.history_dir = history_dir
+        self.table_file = table_file
+        self.max_versions = max_versions
+
+    def get_history_file(self):
+        """
+        Function to return the path of the file with the versions
+        """
+
+        return os.path.join(self.history_dir, TABLE_HISTORY_FILE.format(
+            os.path.splitext(os.path.basename(self.table_file))[0]))
+
+    def get_versions(self):
+        """
+        Function to get the versions of the table
+
+        Return:
+        -------
+        (list): Version number, time, snapshot file, size and hash of every version starting with the oldest
+        """
+
+        history_file = self.get_history_file()
+
+        if not os.path.exists(history_file):
+            return []
+
+        with open(history_file) as stream:
+            return json.load(stream)
+
+    def write_versions(self, version_list):
+        """
+        Function to write the versions of the table
+        """
+
+        history_file = self.get_history_file()
+
+        tmp_file = "{}.tmp".format(history_file)
+        with open(tmp_file, 'w') as stream:
+            json.dump(version_list, stream, indent=1, sort_keys=True)
+        os.rename(tmp_file, history_file)
+
+    def add_version(self, table_file=None, move=False):
+        """
+        Function to add the current content of a table file as a new version
+
+        Args:
+        -----
+        table_file (str): File with the content of the table. Default is the file of the table
+        move (bool): Move the file into the backup directory instead of linking it. Default False
+
+        Return:
+        -------
+        (int): Number of the new version
+        """
+
+        if table_file is None:
+            table_file = self.table_file
+
+        if not os.path.exists(self.history_dir):
+            try:
+                os.makedirs(self.history_dir)
+            except OSError:
+                # another process may have created it at the same time
+                if not os.path.isdir(self.history_dir):
+                    raise
+
+        with open("{}.lock".format(self.get_history_file()), 'a') as lock_stream:
+            fcntl.flock(lock_stream.fileno(), fcntl.LOCK_EX)
+            try:
+                version_list = self.get_versions()
+
+                if len(version_list) == 0:
+                    version = 1
+                else:
+                    version = version_list[-1]['version'] + 1
+
+                version_entry = {'version': version,
+                                 'time': time(),
+                                 'size': os.path.getsize(table_file),
+                                 'hash': None,
+                                 'file': None}
+
+                # a table that did not change uses the snapshot of the previous version
+                if len(version_list) != 0 and version_list[-1]['size'] == version_entry['size']:
+                    previous_entry = version_list[-1]
+                    if previous_entry['hash'] is None:
+                        previous_entry['hash'] = get_file_hash(
+                            os.path.join(self.history_dir, previous_entry['file']))
+                    version_entry['hash'] = get_file_hash(table_file)
+                    if version_entry['hash'] == previous_entry['hash']:
+                        version_entry['file'] = previous_entry['file']
+
+                if version_entry['file'] is None:
+                    table_name, table_extension = os.path.splitext(
+                        os.path.basename(self.table_file))
+                    version_entry['file'] = "{0}_v{1:04d}{2}".format(
+                        table_name, version, table_extension)
+                    snapshot_file = os.path.join(
+                        self.history_dir, version_entry['file'])
+                    if move:
+                        os.rename(table_file, snapshot_file)
+                    else:
+                        link_file(table_file, snapshot_file)
+                elif move:
+                    os.remove(table_file)
+
+                version_list.append(version_entry)
+
+                self.write_versions(self.remove_old_versions(version_list))
+            finally:
+                fcntl.flock(lock_stream.fileno(), fcntl.LOCK_UN)
+
+        logger.info("Added version {0} of {1} to {2}".format(
+            version, os.path.basename(self.table_file), self.history_dir))
+
+        return version
+
+    def remove_old_versions(self, version_list):
+        """
+        Function to remove the versions exceeding the maximum number of versions
+
+        Return:
+        -------
+        (list): The versions that are kept
+        """
+
+        if self.max_versions is None or len(version_list) <= self.max_versions:
+            return version_list
+
+        kept_version_list = version_list[-int(self.max_versions):]
+        kept_file_list = [version_entry['file']
+                          for version_entry in kept_version_list]
+
+        for version_entry in version_list[:-int(self.max_versions)]:
+            snapshot_file = os.path.join(
+                self.history_dir, version_entry['file'])
+            if version_entry['file'] not in kept_file_list and os.path.exists(snapshot_file):
+                logger.debug("Removing version {0} from {1}".format(
+                    version_entry['version'], self.history_dir))
+                os.remove(snapshot_file)
+
+        return kept_version_list
+
+    def get_snapshot_file(self, version):
+        """
+        Function to get the snapshot file of a version
+
+        Return:
+        -------
+        (str): Snapshot file of the version
+        """
+
+        for version_entry in self.get_versions():
+            if version_entry['version'] == int(version):
+                return os.path.join(self.history_dir, version_entry['file'])
+
+        error = "Could not find version {0} in {1}".format(
+            version, self.history_dir)
+        logger.error(error)
+        raise RuntimeError(error)
+
+    def restore(self, version, table_file=None):
+        """
+        Function to replace a table file with a version of the table
+
+        Args:
+        -----
+        version (int): Number of the version
+        table_file (str): File for the version. Default is the file of the table
+        """
+
+        if table_file is None:
+            table_file = self.table_file
+
+        logger.info("Restoring version {0} from {1} to {2}".format(
+            version, self.history_dir, table_file))
+
+        snapshot_file = self.get_snapshot_file(version)
+
+        # renaming a link of the snapshot over the snapshot does nothing
+        if os.path.exists(table_file) and os.path.samefile(snapshot_file, table_file):
+            logger.info("Table {0} is already version {1}".format(
+                table_file, version))
+            return
+
+        tmp_file = "{}.tmp".format(table_file)
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        link_file(snapshot_file, tmp_file)
+        os.rename(tmp_file, table_file)
+
+        logger.info("Restoring version {0} from {1} to {2} ... Done".format(
+            version, self.history_dir, table_file))
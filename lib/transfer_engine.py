@@ -0,0 +1,315 @@
+"""
+Functionality to transfer files concurrently
+
+A transfer is described by a TransferJob that knows how to fetch
+a single file. The TransferEngine runs a bounded number of jobs
+at the same time, repeats failed jobs and keeps track of the progress.
+A job can require another job (e.g., the continuum image of a beam
+is only needed if the cube of the beam could be retrieved) and
+is then only started after the required job was successful.
+If a disk budget is given, a job only starts once the disk space
+it needs can be reserved. The reservation is done by a separate thread
+so that the workers remain free for jobs that do not need new space. The space stays reserved after the transfer
+and has to be released by whoever removes the files again.
+"""
+
+import os
+import logging
+import threading
+import Queue
+from time import time
+
+logger = logging.getLogger(__name__)
+
+
+class TransferJob(object):
+    """
+    Class to describe the transfer of a single file
+
+    Args:
+    -----
+    name (str): Name of the transfer used for logging
+    fetch_function (function): Function without arguments getting the file.
+        It must raise an exception if the transfer failed.
+    output_file (str): Path of the file once the transfer is done. Used for
+        the progress accounting. Default None
+    requires (TransferJob): Job that has to be successful before this job
+        is started. Default None
+    on_success (function): Function without arguments called after the
+        transfer was successful. Default None
+    cube (str): Cube the file belongs to. Default None
+    beam (str): Beam the file belongs to. Default None
+    size (int): Disk space in bytes to reserve before the transfer starts. Default 0
+    """
+
+    def __init__(self, name, fetch_function, output_file=None, requires=None, on_success=None, cube=None, beam=None, size=0):
+        self.name = name
+        self.fetch_function = fetch_function
+        self.output_file = output_file
+        self.requires = requires
+        self.on_success = on_success
+        self.cube = cube
+        self.beam = beam
+        self.size = size
+
+        # status of the job: waiting, running, done, failed
+        self.status = "waiting"
+        self.n_attempts = 0
+        self.n_bytes = 0
+        self.duration = 0.
+        self.dependent_jobs = []
+
+        if requires is not None:
+            requires.dependent_jobs.append(self)
+
+
+class TransferEngine(object):
+    """
+    Class to run file transfers concurrently
+
+    Args:
+    -----
+    n_transfers (int): Maximum number of concurrent transfers. Default 4
+    n_retries (int): Number of times a failed transfer is repeated. Default 2
+    retry_wait (float): Seconds to wait before repeating a transfer. The
+        waiting time increases with every attempt. Default 10.
+    job_callback (function): Function called with the job as argument
+        whenever a job is finished or skipped. Default None
+    disk_budget (ResourceBudget): Budget to reserve the disk space of the
+        jobs from. Default None (no limit)
+    transfer_semaphore (Semaphore): Semaphore shared with other engines, e.g., in other
+        processes, to limit the number of transfers of all of them. Default None
+    """
+
+    def __init__(self, n_transfers=4, n_retries=2, retry_wait=10., job_callback=None, disk_budget=None, transfer_semaphore=None):
+        self.n_transfers = max(1, int(n_transfers))
+        self.n_retries = max(0, int(n_retries))
+        self.retry_wait = retry_wait
+        self.job_callback = job_callback
+        self.disk_budget = disk_budget
+        self.transfer_semaphore = transfer_semaphore
+
+        self.job_list = []
+
+        # for the progress accounting
+        self.n_done = 0
+        self.n_failed = 0
+        self.n_bytes = 0
+        self.start_time = None
+
+        self._lock = threading.Lock()
+        self._queue = Queue.Queue()
+        self._admission_queue = Queue.Queue()
+        self._n_open = 0
+        self._all_finished = threading.Event()
+        self._stopped = threading.Event()
+
+    def add_job(self, job):
+        """
+        Function to add a transfer job to the engine
+        """
+
+        self.job_list.append(job)
+
+        return job
+
+    def run(self):
+        """
+        Function to run all transfer jobs
+
+        Return:
+        -------
+        (list): List of failed jobs
+        """
+
+        n_jobs = len(self.job_list)
+
+        if n_jobs == 0:
+            logger.info("No files to transfer")
+            return []
+
+        logger.info("Transferring {0} files with up to {1} concurrent transfers".format(
+            n_jobs, self.n_transfers))
+
+        self.start_time = time()
+        self._n_open = n_jobs
+        if self._stopped.is_set():
+            return [job for job in self.job_list if job.status == "failed"]
+        self._all_finished.clear()
+
+        # jobs are admitted one by one once their disk space is reserved
+        if self.disk_budget is not None:
+            admission_thread = threading.Thread(
+                target=self._admit, name="transfer_admission")
+            admission_thread.daemon = True
+            admission_thread.start()
+
+        # jobs without requirements can start right away
+        for job in self.job_list:
+            if job.requires is None:
+                self._submit(job)
+
+        # start the workers
+        worker_list = []
+        for k in range(min(self.n_transfers, n_jobs)):
+            worker = threading.Thread(
+                target=self._worker, name="transfer_{}".format(k))
+            worker.daemon = True
+            worker.start()
+            worker_list.append(worker)
+
+        # wait for all jobs (use timeout to remain interruptible)
+        while not self._all_finished.wait(1.):
+            pass
+
+        # stop the workers
+        for worker in worker_list:
+            self._queue.put(None)
+        for worker in worker_list:
+            worker.join()
+        # after a stop, the admission thread may still wait for disk space
+        if self.disk_budget is not None and not self._stopped.is_set():
+            self._admission_queue.put(None)
+            admission_thread.join()
+
+        failed_jobs = [job for job in self.job_list if job.status == "failed"]
+
+        logger.info("Transferring {0} files ... Done ({1} failed, {2}, {3:.0f}s)".format(
+            n_jobs, len(failed_jobs), self.get_progress_summary(), time() - self.start_time))
+
+        return failed_jobs
+
+    def stop(self):
+        """
+        Function to stop the transfers from another thread
+
+        Running transfers are finished, but no new transfers are started.
+        run returns once the running transfers are finished.
+        """
+
+        self._stopped.set()
+        self._all_finished.set()
+
+    def get_progress_summary(self):
+        """
+        Function to return the transferred volume and rate as a string
+        """
+
+        duration = max(time() - self.start_time, 1.e-3)
+
+        return "{0:.2f} GB at {1:.1f} MB/s".format(self.n_bytes / 1024.**3, self.n_bytes / 1024.**2 / duration)
+
+    def _submit(self, job):
+        """
+        Function to pass a job to the workers or to the admission if it needs disk space
+        """
+
+        if self.disk_budget is not None and job.size:
+            self._admission_queue.put(job)
+        else:
+            self._queue.put(job)
+
+    def _admit(self):
+        """
+        Function for the admission thread to reserve the disk space of the jobs
+        """
+
+        while True:
+            job = self._admission_queue.get()
+            if job is None:
+                break
+            self.disk_budget.acquire(job.size)
+            self._queue.put(job)
+
+    def _worker(self):
+        """
+        Function for the worker threads to process the queue
+        """
+
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            # the remaining jobs are not started after a stop
+            if self._stopped.is_set():
+                continue
+            self._run_job(job)
+
+    def _run_job(self, job):
+        """
+        Function to run a single job including retries
+        """
+
+        job.status = "running"
+        start_time_job = time()
+
+        for attempt in range(self.n_retries + 1):
+            job.n_attempts = attempt + 1
+            if self.transfer_semaphore is not None:
+                self.transfer_semaphore.acquire()
+            try:
+                job.fetch_function()
+                if job.on_success is not None:
+                    job.on_success()
+            except Exception as e:
+                logger.warning("Transfer of {0} failed (attempt {1} of {2})".format(
+                    job.name, attempt + 1, self.n_retries + 1))
+                logger.exception(e)
+                if self.transfer_semaphore is not None:
+                    self.transfer_semaphore.release()
+                # the transfer is not repeated after a stop
+                if attempt == self.n_retries or self._stopped.wait(self.retry_wait * (attempt + 1)):
+                    job.status = "failed"
+                    break
+            else:
+                if self.transfer_semaphore is not None:
+                    self.transfer_semaphore.release()
+                job.status = "done"
+                break
+
+        # the space of a failed transfer is not used
+        if job.status == "failed" and self.disk_budget is not None and job.size:
+            self.disk_budget.release(job.size)
+
+        job.duration = time() - start_time_job
+        if job.status == "done" and job.output_file is not None and os.path.exists(job.output_file):
+            job.n_bytes = os.path.getsize(job.output_file)
+
+        self._finish_job(job)
+
+    def _finish_job(self, job):
+        """
+        Function to do the accounting for a finished job and
+        release or skip the jobs depending on it
+        """
+
+        with self._lock:
+            if job.status == "done":
+                self.n_done += 1
+                self.n_bytes += job.n_bytes
+                logger.info("Transfer of {0} ... Done ({1:.0f}s). Progress: {2}/{3} files, {4}".format(
+                    job.name, job.duration, self.n_done + self.n_failed, len(self.job_list), self.get_progress_summary()))
+            else:
+                self.n_failed += 1
+                logger.error("Transfer of {0} ... Failed. Progress: {1}/{2} files".format(
+                    job.name, self.n_done + self.n_failed, len(self.job_list)))
+
+        if self.job_callback is not None:
+            try:
+                self.job_callback(job)
+            except Exception as e:
+                logger.exception(e)
+
+        for dependent_job in job.dependent_jobs:
+            if job.status == "done":
+                self._submit(dependent_job)
+            else:
+                logger.warning("Skipping transfer of {0} because transfer of {1} failed".format(
+                    dependent_job.name, job.name))
+                dependent_job.status = "failed"
+                self._finish_job(dependent_job)
+
+        with self._lock:
+            self._n_open -= 1
+            if self._n_open == 0:
+                self._all_finished.set()
@@ -1,5 +1,4 @@
 import os
-import subprocess
 import numpy as np
 import logging
 import pwd
@@ -10,16 +9,31 @@ import zipfile
 import io
 import multiprocessing as mp
 import functools
+import threading
+import json
+import Queue
 from time import time
 
 
 from lib.setup_logger import setup_logger
 from lib.abort_function import abort_function
-from lib.sharpener_pipeline import sharpener_pipeline
-from lib.get_master_table import get_all_sources_of_cube
+from lib.sharpener_pipeline import run_sharpener_pipeline
+from lib.get_master_table import get_all_sources_of_cube, get_master_table_history
 from lib.cross_match_sources import match_sources_of_beams
 from lib.analyse_spectra import analyse_spectra
 from lib.load_config import load_config
+from lib.transfer_engine import TransferEngine, TransferJob
+from lib.data_sources import get_data_source, DATA_SOURCES
+from lib.cube_cache import CubeCache
+from lib.resource_budget import ResourceBudget
+from lib.sparse_cube import create_sparse_cube, fill_sparse_cube
+from lib.memory_estimate import MemoryEstimate
+from lib.pool_results import PoolResults
+from lib.stage_file import stage_file
+from lib.sdss_cache import SDSSCache
+from lib.spectra_store import convert_spectra_to_store, has_current_spectra_store
+from lib.master_table_store import master_table_exists, get_master_table_store
+from lib.survey_catalogue import SurveyCatalogue
 from base import BaseModule
 
 # from sharpener.srun_sharpener_mp import run_sharpener as sharpener_mp
@@ -57,6 +71,57 @@ class apersharp(BaseModule):
     sharpener_do_spectra_extraction = True
     sharpener_do_plots = True
     sharpener_do_sdss = True
+    apersharp_n_transfers = 4
+    apersharp_transfer_retries = 2
+    apersharp_get_all_cubes_at_once = False
+    apersharp_alta_catalogue_max_age = 86400.
+    apersharp_stream_beams = False
+    apersharp_local_cube_pattern = "{beam}/line/cubes/HI_image_cube{cube}.fits"
+    apersharp_local_continuum_pattern = "{beam}/continuum/image_mf_??.fits"
+    apersharp_local_staging_methods = ["hardlink", "reflink", "symlink", "copy"]
+    apersharp_simulated_latency = 1.
+    apersharp_simulated_bandwidth = 100.
+    apersharp_simulated_transfer_bandwidth = None
+    apersharp_cube_cache_dir = None
+    apersharp_cube_cache_quota = None
+    apersharp_eager_clean_up = False
+    apersharp_disk_budget = None
+    apersharp_sparse_cube = False
+    apersharp_sparse_cube_max_gap = 4096
+    apersharp_process_cubes_together = False
+    apersharp_memory_budget = None
+    apersharp_memory_overhead = 0.5
+    apersharp_memory_factor = 3.
+    apersharp_memory_usage_file = None
+    apersharp_spectra_extraction_engine = "sharpener"
+    apersharp_cube_noise = False
+    apersharp_source_finding_engine = "sharpener"
+    apersharp_share_continuum = False
+    apersharp_sdss_cache = False
+    apersharp_sdss_cache_dir = None
+    apersharp_sdss_cache_max_age = None
+    apersharp_sdss_cache_refresh = False
+    apersharp_sdss_offline = False
+    apersharp_sdss_catalogue = None
+    apersharp_spectra_store = False
+    apersharp_remove_spectra_text_files = False
+    apersharp_use_cube_noise = False
+    apersharp_analysis_engine = "loop"
+    apersharp_analysis_cache = False
+    apersharp_master_table_engine = "csv"
+    apersharp_export_master_table = True
+    apersharp_survey_catalogue = None
+    apersharp_table_history_max_versions = None
+    failed_beams = None
+    failed_cubes = None
+    data_source_backend = None
+    cube_cache = None
+    continuum_locks = None
+    cubes_fetched_at_once = False
+    # set while the cores are used by the pool for sharpener
+    pool_running = False
+    core_semaphore = None
+    transfer_semaphore = None
 
     def __init__(self, config_file=None, **kwargs):
         self.default = load_config(self, config_file)
@@ -64,6 +129,12 @@ class apersharp(BaseModule):
         # making sure the list of beams is in the correct format
         self.beam_list = np.array([str(beam) for beam in self.beam_list])
 
+        # the beams without data are removed from beam_list for every cube
+        self.all_beam_list = np.array(self.beam_list)
+
+        # the continuum image of a beam is retrieved only once for all cubes
+        self.continuum_locks = {}
+
     def go(self):
         """
         Function to call all other function necessary to set things up
@@ -73,9 +144,48 @@ class apersharp(BaseModule):
         # setup_logger('DEBUG', logfile=logfile)
         # logger = logging.getLogger(__name__)
 
+        # the transfer threads must not depend on the working directory changed by sharpener
+        self.sharpener_basedir = os.path.abspath(self.sharpener_basedir)
+
+        # process each beam as soon as its data is on disk
+        stream_beams = self.apersharp_stream_beams and "get_data" in self.steps_list and \
+            "setup_sharpener" in self.steps_list and "run_sharpener" in self.steps_list
+
+        if self.apersharp_disk_budget is not None and not stream_beams:
+            logger.warning(
+                "The disk budget is only used if the beams are processed as soon as their data is on disk (apersharp_stream_beams)")
+
+        # run sharpener for the beams of all cubes in one pool
+        process_cubes_together = self.apersharp_process_cubes_together and "run_sharpener" in self.steps_list and \
+            not stream_beams
+
+        # get the data of all cubes together
+        if "get_data" in self.steps_list and (self.apersharp_get_all_cubes_at_once or process_cubes_together) and not stream_beams:
+            logger.info("# Creating directories and getting data for all cubes")
+
+            for cube in self.cube_list:
+                self.set_directories(cube=cube)
+
+            self.get_data(cube_list=self.cube_list)
+
+            self.cubes_fetched_at_once = True
+
+            logger.info(
+                "# Creating directories and getting data for all cubes ... Done")
+
+        if process_cubes_together:
+            logger.info("# Running sharpener for all cubes together")
+
+            self.run_sharpener_cubes()
+
+            logger.info("# Running sharpener for all cubes together ... Done")
+
+            return
+
         for cube in self.cube_list:
 
             self.cube = cube
+            self.beam_list = np.array(self.all_beam_list)
 
             # start time for processing this cube
             start_time_cube = time()
@@ -85,7 +195,23 @@ class apersharp(BaseModule):
 
             try:
 
-                if "get_data" in self.steps_list:
+                if stream_beams:
+                    logger.info(
+                        "# Getting data and running sharpener beam by beam")
+
+                    self.stream_sharpener()
+
+                    logger.info(
+                        "# Getting data and running sharpener beam by beam ... Done")
+                elif "get_data" in self.steps_list and self.apersharp_get_all_cubes_at_once:
+                    logger.info("# Checking data retrieved for all cubes")
+
+                    self.check_failed_cube()
+
+                    self.remove_failed_beams(self.failed_beams[cube])
+
+                    logger.info("# Checking data retrieved for all cubes ... Done")
+                elif "get_data" in self.steps_list:
                     logger.info("# Creating directories and getting data")
                     # create the directory structure
                     self.set_directories()
@@ -100,7 +226,10 @@ class apersharp(BaseModule):
                         "# Skippting creating directories and getting data")
 
                 # set things up for sharpener
-                if "setup_sharpener" in self.steps_list:
+                if stream_beams:
+                    logger.info(
+                        "# Sharpener was already set up beam by beam")
+                elif "setup_sharpener" in self.steps_list:
                     logger.info("# Setting up sharpner")
 
                     self.setup_sharpener()
@@ -110,7 +239,9 @@ class apersharp(BaseModule):
                     logger.info("# Skipping setting up sharpener")
 
                 # run sharpener
-                if "run_sharpener" in self.steps_list:
+                if stream_beams:
+                    logger.info("# Sharpener was already run beam by beam")
+                elif "run_sharpener" in self.steps_list:
                     logger.info("# Running sharpener")
 
                     self.run_sharpener()
@@ -126,79 +257,103 @@ class apersharp(BaseModule):
                 setup_logger('DEBUG', logfile=self.logfile, new_logfile=False)
                 # logger = logging.getLogger(__name__)
 
-                # collect results from sharpener
-                if "collect_results" in self.steps_list:
-                    logger.info("# Collecting results from sharpener")
+                self.process_cube_results()
+            except Exception as e:
+                logger.error("# Apersharp processing cube {0} of taskid {1} ... Failed ({2:.0f}s)".format(
+                    cube, self.taskid, time() - start_time_cube))
+                logger.exception(e)
+            else:
+                logger.info(
+                    "## Apersharp processing cube {0} of taskid {1} ... Done ({2:.0f}s)".format(cube, self.taskid, time() - start_time_cube))
 
-                    self.collect_sharpener_results()
+    def process_cube_results(self):
+        """
+        Function to process the results of sharpener for the current cube
+        """
 
-                    logger.info("# Collecting results from sharpener ... Done")
-                else:
-                    logger.info("# Skipping collecting results from sharpener")
+        # collect results from sharpener
+        if "collect_results" in self.steps_list:
+            logger.info("# Collecting results from sharpener")
 
-                # create master table
-                if "get_master_table" in self.steps_list:
-                    logger.info(
-                        "# Create master table with source information from all beams")
+            self.collect_sharpener_results()
 
-                    self.get_master_table()
+            logger.info("# Collecting results from sharpener ... Done")
+        else:
+            logger.info("# Skipping collecting results from sharpener")
 
-                    logger.info(
-                        "# Create master table with source information from all beams ... Done")
-                else:
-                    logger.info(
-                        "# Skipping Create master table with source information from all beams")
+        # create master table
+        if "get_master_table" in self.steps_list:
+            logger.info(
+                "# Create master table with source information from all beams")
 
-                # match sources across beams
-                if "match_sources" in self.steps_list:
-                    logger.info("# Matching sources found by sharpener")
+            self.get_master_table()
 
-                    self.match_sources()
+            logger.info(
+                "# Create master table with source information from all beams ... Done")
+        else:
+            logger.info(
+                "# Skipping Create master table with source information from all beams")
 
-                    logger.info(
-                        "# Matching sources found by sharpener ... Done")
-                else:
-                    logger.info(
-                        "# Skipping Matching sources found by sharpener")
+        # match sources across beams
+        if "match_sources" in self.steps_list:
+            logger.info("# Matching sources found by sharpener")
 
-                if "analyse_sources" in self.steps_list:
-                    logger.info(
-                        "# Analysing spectra of sources from sharpener")
+            self.match_sources()
 
-                    self.analyse_sources()
+            logger.info(
+                "# Matching sources found by sharpener ... Done")
+        else:
+            logger.info(
+                "# Skipping Matching sources found by sharpener")
 
-                    logger.info(
-                        "# Analysing spectra of sources from sharpener ... Done")
-                else:
-                    logger.info(
-                        "# Skipping analysis of spectra of sources from sharpener")
+        if "analyse_sources" in self.steps_list:
+            logger.info(
+                "# Analysing spectra of sources from sharpener")
 
-                # clean up by removing the images and cubes
-                if "clean_up" in self.steps_list:
-                    logger.info("# Removing cubes and continuum images")
+            self.analyse_sources()
 
-                    self.clean_up()
+            logger.info(
+                "# Analysing spectra of sources from sharpener ... Done")
+        else:
+            logger.info(
+                "# Skipping analysis of spectra of sources from sharpener")
 
-                    logger.info(
-                        "# Removing cubes and continuum images ... Done")
-                else:
-                    logger.warning(
-                        "# Did not remove cubes and continuum images. WARNING. Be aware of the disk space used by the fits files")
-            except Exception as e:
-                logger.error("# Apersharp processing cube {0} of taskid {1} ... Failed ({2:.0f}s)".format(
-                    cube, self.taskid, time() - start_time_cube))
-                logger.exception(e)
-            else:
-                logger.info(
-                    "## Apersharp processing cube {0} of taskid {1} ... Done ({2:.0f}s)".format(cube, self.taskid, time() - start_time_cube))
+        # export the master table from the store
+        if self.apersharp_master_table_engine == "sqlite" and self.apersharp_export_master_table and \
+                ("get_master_table" in self.steps_list or "match_sources" in self.steps_list or "analyse_sources" in self.steps_list):
+            self.export_master_table()
+
+        # add the tables of the cube to the catalogue of all runs
+        if self.apersharp_survey_catalogue is not None and \
+                ("get_master_table" in self.steps_list or "match_sources" in self.steps_list or "analyse_sources" in self.steps_list):
+            self.ingest_survey_catalogue()
+
+        # clean up by removing the images and cubes
+        if "clean_up" in self.steps_list:
+            logger.info("# Removing cubes and continuum images")
+
+            self.clean_up()
+
+            logger.info(
+                "# Removing cubes and continuum images ... Done")
+        else:
+            logger.warning(
+                "# Did not remove cubes and continuum images. WARNING. Be aware of the disk space used by the fits files")
 
-    def set_directories(self):
+    def set_directories(self, cube=None):
         """
         Function to create the directory structure
+
+        Args:
+        -----
+        cube (str): Cube to create the directories for. Default is the current cube
         """
 
+        if cube is None:
+            cube = self.cube
+
         # Create the cube directory
-        cube_subdir = "cube_{}".format(self.cube)
+        cube_subdir = "cube_{}".format(cube)
         self.cube_dir = os.path.join(self.sharpener_basedir, cube_subdir)
         if not os.path.exists(self.cube_dir):
             try:
@@ -207,7 +362,7 @@ class apersharp(BaseModule):
                 logger.exception(e)
             else:
                 logger.info(
-                    "Cube {}: Created directory for cube".format(self.cube))
+                    "Cube {}: Created directory for cube".format(cube))
 
         # Create beam directories if data is not coming from happili
         if self.data_source != "happili":
@@ -221,323 +376,627 @@ class apersharp(BaseModule):
                         logger.exception(e)
                     else:
                         logger.info(
-                            "Cube {0}: Created directory for beam {1}".format(self.cube, beam))
+                            "Cube {0}: Created directory for beam {1}".format(cube, beam))
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def get_data_source(self):
+        """
+        Function to return the data source for the cubes and continuum images
+
+        The data source is created only once per taskid. For ALTA, the listing
+        of the taskid is stored in the taskid directory.
+        """
+
+        if self.data_source_backend is None or self.data_source_backend.taskid != self.taskid:
+            if self.data_source == "ALTA":
+                data_source_settings = {
+                    'cache_file': os.path.join(self.sharpener_basedir, "{}_alta_listing.json".format(self.taskid)),
+                    'cache_max_age': self.apersharp_alta_catalogue_max_age}
+            else:
+                data_source_settings = {
+                    'data_basedir': self.data_basedir,
+                    'cube_pattern': self.apersharp_local_cube_pattern,
+                    'continuum_pattern': self.apersharp_local_continuum_pattern,
+                    'staging_methods': self.apersharp_local_staging_methods}
+                if self.data_source == "simulated":
+                    data_source_settings['latency'] = self.apersharp_simulated_latency
+                    data_source_settings['bandwidth'] = self.apersharp_simulated_bandwidth
+                    data_source_settings['transfer_bandwidth'] = self.apersharp_simulated_transfer_bandwidth
+
+            self.data_source_backend = get_data_source(
+                self.data_source, self.taskid, **data_source_settings)
+
+        return self.data_source_backend
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def get_cube_cache(self):
+        """
+        Function to return the shared cache for cubes and continuum images
+
+        Return:
+        -------
+        (CubeCache): The cache. None if no cache directory is set
+        """
+
+        if self.apersharp_cube_cache_dir is None:
+            return None
+
+        if self.cube_cache is None:
+            self.cube_cache = CubeCache(
+                self.apersharp_cube_cache_dir, quota=self.apersharp_cube_cache_quota)
 
-    # +++++++++++++++++++++++++++++++++++++++++++++++++++
-    def check_alta_path(self, alta_path):
+        return self.cube_cache
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def get_fetch_function(self, data_source, location, beam, output_file):
         """
-        Function to quickly check the path exists on ALTA
+        Function to return the function to retrieve a file from the data source
+
+        If the cache is enabled, the file is retrieved through the cache.
+        """
+
+        cube_cache = self.get_cube_cache()
+
+        # the size is necessary to identify the file in the cache
+        file_size = None
+        if cube_cache is not None:
+            file_size = data_source.stat(location)
+            if file_size is None:
+                logger.warning(
+                    "Size of {} is unknown. Not using the cache for this file".format(location))
+
+        if file_size is None:
+            return functools.partial(data_source.fetch, location, output_file)
+        else:
+            return functools.partial(cube_cache.fetch, self.taskid, beam, os.path.basename(location), file_size, data_source.checksum(location),
+                                     functools.partial(data_source.fetch, location), output_file)
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def get_shared_continuum_image(self, fetch_function, beam, output_file, image_id=None):
+        """
+        Function to get the continuum image of a beam only once for all cubes
+
+        The image is retrieved into the directory for the continuum products
+        of the beam and linked into the directory of the cube. The origin of the
+        image is stored next to it and an image from a different origin is
+        retrieved again.
 
         Args:
-        ----
-        alta_path (str): The path to check on ALTA
+        -----
+        fetch_function (function): Function to retrieve the image to the shared temporary file
+        beam (str): The beam
+        output_file (str): Path of the continuum image for the cube
+        image_id (dict): Data source, location and size of the image. Default None
+        """
+
+        shared_image_path = self.get_shared_cont_path(beam)
+        image_id_file = "{}.json".format(shared_image_path)
+
+        # the image id is compared after it was stored as json
+        image_id = json.loads(json.dumps(image_id))
+
+        # the cubes of a beam are transferred in different threads
+        with self.continuum_locks.setdefault(beam, threading.Lock()):
+            shared_image_id = None
+            if os.path.exists(image_id_file):
+                with open(image_id_file) as stream:
+                    shared_image_id = json.load(stream)
+
+            if os.path.exists(shared_image_path) and shared_image_id == image_id:
+                logger.info(
+                    "Using continuum image of beam {0} from {1}".format(beam, shared_image_path))
+            else:
+                if os.path.exists(shared_image_path):
+                    logger.info("Continuum image of beam {0} in {1} is from a different origin. Retrieving it again".format(
+                        beam, shared_image_path))
+                    os.remove(shared_image_path)
+                if not os.path.exists(os.path.dirname(shared_image_path)):
+                    os.makedirs(os.path.dirname(shared_image_path))
+                fetch_function()
+                os.rename("{}.tmp".format(shared_image_path),
+                          shared_image_path)
+                with open(image_id_file, 'w') as stream:
+                    json.dump(image_id, stream, sort_keys=True)
+
+        stage_file(shared_image_path, output_file,
+                   methods=["hardlink", "copy"])
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def get_continuum_directory_list(self, unit_list):
+        """
+        Function to return the directories for the continuum products shared by the cubes
+
+        Args:
+        -----
+        unit_list (list): List of (cube, beam)
 
         Return:
         -------
-        return_msg (bool): True or False if path is found
+        (list): Directory for every beam. None if the continuum products are not shared
         """
 
-        alta_cmd = "ils {}".format(alta_path)
-        logger.debug(alta_cmd)
-        return_msg = subprocess.call(alta_cmd, shell=True,
-                                     stdout=FNULL, stderr=FNULL)
-        return return_msg
+        if not self.apersharp_share_continuum:
+            return None
+
+        return [self.get_continuum_beam_dir(beam) for cube, beam in unit_list]
 
     # ++++++++++++++++++++++++++++++++++++++++++++++++++
-    def getdata_from_alta(self, alta_file_name, output_path):
+    def get_data_size(self, data_source, location):
         """
-        Function to get files from ALTA
+        Function to return the size of a file in the data source in bytes
 
-        Could be done by getdata_alta package, too.
+        Return:
+        -------
+        (int): Size of the file. 0 if the size is not known
+        """
 
-        Args
-        ----
-        alta_file_name (str): The name of the file on ALTA
-        output_path (str): The path where the file should be saved to
+        file_size = data_source.stat(location)
 
-        Return
-        ------
-        return_msg (bool): True or False if retrieving data was successfull
+        if file_size is None:
+            logger.warning(
+                "Size of {} is unknown. Not considered for the disk budget".format(location))
+            return 0
 
+        return file_size
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def get_disk_budget(self):
         """
+        Function to return the budget for the disk space used by the cubes and continuum images
 
-        # set the irod files location
-        irods_status_file = os.path.join(
-            os.getcwd(), "transfer_{}_img-icat.irods-status".format(os.path.basename(alta_file_name).split(".")[0]))
-        irods_status_lf_file = os.path.join(
-            os.getcwd(), "transfer_{}_img-icat.lf-irods-status".format(os.path.basename(alta_file_name).split(".")[0]))
+        The budget can only be used together with the eager clean up
+        because otherwise the disk space is not released before the end of the cube.
 
-        # get the file from alta
-        alta_cmd = "iget -rfPIT -X {0} --lfrestart {1} --retries 5 {2} {3}/".format(
-            irods_status_file, irods_status_lf_file, alta_file_name, output_path)
-        logger.debug(alta_cmd)
-        return_msg = subprocess.check_call(
-            alta_cmd, shell=True, stdout=FNULL, stderr=FNULL)
+        Return:
+        -------
+        (ResourceBudget): The budget. None if no budget is set
+        """
+
+        if self.apersharp_disk_budget is None:
+            return None
 
-        return return_msg
+        if not self.apersharp_eager_clean_up:
+            logger.warning(
+                "The disk budget requires the eager clean up (apersharp_eager_clean_up). Not using the disk budget")
+            return None
+
+        return ResourceBudget(self.apersharp_disk_budget * 1024.**3, name="disk space", unit=1024.**3, unit_name=" GB")
 
     # ++++++++++++++++++++++++++++++++++++++++++++++++++
-    def get_data(self):
+    def use_sparse_cube(self):
         """
-        Function to get the HI cubes and continuum images.
+        Function to check whether sparse cubes can be used instead of the full cubes
 
+        A sparse cube only contains the data around the continuum sources. This
+        requires that sharpener finds the sources and that the data source can read parts of a file.
         """
 
-        beam_dir = np.arange(self.NBEAMS)
+        if not self.apersharp_sparse_cube:
+            return False
 
-        # storing failed beams
-        failed_beams = []
-        # self.continuum_image_list = []
+        if not self.sharpener_do_source_finding or not self.sharpener_do_spectra_extraction:
+            logger.warning(
+                "Sparse cubes require source finding and spectra extraction by sharpener. Getting full cubes")
+            return False
 
-        # Going through the beams to get the data:
-        for beam in self.beam_list:
+        if self.data_source not in DATA_SOURCES or not self.get_data_source().supports_read_range:
+            logger.warning(
+                "Data source {} does not support reading parts of a file. Getting full cubes".format(self.data_source))
+            return False
 
-            # check first if they do not already exists
-            cube_path = self.get_cube_path(beam)
-            if os.path.exists(cube_path):
-                logger.info(
-                    "Cube {0}: Found cube for beam {1}".format(self.cube, beam))
+        return True
 
-                # check also the continuum image
-                continuum_image_path = self.get_cont_path(beam)
-                if os.path.exists(continuum_image_path):
-                    logger.info(
-                        "Cube {0}: Found continuum image for beam {1}".format(self.cube, beam))
-                    # self.continuum_image_list.append(continuum_image_path)
-                else:
-                    error = "Did not find continuum image for beam {}".format(
-                        beam)
-                    logger.error(error)
-                    raise RuntimeError(error)
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def analysis_uses_cube_noise(self):
+        """
+        Function to check whether the analysis of the spectra uses the noise of the cubes
+        """
 
+        return self.apersharp_use_cube_noise and not self.apersharp_use_rms
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def do_cube_noise(self):
+        """
+        Function to check whether the noise of every channel should be estimated from the cubes
+
+        The noise is only estimated if it is used by the spectra extraction of apersharp
+        or by the analysis of the spectra. This requires the full cubes as sparse cubes
+        only contain the data around the sources.
+        """
+
+        if not self.apersharp_cube_noise:
+            return False
+
+        if self.apersharp_spectra_extraction_engine != "apersharp" and not self.analysis_uses_cube_noise():
+            logger.warning(
+                "The noise of the cubes is neither used by the spectra extraction nor by the analysis. Not estimating the noise")
+            return False
+
+        if self.use_sparse_cube():
+            logger.warning(
+                "Estimating the noise of the cubes requires the full cubes. Not estimating the noise as sparse cubes are used")
+            return False
+
+        return True
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def get_sparse_cube_location_file(self, beam, cube=None):
+        """
+        Function to return the file that stores the location of the original cube of a sparse cube
+        """
+
+        return "{}.location".format(self.get_sparse_cube_path(beam, cube=cube))
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def has_sparse_cube(self, beam, cube=None):
+        """
+        Function to check whether sharpener uses the sparse cube of a beam
+
+        A full cube on disk is always used instead of the sparse cube.
+        """
+
+        return not os.path.exists(self.get_cube_path(beam, cube=cube)) and os.path.exists(self.get_sparse_cube_path(beam, cube=cube)) and os.path.exists(self.get_sparse_cube_location_file(beam, cube=cube))
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def get_beam_cube_path(self, beam, cube=None):
+        """
+        Function to return the path of the cube used by sharpener for a beam
+
+        Return:
+        -------
+        (str): The sparse cube if the beam has one. Otherwise the full cube
+        """
+
+        if self.has_sparse_cube(beam, cube=cube):
+            return self.get_sparse_cube_path(beam, cube=cube)
+        else:
+            return self.get_cube_path(beam, cube=cube)
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def get_sparse_cube(self, data_source, location, beam, cube):
+        """
+        Function to create the sparse cube of a beam with the header of the original cube
+
+        The location of the original cube is stored next to the sparse cube
+        so that it can be filled after the sources were found. It is written
+        last so that an incomplete sparse cube is not used.
+        """
+
+        create_sparse_cube(data_source, location,
+                           self.get_sparse_cube_path(beam, cube=cube))
+
+        with open(self.get_sparse_cube_location_file(beam, cube=cube), 'w') as stream:
+            stream.write(location)
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def get_sparse_cube_box_size(self):
+        """
+        Function to return half the size of the box around a source used by sharpener
+
+        The box contains the pixels used by sharpener to estimate the noise
+        and one more pixel to allow for rounding of the source position.
+        """
+
+        with open(self.sharpener_configfilename) as stream:
+            sharpener_settings = yaml.load(stream)
+
+        return int(sharpener_settings['spec_ex']['noise_delta_skip'] + sharpener_settings['spec_ex']['noise_delta_pix'] + 1)
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def get_fill_cube_function(self, beam, cube=None):
+        """
+        Function to return the function to fill the sparse cube of a beam
+
+        Return:
+        -------
+        (function): Function without arguments to fill the cube. None if the beam has a full cube
+        """
+
+        if not self.has_sparse_cube(beam, cube=cube):
+            return None
+
+        with open(self.get_sparse_cube_location_file(beam, cube=cube)) as stream:
+            location = stream.read().strip()
+
+        return functools.partial(fill_sparse_cube, self.get_data_source(), location, self.get_sparse_cube_path(beam, cube=cube),
+                                 os.path.join(self.get_cube_beam_dir(
+                                     beam, cube=cube), "sharpOut/abs/mir_src_sharp.csv"),
+                                 self.get_sparse_cube_box_size(), max_gap=self.apersharp_sparse_cube_max_gap)
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def add_beam_transfer_jobs(self, transfer_engine, data_source, beam, cube, sparse_cube=False):
+        """
+        Function to check the data of a beam in the data source and to add
+        the transfers of the cube and the continuum image to the transfer engine
+
+        Args:
+        -----
+        transfer_engine (TransferEngine): Engine to add the transfers to
+        data_source (DataSource): The data source
+        beam (str): The beam
+        cube (str): The cube
+        sparse_cube (bool): Create a sparse cube instead of getting the full cube. Default False
+
+        Return:
+        -------
+        (bool): False if the data of the beam is not available
+        """
+
+        # check that the beam is available
+        if data_source.list_beam(beam) is None:
+            logger.warning("Did not find beam {0} of taskid {1} in {2}".format(
+                beam, self.taskid, data_source.name))
+            return False
+
+        logger.info("Found beam {0} of taskid {1} in {2}".format(
+            beam, self.taskid, data_source.name))
+
+        # look for cube
+        cube_location = data_source.get_cube_location(beam, cube)
+        if cube_location is not None:
+            logger.info("Found cube in {}".format(cube_location))
+        else:
+            # if there is no cube, do not process it
+            logger.warning(
+                "No cube {0} found in {1} for beam {2} of taskid {3}".format(cube, data_source.name, beam, self.taskid))
+            return False
+
+        # create directory for beam in the directory
+        cube_beam_dir = self.get_cube_beam_dir(beam, cube=cube)
+        if not os.path.exists(cube_beam_dir):
+            logger.debug(
+                "Creating directory for beam {0} of cube {1}".format(beam, cube))
+            os.mkdir(cube_beam_dir)
+
+        # transfer of the cube
+        # the disk space for all files of the beam is reserved by this job
+        # so that a beam cannot wait for space held by other beams
+        if sparse_cube:
+            # only the header is transferred, but the blank data uses the space of the full cube
+            cube_job = transfer_engine.add_job(TransferJob(
+                "header of cube {0} of beam {1}".format(cube, beam),
+                functools.partial(self.get_sparse_cube,
+                                  data_source, cube_location, beam, cube),
+                cube=cube, beam=beam, size=self.get_data_size(data_source, cube_location)))
+        else:
+            cube_job = transfer_engine.add_job(TransferJob(
+                "cube {0} of beam {1}".format(cube, beam),
+                self.get_fetch_function(data_source, cube_location,
+                                        beam, self.get_cube_path(beam, cube=cube)),
+                output_file=self.get_cube_path(beam, cube=cube), cube=cube, beam=beam,
+                size=self.get_data_size(data_source, cube_location)))
+
+        # getting continuum fits image
+        if self.cont_src_resource == "image":
+            continuum_image_path = self.get_cont_path(beam, cube=cube)
+            if os.path.exists(continuum_image_path):
+                logger.info("Image of beam {0} of taskid {1} already on disk".format(
+                    beam, self.taskid))
+                return True
+
+            continuum_image_location = data_source.get_continuum_image_location(
+                beam)
+            # if there is no continuum image, this is a critical error
+            # This should not happen because the continuum image is necessary
+            # for the continuum subtraction
+            if continuum_image_location is None:
+                error = "No image found in {0} for beam {1} of taskid {2} but cube {3} exists. This should not happen. Abort".format(
+                    data_source.name, beam, self.taskid, cube)
+                logger.error(error)
+                raise RuntimeError(error)
+
+            logger.info(
+                "Found continuum image for beam {0} in {1}".format(beam, continuum_image_location))
+
+            # sharpener creates a miriad copy of the image
+            continuum_image_size = self.get_data_size(
+                data_source, continuum_image_location)
+            cube_job.size += 2 * continuum_image_size
+
+            if self.apersharp_share_continuum:
+                # the image is retrieved only once for all cubes
+                fetch_function = functools.partial(self.get_shared_continuum_image, self.get_fetch_function(
+                    data_source, continuum_image_location, beam, "{}.tmp".format(self.get_shared_cont_path(beam))), beam, continuum_image_path,
+                    image_id={'data_source': data_source.name, 'location': continuum_image_location,
+                              'size': continuum_image_size})
             else:
-                logger.info(
-                    "Cube {0}: Getting cube for beam {1}".format(self.cube, beam))
-
-                # go through the different options of where data can come from
-                if self.data_source == 'local':
-                    # check that the directory exists
-                    local_basedir = os.path.join(
-                        self.data_basedir, self.taskid)
-                    if os.path.exists(local_basedir):
+                fetch_function = self.get_fetch_function(data_source,
+                                                         continuum_image_location, beam, continuum_image_path)
+
+            # the image is only needed if the cube could be retrieved
+            transfer_engine.add_job(TransferJob(
+                "continuum image of beam {0} for cube {1}".format(beam, cube),
+                fetch_function, output_file=continuum_image_path, requires=cube_job, cube=cube, beam=beam))
+
+        return True
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def add_transfer_jobs(self, transfer_engine, cube_list, failed_beams, failed_cubes):
+        """
+        Function to check the data of all beams and add the necessary
+        transfers to the transfer engine
+
+        A cube that cannot be processed, e.g., because the continuum image of
+        a beam is missing, is recorded with the error and the other cubes continue.
+
+        Args:
+        -----
+        transfer_engine (TransferEngine): Engine to add the transfers to
+        cube_list (list): List of cubes to get the data for
+        failed_beams (dict): Beams without data for each cube. Will be updated
+        failed_cubes (dict): Error for each cube that cannot be processed. Will be updated
+
+        Return:
+        -------
+        (list): List of (cube, beam) for which the data is already on disk
+        """
+
+        available_data = []
+
+        sparse_cube = self.use_sparse_cube()
+
+        for cube in cube_list:
+
+            # Going through the beams to get the data:
+            for beam in self.beam_list:
+
+                # check first if they do not already exists
+                # a sparse cube is only used if sparse cubes are enabled
+                cube_path = self.get_cube_path(beam, cube=cube)
+                if os.path.exists(cube_path) or (sparse_cube and self.has_sparse_cube(beam, cube=cube)):
+                    logger.info(
+                        "Cube {0}: Found cube for beam {1}".format(cube, beam))
+
+                    # check also the continuum image
+                    continuum_image_path = self.get_cont_path(beam, cube=cube)
+                    if os.path.exists(continuum_image_path):
                         logger.info(
-                            "Found local directory for data {}".format(local_basedir))
-                        if local_basedir == self.sharpener_basedir:
-                            logger.info(
-                                "Data is already in the working directory.")
-                            get_data_local = True
-                        else:
-                            # copy the data
-                            abort_function(
-                                "Functionality to copy from a local data directory is not yet available")
-                # look for data in ALTA
-                elif self.data_source == 'ALTA':
-                    # /altaZone/archive/apertif_main/visibilities_default/<taskid>_AP_B0XY
-                    alta_taskid_beam_dir = "/altaZone/archive/apertif_main/visibilities_default/{0}_AP_B{1}".format(
-                        self.taskid, str(beam).zfill(3))
-
-                    # check that the beam is available on ALTA
-                    if self.check_alta_path(alta_taskid_beam_dir) == 0:
-                        logger.info("Found beam {} of taskid {} on ALTA".format(
-                            beam, self.taskid))
-
-                        # look for cube
-                        # look for the cube file using try and error
-                        cube_name = ''
-                        alta_beam_cube_path = ''
-                        cube_name = "HI_image_cube{}.fits".format(
-                            self.cube)
-                        alta_beam_cube_path = os.path.join(
-                            alta_taskid_beam_dir, "{}".format(cube_name))
-                        # check that path exists on alta
-                        if self.check_alta_path(alta_beam_cube_path) == 0:
-                            logger.info("Found cube on ALTA in {}".format(
-                                alta_beam_cube_path))
-                        else:
-                            # make empty again when no image was found
-                            cube_name = ''
-                        # if there is no cube, do not process it
-                        if cube_name == '':
-                            logger.warning(
-                                "No cube {0} found on ALTA for beam {1} of taskid {2}".format(self.cube, beam, self.taskid))
-                            if beam not in failed_beams:
-                                failed_beams.append(beam)
-                        else:
-                            # create directory for beam in the directory
-                            cube_beam_dir = self.get_cube_beam_dir(beam)
-                            if not os.path.exists(cube_beam_dir):
-                                logger.debug(
-                                    "Creating directory for beam {0} of cube {1}".format(beam, self.cube))
-                                os.mkdir(cube_beam_dir)
-                            # check whether file already there:
-                            if not os.path.exists(os.path.join(cube_beam_dir, os.path.basename(alta_beam_cube_path))):
-                                # copy the cube to this directory
-                                try:
-                                    return_msg = self.getdata_from_alta(
-                                        alta_beam_cube_path, cube_beam_dir)
-                                except Exception as e:
-                                    logger.error("Could not retrive cube {0}".format(
-                                        alta_beam_cube_path))
-                                    logger.exception(e)
-                                    return_msg = -1
-                                if return_msg == 0:
-                                    logger.info("Getting image cube of beam {0} of taskid {1} ... Done".format(
-                                        beam, self.taskid))
-                                else:
-                                    logger.warning("Getting image cube of beam {0} of taskid {1} ... Failed".format(
-                                        beam, self.taskid))
-                                    if beam not in failed_beams:
-                                        failed_beams.append(beam)
-                                    #  no need to try to get an image if there is no cube
-                                    continue
-                            else:
-                                logger.info("Cube {0} of beam {1} of taskid {2} already on disk".format(
-                                    self.cube, beam, self.taskid))
-
-                            # getting continuum fits image
-                            if self.cont_src_resource == "image":
-                                # now get the continuum image
-                                # look for the image file ALTA by try and error
-                                continuum_image_name = ''
-                                alta_beam_image_path = ''
-                                for k in range(10):
-                                    continuum_image_name = "image_mf_{0:02d}.fits".format(
-                                        k)
-                                    alta_beam_image_path = os.path.join(
-                                        alta_taskid_beam_dir, continuum_image_name)
-                                    if self.check_alta_path(alta_beam_image_path) == 0:
-                                        break
-                                    else:
-                                        # make empty again when no image was found
-                                        continuum_image_name = ''
-                                # if there is no continuum image, this is a critical error
-                                # This should not happen because the continuum image is necessary
-                                # for the continuum subtraction
-                                if continuum_image_name == '':
-                                    error = "No image found on ALTA for beam {0} of taskid {1} but cube {2} exists. This should not happen. Abort".format(
-                                        beam, self.taskid, self.cube)
-                                    logger.error(error)
-                                    raise RuntimeError(error)
-                                else:
-                                    logger.info(
-                                        "Found continuum image for beam {} on ALTA".format(beam))
-                                    # check whether file already there:
-                                    if not os.path.exists(os.path.join(self.get_cube_dir(), os.path.basename(alta_beam_image_path))):
-                                        # copy the continuum image to this directory
-                                        return_msg = self.getdata_from_alta(
-                                            alta_beam_image_path, cube_beam_dir)
-                                        if return_msg == 0:
-                                            logger.info("Getting image of beam {0} of taskid {1} ... Done".format(
-                                                beam, self.taskid))
-                                        else:
-                                            error = "Getting image of beam {0} of taskid {1} ... Failed".format(
-                                                beam, self.taskid)
-                                            logger.error(error)
-                                            raise RuntimeError(error)
-
-                                        # rename the file
-                                        original_continuum_image_name = os.path.join(
-                                            cube_beam_dir, continuum_image_name)
-                                        continuum_image_name = os.path.join(
-                                            cube_beam_dir, "image_mf.fits")
-                                        logger.info("Renaming {0} to {1}".format(
-                                            original_continuum_image_name, continuum_image_name))
-                                        os.rename(
-                                            original_continuum_image_name, continuum_image_name)
-
-                                        # self.continuum_image_list.append(
-                                        #     continuum_image_name)
-                                    else:
-                                        logger.info("Image of beam {0} of taskid {1} already on disk".format(
-                                            beam, self.mosaic_taskid))
+                            "Cube {0}: Found continuum image for beam {1}".format(cube, beam))
                     else:
-                        logger.warning("Did not find beam {0} of taskid {1}".format(
-                            beam, self.taskid))
-                        # remove the beam
-                        if beam not in failed_beams:
-                            failed_beams.append(beam)
+                        error = "Cube {0}: Did not find continuum image for beam {1}".format(
+                            cube, beam)
+                        logger.error(error)
+                        failed_cubes[cube] = error
+                        break
+
+                    available_data.append((cube, beam))
+                    continue
+
+                logger.info(
+                    "Cube {0}: Getting cube for beam {1}".format(cube, beam))
+
+                # data that is already in the working directory
+                if self.data_source == 'local' and os.path.abspath(os.path.join(self.data_basedir, self.taskid)) == self.sharpener_basedir:
+                    logger.info(
+                        "Data is already in the working directory.")
+                    available_data.append((cube, beam))
                 elif self.data_source == "happili":
-                    self.abort_function(
+                    abort_function(
                         "Getting data from happili not supported at the moment")
-
-                    # works only within ASTRON network
-                    logger.warning(
-                        "Cube {}: Assuming that data was transferred from happili keeping pipeline directory structure.".format(self.cube))
-                    # get the happili path
-                    if self.data_basedir == '':
-                        self.data_basedir = self.sharpener_basedir
-
-                    # go through the different beams
-                    # check if the cubes and continuum images are there
-                    # and link them to working directory
-                    for beam in self.beam_list:
-
-                        # for the cubes
-                        cube_path = os.path.join(
-                            self.data_basedir, "data/{0}/cont/cubes/HI_image_cube{1}.fits".format(beam, self.cube))
-                        link_name = os.path.join(
-                            self.sharpener_basedir, "cube{0}/HI_image_cube{1}.fits".format(beam, self.cube))
-                        # check if link exists
-                        if not os.path.exists(link_name):
-                            logger.debug("Cube {0}: Creating link {1} to cube {2}".format(
-                                self.cube, link_name, cube_path))
-                            os.symlink(cube_path, link_name)
-                        else:
-                            logger.debug("Cube {0}: Cube {1} already exists".format(
-                                self.cube, link_name))
-
-                        # for the continuum images
-                        link_name = os.path.join(
-                            self.sharpener_basedir, "{}/image_mf.fits".format(beam))
-                        # check if link exists
-                        if not os.path.exists(link_name):
-                            cont_path = os.path.join(
-                                self.data_basedir, "{0}/cont/cubes/HI_image_cube{1}.fits".format(beam, self.cube))
-                            logger.debug("Cube {0}: Creating link {1} to cube {2}".format(
-                                self.cube, link_name, cube_path))
-                            os.symlink(cube_path, link_name)
-                        else:
-                            logger.debug("Cube {0}: Continuum image {1} already exists".format(
-                                self.cube, link_name))
-
-                    # data_basedir = os.path.join(self.data_basedir, self.taskid)
-                    # happili_path = os.path.join(
-                    #     data_basedir, "./[0-3][0-9]/line/cubes/HI_image_cube{}.fits".format(self.cube))
-                    # # get the user name
-                    # user_name = pwd.getpwuid(os.getuid())[0]
-
-                    # rsync_cmd = 'rsync -Razuve ssh {0}@{1}:"{2}" {3}/'.format(
-                    #     user_name, self.data_source, happili_path, self.cube_dir)
-                    # logger.debug(rsync_cmd)
-
-                    # try:
-                    #     logger.info("Cube {0}: Copying data from {1}".format(
-                    #         self.cube, self.data_source))
-                    #     subprocess.check_call(
-                    #         rsync_cmd, shell=True, stdout=FNULL, stderr=FNULL)
-                    # except Exception as e:
-                    #     logger.error(
-                    #         "Cube {0}:Copying data from {1} ... Failed".format(self.cube, self.data_source))
-                    #     logger.exception(e)
-                    # else:
-                    #     logger.info(
-                    #         "Cube {0}:Copying data from {1} ... Done".format(self.cube, self.data_source))
                 else:
-                    error = "Did not recognize data source. Abort"
-                    logger.error(error)
-                    raise RuntimeError(error)
+                    try:
+                        data_available = self.add_beam_transfer_jobs(
+                            transfer_engine, self.get_data_source(), beam, cube, sparse_cube=sparse_cube)
+                    except RuntimeError as e:
+                        failed_cubes[cube] = str(e)
+                        break
+                    if not data_available and beam not in failed_beams[cube]:
+                        failed_beams[cube].append(beam)
+
+        return available_data
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def check_failed_transfers(self, failed_jobs, failed_beams, failed_cubes):
+        """
+        Function to add the beams with failed transfers to the failed beams
+
+        Args:
+        -----
+        failed_jobs (list): List of failed transfer jobs
+        failed_beams (dict): Beams without data for each cube. Will be updated
+        failed_cubes (dict): Error for each cube that cannot be processed. Will be updated
+        """
+
+        for job in failed_jobs:
+            # the continuum image is necessary if the cube is available
+            if job.requires is not None and job.requires.status == "done":
+                error = "Getting {0} of taskid {1} ... Failed".format(
+                    job.name, self.taskid)
+                logger.error(error)
+                if job.cube not in failed_cubes:
+                    failed_cubes[job.cube] = error
+                continue
+            logger.warning("Getting {0} of taskid {1} ... Failed".format(
+                job.name, self.taskid))
+            if job.beam not in failed_beams[job.cube]:
+                failed_beams[job.cube].append(job.beam)
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def get_data(self, cube_list=None):
+        """
+        Function to get the HI cubes and continuum images.
+
+        The data of all beams is transferred concurrently with up to
+        apersharp_n_transfers transfers at the same time.
+
+        Args:
+        -----
+        cube_list (list): List of cubes to get the data for. If not given, only the
+            current cube is retrieved and the failed beams are removed right away.
+            Otherwise, the failed beams of each cube are stored in self.failed_beams
+            and the cubes that cannot be processed in self.failed_cubes
+        """
+
+        remove_failed_beams = cube_list is None
+        if cube_list is None:
+            cube_list = [self.cube]
+
+        # storing failed beams for each cube
+        failed_beams = dict([(cube, []) for cube in cube_list])
+        failed_cubes = {}
+
+        # the transfers are collected first and then run together
+        transfer_engine = TransferEngine(
+            n_transfers=self.apersharp_n_transfers, n_retries=self.apersharp_transfer_retries,
+            transfer_semaphore=self.transfer_semaphore)
+
+        self.add_transfer_jobs(transfer_engine, cube_list,
+                               failed_beams, failed_cubes)
+
+        # run all transfers
+        failed_jobs = transfer_engine.run()
+
+        self.check_failed_transfers(failed_jobs, failed_beams, failed_cubes)
+
+        self.failed_beams = failed_beams
+        self.failed_cubes = failed_cubes
+
+        if remove_failed_beams:
+            self.check_failed_cube()
+            self.remove_failed_beams(failed_beams[self.cube])
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def check_failed_cube(self, cube=None):
+        """
+        Function to raise the error of a cube that cannot be processed
+
+        Args:
+        -----
+        cube (str): The cube. Default is the current cube
+        """
+
+        if cube is None:
+            cube = self.cube
+
+        if self.failed_cubes is not None and cube in self.failed_cubes:
+            raise RuntimeError(self.failed_cubes[cube])
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def remove_failed_beams(self, failed_beams):
+        """
+        Function to remove beams without data from the list of beams of the current cube
+
+        The beams are removed from all beams so that the beams removed for
+        another cube are not counted.
+
+        Args:
+        -----
+        failed_beams (list): List of beams without data
+        """
+
+        new_beam_list = [
+            beam for beam in self.all_beam_list if beam not in failed_beams]
 
         # check the failed beams
-        if len(failed_beams) == len(self.beam_list):
+        if len(new_beam_list) == 0:
             abort_function(
                 "Cube {0}: Did not find cubes for all beams.".format(self.cube))
-        elif len(failed_beams) != 0:
+
+        self.beam_list = np.array(new_beam_list)
+
+        if len(failed_beams) != 0:
             logger.warning("Cube {0}: Could not find cubes for some beams {1}. Removing those beams".format(self.cube,
                                                                                                             str(failed_beams)))
-            new_beam_list = self.beam_list.tolist()
-            for beam in failed_beams:
-                new_beam_list.remove(beam)
-            self.beam_list = np.array(new_beam_list)
             logger.warning("Cube {0}: Will only process cubes for {1} beams ({2})".format(
                 self.cube, len(self.beam_list), str(self.beam_list)))
         else:
@@ -545,13 +1004,10 @@ class apersharp(BaseModule):
                 "Cube {0}: Found image cubes for all beams".format(self.cube))
 
     # ++++++++++++++++++++++++++++++++++++++++++++++++++
-    def setup_sharpener(self):
+    def check_sharpener_configfile(self):
         """
-        Function to setup the parameters for sharpener
+        Function to check the template config file for sharpener
         """
-        # import sharpener
-
-        logger.info("Setting up sharpener")
 
         using_default_config_file = True
 
@@ -581,68 +1037,311 @@ class apersharp(BaseModule):
                 logger.error(error)
                 raise RuntimeError(error)
 
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def setup_sharpener_beam(self, beam, cube=None):
+        """
+        Function to copy the sharpener config file to a beam and adjust the settings
+
+        Args:
+        -----
+        beam (str): The beam
+        cube (str): The cube. Default is the current cube
+        """
+
+        if cube is None:
+            cube = self.cube
+
+        logger.info(
+            "Cube {0}: Setting up sharpener for beam {1}".format(cube, beam))
+
+        # get beam directory for given cube
+        cube_beam_dir = self.get_cube_beam_dir(beam, cube=cube)
+
+        # configfile of the beam
+        beam_configfilename = os.path.join(
+            cube_beam_dir, "beam_{0}_{1}".format(beam.zfill(2), os.path.basename(self.sharpener_configfilename).replace("default", "settings")))
+
+        # copy the file
+        shutil.copy2(self.sharpener_configfilename, beam_configfilename)
+
+        # open and read the default sharpener setup file
+        with open("{0}".format(beam_configfilename)) as stream:
+            sharpener_settings = yaml.load(stream)
+
+        # need to cut the work directory because of Miriad string limits
+        sharpener_settings['general']['workdir'] = "./"
+        # sharpener_settings['general']['workdir'] = "{0:s}/".format(
+        #     beam)
+        sharpener_settings['general']['contname'] = os.path.basename(
+            self.get_cont_path(beam, cube=cube))
+        sharpener_settings['general']['cubename'] = os.path.basename(self.get_beam_cube_path(
+            beam, cube=cube))
+
+        # make sure that certain steps are disabled only if the default is used
+        # if using_default_config_file:
+        #     sharpener_settings['source_catalog']['enable'] = False
+        #     sharpener_settings['simulate_continuum']['enable'] = False
+        #     sharpener_settings['polynomial_subtraction']['enable'] = False
+        #     sharpener_settings['hanning']['enable'] = False
+
+        #     sharpener_settings['source_finder']['enable'] = True
+        #     sharpener_settings['source_finder']['clip'] = 1e-2
+
+        #     sharpener_settings['source_catalog']['enable'] = False
+
+        #     sharpener_settings['sdss_match']['enable'] = self.do_sdss
+        #     sharpener_settings['sdss_match']['zunitCube'] = ""
+        #     sharpener_settings['sdss_match']['plot_format'] = "pdf"
+
+        #     sharpener_settings['spec_ex']['enable'] = True
+        #     sharpener_settings['spec_ex']['chrom_aberration'] = False
+
+        #     sharpener_settings['abs_plot']['enable'] = True
+        #     sharpener_settings['abs_plot']['fixed_scale'] = False
+        #     sharpener_settings['abs_plot']['plot_contImage'] = True
+        #     # for the detailed plots, 3 rows
+        #     sharpener_settings['abs_plot']['channels_per_plot'] = 406
+
+        with io.open(beam_configfilename, 'w', encoding='utf8') as outfile:
+            yaml.dump(sharpener_settings, outfile,
+                      default_flow_style=False, allow_unicode=True)
+
+        logger.info(
+            "Cube {0}: Setting up sharpener for beam {1} ... Done".format(cube, beam))
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def setup_sharpener(self):
+        """
+        Function to setup the parameters for sharpener
+        """
+        # import sharpener
+
+        logger.info("Setting up sharpener")
+
+        self.check_sharpener_configfile()
+
         # go through the list of beams, copy the config file and adjust the settings
         for beam in self.beam_list:
 
+            self.setup_sharpener_beam(beam)
+
+        logger.info("Setting up sharpener ... Done")
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def finish_sharpener_beam(self, beam, error, failed_sharpener_beams, cube=None):
+        """
+        Function to handle a beam after sharpener is finished
+
+        If enabled, the cubes and continuum images of the beam are removed right away.
+
+        Args:
+        -----
+        beam (str): The beam
+        error (str): Error message from sharpener. None if sharpener was successful
+        failed_sharpener_beams (list): List of beams for which sharpener failed. Will be updated
+        cube (str): The cube. Default is the current cube
+        """
+
+        if cube is None:
+            cube = self.cube
+
+        if error is not None:
+            logger.error("Cube {0}: Running sharpener for beam {1} ... Failed".format(
+                cube, beam))
+            logger.error(error)
+            failed_sharpener_beams.append(beam)
+        else:
             logger.info(
-                "Cube {0}: Setting up sharpener for beam {1}".format(self.cube, beam))
+                "Cube {0}: Running sharpener for beam {1} ... Done".format(cube, beam))
+            # inputs of failed beams are kept to investigate the error
+            if self.apersharp_eager_clean_up:
+                self.clean_up_beam(beam, cube=cube)
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def check_sharpener_beams(self, failed_sharpener_beams):
+        """
+        Function to raise an error if sharpener failed for any beam
+        """
+
+        if len(failed_sharpener_beams) != 0:
+            error = "Cube {0}: Running sharpener failed for beams {1}".format(
+                self.cube, str(sorted(failed_sharpener_beams)))
+            logger.error(error)
+            raise RuntimeError(error)
 
-            # get beam directory for given cube
-            cube_beam_dir = self.get_cube_beam_dir(beam)
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def get_pool(self, renew_processes=None):
+        """
+        Function to create the pool of processes for running sharpener
 
-            # configfile of the beam
-            beam_configfilename = os.path.join(
-                cube_beam_dir, "beam_{0}_{1}".format(beam.zfill(2), os.path.basename(self.sharpener_configfilename).replace("default", "settings")))
+        If the cores are shared with other taskids, a beam is only passed to
+        the pool once one of the shared cores is available (see PoolResults).
 
-            # copy the file
-            shutil.copy2(self.sharpener_configfilename, beam_configfilename)
+        Args:
+        -----
+        renew_processes (bool): Use a new process for every beam so that the memory
+            is returned after each beam and the peak memory is measured per beam.
+            Should not be used if other threads are running. Default None to only
+            use new processes if a memory budget is set
+        """
 
-            # open and read the default sharpener setup file
-            with open("{0}".format(beam_configfilename)) as stream:
-                sharpener_settings = yaml.load(stream)
+        if renew_processes is None:
+            renew_processes = self.apersharp_memory_budget is not None
 
-            # need to cut the work directory because of Miriad string limits
-            sharpener_settings['general']['workdir'] = "./"
-            # sharpener_settings['general']['workdir'] = "{0:s}/".format(
-            #     beam)
-            sharpener_settings['general']['contname'] = os.path.basename(
-                self.get_cont_path(beam))
-            sharpener_settings['general']['cubename'] = os.path.basename(self.get_cube_path(
-                beam))
+        if renew_processes:
+            maxtasksperchild = 1
+        else:
+            maxtasksperchild = None
 
-            # make sure that certain steps are disabled only if the default is used
-            # if using_default_config_file:
-            #     sharpener_settings['source_catalog']['enable'] = False
-            #     sharpener_settings['simulate_continuum']['enable'] = False
-            #     sharpener_settings['polynomial_subtraction']['enable'] = False
-            #     sharpener_settings['hanning']['enable'] = False
+        return mp.Pool(processes=self.n_cores, maxtasksperchild=maxtasksperchild)
 
-            #     sharpener_settings['source_finder']['enable'] = True
-            #     sharpener_settings['source_finder']['clip'] = 1e-2
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def run_on_shared_core(self, function, *args, **kwargs):
+        """
+        Function to run sharpener for a beam in this process on one of the cores shared with other taskids
+        """
 
-            #     sharpener_settings['source_catalog']['enable'] = False
+        if self.core_semaphore is not None:
+            self.core_semaphore.acquire()
 
-            #     sharpener_settings['sdss_match']['enable'] = self.do_sdss
-            #     sharpener_settings['sdss_match']['zunitCube'] = ""
-            #     sharpener_settings['sdss_match']['plot_format'] = "pdf"
+        try:
+            return function(*args, **kwargs)
+        finally:
+            if self.core_semaphore is not None:
+                self.core_semaphore.release()
 
-            #     sharpener_settings['spec_ex']['enable'] = True
-            #     sharpener_settings['spec_ex']['chrom_aberration'] = False
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def get_memory_estimate(self):
+        """
+        Function to return the estimate of the memory needed by sharpener for a beam
 
-            #     sharpener_settings['abs_plot']['enable'] = True
-            #     sharpener_settings['abs_plot']['fixed_scale'] = False
-            #     sharpener_settings['abs_plot']['plot_contImage'] = True
-            #     # for the detailed plots, 3 rows
-            #     sharpener_settings['abs_plot']['channels_per_plot'] = 406
+        The peak memory of the beams is recorded in apersharp_memory_usage_file
+        or by default in "apersharp_memory_usage.json" next to the taskid directories.
+        """
 
-            with io.open(beam_configfilename, 'w', encoding='utf8') as outfile:
-                yaml.dump(sharpener_settings, outfile,
-                          default_flow_style=False, allow_unicode=True)
+        if self.apersharp_memory_usage_file is None:
+            usage_file = os.path.join(os.path.dirname(os.path.normpath(
+                self.sharpener_basedir)), "apersharp_memory_usage.json")
+        else:
+            usage_file = self.apersharp_memory_usage_file
 
-            logger.info(
-                "Cube {0}: Setting up sharpener for beam {1} ... Done".format(self.cube, beam))
+        return MemoryEstimate(usage_file=usage_file, overhead=self.apersharp_memory_overhead, factor=self.apersharp_memory_factor)
 
-        logger.info("Setting up sharpener ... Done")
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def get_sdss_cache(self):
+        """
+        Function to return the cache for the queries of SDSS sources
+
+        The queries are stored in apersharp_sdss_cache_dir or by default
+        in "sdss_cache" next to the taskid directories.
+
+        Return:
+        -------
+        (SDSSCache): The cache. None if neither the cache nor the offline mode is used
+        """
+
+        if not self.apersharp_sdss_cache and not self.apersharp_sdss_offline:
+            return None
+
+        if not self.apersharp_sdss_cache:
+            cache_dir = None
+        elif self.apersharp_sdss_cache_dir is None:
+            cache_dir = os.path.join(os.path.dirname(os.path.normpath(
+                self.sharpener_basedir)), "sdss_cache")
+        else:
+            cache_dir = self.apersharp_sdss_cache_dir
+
+        return SDSSCache(cache_dir=cache_dir, offline=self.apersharp_sdss_offline, catalogue_file=self.apersharp_sdss_catalogue,
+                         max_age=self.apersharp_sdss_cache_max_age, refresh=self.apersharp_sdss_cache_refresh)
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def get_memory_budget(self):
+        """
+        Function to return the budget for the memory used by sharpener
+
+        Return:
+        -------
+        (ResourceBudget): The budget. None if no budget is set
+        """
+
+        if self.apersharp_memory_budget is None:
+            return None
+
+        return ResourceBudget(self.apersharp_memory_budget * 1024.**3, name="memory", unit=1024.**3, unit_name=" GB")
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def run_pool_beams(self, pool, function, index_list, cube_file_list, finish_function):
+        """
+        Function to run sharpener for beams in the pool while their memory fits into the budget
+
+        If a memory budget is set, the memory of each beam is estimated from
+        its cube. A beam is only passed to the pool if its memory fits into the
+        memory budget together with the beams that are still running. The peak
+        memory of every beam is recorded to improve the estimates.
+
+        Args:
+        -----
+        pool (Pool): The pool of processes created by get_pool
+        function (function): Function running sharpener with the index of the beam as argument
+        index_list (list): Indices of the beams in the order they should be processed
+        cube_file_list (list): Cube of every beam in the same order as index_list
+        finish_function (function): Function called with the index and the error for every finished beam
+
+        Beams whose task failed in the pool, e.g., because its worker was killed,
+        are finished with the error. The pool is terminated if tasks were lost with their workers.
+        """
+
+        memory_budget = self.get_memory_budget()
+        if memory_budget is not None:
+            memory_estimate = self.get_memory_estimate()
+        else:
+            memory_estimate = None
+
+        # results are collected in this thread as failed tasks have no callback
+        pool_results = PoolResults(pool, core_semaphore=self.core_semaphore)
+
+        def finish_result():
+            """
+            Helper to finish the next beam returned by the pool
+            """
+
+            (index, cube_file, estimated_memory), result, error = pool_results.get()
+            if memory_budget is not None:
+                memory_budget.release(estimated_memory)
+            if result is None:
+                finish_function(index, error)
+                return
+            if memory_estimate is not None:
+                memory_estimate.record(
+                    cube_file, result[2], estimated_memory=estimated_memory)
+            finish_function(result[0], result[1])
+
+        try:
+            for index, cube_file in zip(index_list, cube_file_list):
+                estimated_memory = None
+                if memory_budget is not None:
+                    estimated_memory = memory_estimate.estimate(cube_file)
+                    # finish beams until there is enough memory for this one
+                    while not memory_budget.fits(estimated_memory):
+                        finish_result()
+                    memory_budget.acquire(estimated_memory, block=False)
+                pool_results.acquire_core()
+                pool_results.add((index, cube_file, estimated_memory),
+                                 pool.apply_async(function, (index,)))
+
+            while len(pool_results) != 0:
+                finish_result()
+        finally:
+            # the cores of beams that were not collected are not used by this taskid any more
+            pool_results.release_cores()
+
+        # the pool would wait forever for the tasks of killed workers
+        if pool_results.n_lost != 0:
+            pool.terminate()
+
+        if memory_budget is not None:
+            logger.info("Peak of reserved memory was {0:.2f} GB of {1:.2f} GB".format(
+                memory_budget.peak / 1024.**3, self.apersharp_memory_budget))
 
     # ++++++++++++++++++++++++++++++++++++++++++++++++++
     def run_sharpener(self):
@@ -658,27 +1357,47 @@ class apersharp(BaseModule):
         # index array for pool based on the number of files
         beam_count = np.arange(np.size(beam_directory_list))
 
+        failed_sharpener_beams = []
+
+        # sparse cubes are filled after the sources were found
+        fill_cube_function_list = [
+            self.get_fill_cube_function(beam) for beam in self.beam_list]
+        if np.all([fill_cube_function is None for fill_cube_function in fill_cube_function_list]):
+            fill_cube_function_list = None
+
+        # the continuum products are shared by the cubes of a beam
+        continuum_directory_list = self.get_continuum_directory_list(
+            [(self.cube, beam) for beam in self.beam_list])
+
         # if only one core is requested, use loop instead of pool
         if self.n_cores == 1:
             logger.info(
                 "Cube {0}: Processing on one core only".format(self.cube))
             for beam_index in beam_count:
-                sharpener_pipeline(beam_directory_list, self.sharpener_do_source_finding,
-                                   self.sharpener_do_spectra_extraction, self.sharpener_do_plots, self.sharpener_do_sdss, beam_index)
-                # setup_logger('DEBUG', logfile=self.logfile, new_logfile=False)
-                # logger = logging.getLogger(__name__)
+                beam_index, error, peak_memory = self.run_on_shared_core(run_sharpener_pipeline, beam_directory_list, self.sharpener_do_source_finding,
+                                                                         self.sharpener_do_spectra_extraction, self.sharpener_do_plots, self.sharpener_do_sdss, beam_index,
+                                                                         fill_cube_function_list=fill_cube_function_list, spectra_extraction_engine=self.apersharp_spectra_extraction_engine, do_cube_noise=self.do_cube_noise(), use_cube_noise=self.analysis_uses_cube_noise(), source_finding_engine=self.apersharp_source_finding_engine,
+                                                                         continuum_directory_list=continuum_directory_list, sdss_cache=self.get_sdss_cache(),
+                                                                         spectra_store=self.apersharp_spectra_store, remove_text_files=self.apersharp_remove_spectra_text_files)
+                setup_logger('DEBUG', logfile=self.logfile, new_logfile=False)
+                self.finish_sharpener_beam(
+                    self.beam_list[beam_index], error, failed_sharpener_beams)
         else:
             logger.info("Cube {0}: Processing on {1} cores".format(
                 self.cube, self.n_cores))
             # create pool object with number of processes
-            pool = mp.Pool(processes=self.n_cores)
+            pool = self.get_pool()
 
             # create function iterater to provide additional arguments
             fct_partial = functools.partial(
-                sharpener_pipeline, beam_directory_list, self.sharpener_do_source_finding, self.sharpener_do_spectra_extraction, self.sharpener_do_plots, self.sharpener_do_sdss)
-
-            # create and run map
-            pool.map(fct_partial, beam_count)
+                run_sharpener_pipeline, beam_directory_list, self.sharpener_do_source_finding, self.sharpener_do_spectra_extraction, self.sharpener_do_plots, self.sharpener_do_sdss,
+                fill_cube_function_list=fill_cube_function_list, spectra_extraction_engine=self.apersharp_spectra_extraction_engine, do_cube_noise=self.do_cube_noise(), use_cube_noise=self.analysis_uses_cube_noise(), source_finding_engine=self.apersharp_source_finding_engine,
+                continuum_directory_list=continuum_directory_list, sdss_cache=self.get_sdss_cache(),
+                spectra_store=self.apersharp_spectra_store, remove_text_files=self.apersharp_remove_spectra_text_files)
+
+            # handle each beam as soon as it is finished
+            self.run_pool_beams(pool, fct_partial, beam_count, [self.get_beam_cube_path(beam) for beam in self.beam_list],
+                                lambda beam_index, error: self.finish_sharpener_beam(self.beam_list[beam_index], error, failed_sharpener_beams))
             pool.close()
             pool.join()
 
@@ -688,9 +1407,406 @@ class apersharp(BaseModule):
         setup_logger('DEBUG', logfile=self.logfile, new_logfile=False)
         # logger = logging.getLogger(__name__)
 
+        self.check_sharpener_beams(failed_sharpener_beams)
+
         logger.info("Cube {0}: Running sharpener ... Done".format(
             self.cube, str(self.beam_list)))
 
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def stream_sharpener(self):
+        """
+        Function to get the data, set up and run sharpener beam by beam
+
+        Each beam is set up and processed by sharpener as soon as its cube
+        and continuum image are on disk while the data of the other beams
+        is still being transferred. With a disk budget, new transfers only
+        start if the data fits into the budget. The space is released once
+        the data of a beam was removed by the eager clean up. With a disk budget,
+        the data of failed beams is removed, too.
+        """
+
+        logger.info(
+            "Cube {0}: Getting data and running sharpener beam by beam".format(self.cube))
+
+        self.set_directories()
+
+        self.check_sharpener_configfile()
+
+        # storing failed beams
+        failed_beams = {self.cube: []}
+        failed_cubes = {}
+        failed_sharpener_beams = []
+
+        # beams are put in this queue as soon as their data is on disk
+        # together with False if getting the data failed
+        beam_queue = Queue.Queue()
+        queued_beams = []
+        queue_lock = threading.Lock()
+
+        def queue_beam(job):
+            """
+            Helper to queue a beam once all its transfers are finished
+            """
+
+            with queue_lock:
+                if job.beam in queued_beams:
+                    return
+                job_status = [beam_job.status for beam_job in transfer_engine.job_list
+                              if beam_job.beam == job.beam]
+                if "failed" in job_status:
+                    queued_beams.append(job.beam)
+                    beam_queue.put((job.beam, False))
+                elif np.all([status == "done" for status in job_status]):
+                    queued_beams.append(job.beam)
+                    beam_queue.put((job.beam, True))
+
+        disk_budget = self.get_disk_budget()
+
+        # disk space reserved for data that was already on disk
+        reserved_disk_space = {}
+
+        memory_budget = self.get_memory_budget()
+        if memory_budget is not None:
+            memory_estimate = self.get_memory_estimate()
+        else:
+            memory_estimate = None
+
+        # estimated memory of the beams running in the pool
+        estimated_memory = {}
+
+        def release_beam(beam, error):
+            """
+            Helper to finish a beam and release its memory and, once its data was removed, its disk space
+            """
+
+            if memory_budget is not None and beam in estimated_memory:
+                memory_budget.release(estimated_memory.pop(beam))
+
+            self.finish_sharpener_beam(beam, error, failed_sharpener_beams)
+
+            if disk_budget is not None:
+                # the data of failed beams cannot be kept without exceeding the disk budget
+                if error is not None:
+                    logger.warning("Cube {0}: Removing the data of failed beam {1} to stay within the disk budget".format(
+                        self.cube, beam))
+                    self.clean_up_beam(beam)
+                # failed transfers have already released their space
+                disk_budget.release(reserved_disk_space.get(beam, 0) + sum([
+                    job.size for job in transfer_engine.job_list if job.beam == beam and job.status == "done"]))
+
+        transfer_engine = TransferEngine(
+            n_transfers=self.apersharp_n_transfers, n_retries=self.apersharp_transfer_retries, job_callback=queue_beam,
+            disk_budget=disk_budget, transfer_semaphore=self.transfer_semaphore)
+
+        available_data = self.add_transfer_jobs(
+            transfer_engine, [self.cube], failed_beams, failed_cubes)
+
+        self.failed_cubes = failed_cubes
+        self.check_failed_cube()
+
+        # beams already on disk can be processed right away
+        for cube, beam in available_data:
+            if disk_budget is not None:
+                reserved_disk_space[beam] = sum([os.path.getsize(file_path) for file_path in [
+                    self.get_beam_cube_path(beam), self.get_cont_path(beam)] if os.path.exists(file_path)])
+                disk_budget.acquire(reserved_disk_space[beam], block=False)
+            queued_beams.append(beam)
+            beam_queue.put((beam, True))
+
+        n_beams = len(self.beam_list) - len(failed_beams[self.cube])
+
+        # sharpener always runs in the processes of the pool because it changes the working
+        # directory and the logger, which must not happen while the transfer threads are running.
+        # The pool has to be created before the transfer threads are started
+        if self.n_cores == 1:
+            logger.info(
+                "Cube {0}: Processing on one core only".format(self.cube))
+        else:
+            logger.info("Cube {0}: Processing on {1} cores".format(
+                self.cube, self.n_cores))
+        # new processes must not be started while the transfer threads are running
+        pool = self.get_pool(renew_processes=False)
+
+        # results are collected in this thread as failed tasks have no callback
+        pool_results = PoolResults(pool, core_semaphore=self.core_semaphore)
+
+        def finish_result(timeout=None):
+            """
+            Helper to finish the next beam returned by the pool
+
+            Return:
+            -------
+            (bool): True if a beam was finished within the timeout
+            """
+
+            finished = pool_results.get(timeout=timeout)
+            if finished is None:
+                return False
+            beam, result, error = finished
+            if result is not None:
+                error = result[1]
+            # errors of a single beam must not stop the other beams
+            try:
+                release_beam(beam, error)
+            except Exception as e:
+                logger.exception(e)
+            return True
+
+        def get_next_beam():
+            """
+            Helper to wait for the next beam with its data while finishing the beams of the pool
+            """
+
+            while True:
+                while finish_result(timeout=0):
+                    pass
+                try:
+                    return beam_queue.get(timeout=pool_results.poll_interval)
+                except Queue.Empty:
+                    pass
+
+        transfer_thread = threading.Thread(
+            target=transfer_engine.run, name="transfer_engine")
+        transfer_thread.daemon = True
+        transfer_thread.start()
+
+        try:
+            for k in range(n_beams):
+
+                beam, data_available = get_next_beam()
+
+                if not data_available:
+                    logger.warning(
+                        "Cube {0}: Getting data for beam {1} failed. Skipping beam".format(self.cube, beam))
+                    if self.apersharp_eager_clean_up:
+                        # remove what was transferred to free the space
+                        self.clean_up_beam(beam)
+                    if disk_budget is not None:
+                        disk_budget.release(sum([
+                            job.size for job in transfer_engine.job_list if job.beam == beam and job.status == "done"]))
+                    continue
+
+                logger.info(
+                    "Cube {0}: Data for beam {1} available. Running sharpener".format(self.cube, beam))
+
+                self.setup_sharpener_beam(beam)
+
+                beam_directory_list = np.array([self.get_cube_beam_dir(beam)])
+
+                fill_cube_function_list = [self.get_fill_cube_function(beam)]
+
+                continuum_directory_list = self.get_continuum_directory_list([
+                                                                             (self.cube, beam)])
+
+                # the peak memory is not recorded as the processes of the pool are reused
+                if memory_budget is not None:
+                    estimated_memory[beam] = memory_estimate.estimate(
+                        self.get_beam_cube_path(beam))
+                    # finish beams until there is enough memory for this one
+                    while not memory_budget.fits(estimated_memory[beam]) and finish_result():
+                        pass
+                    memory_budget.acquire(
+                        estimated_memory[beam], block=False)
+                pool_results.acquire_core()
+                async_result = pool.apply_async(run_sharpener_pipeline, (beam_directory_list, self.sharpener_do_source_finding,
+                                                                         self.sharpener_do_spectra_extraction, self.sharpener_do_plots, self.sharpener_do_sdss, 0),
+                                                {'fill_cube_function_list': fill_cube_function_list,
+                                                 'spectra_extraction_engine': self.apersharp_spectra_extraction_engine, 'do_cube_noise': self.do_cube_noise(), 'use_cube_noise': self.analysis_uses_cube_noise(),
+                                                 'source_finding_engine': self.apersharp_source_finding_engine, 'continuum_directory_list': continuum_directory_list,
+                                                 'sdss_cache': self.get_sdss_cache(), 'spectra_store': self.apersharp_spectra_store,
+                                                 'remove_text_files': self.apersharp_remove_spectra_text_files})
+                pool_results.add(beam, async_result)
+
+            while finish_result():
+                pass
+
+            pool_results.close_pool()
+
+            transfer_thread.join()
+        except BaseException:
+            # do not leave transfers and sharpener runs behind
+            transfer_engine.stop()
+            pool.terminate()
+            pool.join()
+            pool_results.release_cores()
+            transfer_thread.join()
+            raise
+
+        setup_logger('DEBUG', logfile=self.logfile, new_logfile=False)
+
+        if memory_budget is not None:
+            logger.info("Cube {0}: Peak of reserved memory was {1:.2f} GB of {2:.2f} GB".format(
+                self.cube, memory_budget.peak / 1024.**3, self.apersharp_memory_budget))
+
+        if disk_budget is not None:
+            logger.info("Cube {0}: Peak of reserved disk space was {1:.2f} GB of {2:.2f} GB".format(
+                self.cube, disk_budget.peak / 1024.**3, self.apersharp_disk_budget))
+
+        failed_jobs = [
+            job for job in transfer_engine.job_list if job.status == "failed"]
+        self.check_failed_transfers(failed_jobs, failed_beams, failed_cubes)
+
+        self.failed_beams = failed_beams
+
+        self.check_failed_cube()
+
+        self.remove_failed_beams(failed_beams[self.cube])
+
+        self.check_sharpener_beams(failed_sharpener_beams)
+
+        logger.info(
+            "Cube {0}: Getting data and running sharpener beam by beam ... Done".format(self.cube))
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def run_sharpener_cubes(self):
+        """
+        Function to set up and run sharpener for the beams of all cubes in a single pool
+
+        The beams are processed starting with the largest cubes independent of
+        the cube they belong to. The results of a cube are processed as soon
+        as sharpener has finished all its beams while the pool continues with
+        the beams of the other cubes.
+        """
+
+        logger.info("Running sharpener for cubes {}".format(
+            str(self.cube_list)))
+
+        beam_list = self.beam_list
+
+        # beams of each cube and the start time for processing the cube
+        cube_beam_lists = {}
+        start_time_cubes = {}
+        unit_list = []
+
+        for cube in self.cube_list:
+
+            self.cube = cube
+            self.beam_list = beam_list
+            start_time_cubes[cube] = time()
+
+            logger.info("#### Apersharp processing cube {0} of taskid {1}".format(
+                cube, self.taskid))
+
+            try:
+                if "get_data" in self.steps_list:
+                    self.check_failed_cube()
+
+                    self.remove_failed_beams(self.failed_beams[cube])
+
+                if "setup_sharpener" in self.steps_list:
+                    logger.info("# Setting up sharpner")
+
+                    self.setup_sharpener()
+
+                    logger.info("# Setting up sharpner ... Done")
+                else:
+                    logger.info("# Skipping setting up sharpener")
+            except Exception as e:
+                logger.error("# Apersharp processing cube {0} of taskid {1} ... Failed ({2:.0f}s)".format(
+                    cube, self.taskid, time() - start_time_cubes[cube]))
+                logger.exception(e)
+                continue
+
+            cube_beam_lists[cube] = self.beam_list
+            unit_list.extend([(cube, beam) for beam in self.beam_list])
+
+        self.beam_list = beam_list
+
+        def get_cube_size(unit):
+            """
+            Helper to get the size of the cube of a beam
+            """
+
+            cube_path = self.get_beam_cube_path(unit[1], cube=unit[0])
+            if os.path.exists(cube_path):
+                return os.path.getsize(cube_path)
+            else:
+                return 0
+
+        # largest cubes first
+        unit_list.sort(key=get_cube_size, reverse=True)
+
+        beam_directory_list = np.array([
+            self.get_cube_beam_dir(beam, cube=cube) for cube, beam in unit_list])
+
+        fill_cube_function_list = [
+            self.get_fill_cube_function(beam, cube=cube) for cube, beam in unit_list]
+        if np.all([fill_cube_function is None for fill_cube_function in fill_cube_function_list]):
+            fill_cube_function_list = None
+
+        # number of beams of each cube that are not finished
+        n_open_beams = dict([(cube, len(cube_beam_lists[cube]))
+                             for cube in cube_beam_lists])
+        failed_sharpener_beams = dict([(cube, [])
+                                       for cube in cube_beam_lists])
+
+        def finish_unit(unit_index, error):
+            """
+            Helper to finish a beam and the cube once all its beams are finished
+            """
+
+            cube, beam = unit_list[unit_index]
+
+            self.finish_sharpener_beam(
+                beam, error, failed_sharpener_beams[cube], cube=cube)
+
+            n_open_beams[cube] -= 1
+            if n_open_beams[cube] == 0:
+                self.cube = cube
+                self.beam_list = cube_beam_lists[cube]
+                try:
+                    self.check_sharpener_beams(failed_sharpener_beams[cube])
+
+                    self.process_cube_results()
+                except Exception as e:
+                    logger.error("# Apersharp processing cube {0} of taskid {1} ... Failed ({2:.0f}s)".format(
+                        cube, self.taskid, time() - start_time_cubes[cube]))
+                    logger.exception(e)
+                else:
+                    logger.info(
+                        "## Apersharp processing cube {0} of taskid {1} ... Done ({2:.0f}s)".format(cube, self.taskid, time() - start_time_cubes[cube]))
+                self.beam_list = beam_list
+
+        fct_partial = functools.partial(
+            run_sharpener_pipeline, beam_directory_list, self.sharpener_do_source_finding, self.sharpener_do_spectra_extraction, self.sharpener_do_plots, self.sharpener_do_sdss,
+            fill_cube_function_list=fill_cube_function_list, spectra_extraction_engine=self.apersharp_spectra_extraction_engine, do_cube_noise=self.do_cube_noise(), use_cube_noise=self.analysis_uses_cube_noise(), source_finding_engine=self.apersharp_source_finding_engine,
+            continuum_directory_list=self.get_continuum_directory_list(unit_list), sdss_cache=self.get_sdss_cache(),
+            spectra_store=self.apersharp_spectra_store, remove_text_files=self.apersharp_remove_spectra_text_files)
+
+        # if only one core is requested, use loop instead of pool
+        if self.n_cores == 1:
+            logger.info(
+                "Processing {} beams on one core only".format(len(unit_list)))
+            for unit_index in range(len(unit_list)):
+                unit_index, error, peak_memory = self.run_on_shared_core(
+                    fct_partial, unit_index)
+                setup_logger('DEBUG', logfile=self.logfile, new_logfile=False)
+                finish_unit(unit_index, error)
+        else:
+            logger.info("Processing {0} beams on {1} cores".format(
+                len(unit_list), self.n_cores))
+            pool = self.get_pool()
+
+            # beams are handed out one by one as workers become available
+            self.pool_running = True
+            try:
+                self.run_pool_beams(pool, fct_partial, range(len(unit_list)), [self.get_beam_cube_path(beam, cube=cube) for cube, beam in unit_list],
+                                    finish_unit)
+                pool.close()
+                pool.join()
+            except BaseException:
+                # do not leave sharpener runs behind
+                pool.terminate()
+                pool.join()
+                raise
+            finally:
+                self.pool_running = False
+
+        setup_logger('DEBUG', logfile=self.logfile, new_logfile=False)
+
+        logger.info("Running sharpener for cubes {} ... Done".format(
+            str(self.cube_list)))
+
     # ++++++++++++++++++++++++++++++++++++++++++++++++++
     def collect_sharpener_results(self):
         """
@@ -778,6 +1894,28 @@ class apersharp(BaseModule):
         else:
             logger.info("Did not create zip file for source files")
 
+        # Store the spectra of every beam in binary files
+        # +++++++++++++++++++++++++++++++++++++++++++++++
+
+        if self.apersharp_spectra_store:
+            logger.info("Converting spectra to spectra stores")
+
+            # the spectra of the beams extracted in this run are already in the stores
+            for beam in self.beam_list:
+                if has_current_spectra_store(self.get_cube_beam_dir(beam)):
+                    logger.debug(
+                        "Cube {0}: Using spectra store of beam {1}".format(self.cube, beam))
+                elif os.path.isdir(os.path.join(self.get_cube_beam_dir(beam), "sharpOut/spec")):
+                    convert_spectra_to_store(self.get_cube_beam_dir(
+                        beam), remove_text_files=self.apersharp_remove_spectra_text_files)
+                else:
+                    logger.warning(
+                        "Cube {0}: No spectra for beam {1}".format(self.cube, beam))
+
+            logger.info("Converting spectra to spectra stores ... Done")
+        else:
+            logger.info("Did not convert spectra to spectra stores")
+
         logger.info(
             "Cube {0}: Collecting the results from sharpener ... Done".format(self.cube))
 
@@ -799,7 +1937,9 @@ class apersharp(BaseModule):
                                 taskid=self.taskid, cube_nr=self.cube, beam_list=self.beam_list,
                                 overwrite_master_table=self.apersharp_overwrite_master_table,
                                 create_master_table_backup=self.apersharp_create_master_table_backup,
-                                allow_multiple_source_entries=self.apersharp_allow_multiple_source_entries)
+                                allow_multiple_source_entries=self.apersharp_allow_multiple_source_entries,
+                                master_table_engine=self.apersharp_master_table_engine,
+                                table_history_max_versions=self.apersharp_table_history_max_versions)
 
         logger.info(
             "Cube {}: Collecting source information from different beams ... Done".format(self.cube))
@@ -815,7 +1955,7 @@ class apersharp(BaseModule):
 
         # check that csv file exists
         # i.e., that the master table has been created
-        if not os.path.exists(self.get_src_csv_file_name()):
+        if not self.has_master_table():
             logger.warning(
                 "Could not find file with source information. Will create master table now before continuing.")
             self.get_master_table()
@@ -829,7 +1969,8 @@ class apersharp(BaseModule):
         self.cube_dir = self.get_cube_dir()
 
         # match the srouces
-        match_sources_of_beams(src_cat_file_name, max_sep=3)
+        match_sources_of_beams(src_cat_file_name, max_sep=3,
+                               master_table_engine=self.apersharp_master_table_engine)
 
         logger.info(
             "Cube {}: Matching sources from different beams ... Done".format(self.cube))
@@ -845,7 +1986,7 @@ class apersharp(BaseModule):
 
         # check that csv file exists
         # i.e., that the previous step was executed
-        if not os.path.exists(self.get_src_csv_file_name()):
+        if not self.has_master_table():
             logger.warning(
                 "Could not find file with source information. Will create master table now before continuing.")
             self.get_master_table()
@@ -858,15 +1999,135 @@ class apersharp(BaseModule):
 
         cube_dir = self.get_cube_dir()
 
+        # the cubes finished while sharpener is still running for other cubes
+        # are analysed on one core without creating another pool
+        if self.pool_running:
+            n_cores = 1
+        else:
+            n_cores = self.n_cores
+
         # analyze spectra of sources
         analyse_spectra(
-            src_cat_file_name, self.get_src_csv_file_name_candidates(), cube_dir, do_subtract_median=self.apersharp_do_subtract_median, do_subtract_mean=self.apersharp_do_subtract_mean, use_rms=self.apersharp_use_rms, negative_snr_threshold=self.apersharp_negative_snr_threshold, positive_snr_threshold=self.apersharp_positive_snr_threshold, create_candidate_table_backup=self.apersharp_create_candidate_table_backup)
+            src_cat_file_name, self.get_src_csv_file_name_candidates(), cube_dir, do_subtract_median=self.apersharp_do_subtract_median, do_subtract_mean=self.apersharp_do_subtract_mean, use_rms=self.apersharp_use_rms, use_cube_noise=self.apersharp_use_cube_noise, use_spectra_store=self.apersharp_spectra_store, analysis_engine=self.apersharp_analysis_engine, n_cores=n_cores, core_semaphore=self.core_semaphore, use_metrics_cache=self.apersharp_analysis_cache, negative_snr_threshold=self.apersharp_negative_snr_threshold, positive_snr_threshold=self.apersharp_positive_snr_threshold, create_candidate_table_backup=self.apersharp_create_candidate_table_backup, master_table_engine=self.apersharp_master_table_engine, table_history_max_versions=self.apersharp_table_history_max_versions)
 
         logger.info(
             "Cube {}: Analysing spectra of sources from different beams ... Done".format(self.cube))
 
     # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def has_master_table(self):
+        """
+        Function to check if the master table of the cube exists
+        """
+
+        return master_table_exists(self.get_src_csv_file_name(), master_table_engine=self.apersharp_master_table_engine)
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def export_master_table(self):
+        """
+        Function to write the master table from the store to the csv file
+
+        The previous csv file is added to the history of the master table.
+        """
+
+        logger.info(
+            "Cube {}: Exporting master table to csv file".format(self.cube))
+
+        src_cat_file_name = self.get_src_csv_file_name()
+
+        store = get_master_table_store(src_cat_file_name)
+
+        if store.exists():
+            if self.apersharp_create_master_table_backup and os.path.exists(src_cat_file_name):
+                get_master_table_history(src_cat_file_name, self.get_cube_dir(
+                ), max_versions=self.apersharp_table_history_max_versions).add_version()
+            store.export_csv(src_cat_file_name)
+        else:
+            logger.warning(
+                "Could not find master table store {}. Nothing to export".format(store.store_file))
+
+        logger.info(
+            "Cube {}: Exporting master table to csv file ... Done".format(self.cube))
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def ingest_survey_catalogue(self):
+        """
+        Function to add the master table and the candidate table of the cube to the survey catalogue
+        """
+
+        logger.info(
+            "Cube {}: Adding tables to survey catalogue".format(self.cube))
+
+        if not self.has_master_table():
+            logger.warning(
+                "Could not find master table {}. Nothing to add".format(self.get_src_csv_file_name()))
+        else:
+            SurveyCatalogue(self.apersharp_survey_catalogue).ingest_cube(self.taskid, self.cube, self.get_src_csv_file_name(),
+                                                                         candidate_file=self.get_src_csv_file_name_candidates(), master_table_engine=self.apersharp_master_table_engine)
+
+        logger.info(
+            "Cube {}: Adding tables to survey catalogue ... Done".format(self.cube))
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def remove_data_file(self, file_path):
+        """
+        Function to remove a cube or continuum image from the working directory
+
+        If the cache is enabled, the file is only released and stays in the cache.
+        """
+
+        logger.debug("Removing {}".format(file_path))
+
+        cube_cache = self.get_cube_cache()
+        if cube_cache is not None:
+            cube_cache.release(file_path)
+        elif os.path.exists(file_path):
+            os.remove(file_path)
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
+    def clean_up_beam(self, beam, cube=None):
+        """
+        Function to remove the cube, continuum image and miriad files of a beam
+
+        Args:
+        -----
+        beam (str): The beam
+        cube (str): The cube. Default is the current cube
+        """
+
+        if cube is None:
+            cube = self.cube
 
+        logger.debug(
+            "Cube {0}: Removing cube and continuum image of beam {1}".format(cube, beam))
+
+        # remove cube
+        self.remove_data_file(self.get_cube_path(beam, cube=cube))
+
+        # removing continum image
+        self.remove_data_file(self.get_cont_path(beam, cube=cube))
+
+        # remove the continuum image shared by the cubes once no other cube needs it
+        if self.apersharp_share_continuum and os.path.exists(self.get_shared_cont_path(beam)):
+            cubes_to_fetch = [] if self.cubes_fetched_at_once else list(
+                self.cube_list)[list(self.cube_list).index(cube) + 1:]
+            if len(cubes_to_fetch) == 0 and not np.any([os.path.exists(self.get_cont_path(beam, cube=other_cube)) for other_cube in self.cube_list]):
+                self.remove_data_file(self.get_shared_cont_path(beam))
+                if os.path.exists("{}.json".format(self.get_shared_cont_path(beam))):
+                    os.remove("{}.json".format(self.get_shared_cont_path(beam)))
+
+        # remove the sparse cube and the location of its original cube
+        if os.path.exists(self.get_sparse_cube_location_file(beam, cube=cube)):
+            os.remove(self.get_sparse_cube_location_file(beam, cube=cube))
+        # sparse cubes are not cached
+        if os.path.exists(self.get_sparse_cube_path(beam, cube=cube)):
+            os.remove(self.get_sparse_cube_path(beam, cube=cube))
+
+        # remove the miriad files created by sharpener from the fits files
+        for mir_file in glob.glob(os.path.join(self.get_cube_beam_dir(beam, cube=cube), "sharpOut/*.mir")):
+            logger.debug("Removing {}".format(mir_file))
+            shutil.rmtree(mir_file, ignore_errors=True)
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++
     def clean_up(self):
         """
         Function to remove cubes and continuum fits files
@@ -877,26 +2138,11 @@ class apersharp(BaseModule):
 
         for beam in self.beam_list:
 
-            # get the path to the cube
-            cube_file = self.get_cube_path(beam)
-            # remove cube
-            logger.debug("Removing {}".format(cube_file))
-            if os.path.exists(cube_file):
-                os.remove(cube_file)
-
-            # get the path to the continuum image
-            continuum_file = self.get_cont_path(beam)
-            # removing continum image
-            logger.debug("Removing {}".format(continuum_file))
-            if os.path.exists(continuum_file):
-                os.remove(continuum_file)
-
-            # remove the miriad image
-            continuum_file_mir = continuum_file.replace(os.path.basename(
-                continuum_file), "sharpOut/{0}".format(os.path.basename(continuum_file).replace(".fits", ".mir")))
-            logger.debug("Removing {}".format(continuum_file_mir))
-            if os.path.isdir(continuum_file_mir):
-                shutil.rmtree(continuum_file_mir, ignore_errors=True)
+            self.clean_up_beam(beam)
+
+        # make sure the cache does not exceed the quota now that files were released
+        if self.get_cube_cache() is not None:
+            self.get_cube_cache().evict()
 
         logger.info(
             "Cube {}: Removing cubes and continuum fits files ... Done".format(self.cube))
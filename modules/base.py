@@ -41,33 +41,69 @@ class BaseModule:
     # Name of the csv file with all sources after checking for candidates
     all_src_csv_file_name_candidates = None
 
-    def get_cube_dir(self):
+    def get_cube_dir(self, cube=None):
         """
         Function to return the directory of the cube for a given beam
         """
 
-        return os.path.join(self.sharpener_basedir, "cube_{0}".format(self.cube))
+        if cube is None:
+            cube = self.cube
 
-    def get_cube_beam_dir(self, beam):
+        return os.path.join(self.sharpener_basedir, "cube_{0}".format(cube))
+
+    def get_cube_beam_dir(self, beam, cube=None):
         """
         Function to return the directory of the cube for a given beam
         """
 
-        return os.path.join(self.sharpener_basedir, "cube_{0}/{1}".format(self.cube, beam.zfill(2)))
+        if cube is None:
+            cube = self.cube
+
+        return os.path.join(self.sharpener_basedir, "cube_{0}/{1}".format(cube, beam.zfill(2)))
 
-    def get_cube_path(self, beam):
+    def get_cube_path(self, beam, cube=None):
         """
         Function to return the path of the line cube in the sharpener directory for a given beam
         """
 
-        return os.path.join(self.sharpener_basedir, "cube_{0}/{1}/HI_image_cube{0}.fits".format(self.cube, beam.zfill(2)))
+        if cube is None:
+            cube = self.cube
+
+        return os.path.join(self.sharpener_basedir, "cube_{0}/{1}/HI_image_cube{0}.fits".format(cube, beam.zfill(2)))
 
-    def get_cont_path(self, beam):
+    def get_sparse_cube_path(self, beam, cube=None):
+        """
+        Function to return the path of the sparse line cube in the sharpener directory for a given beam
+        """
+
+        if cube is None:
+            cube = self.cube
+
+        return os.path.join(self.sharpener_basedir, "cube_{0}/{1}/HI_image_cube{0}_sparse.fits".format(cube, beam.zfill(2)))
+
+    def get_cont_path(self, beam, cube=None):
         """
         Function to return the path of the continuum image in the sharpener directory for a given beam
         """
 
-        return os.path.join(self.sharpener_basedir, "cube_{0}/{1}/image_mf.fits".format(self.cube, beam.zfill(2)))
+        if cube is None:
+            cube = self.cube
+
+        return os.path.join(self.sharpener_basedir, "cube_{0}/{1}/image_mf.fits".format(cube, beam.zfill(2)))
+
+    def get_continuum_beam_dir(self, beam):
+        """
+        Function to return the directory for the continuum products of a beam shared by all cubes
+        """
+
+        return os.path.join(self.sharpener_basedir, "continuum/{0}".format(beam.zfill(2)))
+
+    def get_shared_cont_path(self, beam):
+        """
+        Function to return the path of the continuum image of a beam shared by all cubes
+        """
+
+        return os.path.join(self.get_continuum_beam_dir(beam), "image_mf.fits")
 
     def get_src_csv_file_name(self):
         """
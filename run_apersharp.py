@@ -8,7 +8,8 @@ import os
 import sys
 import logging
 import argparse
-from time import time
+import multiprocessing as mp
+from time import time, sleep
 import numpy as np
 
 from lib.setup_logger import setup_logger
@@ -17,7 +18,186 @@ from modules.apersharp import apersharp
 
 
 # def run_apersharp(taskid, sharpener_basedir, data_basedir=None, data_source='ALTA', steps=None, user=None, beams='all', output_form="pdf", cubes="0", cont_src_resource="continuum", configfilename=None, no_sdss=False, n_cores=1):
-def run_apersharp(taskid, sharpener_basedir, apersharp_configfilename=None, steps=None, beams=None, cubes=None, n_cores=None):
+def process_taskid(taskid, sharpener_basedir, logfile, apersharp_configfilename=None, steps=None, beams=None, cubes=None, n_cores=None, core_semaphore=None, transfer_semaphore=None):
+    """
+    Function to process a single taskid with apersharp
+
+    Errors are logged and not raised so that the other taskids can still be processed.
+
+    Args:
+    =====
+    taskid (str): Name of the taskid to process
+    sharpener_basedir (str): Directory for the directory where the data should be stored for processing
+    logfile (str): Main logfile
+    core_semaphore (Semaphore): Semaphore limiting the number of sharpener runs across
+        taskids processed at the same time. Default None
+    transfer_semaphore (Semaphore): Semaphore limiting the number of transfers across
+        taskids processed at the same time. Default None
+    For the other arguments see run_apersharp
+    """
+
+    logger = logging.getLogger(__name__)
+
+    # get the start time of the function call
+    start_time_taskid = time()
+
+    logger.info("#### Apersharp processing of taskid {}".format(taskid))
+
+    # check the output directory
+    # if sharpener_basedir == '':
+    #     sharpener_basedir = os.path.join(os.getcwd(), "{}".format(taskid))
+    # else:
+    sharpener_basedir_taskid = os.path.join(
+        sharpener_basedir, "{}".format(taskid))
+    if not os.path.exists(sharpener_basedir_taskid):
+        os.mkdir(sharpener_basedir_taskid)
+
+    # Create logfile
+    # logfile = os.path.join(sharpener_basedir_taskid,
+    #                        "{}_apersharp.log".format(taskid))
+    # setup_logger('DEBUG', logfile=logfile)
+    # logger = logging.getLogger(__name__)
+
+    # check the steps
+    # if steps is None:
+    #     steps_list = ["get_data", "setup_sharpener",
+    #                   "run_sharpener", "collect_results", "clean_up"]
+    # else:
+    #     steps_list = steps.split(",")
+
+    # if beams is None:
+    #     beam_list = np.array(["{}".format(str(beam).zfill(2))
+    #                           for beam in np.arange(40)])
+    # elif beams == 'all':
+    #     beam_list = np.array(["{}".format(str(beam).zfill(2))
+    #                           for beam in np.arange(40)])
+    # else:
+    #     beam_list = np.array(beams.split(","))
+
+    logger.info("##")
+    logger.info("# Apersharp called with:")
+    logger.info("# taskid: {}".format(taskid))
+    logger.info("# basedir: {}".format(sharpener_basedir_taskid))
+    # logger.info("# steps: {}".format(str(steps)))
+    # logger.info("# output format: {}".format(output_form))
+    # logger.info("# cubes: {}".format(cubes))
+    # logger.info("# beams: {}".format(str(beam_list)))
+    # #logger.info(" ")
+    # logger.info("# do_sdss: {}".format(do_sdss))
+    # logger.info("# n_cores: {}".format(n_cores))
+    logger.info("##")
+
+    def set_params(p):
+        """
+        Helper to set/overwrite the base parameters for the module
+        """
+
+        # overwrite the number of cores
+        if n_cores is not None:
+            logger.info(
+                "Overwriting default setting for number of cores: {}".format(n_cores))
+            p.n_cores = n_cores
+        # overwrite the steps
+        if steps is not None:
+            logger.info(
+                "Overwriting default setting for steps: {}".format(steps))
+            p.steps_list = steps.split(",")
+        # overwrite beams
+        if beams is not None:
+            logger.info(
+                "Ovewriting default list of beams: {}".format(beams))
+            p.beam_list = np.array([str(beam).zfill(2)
+                                    for beam in beams.split(",")])
+        elif beams == "all":
+            p.beam_list = np.array(["{}".format(str(beam).zfill(2))
+                                    for beam in np.arange(40)])
+        # overwrite list of cubes
+        if cubes is not None:
+            logger.info(
+                "Overwriting default settings for list of cubes: {}".format(cubes))
+            p.cube_list = cubes.split(",")
+
+        p.taskid = taskid
+        p.sharpener_basedir = sharpener_basedir_taskid
+
+        # p.data_basedir = data_basedir
+        # p.data_source = data_source
+        # p.output_form = output_form
+        # p.cube = cube
+        # p.steps = steps_list
+        # p.do_sdss = do_sdss
+        # p.n_cores = n_cores
+        # p.cont_src_resource = cont_src_resource
+        # p.beam_list = beam_list
+        # p.configfilename = configfilename
+
+    logfile_taskid = os.path.join(sharpener_basedir_taskid,
+                                  "{}_apersharp.log".format(taskid))
+    setup_logger('DEBUG', logfile=logfile_taskid)
+    logger = logging.getLogger(__name__)
+
+    # start time for processing this cube
+    start_time_cube = time()
+
+    p = apersharp(config_file=apersharp_configfilename)
+    set_params(p)
+    p.logfile = logfile_taskid
+    p.core_semaphore = core_semaphore
+    p.transfer_semaphore = transfer_semaphore
+    try:
+        p.go()
+    except Exception as e:
+        setup_logger('DEBUG', logfile=logfile, new_logfile=False)
+        logger = logging.getLogger(__name__)
+        logger.warning(
+            "Processing of taskid {0} ... Failed ({1:.0f}s)".format(taskid, time() - start_time_cube))
+        logger.exception(e)
+    else:
+        setup_logger('DEBUG', logfile=logfile, new_logfile=False)
+        logger = logging.getLogger(__name__)
+        logger.info(
+            "Processing of taskid {0} ... Done ({1:.0f})".format(taskid, time() - start_time_cube))
+
+    logger.info("## Apershap finished processing of taskid {0} after {1:.0f}s".format(
+        taskid, time() - start_time_taskid))
+
+
+def get_taskid_cores(n_cores, n_parallel_taskids, n_taskids):
+    """
+    Function to split the cores across the taskids processed at the same time
+
+    Instead of every taskid creating a pool for all cores, each taskid gets
+    its share. Rounding up allows a taskid to use a core left over by another
+    one while the shared semaphore limits the number of sharpener runs.
+
+    Return:
+    -------
+    (int): Number of processes of the pool of a taskid
+    """
+
+    return max(int(np.ceil(n_cores / float(max(min(n_parallel_taskids, n_taskids), 1)))), 1)
+
+
+def positive_int(value):
+    """
+    Function to convert an argument to an integer of at least 1
+
+    Used as type of the command line arguments
+    """
+
+    try:
+        number = int(value)
+    except ValueError:
+        number = None
+
+    if number is None or number < 1:
+        raise argparse.ArgumentTypeError(
+            "{} is not an integer of at least 1".format(value))
+
+    return number
+
+
+def run_apersharp(taskid, sharpener_basedir, apersharp_configfilename=None, steps=None, beams=None, cubes=None, n_cores=None, n_parallel_taskids=1):
     """
     Main function run apersharp.
 
@@ -37,8 +217,14 @@ def run_apersharp(taskid, sharpener_basedir, apersharp_configfilename=None, step
     steps (str): List of steps to run through.
     cubes (str): Select the cube to be processed. If "all", all cubes will be processed.
     n_cores (int): Number of cores for running sharpener in parallel
+    n_parallel_taskids (int): Number of taskids processed at the same time (at least 1). They share the
+        number of cores and the number of transfers
     """
 
+    if n_parallel_taskids < 1:
+        raise ValueError("The number of parallel taskids must be at least 1, but is {}".format(
+            n_parallel_taskids))
+
     start_time = time()
 
     # get a list of taskids
@@ -60,128 +246,48 @@ def run_apersharp(taskid, sharpener_basedir, apersharp_configfilename=None, step
     logger.info("Processing taskids: {}".format(str(taskid_list)))
     logger.info("########")
 
-    for taskid in taskid_list:
-
-        # get the start time of the function call
-        start_time_taskid = time()
-
-        logger.info("#### Apersharp processing of taskid {}".format(taskid))
-
-        # check the output directory
-        # if sharpener_basedir == '':
-        #     sharpener_basedir = os.path.join(os.getcwd(), "{}".format(taskid))
-        # else:
-        sharpener_basedir_taskid = os.path.join(
-            sharpener_basedir, "{}".format(taskid))
-        if not os.path.exists(sharpener_basedir_taskid):
-            os.mkdir(sharpener_basedir_taskid)
-
-        # Create logfile
-        # logfile = os.path.join(sharpener_basedir_taskid,
-        #                        "{}_apersharp.log".format(taskid))
-        # setup_logger('DEBUG', logfile=logfile)
-        # logger = logging.getLogger(__name__)
-
-        # check the steps
-        # if steps is None:
-        #     steps_list = ["get_data", "setup_sharpener",
-        #                   "run_sharpener", "collect_results", "clean_up"]
-        # else:
-        #     steps_list = steps.split(",")
-
-        # if beams is None:
-        #     beam_list = np.array(["{}".format(str(beam).zfill(2))
-        #                           for beam in np.arange(40)])
-        # elif beams == 'all':
-        #     beam_list = np.array(["{}".format(str(beam).zfill(2))
-        #                           for beam in np.arange(40)])
-        # else:
-        #     beam_list = np.array(beams.split(","))
-
-        logger.info("##")
-        logger.info("# Apersharp called with:")
-        logger.info("# taskid: {}".format(taskid))
-        logger.info("# basedir: {}".format(sharpener_basedir_taskid))
-        # logger.info("# steps: {}".format(str(steps)))
-        # logger.info("# output format: {}".format(output_form))
-        # logger.info("# cubes: {}".format(cubes))
-        # logger.info("# beams: {}".format(str(beam_list)))
-        # #logger.info(" ")
-        # logger.info("# do_sdss: {}".format(do_sdss))
-        # logger.info("# n_cores: {}".format(n_cores))
-        logger.info("##")
-
-        def set_params(p):
-            """
-            Helper to set/overwrite the base parameters for the module
-            """
-
-            # overwrite the number of cores
-            if n_cores is not None:
-                logger.info(
-                    "Overwriting default setting for number of cores: {}".format(n_cores))
-                p.n_cores = n_cores
-            # overwrite the steps
-            if steps is not None:
-                logger.info(
-                    "Overwriting default setting for steps: {}".format(steps))
-                p.steps_list = steps.split(",")
-            # overwrite beams
-            if beams is not None:
-                logger.info(
-                    "Ovewriting default list of beams: {}".format(beams))
-                p.beam_list = np.array([str(beam).zfill(2)
-                                        for beam in beams.split(",")])
-            elif beams == "all":
-                p.beam_list = np.array(["{}".format(str(beam).zfill(2))
-                                        for beam in np.arange(40)])
-            # overwrite list of cubes
-            if cubes is not None:
-                logger.info(
-                    "Overwriting default settings for list of cubes: {}".format(cubes))
-                p.cube_list = cubes.split(",")
-
-            p.taskid = taskid
-            p.sharpener_basedir = sharpener_basedir_taskid
-
-            # p.data_basedir = data_basedir
-            # p.data_source = data_source
-            # p.output_form = output_form
-            # p.cube = cube
-            # p.steps = steps_list
-            # p.do_sdss = do_sdss
-            # p.n_cores = n_cores
-            # p.cont_src_resource = cont_src_resource
-            # p.beam_list = beam_list
-            # p.configfilename = configfilename
-
-        logfile_taskid = os.path.join(sharpener_basedir_taskid,
-                                      "{}_apersharp.log".format(taskid))
-        setup_logger('DEBUG', logfile=logfile_taskid)
-        logger = logging.getLogger(__name__)
-
-        # start time for processing this cube
-        start_time_cube = time()
-
+    if n_parallel_taskids == 1:
+        for taskid in taskid_list:
+            process_taskid(taskid, sharpener_basedir, logfile, apersharp_configfilename=apersharp_configfilename,
+                           steps=steps, beams=beams, cubes=cubes, n_cores=n_cores)
+    else:
+        # the number of cores and transfers are shared by all taskids
         p = apersharp(config_file=apersharp_configfilename)
-        set_params(p)
-        p.logfile = logfile_taskid
-        try:
-            p.go()
-        except Exception as e:
-            setup_logger('DEBUG', logfile=logfile, new_logfile=False)
-            logger = logging.getLogger(__name__)
-            logger.warning(
-                "Processing of taskid {0} ... Failed ({1:.0f}s)".format(taskid, time() - start_time_cube))
-            logger.exception(e)
-        else:
-            setup_logger('DEBUG', logfile=logfile, new_logfile=False)
-            logger = logging.getLogger(__name__)
-            logger.info(
-                "Processing of taskid {0} ... Done ({1:.0f})".format(taskid, time() - start_time_cube))
-
-        logger.info("## Apershap finished processing of taskid {0} after {1:.0f}s".format(
-            taskid, time() - start_time_taskid))
+        if n_cores is None:
+            n_cores = p.n_cores
+        core_semaphore = mp.BoundedSemaphore(n_cores)
+        transfer_semaphore = mp.BoundedSemaphore(p.apersharp_n_transfers)
+
+        n_taskid_cores = get_taskid_cores(
+            n_cores, n_parallel_taskids, len(taskid_list))
+
+        logger.info("Processing up to {0} taskids at the same time using {1} cores ({2} per taskid) and {3} transfers".format(
+            n_parallel_taskids, n_cores, n_taskid_cores, p.apersharp_n_transfers))
+
+        # each taskid is processed in a separate process
+        # they cannot be daemonic as they create their own pool
+        taskid_queue = list(taskid_list)
+        process_list = []
+        while len(taskid_queue) != 0 or len(process_list) != 0:
+            while len(taskid_queue) != 0 and len(process_list) < n_parallel_taskids:
+                taskid = taskid_queue.pop(0)
+                process = mp.Process(target=process_taskid, name="taskid_{}".format(taskid),
+                                     args=(taskid, sharpener_basedir, logfile),
+                                     kwargs={'apersharp_configfilename': apersharp_configfilename,
+                                             'steps': steps, 'beams': beams, 'cubes': cubes, 'n_cores': n_taskid_cores,
+                                             'core_semaphore': core_semaphore, 'transfer_semaphore': transfer_semaphore})
+                process.start()
+                process_list.append((taskid, process))
+
+            sleep(1)
+
+            for taskid, process in list(process_list):
+                if not process.is_alive():
+                    process.join()
+                    process_list.remove((taskid, process))
+                    if process.exitcode != 0:
+                        logger.error("Process for taskid {0} ended with exit code {1}".format(
+                            taskid, process.exitcode))
 
     logger.info("#### Apersharp processing finished after {0:.0f}s ####".format(
         time() - start_time))
@@ -230,6 +336,9 @@ if __name__ == "__main__":
     parser.add_argument("--n_cores", type=int, default=None,
                         help='Number of cores for running sharpener. Will overwrite config file setting.')
 
+    parser.add_argument("--n_parallel_taskids", type=positive_int, default=1,
+                        help='Number of taskids processed at the same time. They share the cores and transfers.')
+
     # parser.add_argument("--no_sdss", action="store_true", default=False,
     #                     help='Enable sdss cross-matching')
 
@@ -239,4 +348,4 @@ if __name__ == "__main__":
     #               steps=args.steps, user=args.user, beams=args.beams, output_form=args.output_form, cubes=args.cubes, cont_src_resource=args.cont_src_resource, configfilename=args.configfilename, no_sdss=args.no_sdss, n_cores=args.n_cores)
 
     run_apersharp(args.taskid, args.sharpener_basedir, apersharp_configfilename=args.config,
-                  steps=args.steps, beams=args.beams, cubes=args.cubes, n_cores=args.n_cores)
+                  steps=args.steps, beams=args.beams, cubes=args.cubes, n_cores=args.n_cores, n_parallel_taskids=args.n_parallel_taskids)
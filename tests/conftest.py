@@ -0,0 +1,147 @@
+"""
+Setup of the tests and generators of synthetic data shared by the tests and the benchmarks
+"""
+
+import os
+import sys
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+from astropy.table import Table
+from astropy.coordinates import SkyCoord
+import astropy.units as units
+
+# the tests import the modules of apersharp from the directory of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from lib.find_sources import get_source_name, SHARPENER_SOURCE_COLUMNS
+
+
+def create_synthetic_beam(beam_dir, n_chan, n_pix, n_sources, noise_delta=12):
+    """
+    Function to create a cube, a continuum image and a source file
+    for a beam with the names used by sharpener
+
+    Args:
+    -----
+    beam_dir (str): Directory of the beam
+    n_chan (int): Number of channels of the cube
+    n_pix (int): Number of pixels along each spatial axis
+    n_sources (int): Number of sources
+    noise_delta (int): Minimum distance of the sources from the edge in pixels. Default 12
+    """
+
+    if not os.path.exists(os.path.join(beam_dir, "sharpOut/abs")):
+        os.makedirs(os.path.join(beam_dir, "sharpOut/abs"))
+
+    header = fits.Header()
+    header['CTYPE1'] = 'RA---SIN'
+    header['CRVAL1'] = 180.
+    header['CRPIX1'] = n_pix / 2.
+    header['CDELT1'] = -1. / 720.
+    header['CUNIT1'] = 'deg'
+    header['CTYPE2'] = 'DEC--SIN'
+    header['CRVAL2'] = 45.
+    header['CRPIX2'] = n_pix / 2.
+    header['CDELT2'] = 1. / 720.
+    header['CUNIT2'] = 'deg'
+    header['CTYPE3'] = 'FREQ'
+    header['CRVAL3'] = 1.3e9
+    header['CRPIX3'] = 1.
+    header['CDELT3'] = 36621.09375
+    header['CUNIT3'] = 'Hz'
+    header['CTYPE4'] = 'STOKES'
+    header['CRVAL4'] = 1.
+    header['CRPIX4'] = 1.
+    header['CDELT4'] = 1.
+
+    cube_data = np.random.normal(
+        0., 1.e-3, (1, n_chan, n_pix, n_pix)).astype(np.float32)
+    fits.PrimaryHDU(cube_data, header=header).writeto(
+        os.path.join(beam_dir, "HI_image_cube0.fits"), overwrite=True)
+
+    cont_header = header.copy()
+    cont_data = np.zeros((1, 1, n_pix, n_pix), dtype=np.float32)
+
+    pixel_x = np.random.randint(noise_delta, n_pix - noise_delta, n_sources)
+    pixel_y = np.random.randint(noise_delta, n_pix - noise_delta, n_sources)
+    cont_data[0, 0, pixel_y, pixel_x] = 0.1
+    fits.PrimaryHDU(cont_data, header=cont_header).writeto(
+        os.path.join(beam_dir, "image_mf.fits"), overwrite=True)
+
+    # the source file has the columns written by sharpener
+    ra, dec = WCS(header).celestial.wcs_pix2world(pixel_x, pixel_y, 0)
+    src_coord = SkyCoord(ra, dec, unit=units.deg, frame='fk5')
+    src_ra = src_coord.ra.to_string(
+        unit=units.hourangle, sep=':', precision=3, pad=True)
+    src_dec = src_coord.dec.to_string(
+        sep=':', precision=2, alwayssign=True, pad=True)
+    src_name = get_source_name(src_ra, src_dec)
+    src_order = np.argsort(src_name, kind='mergesort')
+    Table([np.arange(1, n_sources + 1), src_name[src_order], src_ra[src_order], src_dec[src_order],
+           np.full(n_sources, 0.1), np.full(n_sources, 0.1),
+           np.full(n_sources, np.nan), np.full(n_sources, np.nan), np.full(n_sources, np.nan),
+           np.full(n_sources, "-"), np.full(n_sources, "-"), np.full(n_sources, "-"),
+           pixel_x[src_order] + 1, pixel_y[src_order] + 1], names=SHARPENER_SOURCE_COLUMNS).write(
+        os.path.join(beam_dir, "sharpOut/abs/mir_src_sharp.csv"), format="ascii.csv", overwrite=True)
+
+
+def create_synthetic_spectra(beam_dir, n_chan, n_sources):
+    """
+    Function to create the text files of the spectra of a beam in the layout of sharpener
+
+    Args:
+    -----
+    beam_dir (str): Directory of the beam
+    n_chan (int): Number of channels
+    n_sources (int): Number of sources
+    """
+
+    spec_dir = os.path.join(beam_dir, "sharpOut/spec")
+    if not os.path.exists(spec_dir):
+        os.makedirs(spec_dir)
+
+    frequency = 1.3e9 + 36621.09375 * np.arange(n_chan)
+
+    for src_index in range(n_sources):
+        flux = np.random.normal(0., 1.e-3, n_chan)
+        noise = np.abs(np.random.normal(1.e-3, 1.e-4, n_chan))
+        Table([frequency, flux, noise, -np.log(1. + flux / 0.1), noise / 0.1],
+              names=['Frequency [Hz]', 'Flux [Jy]', 'Noise [Jy]', 'Optical depth', 'Noise optical depth']).write(
+            os.path.join(spec_dir, "{0}_J1200{1:04d}+450000.txt".format(src_index, src_index)), format="ascii", overwrite=True)
+
+
+def create_synthetic_sources(beam_dir, n_sources, src_file="radio_sdss_src_match.csv"):
+    """
+    Function to create the table of the sources of a beam in the layout of sharpener
+
+    Args:
+    -----
+    beam_dir (str): Directory of the beam
+    n_sources (int): Number of sources
+    src_file (str): Name of the table. Default radio_sdss_src_match.csv
+    """
+
+    abs_dir = os.path.join(beam_dir, "sharpOut/abs")
+    if not os.path.exists(abs_dir):
+        os.makedirs(abs_dir)
+
+    ra = np.random.uniform(179., 181., n_sources)
+    dec = np.random.uniform(44., 46., n_sources)
+    src_coord = SkyCoord(ra, dec, unit=units.deg)
+    j2000 = np.char.add(src_coord.ra.to_string(unit=units.hourangle, sep="", precision=1, pad=True),
+                        src_coord.dec.to_string(sep="", precision=0, alwayssign=True, pad=True))
+
+    src_data = Table([np.arange(n_sources), j2000, ra, dec, np.random.uniform(1.e-3, 1., n_sources),
+                      np.random.uniform(1.e-3, 1., n_sources), np.random.choice([0, 1], n_sources)],
+                     names=['ID', 'J2000', 'ra', 'dec', 'peak', 'flux_int', 'FFLAG'])
+
+    if src_file == "radio_sdss_src_match.csv":
+        src_data['sdss_id'] = np.random.randint(0, 10**15, n_sources)
+        src_data['sdss_ra'] = ra
+        src_data['sdss_dec'] = dec
+        src_data['sdss_radio_sep'] = np.random.uniform(0., 5., n_sources)
+        src_data['sdss_redshift'] = np.random.uniform(0., 0.2, n_sources)
+
+    src_data.write(os.path.join(abs_dir, src_file),
+                   format="ascii.csv", overwrite=True)
@@ -0,0 +1,72 @@
+import os
+import json
+
+import lib.alta_catalogue
+from lib.alta_catalogue import AltaCatalogue
+
+IQUEST_OUTPUT = """/altaZone/archive/apertif_main/visibilities_default/190101001_AP_B000/HI_image_cube0.fits|1000|sha2:abc
+/altaZone/archive/apertif_main/visibilities_default/190101001_AP_B000/image_mf_02.fits|10|
+"""
+
+
+def test_listing_with_checksums(tmpdir, monkeypatch):
+    monkeypatch.setattr(lib.alta_catalogue.subprocess, "check_output",
+                        lambda *args, **kwargs: IQUEST_OUTPUT)
+
+    cache_file = str(tmpdir.join("listing.json"))
+    catalogue = AltaCatalogue("190101001", cache_file=cache_file)
+    collection = catalogue.get_beam_collection(0)
+
+    assert catalogue.get_file_size(
+        collection + "/HI_image_cube0.fits") == 1000
+    assert catalogue.get_file_checksum(
+        collection + "/HI_image_cube0.fits") == "sha2:abc"
+    assert catalogue.get_file_checksum(
+        collection + "/image_mf_02.fits") is None
+    assert catalogue.get_continuum_image_name(0) == "image_mf_02.fits"
+
+    cached_catalogue = AltaCatalogue("190101001", cache_file=cache_file)
+    assert cached_catalogue.get_file_checksum(
+        collection + "/HI_image_cube0.fits") == "sha2:abc"
+
+
+def test_listing_without_checksums_in_cache(tmpdir):
+    cache_file = str(tmpdir.join("listing.json"))
+    catalogue = AltaCatalogue("190101001", cache_file=cache_file)
+    collection = catalogue.get_beam_collection(0)
+
+    with open(cache_file, 'w') as stream:
+        json.dump({collection: {"HI_image_cube0.fits": 1000}}, stream)
+
+    assert catalogue.get_file_size(
+        collection + "/HI_image_cube0.fits") == 1000
+    assert catalogue.get_file_checksum(
+        collection + "/HI_image_cube0.fits") is None
+
+
+def test_empty_listing_is_not_cached(tmpdir, monkeypatch):
+    outputs = ["CAT_NO_ROWS_FOUND", IQUEST_OUTPUT]
+
+    def check_output(*args, **kwargs):
+        output = outputs.pop(0)
+        if "CAT_NO_ROWS_FOUND" in output:
+            raise lib.alta_catalogue.subprocess.CalledProcessError(
+                4, args[0], output=output)
+        return output
+
+    monkeypatch.setattr(lib.alta_catalogue.subprocess,
+                        "check_output", check_output)
+
+    cache_file = str(tmpdir.join("listing.json"))
+    catalogue = AltaCatalogue("190101001", cache_file=cache_file)
+    assert catalogue.list_beam(0) is None
+    assert not os.path.exists(cache_file)
+
+    # an empty listing from an earlier version is ignored, too
+    with open(cache_file, 'w') as stream:
+        json.dump({'listing': {}, 'checksums': {}}, stream)
+
+    catalogue = AltaCatalogue("190101001", cache_file=cache_file)
+    assert catalogue.list_beam(0) == ["HI_image_cube0.fits", "image_mf_02.fits"]
+    with open(cache_file) as stream:
+        assert len(json.load(stream)['listing']) == 1
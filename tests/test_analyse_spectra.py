@@ -0,0 +1,139 @@
+import os
+import json
+import multiprocessing as mp
+import numpy as np
+from astropy.table import Table
+
+import lib.analyse_spectra
+from lib.analyse_spectra import analyse_spectra, get_source_metrics, get_source_spec_file
+from lib.spectra_store import convert_spectra_to_store
+from lib.metrics_cache import MetricsCache, METRICS_CACHE_FILE
+from conftest import create_synthetic_spectra
+
+
+def create_cube(cube_dir, beam_list, n_sources):
+    for beam in beam_list:
+        create_synthetic_spectra(os.path.join(
+            cube_dir, str(beam).zfill(2)), 16, n_sources)
+
+    src_data = Table([["S{0}_{1}".format(beam, k) for beam in beam_list for k in range(n_sources)],
+                      ["1200{0:04d}+450000".format(k)
+                       for beam in beam_list for k in range(n_sources)],
+                      [k + 1 for beam in beam_list for k in range(n_sources)],
+                      [beam for beam in beam_list for k in range(n_sources)]],
+                     names=['Source_ID', 'J2000', 'Beam_Source_ID', 'Beam'])
+    src_cat_file = os.path.join(cube_dir, "master_table.csv")
+    src_data.write(src_cat_file, format="ascii.csv")
+
+    return src_cat_file
+
+
+class DaemonProcess(object):
+    name = "MainProcess"
+    daemon = True
+
+
+def test_no_pool_in_pool_worker(tmpdir, monkeypatch):
+    cube_dir = str(tmpdir)
+    src_cat_file = create_cube(cube_dir, [0, 1], 2)
+
+    def no_pool(*args, **kwargs):
+        raise AssertionError("Pool created in a process of a pool")
+
+    monkeypatch.setattr(lib.analyse_spectra.mp,
+                        "current_process", DaemonProcess)
+    monkeypatch.setattr(lib.analyse_spectra.mp, "Pool", no_pool)
+
+    analyse_spectra(src_cat_file, os.path.join(
+        cube_dir, "candidates.csv"), cube_dir, n_cores=4)
+
+    assert np.all(Table.read(src_cat_file, format="ascii.csv")['RMS'] > 0)
+
+
+def test_metrics_cache_drops_missing_spectra(tmpdir):
+    cube_dir = str(tmpdir)
+    src_cat_file = create_cube(cube_dir, [0], 3)
+
+    analyse_spectra(src_cat_file, os.path.join(cube_dir, "candidates.csv"),
+                    cube_dir, use_metrics_cache=True, create_candidate_table_backup=False)
+
+    os.remove(os.path.join(cube_dir, "00/sharpOut/spec/2_J12000002+450000.txt"))
+
+    analyse_spectra(src_cat_file, os.path.join(cube_dir, "candidates.csv"),
+                    cube_dir, use_metrics_cache=True, create_candidate_table_backup=False)
+
+    with open(os.path.join(cube_dir, METRICS_CACHE_FILE)) as stream:
+        assert sorted(json.load(stream)['metrics']) == [
+            "0_0_J12000000+450000", "0_1_J12000001+450000"]
+
+
+def test_metrics_cache_drops_unused_spectra(tmpdir):
+    cache_file = str(tmpdir.join(METRICS_CACHE_FILE))
+
+    metrics_cache = MetricsCache(cache_file, {})
+    metrics_cache.set("a", [[1, 1.]], [1.])
+    metrics_cache.set("b", [[1, 1.]], [2.])
+    metrics_cache.write()
+
+    metrics_cache = MetricsCache(cache_file, {})
+    assert metrics_cache.get("a", [[1, 1.]]) == [1.]
+    metrics_cache.write()
+
+    assert sorted(MetricsCache(cache_file, {}).metrics) == ["a"]
+
+
+def test_pool_with_shared_cores(tmpdir):
+    cube_dir = str(tmpdir)
+    src_cat_file = create_cube(cube_dir, [0, 1, 2], 2)
+
+    core_semaphore = mp.BoundedSemaphore(1)
+    analyse_spectra(src_cat_file, os.path.join(
+        cube_dir, "candidates.csv"), cube_dir, n_cores=3, core_semaphore=core_semaphore)
+    pool_rms = Table.read(src_cat_file, format="ascii.csv")['RMS']
+
+    # the core was given back
+    assert core_semaphore.acquire(False)
+
+    analyse_spectra(src_cat_file, os.path.join(
+        cube_dir, "candidates.csv"), cube_dir)
+
+    assert np.all(pool_rms == Table.read(
+        src_cat_file, format="ascii.csv")['RMS'])
+
+
+def test_batch_engine_matches_loop_engine(tmpdir):
+    cube_dir = str(tmpdir)
+    src_cat_file = create_cube(cube_dir, [0, 1], 4)
+    src_data = Table.read(src_cat_file, format="ascii.csv")
+
+    # channels without data and a spectrum without noise information
+    spec_file = get_source_spec_file(
+        src_data['J2000'][0], 0, 0, cube_dir)
+    spec_data = Table.read(spec_file, format="ascii")
+    spec_data['Flux [Jy]'][[0, 5]] = np.nan
+    spec_data['Noise [Jy]'][[0, 5, 7]] = np.nan
+    spec_data.write(spec_file, format="ascii", overwrite=True)
+
+    spec_file = get_source_spec_file(
+        src_data['J2000'][1], 1, 0, cube_dir)
+    spec_data = Table.read(spec_file, format="ascii")
+    spec_data['Noise [Jy]'][3] = 0.
+    spec_data.write(spec_file, format="ascii", overwrite=True)
+
+    # float32 spectra in the store for beam 1, float64 text files for beam 0
+    convert_spectra_to_store(os.path.join(cube_dir, "01"))
+
+    for use_spectra_store in [False, True]:
+        for use_rms in [True, False]:
+            for do_subtract_median, do_subtract_mean in [(True, False), (False, True)]:
+                settings = {'do_subtract_median': do_subtract_median, 'do_subtract_mean': do_subtract_mean,
+                            'use_rms': use_rms, 'use_spectra_store': use_spectra_store}
+                loop_metrics = get_source_metrics(
+                    src_data, cube_dir, analysis_engine="loop", **settings)
+                batch_metrics = get_source_metrics(
+                    src_data, cube_dir, analysis_engine="batch", **settings)
+
+                # max negative SNR with its channel and frequency
+                for metric_index in [7, 8, 9]:
+                    np.testing.assert_array_equal(
+                        batch_metrics[metric_index], loop_metrics[metric_index], err_msg=str(settings))
@@ -0,0 +1,198 @@
+import os
+import multiprocessing as mp
+
+import numpy as np
+import pytest
+
+from lib.transfer_engine import TransferJob
+import modules.apersharp
+from modules.apersharp import apersharp
+
+
+def get_pipeline(beam_list):
+    pipeline = apersharp.__new__(apersharp)
+    pipeline.beam_list = np.array(beam_list)
+    pipeline.all_beam_list = np.array(beam_list)
+
+    return pipeline
+
+
+def test_remove_failed_beams_of_every_cube():
+    pipeline = get_pipeline(["0", "1", "2"])
+    failed_beams = {"0": ["0"], "1": ["1", "2"]}
+
+    for cube in ["0", "1"]:
+        pipeline.cube = cube
+        pipeline.remove_failed_beams(failed_beams[cube])
+        assert list(pipeline.beam_list) == [
+            beam for beam in ["0", "1", "2"] if beam not in failed_beams[cube]]
+
+
+def test_remove_failed_beams_aborts_without_beams():
+    pipeline = get_pipeline(["0", "1"])
+    pipeline.cube = "0"
+    pipeline.beam_list = np.array(["1"])
+
+    with pytest.raises(RuntimeError):
+        pipeline.remove_failed_beams(["0", "1"])
+
+
+def test_cube_noise_only_estimated_when_used():
+    pipeline = get_pipeline(["0"])
+    pipeline.apersharp_cube_noise = True
+
+    pipeline.apersharp_spectra_extraction_engine = "sharpener"
+    pipeline.apersharp_use_cube_noise = True
+    pipeline.apersharp_use_rms = True
+    assert not pipeline.do_cube_noise()
+
+    pipeline.apersharp_use_rms = False
+    assert pipeline.do_cube_noise() and pipeline.analysis_uses_cube_noise()
+
+    pipeline.apersharp_use_cube_noise = False
+    pipeline.apersharp_spectra_extraction_engine = "apersharp"
+    assert pipeline.do_cube_noise() and not pipeline.analysis_uses_cube_noise()
+
+    pipeline.apersharp_cube_noise = False
+    assert not pipeline.do_cube_noise()
+
+
+def test_missing_continuum_image_only_fails_its_cube(tmpdir):
+    pipeline = get_pipeline(["0", "1"])
+    pipeline.sharpener_basedir = str(tmpdir)
+
+    for cube in ["0", "1"]:
+        for beam in ["0", "1"]:
+            file_list = [pipeline.get_cube_path(beam, cube=cube)]
+            # the continuum image of beam 1 of cube 0 is missing
+            if cube != "0" or beam != "1":
+                file_list.append(pipeline.get_cont_path(beam, cube=cube))
+            for file_path in file_list:
+                if not os.path.exists(os.path.dirname(file_path)):
+                    os.makedirs(os.path.dirname(file_path))
+                open(file_path, 'w').close()
+
+    failed_beams = {"0": [], "1": []}
+    failed_cubes = {}
+    available_data = pipeline.add_transfer_jobs(
+        None, ["0", "1"], failed_beams, failed_cubes)
+
+    assert list(failed_cubes.keys()) == ["0"]
+    assert ("1", "0") in available_data and ("1", "1") in available_data
+
+    pipeline.failed_cubes = failed_cubes
+    with pytest.raises(RuntimeError):
+        pipeline.check_failed_cube("0")
+    pipeline.check_failed_cube("1")
+
+
+def test_failed_continuum_transfer_only_fails_its_cube():
+    pipeline = get_pipeline(["0", "1"])
+    pipeline.taskid = "190101001"
+
+    cube_job = TransferJob("cube 1 of beam 0", None, cube="1", beam="0")
+    cube_job.status = "done"
+    failed_jobs = [TransferJob("continuum image of beam 0 for cube 1", None, requires=cube_job, cube="1", beam="0"),
+                   TransferJob("cube 0 of beam 1", None, cube="0", beam="1")]
+
+    failed_beams = {"0": [], "1": []}
+    failed_cubes = {}
+    pipeline.check_failed_transfers(failed_jobs, failed_beams, failed_cubes)
+
+    assert list(failed_cubes.keys()) == ["1"]
+    assert failed_beams == {"0": ["1"], "1": []}
+
+
+def run_beam(beam_directory_list, do_source_finding, do_spectra_extraction, do_plots, do_sdss, index, **kwargs):
+    return index, None, 0
+
+
+def test_cube_results_processed_once_per_cube(tmpdir, monkeypatch):
+    monkeypatch.setattr(modules.apersharp, "run_sharpener_pipeline", run_beam)
+
+    pipeline = get_pipeline(["0", "1", "2"])
+    pipeline.sharpener_basedir = str(tmpdir)
+    pipeline.taskid = "190101001"
+    pipeline.cube_list = ["0", "1"]
+    pipeline.logfile = str(tmpdir.join("apersharp.log"))
+    pipeline.steps_list = ["run_sharpener"]
+    pipeline.n_cores = 2
+    # the cores are shared with another taskid
+    pipeline.core_semaphore = mp.BoundedSemaphore(1)
+
+    processed_cubes = []
+
+    def process_cube_results():
+        # all beams of the cube are finished
+        processed_cubes.append((pipeline.cube, list(pipeline.beam_list)))
+
+    pipeline.process_cube_results = process_cube_results
+
+    pipeline.run_sharpener_cubes()
+
+    assert sorted(processed_cubes) == [
+        ("0", ["0", "1", "2"]), ("1", ["0", "1", "2"])]
+    assert not pipeline.pool_running
+    assert pipeline.core_semaphore.acquire(False)
+
+
+def test_failed_cube_is_skipped_with_cubes_together(tmpdir, monkeypatch):
+    monkeypatch.setattr(modules.apersharp, "run_sharpener_pipeline", run_beam)
+
+    pipeline = get_pipeline(["0", "1"])
+    pipeline.sharpener_basedir = str(tmpdir)
+    pipeline.taskid = "190101001"
+    pipeline.cube_list = ["0", "1"]
+    pipeline.logfile = str(tmpdir.join("apersharp.log"))
+    pipeline.steps_list = ["get_data", "run_sharpener"]
+    pipeline.n_cores = 1
+    pipeline.failed_beams = {"0": [], "1": []}
+    pipeline.failed_cubes = {"0": "Did not find continuum image for beam 1"}
+
+    processed_cubes = []
+    pipeline.process_cube_results = lambda: processed_cubes.append(
+        pipeline.cube)
+
+    pipeline.run_sharpener_cubes()
+
+    assert processed_cubes == ["1"]
+
+
+def fail_beam_1(beam_directory_list, do_source_finding, do_spectra_extraction, do_plots, do_sdss, index, **kwargs):
+    if os.path.basename(beam_directory_list[0]) == "01":
+        return index, "Sharpener failed for beam 1", 0
+    return index, None, 0
+
+
+def test_eager_clean_up_with_disk_budget(tmpdir, monkeypatch):
+    monkeypatch.setattr(modules.apersharp,
+                        "run_sharpener_pipeline", fail_beam_1)
+
+    pipeline = get_pipeline(["0", "1", "2"])
+    pipeline.taskid = "190101001"
+    pipeline.cube = "0"
+    pipeline.sharpener_basedir = str(tmpdir.mkdir("work"))
+    pipeline.logfile = str(tmpdir.join("apersharp.log"))
+    pipeline.sharpener_configfilename = None
+    pipeline.cont_src_resource = "image"
+    pipeline.data_source = "local"
+    pipeline.data_basedir = str(tmpdir.join("data"))
+    pipeline.n_cores = 1
+    pipeline.apersharp_eager_clean_up = True
+    # the data of only one beam fits into the budget
+    pipeline.apersharp_disk_budget = 1500. / 1024.**3
+
+    for beam in pipeline.beam_list:
+        for file_name, file_size in [("line/cubes/HI_image_cube0.fits", 1000), ("continuum/image_mf_00.fits", 100)]:
+            file_path = tmpdir.join(
+                "data", pipeline.taskid, beam.zfill(2), file_name)
+            file_path.dirpath().ensure(dir=True)
+            file_path.write("0" * file_size)
+
+    # the disk space of the failed beam is given back, too
+    with pytest.raises(RuntimeError, match=r"failed for beams \['1'\]"):
+        pipeline.stream_sharpener()
+
+    for beam in pipeline.beam_list:
+        assert not os.path.exists(pipeline.get_cube_path(beam))
+        assert not os.path.exists(pipeline.get_cont_path(beam))
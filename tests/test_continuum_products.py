@@ -0,0 +1,72 @@
+import os
+import copy
+
+from conftest import create_synthetic_beam
+from lib.continuum_products import get_continuum_settings, store_continuum_products, get_continuum_products
+
+CFG_PAR = {'general': {'workdir': "", 'contname': "image_mf.fits"},
+           'source_finder': {'clip': 0.01, 'enable': True},
+           'source_catalog': {'enable': False},
+           'sdss_match': {'enable': True, 'max_sep': 30}}
+
+
+def get_settings(beam_dir, cfg_par=CFG_PAR, source_finding_engine="sharpener"):
+    cfg_par = copy.deepcopy(cfg_par)
+    cfg_par['general']['workdir'] = beam_dir
+    return get_continuum_settings(cfg_par, source_finding_engine=source_finding_engine)
+
+
+def store_products(continuum_dir, beam_dir):
+    # all files in the beam directory are new products
+    store_continuum_products(continuum_dir, beam_dir, {},
+                             True, True, continuum_settings=get_settings(beam_dir))
+
+
+def test_products_are_reused_with_same_settings(tmpdir):
+    beam_dir = str(tmpdir.join("cube_0"))
+    continuum_dir = str(tmpdir.join("continuum"))
+    create_synthetic_beam(beam_dir, 4, 32, 2)
+    os.makedirs(continuum_dir)
+    store_products(continuum_dir, beam_dir)
+
+    other_beam_dir = str(tmpdir.join("cube_1"))
+    create_synthetic_beam(other_beam_dir, 4, 32, 2)
+    os.remove(os.path.join(other_beam_dir, "image_mf.fits"))
+    os.link(os.path.join(beam_dir, "image_mf.fits"),
+            os.path.join(other_beam_dir, "image_mf.fits"))
+
+    assert get_continuum_products(continuum_dir, other_beam_dir, True, True,
+                                  continuum_settings=get_settings(other_beam_dir))
+
+
+def test_products_are_not_reused_with_other_settings(tmpdir):
+    beam_dir = str(tmpdir.join("cube_0"))
+    continuum_dir = str(tmpdir.join("continuum"))
+    create_synthetic_beam(beam_dir, 4, 32, 2)
+    os.makedirs(continuum_dir)
+    store_products(continuum_dir, beam_dir)
+
+    cfg_par = copy.deepcopy(CFG_PAR)
+    cfg_par['source_finder']['clip'] = 0.005
+    assert not get_continuum_products(continuum_dir, beam_dir, True, True,
+                                      continuum_settings=get_settings(beam_dir, cfg_par=cfg_par))
+
+    cfg_par = copy.deepcopy(CFG_PAR)
+    cfg_par['sdss_match']['max_sep'] = 10
+    assert not get_continuum_products(continuum_dir, beam_dir, True, True,
+                                      continuum_settings=get_settings(beam_dir, cfg_par=cfg_par))
+
+    assert not get_continuum_products(continuum_dir, beam_dir, True, True,
+                                      continuum_settings=get_settings(beam_dir, source_finding_engine="apersharp"))
+
+
+def test_products_are_not_reused_for_other_image(tmpdir):
+    beam_dir = str(tmpdir.join("cube_0"))
+    continuum_dir = str(tmpdir.join("continuum"))
+    create_synthetic_beam(beam_dir, 4, 32, 2)
+    os.makedirs(continuum_dir)
+    store_products(continuum_dir, beam_dir)
+
+    create_synthetic_beam(beam_dir, 4, 48, 2)
+    assert not get_continuum_products(continuum_dir, beam_dir, True, True,
+                                      continuum_settings=get_settings(beam_dir))
@@ -0,0 +1,93 @@
+import os
+import fcntl
+
+import lib.cube_cache
+from lib.cube_cache import CubeCache
+from lib.stage_file import stage_file
+
+
+def write_file(file_path, content="cube"):
+    with open(file_path, 'w') as stream:
+        stream.write(content)
+
+
+def read_file(file_path):
+    with open(file_path) as stream:
+        return stream.read()
+
+
+def test_fetch_only_once(tmpdir):
+    cache = CubeCache(str(tmpdir.join("cache")))
+    fetched_files = []
+
+    def fetch_function(output_file):
+        fetched_files.append(output_file)
+        write_file(output_file)
+
+    for k in range(2):
+        output_file = str(tmpdir.join("cube{}.fits".format(k)))
+        cache.fetch("190101001", "00", "HI_image_cube0.fits",
+                    4, None, fetch_function, output_file)
+        assert read_file(output_file) == "cube"
+
+    assert len(fetched_files) == 1
+    assert [file_name for file_name in os.listdir(str(tmpdir)) if file_name.endswith(".part")] == []
+
+
+def test_checksum_is_part_of_key(tmpdir):
+    cache = CubeCache(str(tmpdir.join("cache")))
+    fetched_files = []
+
+    def fetch_function(output_file):
+        fetched_files.append(output_file)
+        write_file(output_file)
+
+    for checksum in ["sha2:a", "sha2:b", "sha2:a"]:
+        cache.fetch("190101001", "00", "HI_image_cube0.fits", 4, checksum,
+                    fetch_function, str(tmpdir.join("cube_{}.fits".format(checksum))))
+
+    assert len(fetched_files) == 2
+
+
+def test_files_are_linked_without_lock(tmpdir, monkeypatch):
+    cache = CubeCache(str(tmpdir.join("cache")))
+    locked_while_staging = []
+
+    def check_stage_file(source_file, output_file, methods=None):
+        with open(cache.lock_file, 'a') as lock_stream:
+            try:
+                fcntl.flock(lock_stream.fileno(),
+                            fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                locked_while_staging.append(output_file)
+            else:
+                fcntl.flock(lock_stream.fileno(), fcntl.LOCK_UN)
+        return stage_file(source_file, output_file, methods=methods)
+
+    monkeypatch.setattr(lib.cube_cache, "stage_file", check_stage_file)
+
+    for k in range(2):
+        cache.fetch("190101001", "00", "HI_image_cube0.fits", 4, None,
+                    write_file, str(tmpdir.join("cube{}.fits".format(k))))
+
+    assert locked_while_staging == []
+
+
+def test_evicted_file_is_fetched_again(tmpdir):
+    cache = CubeCache(str(tmpdir.join("cache")), quota=0.)
+    fetched_files = []
+
+    def fetch_function(output_file):
+        fetched_files.append(output_file)
+        write_file(output_file)
+
+    output_file = str(tmpdir.join("cube.fits"))
+    cache.fetch("190101001", "00", "HI_image_cube0.fits",
+                4, None, fetch_function, output_file)
+    cache.release(output_file)
+    cache.evict()
+    cache.fetch("190101001", "00", "HI_image_cube0.fits",
+                4, None, fetch_function, output_file)
+
+    assert len(fetched_files) == 2
+    assert read_file(output_file) == "cube"
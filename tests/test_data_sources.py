@@ -0,0 +1,134 @@
+import os
+import glob
+import pickle
+
+import pytest
+
+import lib.data_sources
+from lib.data_sources import AltaDataSource, LocalDataSource, SimulatedDataSource
+
+
+def create_beam(data_dir, beam, file_list):
+    for file_name in file_list:
+        file_path = os.path.join(data_dir, "190101001", beam, file_name)
+        if not os.path.exists(os.path.dirname(file_path)):
+            os.makedirs(os.path.dirname(file_path))
+        open(file_path, 'w').close()
+
+
+def test_list_beam_matches_patterns(tmpdir):
+    create_beam(str(tmpdir), "00", ["line/cubes/HI_image_cube0.fits", "line/cubes/HI_image_cube1.fits",
+                                    "line/cubes/HI_beam_cube0.fits", "continuum/image_mf_00.fits",
+                                    "raw/WSRTA190101001_B000.MS/table.dat"])
+
+    data_source = LocalDataSource("190101001", str(tmpdir))
+
+    assert data_source.list_beam("0") == ["continuum/image_mf_00.fits", "line/cubes/HI_image_cube0.fits",
+                                          "line/cubes/HI_image_cube1.fits"]
+    assert data_source.list_beam("01") is None
+
+
+def test_list_beam_only_once(tmpdir, monkeypatch):
+    create_beam(str(tmpdir), "00", ["line/cubes/HI_image_cube0.fits"])
+
+    data_source = LocalDataSource("190101001", str(tmpdir))
+
+    glob_calls = []
+    original_glob = glob.glob
+
+    def count_glob(pattern):
+        glob_calls.append(pattern)
+        return original_glob(pattern)
+
+    monkeypatch.setattr(lib.data_sources.glob, "glob", count_glob)
+
+    for k in range(3):
+        assert data_source.list_beam("00") == [
+            "line/cubes/HI_image_cube0.fits"]
+
+    assert len(glob_calls) == 2
+
+
+def test_local_data_source_pickle(tmpdir):
+    create_beam(str(tmpdir), "00", ["line/cubes/HI_image_cube0.fits"])
+
+    data_source = LocalDataSource("190101001", str(tmpdir))
+    data_source.list_beam("00")
+
+    copied_data_source = pickle.loads(pickle.dumps(data_source))
+
+    assert copied_data_source.list_beam("00") == [
+        "line/cubes/HI_image_cube0.fits"]
+
+
+def test_simulated_data_source_pickle(tmpdir):
+    create_beam(str(tmpdir), "00", ["line/cubes/HI_image_cube0.fits"])
+
+    data_source = SimulatedDataSource("190101001", str(tmpdir), latency=0.)
+
+    copied_data_source = pickle.loads(pickle.dumps(data_source))
+
+    assert copied_data_source.list_beam("00") == [
+        "line/cubes/HI_image_cube0.fits"]
+    assert copied_data_source.read_range(copied_data_source.get_cube_location(0, 0), 0, 10) == b""
+
+
+def test_alta_data_source_pickle(tmpdir):
+    data_source = AltaDataSource(
+        "190101001", cache_file=str(tmpdir.join("listing.json")))
+
+    copied_data_source = pickle.loads(pickle.dumps(data_source))
+
+    assert copied_data_source.catalogue.cache_file == data_source.catalogue.cache_file
+
+
+def test_interrupted_fetch_leaves_no_file(tmpdir):
+    create_beam(str(tmpdir), "00", ["line/cubes/HI_image_cube0.fits"])
+    cube_path = str(tmpdir.join(
+        "190101001", "00", "line", "cubes", "HI_image_cube0.fits"))
+    with open(cube_path, 'wb') as stream:
+        stream.write(b"0" * 1000)
+
+    data_source = SimulatedDataSource(
+        "190101001", str(tmpdir), latency=0., chunk_size=100)
+
+    def interrupt(n_bytes):
+        raise IOError("connection lost")
+
+    data_source._wait_for_connection = interrupt
+
+    output_dir = tmpdir.mkdir("output")
+    output_file = str(output_dir.join("HI_image_cube0.fits"))
+    with pytest.raises(IOError):
+        data_source.fetch(cube_path, output_file)
+
+    assert os.listdir(str(output_dir)) == []
+
+    LocalDataSource("190101001", str(tmpdir)).fetch(cube_path, output_file)
+
+    assert os.listdir(str(output_dir)) == ["HI_image_cube0.fits"]
+    assert os.path.getsize(output_file) == 1000
+
+
+def test_incomplete_alta_fetch_leaves_no_file(tmpdir, monkeypatch):
+    data_source = AltaDataSource("190101001")
+    location = data_source.catalogue.get_beam_collection(
+        0) + "/HI_image_cube0.fits"
+    monkeypatch.setattr(data_source, "stat", lambda location: 1000)
+    monkeypatch.setattr(data_source, "checksum", lambda location: None)
+
+    alta_cmd_list = []
+
+    def iget(alta_cmd, **kwargs):
+        alta_cmd_list.append(alta_cmd)
+        with open(alta_cmd.split()[-1], 'wb') as stream:
+            stream.write(b"0" * 500)
+
+    monkeypatch.setattr(lib.data_sources.subprocess, "check_call", iget)
+
+    with pytest.raises(IOError):
+        data_source.fetch(location, str(tmpdir.join("HI_image_cube0.fits")))
+
+    assert os.listdir(str(tmpdir)) == []
+    # the partial file is removed, so there is nothing to restart
+    assert "-X" not in alta_cmd_list[0].split()
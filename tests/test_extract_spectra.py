@@ -0,0 +1,62 @@
+import os
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table
+
+from conftest import create_synthetic_beam
+from lib.extract_spectra import extract_spectra, check_sharpener_settings
+
+
+def get_beam(tmpdir, n_sources=5):
+    beam_dir = str(tmpdir.join("00"))
+    create_synthetic_beam(beam_dir, 10, 64, n_sources)
+
+    return (os.path.join(beam_dir, "HI_image_cube0.fits"),
+            os.path.join(beam_dir, "sharpOut/abs/mir_src_sharp.csv"),
+            os.path.join(beam_dir, "image_mf.fits"))
+
+
+def test_flux_is_pixel_of_source(tmpdir):
+    cube_file, src_file, cont_file = get_beam(tmpdir)
+    src_data = Table.read(src_file, format="ascii.csv")
+    cube_data = fits.getdata(cube_file)[0]
+
+    spec_file_list = extract_spectra(
+        cube_file, src_file, str(tmpdir.join("spec")), cont_file=cont_file)
+
+    assert len(spec_file_list) == len(src_data)
+    for src_index, spec_file in enumerate(spec_file_list):
+        spec = Table.read(spec_file, format="ascii")
+        pixel_x = src_data['pixel_ra'][src_index] - 1
+        pixel_y = src_data['pixel_dec'][src_index] - 1
+        assert np.allclose(spec['Flux [Jy]'], cube_data[:, pixel_y, pixel_x])
+        # the noise of the synthetic cube has a standard deviation of 1 mJy
+        assert np.all(spec['Noise [Jy]'] > 0.5e-3)
+        assert np.all(spec['Noise [Jy]'] < 2.e-3)
+        assert np.allclose(spec['Optical depth'],
+                           -np.log(1. + spec['Flux [Jy]'] / 0.1))
+
+
+def test_spectra_do_not_depend_on_chunk_size(tmpdir):
+    cube_file, src_file, cont_file = get_beam(tmpdir)
+
+    spec_file_list = extract_spectra(
+        cube_file, src_file, str(tmpdir.join("spec")), chunk_size=64)
+    spec_chunk_file_list = extract_spectra(
+        cube_file, src_file, str(tmpdir.join("spec_chunk")), chunk_size=3)
+
+    for spec_file, spec_chunk_file in zip(spec_file_list, spec_chunk_file_list):
+        assert os.path.basename(spec_file) == os.path.basename(spec_chunk_file)
+        spec = Table.read(spec_file, format="ascii")
+        spec_chunk = Table.read(spec_chunk_file, format="ascii")
+        assert np.array_equal(spec['Flux [Jy]'], spec_chunk['Flux [Jy]'])
+        assert np.array_equal(spec['Noise [Jy]'], spec_chunk['Noise [Jy]'])
+
+
+def test_unsupported_settings():
+    cfg_par = {'spec_ex': {'chrom_aberration': False, 'zunit': 'km/s'},
+               'hanning': {'enable': True},
+               'polynomial_subtraction': {'enable': False}}
+
+    assert check_sharpener_settings(cfg_par) == [
+        "spec_ex:zunit", "hanning:enable"]
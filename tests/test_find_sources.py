@@ -0,0 +1,68 @@
+import os
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+from astropy.table import Table
+from astropy.coordinates import SkyCoord
+import astropy.units as units
+
+from conftest import create_synthetic_beam
+from lib.find_sources import find_sources_sharpener, SHARPENER_SOURCE_COLUMNS
+from lib.extract_spectra import extract_spectra_sharpener
+from lib.get_master_table import read_beam_sources
+
+
+def get_cfg_par(beam_dir):
+    return {'general': {'workdir': beam_dir, 'contname': "image_mf.fits", 'cubename': "HI_image_cube0.fits"},
+            'source_finder': {'clip': 0.01},
+            'spec_ex': {'noise_delta_skip': 2, 'noise_delta_pix': 2}}
+
+
+def test_sources_have_schema_of_sharpener(tmpdir):
+    beam_dir = str(tmpdir)
+    create_synthetic_beam(beam_dir, 8, 64, 3)
+    src_file = os.path.join(beam_dir, "sharpOut/abs/mir_src_sharp.csv")
+    sharpener_sources = Table.read(src_file, format="ascii.csv")
+
+    find_sources_sharpener(get_cfg_par(beam_dir))
+
+    src_data = Table.read(src_file, format="ascii.csv")
+    assert src_data.colnames == SHARPENER_SOURCE_COLUMNS
+    assert list(src_data['ID']) == [1, 2, 3]
+    np.testing.assert_allclose(src_data['peak'], 0.1)
+
+    # names are the coordinates of imsad without colons and sorted
+    assert src_data['ra'][0].count(':') == 2 and len(src_data['ra'][0]) == 12
+    assert src_data['dec'][0][0] in "+-" and len(src_data['dec'][0]) == 12
+    assert list(src_data['J2000']) == sorted(
+        [ra.replace(':', '') + dec.replace(':', '') for ra, dec in zip(src_data['ra'], src_data['dec'])])
+
+    # every source is found at its position in the image
+    src_coord = SkyCoord(src_data['ra'], src_data['dec'],
+                         unit=(units.hourangle, units.deg), frame='fk5')
+    sharpener_coord = SkyCoord(sharpener_sources['ra'], sharpener_sources['dec'],
+                               unit=(units.hourangle, units.deg), frame='fk5')
+    assert np.all(src_coord.match_to_catalog_sky(
+        sharpener_coord)[1].arcsec < 1.)
+
+    # pixels start at 1
+    ra, dec = WCS(fits.getheader(os.path.join(beam_dir, "image_mf.fits"))).celestial.wcs_pix2world(
+        src_data['pixel_ra'], src_data['pixel_dec'], 1)
+    assert np.all(SkyCoord(ra, dec, unit=units.deg, frame='fk5').separation(
+        src_coord).arcsec < 1.)
+
+
+def test_sources_are_used_for_extraction(tmpdir):
+    beam_dir = str(tmpdir.join("00"))
+    create_synthetic_beam(beam_dir, 8, 64, 3)
+    cfg_par = get_cfg_par(beam_dir)
+
+    src_data = find_sources_sharpener(cfg_par)
+    spec_file_list = extract_spectra_sharpener(cfg_par)
+
+    assert sorted([os.path.basename(spec_file) for spec_file in spec_file_list]) == sorted(
+        ["{0}_J{1}.txt".format(src_id - 1, src_name) for src_id, src_name in zip(src_data['ID'], src_data['J2000'])])
+
+    # the sources are added to the master table like those of sharpener
+    beam_sources = read_beam_sources(str(tmpdir), "00")
+    assert len(beam_sources) == 3
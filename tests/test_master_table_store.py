@@ -0,0 +1,69 @@
+import os
+import numpy as np
+from astropy.table import Table
+
+from conftest import create_synthetic_sources
+from lib.get_master_table import get_all_sources_of_cube
+from lib.master_table_store import MasterTableStore, get_master_table_store_file, master_table_exists, read_master_table
+
+
+def create_cube(cube_dir, beam_list, n_sources=5):
+    for beam in beam_list:
+        create_synthetic_sources(os.path.join(cube_dir, beam), n_sources)
+
+
+def test_switch_from_csv_to_sqlite_keeps_beams(tmpdir):
+    cube_dir = str(tmpdir.join("cube_0"))
+    src_cat_file = os.path.join(cube_dir, "test_cube_0_master_table.csv")
+    create_cube(cube_dir, ["00", "01", "02"])
+
+    get_all_sources_of_cube(src_cat_file, cube_dir, taskid="test", cube_nr="0", beam_list=np.array(
+        ["00", "01"]), master_table_engine="csv")
+    assert master_table_exists(src_cat_file, master_table_engine="sqlite")
+
+    get_all_sources_of_cube(src_cat_file, cube_dir, taskid="test", cube_nr="0", beam_list=np.array(
+        ["02"]), master_table_engine="sqlite")
+
+    src_data = read_master_table(src_cat_file, master_table_engine="sqlite")
+    assert sorted(np.unique(src_data['Beam'])) == [0, 1, 2]
+    assert len(src_data) == 15
+
+
+def test_replace_beam_in_store(tmpdir):
+    cube_dir = str(tmpdir.join("cube_0"))
+    src_cat_file = os.path.join(cube_dir, "test_cube_0_master_table.csv")
+    create_cube(cube_dir, ["00", "01"])
+
+    get_all_sources_of_cube(src_cat_file, cube_dir, taskid="test", cube_nr="0", beam_list=np.array(
+        ["00", "01"]), master_table_engine="sqlite")
+    create_synthetic_sources(os.path.join(cube_dir, "01"), 3)
+    get_all_sources_of_cube(src_cat_file, cube_dir, taskid="test", cube_nr="0", beam_list=np.array(
+        ["01"]), master_table_engine="sqlite")
+
+    src_data = read_master_table(src_cat_file, master_table_engine="sqlite")
+    assert np.sum(src_data['Beam'] == 0) == 5
+    assert np.sum(src_data['Beam'] == 1) == 3
+
+
+def test_store_collection_does_not_back_up(tmpdir):
+    cube_dir = str(tmpdir.join("cube_0"))
+    src_cat_file = os.path.join(cube_dir, "test_cube_0_master_table.csv")
+    create_cube(cube_dir, ["00"])
+
+    for k in range(2):
+        get_all_sources_of_cube(src_cat_file, cube_dir, taskid="test", cube_nr="0", beam_list=np.array(
+            ["00"]), master_table_engine="sqlite")
+
+    assert not os.path.exists(os.path.join(cube_dir, "master_table_backup"))
+    assert not os.path.exists(src_cat_file)
+
+
+def test_export_csv(tmpdir):
+    store = MasterTableStore(str(tmpdir.join("tab.sqlite")))
+    store.overwrite(Table([["b", "a"], [1, 2]], names=["Source_ID", "Beam"]))
+    store.export_csv(str(tmpdir.join("tab.csv")))
+
+    src_data = Table.read(str(tmpdir.join("tab.csv")), format="ascii.csv")
+    assert list(src_data['Source_ID']) == ["a", "b"]
+    assert get_master_table_store_file(
+        str(tmpdir.join("tab.csv"))) == str(tmpdir.join("tab.sqlite"))
@@ -0,0 +1,103 @@
+import os
+import multiprocessing as mp
+import numpy as np
+from astropy.io import fits
+
+from lib.memory_estimate import MemoryEstimate, get_peak_memory, get_current_memory
+from modules.apersharp import apersharp
+
+# memory allocated by a beam in bytes
+BEAM_MEMORY = 64 * 1024**2
+
+
+def run_beam(index):
+    start_memory = get_current_memory()
+    np.ones(BEAM_MEMORY // 8)
+    return index, None, get_peak_memory() - start_memory
+
+
+def fail_beam(index):
+    raise ValueError("beam {} failed".format(index))
+
+
+def test_peak_memory_excludes_parent():
+    parent_data = np.ones(4 * BEAM_MEMORY // 8)
+
+    pool = mp.Pool(processes=1, maxtasksperchild=1)
+    try:
+        index, error, peak_memory = pool.apply(run_beam, (0,))
+    finally:
+        pool.close()
+        pool.join()
+
+    assert 0.9 * BEAM_MEMORY < peak_memory < parent_data.nbytes
+
+
+def test_estimate_adjusts_to_records(tmpdir):
+    usage_file = str(tmpdir.join("usage.json"))
+    cube_file = str(tmpdir.join("cube.fits"))
+    fits.PrimaryHDU(np.zeros((4, 16, 16), dtype=np.float32)).writeto(cube_file)
+
+    memory_estimate = MemoryEstimate(
+        usage_file=usage_file, overhead=0., factor=3.)
+    assert memory_estimate.estimate(cube_file) == 3 * 4 * 16 * 16 * 4
+
+    memory_estimate.record(cube_file, 5 * 4 * 16 * 16 * 4)
+    assert MemoryEstimate(usage_file=usage_file, overhead=0.).estimate(
+        cube_file) == 5 * 4 * 16 * 16 * 4
+
+
+def test_pool_without_memory_budget(tmpdir):
+    apersharp_object = apersharp()
+    apersharp_object.sharpener_basedir = str(tmpdir.join("run"))
+    apersharp_object.n_cores = 2
+    apersharp_object.apersharp_memory_budget = None
+
+    pool = apersharp_object.get_pool()
+    finished_beams = []
+    try:
+        assert pool._maxtasksperchild is None
+        apersharp_object.run_pool_beams(pool, run_beam, [0, 1], ["a.fits", "b.fits"],
+                                        lambda index, error: finished_beams.append(index))
+    finally:
+        pool.close()
+        pool.join()
+
+    assert sorted(finished_beams) == [0, 1]
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_pool_with_memory_budget(tmpdir):
+    apersharp_object = apersharp()
+    apersharp_object.sharpener_basedir = str(tmpdir.join("run"))
+    apersharp_object.n_cores = 2
+    apersharp_object.apersharp_memory_budget = 1.
+
+    pool = apersharp_object.get_pool()
+    try:
+        assert pool._maxtasksperchild == 1
+        apersharp_object.run_pool_beams(
+            pool, run_beam, [0], ["a.fits"], lambda index, error: None)
+    finally:
+        pool.close()
+        pool.join()
+
+    assert os.path.exists(str(tmpdir.join("apersharp_memory_usage.json")))
+
+
+def test_pool_with_failed_beams(tmpdir):
+    apersharp_object = apersharp()
+    apersharp_object.sharpener_basedir = str(tmpdir.join("run"))
+    apersharp_object.n_cores = 2
+    apersharp_object.apersharp_memory_budget = 1.
+
+    pool = apersharp_object.get_pool()
+    finished_beams = []
+    try:
+        apersharp_object.run_pool_beams(pool, fail_beam, [0, 1], ["a.fits", "b.fits"],
+                                        lambda index, error: finished_beams.append((index, "beam {} failed".format(index) in error)))
+    finally:
+        pool.close()
+        pool.join()
+
+    assert sorted(finished_beams) == [(0, True), (1, True)]
@@ -0,0 +1,86 @@
+import os
+import signal
+import threading
+import multiprocessing as mp
+
+from lib.pool_results import PoolResults
+
+
+def run_task(index):
+    if index == 1:
+        raise ValueError("task {} failed".format(index))
+    if index == 2:
+        os.kill(os.getpid(), signal.SIGKILL)
+    return index
+
+
+def collect_results(pool_results):
+    results = {}
+    while len(pool_results) != 0:
+        key, result, error = pool_results.get()
+        results[key] = (result, error)
+    return results
+
+
+def test_failed_tasks_are_returned():
+    pool = mp.Pool(processes=2)
+    pool_results = PoolResults(pool, poll_interval=0.1)
+    try:
+        for index in range(2):
+            pool_results.add(index, pool.apply_async(run_task, (index,)))
+        # tasks that cannot be pickled fail, too
+        pool_results.add("lock", pool.apply_async(
+            run_task, (threading.Lock(),)))
+        results = collect_results(pool_results)
+    finally:
+        pool_results.close_pool()
+
+    assert results[0] == (0, None)
+    assert results[1][0] is None and "task 1 failed" in results[1][1]
+    assert results["lock"][0] is None and results["lock"][1] is not None
+    assert pool_results.n_lost == 0
+
+
+def test_task_of_killed_worker_is_given_up():
+    pool = mp.Pool(processes=2)
+    pool_results = PoolResults(pool, poll_interval=0.1)
+    try:
+        for index in [0, 2, 3]:
+            pool_results.add(index, pool.apply_async(run_task, (index,)))
+        results = collect_results(pool_results)
+    finally:
+        pool_results.close_pool()
+
+    assert results[0] == (0, None)
+    assert results[3] == (3, None)
+    assert results[2][0] is None and "killed" in results[2][1]
+    assert pool_results.n_lost == 1
+
+
+def test_get_with_timeout():
+    pool = mp.Pool(processes=1)
+    pool_results = PoolResults(pool, poll_interval=0.1)
+    try:
+        assert pool_results.get(timeout=0) is None
+    finally:
+        pool_results.close_pool()
+
+
+def test_cores_are_given_back():
+    core_semaphore = mp.BoundedSemaphore(2)
+    pool = mp.Pool(processes=2)
+    pool_results = PoolResults(
+        pool, poll_interval=0.1, core_semaphore=core_semaphore)
+    try:
+        for index in [0, 1, 2, 3]:
+            # waits for the cores of the finished tasks
+            pool_results.acquire_core()
+            pool_results.add(index, pool.apply_async(run_task, (index,)))
+        results = collect_results(pool_results)
+    finally:
+        pool_results.close_pool()
+
+    assert sorted(results.keys()) == [0, 1, 2, 3]
+    assert pool_results.n_lost == 1
+    # the core of the killed worker was given back, too
+    assert core_semaphore.acquire(False) and core_semaphore.acquire(False)
@@ -0,0 +1,78 @@
+import numpy as np
+from astropy.table import Table
+
+from lib.read_spectra import read_spectra, read_spectrum, SPECTRUM_COLUMNS
+
+
+def write_spectrum(spec_file, spec_data, header=True, masked_chan=None):
+    with open(spec_file, 'w') as stream:
+        if header:
+            stream.write(
+                '"Frequency [Hz]" "Flux [Jy]" "Noise [Jy]" "Optical depth" "Noise optical depth"\n')
+        for chan, values in enumerate(spec_data):
+            if chan == masked_chan:
+                values = ["--" if k > 0 else value for k,
+                          value in enumerate(values)]
+            stream.write(" ".join([str(value) for value in values]) + "\n")
+
+
+def test_spectra_with_and_without_header(tmpdir):
+    spec_data = np.random.normal(0., 1., (16, 5))
+    spec_data[:, 0] = np.linspace(1.3e9, 1.4e9, 16)
+
+    spec_file_list = []
+    for k, header in enumerate([True, False]):
+        spec_file_list.append(str(tmpdir.join("{}_J120000+450000.txt".format(k))))
+        write_spectrum(spec_file_list[-1], spec_data, header=header)
+
+    spectra = read_spectra(spec_file_list)
+    assert spectra.shape == (2, 3, 16)
+    np.testing.assert_allclose(spectra[0], spec_data[:, :3].T)
+    np.testing.assert_allclose(spectra[1], spec_data[:, :3].T)
+
+    assert read_spectrum(spec_file_list[1]).colnames[:3] == SPECTRUM_COLUMNS
+
+
+def test_masked_spectra(tmpdir):
+    spec_data = np.random.normal(0., 1., (16, 5))
+
+    for header in [True, False]:
+        spec_file = str(tmpdir.join("{}_J120000+450000.txt".format(int(header))))
+        write_spectrum(spec_file, spec_data, header=header, masked_chan=0)
+
+        spectrum = read_spectrum(spec_file)
+        assert spectrum.colnames[:3] == SPECTRUM_COLUMNS
+        assert len(spectrum) == 16
+        assert np.isnan(spectrum['Flux [Jy]'][0])
+        np.testing.assert_allclose(
+            spectrum['Flux [Jy]'][1:], spec_data[1:, 1])
+
+
+class ColumnMaskedTable(object):
+    """
+    Table as read by astropy 4 and newer, which only masks the columns
+    """
+
+    masked = False
+
+    def __init__(self, table):
+        self.table = table
+        self.colnames = table.colnames
+
+    def __getitem__(self, col_name):
+        return self.table[col_name]
+
+
+def test_masked_columns(tmpdir, monkeypatch):
+    spec_data = np.random.normal(0., 1., (16, 5))
+    spec_file = str(tmpdir.join("0_J120000+450000.txt"))
+    write_spectrum(spec_file, spec_data, masked_chan=3)
+
+    table_read = Table.read
+    monkeypatch.setattr(Table, "read", staticmethod(
+        lambda *args, **kwargs: ColumnMaskedTable(table_read(*args, **kwargs))))
+
+    spectrum = read_spectrum(spec_file)
+    assert np.isnan(spectrum['Flux [Jy]'][3])
+    assert np.isnan(spectrum['Noise [Jy]'][3])
+    np.testing.assert_allclose(spectrum['Flux [Jy]'][4:], spec_data[4:, 1])
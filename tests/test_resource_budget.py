@@ -0,0 +1,60 @@
+import threading
+
+from lib.resource_budget import ResourceBudget
+
+
+def test_reservation_waits_until_it_fits():
+    budget = ResourceBudget(10.)
+    budget.acquire(6.)
+    assert not budget.fits(6.)
+
+    acquired = threading.Event()
+
+    def acquire():
+        budget.acquire(6.)
+        acquired.set()
+
+    acquire_thread = threading.Thread(target=acquire)
+    acquire_thread.start()
+
+    # the second reservation waits for the first one
+    assert not acquired.wait(0.5)
+
+    budget.release(6.)
+    acquire_thread.join(10.)
+
+    assert acquired.is_set()
+    assert budget.used == 6.
+    assert budget.peak == 6.
+
+
+def test_reservation_larger_than_limit():
+    budget = ResourceBudget(10.)
+
+    # nothing is reserved, so the reservation does not get stuck
+    assert budget.fits(20.)
+    budget.acquire(20.)
+    assert not budget.fits(1.)
+
+    budget.release(20.)
+    assert budget.used == 0.
+    assert budget.peak == 20.
+
+
+def test_reservation_without_blocking():
+    budget = ResourceBudget(10.)
+    budget.acquire(6.)
+    budget.acquire(6., block=False)
+
+    assert budget.used == 12.
+
+    # more than reserved is never released
+    budget.release(20.)
+    assert budget.used == 0.
+
+
+def test_no_limit():
+    budget = ResourceBudget(None)
+    budget.acquire(1.e12)
+
+    assert budget.fits(1.e12)
@@ -0,0 +1,26 @@
+import argparse
+
+import pytest
+
+from run_apersharp import get_taskid_cores, positive_int, run_apersharp
+
+
+def test_cores_are_split_across_taskids():
+    assert get_taskid_cores(8, 2, 5) == 4
+    assert get_taskid_cores(5, 2, 5) == 3
+    assert get_taskid_cores(2, 4, 5) == 1
+
+
+def test_fewer_taskids_than_parallel_taskids():
+    assert get_taskid_cores(8, 4, 2) == 4
+    assert get_taskid_cores(8, 4, 1) == 8
+
+
+def test_parallel_taskids_must_be_positive(tmpdir):
+    with pytest.raises(ValueError):
+        run_apersharp("190101001", str(tmpdir), n_parallel_taskids=0)
+
+    assert positive_int("2") == 2
+    for value in ["0", "-1", "a"]:
+        with pytest.raises(argparse.ArgumentTypeError):
+            positive_int(value)
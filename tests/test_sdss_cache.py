@@ -0,0 +1,81 @@
+import os
+import pytest
+from astropy.table import Table
+import astropy.units as units
+
+import lib.sdss_cache
+from lib.sdss_cache import SDSSCache, SDSS_CACHE_INDEX
+
+
+class QueryCounter(object):
+    """
+    Query of SDSS sources that counts how often it is sent
+    """
+
+    def __init__(self):
+        self.n_queries = 0
+
+    def __call__(self, coordinates, radius=2. * units.arcsec, **kwargs):
+        self.n_queries += 1
+        return Table([[180.], [45.]], names=['ra', 'dec'])
+
+
+def test_expired_queries_are_sent_again(tmpdir, monkeypatch):
+    cache_dir = str(tmpdir.join("sdss_cache"))
+    query_function = QueryCounter()
+
+    SDSSCache(cache_dir=cache_dir).query_region(
+        query_function, "180d 45d", radius=1. * units.arcmin)
+    assert query_function.n_queries == 1
+
+    sdss_cache = SDSSCache(cache_dir=cache_dir, max_age=1.)
+    sdss_cache.query_region(query_function, "180d 45d",
+                            radius=1. * units.arcmin)
+    assert query_function.n_queries == 1
+
+    # two days later
+    start_time = lib.sdss_cache.time()
+    monkeypatch.setattr(lib.sdss_cache, "time",
+                        lambda: start_time + 2. * 86400.)
+    sdss_cache.query_region(query_function, "180d 45d",
+                            radius=1. * units.arcmin)
+    assert query_function.n_queries == 2
+
+    # the query is replaced
+    sdss_cache.query_region(query_function, "180d 45d",
+                            radius=1. * units.arcmin)
+    assert query_function.n_queries == 2
+    assert len(sdss_cache.get_index()) == 1
+
+    with pytest.raises(RuntimeError):
+        SDSSCache(cache_dir=cache_dir, offline=True, refresh=True)
+
+
+def test_refresh_sends_queries_again(tmpdir):
+    cache_dir = str(tmpdir.join("sdss_cache"))
+    query_function = QueryCounter()
+
+    for refresh in [False, False, True]:
+        SDSSCache(cache_dir=cache_dir, refresh=refresh).query_region(
+            query_function, "180d 45d", radius=1. * units.arcmin)
+    assert query_function.n_queries == 2
+
+    # no temporary files are left
+    assert sorted(os.listdir(cache_dir)) == sorted(
+        [SDSS_CACHE_INDEX, "{}.lock".format(SDSS_CACHE_INDEX), SDSSCache(cache_dir=cache_dir).get_index()[0]['file']])
+
+
+def test_cache_failures_are_errors(tmpdir):
+    query_function = QueryCounter()
+
+    # the cache directory cannot be created
+    tmpdir.join("sdss_cache").write("")
+    with pytest.raises(RuntimeError):
+        SDSSCache(cache_dir=str(tmpdir.join("sdss_cache"))).query_region(
+            query_function, "180d 45d", radius=1. * units.arcmin)
+
+    cache_dir = tmpdir.mkdir("other_sdss_cache")
+    cache_dir.join(SDSS_CACHE_INDEX).write("[{")
+    with pytest.raises(RuntimeError):
+        SDSSCache(cache_dir=str(cache_dir)).query_region(
+            query_function, "180d 45d", radius=1. * units.arcmin)
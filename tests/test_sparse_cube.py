@@ -0,0 +1,60 @@
+import os
+import numpy as np
+from astropy.io import fits
+
+from conftest import create_synthetic_beam
+from lib.data_sources import LocalDataSource
+from lib.sparse_cube import create_sparse_cube, fill_sparse_cube
+from modules.apersharp import apersharp
+
+
+def get_local_cube(tmpdir):
+    beam_dir = str(tmpdir.join("data", "190101001", "00"))
+    create_synthetic_beam(beam_dir, 4, 64, 3)
+    data_source = LocalDataSource("190101001", str(tmpdir.join("data")),
+                                  cube_pattern="{beam}/HI_image_cube{cube}.fits")
+
+    return data_source, data_source.get_cube_location("00", 0), beam_dir
+
+
+def test_pixels_outside_boxes_are_nan(tmpdir):
+    data_source, location, beam_dir = get_local_cube(tmpdir)
+    output_file = str(tmpdir.join("HI_image_cube0_sparse.fits"))
+
+    create_sparse_cube(data_source, location, output_file)
+    assert os.path.getsize(output_file) == os.path.getsize(location)
+    assert np.all(np.isnan(fits.getdata(output_file)))
+
+    fill_sparse_cube(data_source, location, output_file,
+                     os.path.join(beam_dir, "sharpOut/abs/mir_src_sharp.csv"), 2)
+
+    sparse_data = fits.getdata(output_file)
+    cube_data = fits.getdata(location)
+    filled = ~np.isnan(sparse_data)
+    assert np.any(filled) and not np.all(filled)
+    assert np.array_equal(sparse_data[filled], cube_data[filled])
+
+
+def test_sparse_cube_is_not_used_as_full_cube(tmpdir):
+    pipeline = apersharp.__new__(apersharp)
+    pipeline.sharpener_basedir = str(tmpdir)
+    pipeline.cube = "0"
+
+    beam_dir = pipeline.get_cube_beam_dir("00")
+    os.makedirs(beam_dir)
+
+    assert pipeline.get_sparse_cube_path("00") != pipeline.get_cube_path("00")
+
+    # the sparse cube is only used once it is complete
+    open(pipeline.get_sparse_cube_path("00"), 'w').close()
+    assert pipeline.get_beam_cube_path("00") == pipeline.get_cube_path("00")
+
+    with open(pipeline.get_sparse_cube_location_file("00"), 'w') as stream:
+        stream.write("HI_image_cube0.fits")
+    assert pipeline.get_beam_cube_path(
+        "00") == pipeline.get_sparse_cube_path("00")
+
+    # a full cube is always preferred
+    open(pipeline.get_cube_path("00"), 'w').close()
+    assert pipeline.get_beam_cube_path("00") == pipeline.get_cube_path("00")
+    assert pipeline.get_fill_cube_function("00") is None
@@ -0,0 +1,53 @@
+import os
+import numpy as np
+
+from conftest import create_synthetic_beam
+from lib.extract_spectra import extract_spectra
+from lib.read_spectra import read_beam_spectra
+from lib.spectra_store import SpectraStore, convert_spectra_to_store, has_current_spectra_store
+
+
+def extract_beam_spectra(beam_dir, **kwargs):
+    return extract_spectra(os.path.join(beam_dir, "HI_image_cube0.fits"), os.path.join(beam_dir, "sharpOut/abs/mir_src_sharp.csv"),
+                           os.path.join(beam_dir, "sharpOut/spec"), cont_file=os.path.join(beam_dir, "image_mf.fits"), **kwargs)
+
+
+def test_extractor_writes_store(tmpdir):
+    beam_dir = str(tmpdir)
+    create_synthetic_beam(beam_dir, 16, 64, 3)
+
+    extract_beam_spectra(beam_dir)
+    src_nr, src_name, spectra = read_beam_spectra(beam_dir)
+
+    assert extract_beam_spectra(
+        beam_dir, store_beam_dir=beam_dir, write_text_files=True) != []
+    assert has_current_spectra_store(beam_dir)
+
+    store = SpectraStore(beam_dir)
+    for k in range(len(src_nr)):
+        spectrum = store.get_spectrum(src_nr[k], src_name[k])
+        np.testing.assert_allclose(spectrum['Flux [Jy]'], spectra[k, 1], rtol=1.e-6)
+        np.testing.assert_allclose(spectrum['Noise [Jy]'], spectra[k, 2], rtol=1.e-6)
+
+
+def test_extractor_without_text_files(tmpdir):
+    beam_dir = str(tmpdir)
+    create_synthetic_beam(beam_dir, 16, 64, 3)
+
+    assert extract_beam_spectra(
+        beam_dir, store_beam_dir=beam_dir, write_text_files=False) == []
+    assert os.listdir(os.path.join(beam_dir, "sharpOut/spec")) == []
+    assert len(SpectraStore(beam_dir).row) == 3
+
+
+def test_convert_again_after_removing_text_files(tmpdir):
+    beam_dir = str(tmpdir)
+    create_synthetic_beam(beam_dir, 16, 64, 3)
+    extract_beam_spectra(beam_dir)
+    src_nr, src_name, spectra = read_beam_spectra(beam_dir)
+
+    assert convert_spectra_to_store(beam_dir, remove_text_files=True) == 3
+    assert convert_spectra_to_store(beam_dir, remove_text_files=True) == 3
+
+    assert SpectraStore(beam_dir).get_spectrum(
+        src_nr[0], src_name[0]) is not None
@@ -0,0 +1,60 @@
+import os
+import errno
+import pytest
+
+import lib.stage_file
+from lib.stage_file import stage_file
+
+
+def create_source_file(tmpdir):
+    source_file = str(tmpdir.join("source.fits"))
+    with open(source_file, 'w') as stream:
+        stream.write("data")
+
+    return source_file
+
+
+def test_fallback_order(tmpdir, monkeypatch):
+    source_file = create_source_file(tmpdir)
+    output_file = str(tmpdir.join("output.fits"))
+    failed_methods = []
+
+    def fail_hardlink(source_file, output_file):
+        failed_methods.append("hardlink")
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+    def fail_reflink(fd, request, arg):
+        failed_methods.append("reflink")
+        raise IOError(errno.EOPNOTSUPP, "Operation not supported")
+
+    def fail_symlink(source_file, output_file):
+        failed_methods.append("symlink")
+        raise OSError(errno.EPERM, "Operation not permitted")
+
+    monkeypatch.setattr(lib.stage_file.os, "link", fail_hardlink)
+    monkeypatch.setattr(lib.stage_file.fcntl, "ioctl", fail_reflink)
+    assert stage_file(source_file, output_file) == "symlink"
+    assert failed_methods == ["hardlink", "reflink"]
+    assert os.path.islink(output_file)
+
+    monkeypatch.setattr(lib.stage_file.os, "symlink", fail_symlink)
+    assert stage_file(source_file, output_file) == "copy"
+    assert failed_methods == ["hardlink", "reflink"] * 2 + ["symlink"]
+    assert not os.path.islink(output_file)
+    with open(output_file) as stream:
+        assert stream.read() == "data"
+
+
+def fail_reflink(fd, request, arg):
+    raise IOError(errno.EOPNOTSUPP, "Operation not supported")
+
+
+def test_failed_reflink_leaves_no_file(tmpdir, monkeypatch):
+    source_file = create_source_file(tmpdir)
+    output_file = str(tmpdir.join("output.fits"))
+
+    monkeypatch.setattr(lib.stage_file.fcntl, "ioctl", fail_reflink)
+    with pytest.raises(IOError):
+        stage_file(source_file, output_file, methods=["reflink"])
+
+    assert not os.path.lexists(output_file)
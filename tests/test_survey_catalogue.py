@@ -0,0 +1,122 @@
+import os
+import multiprocessing as mp
+import numpy as np
+from astropy.table import Table
+
+from apersharp_catalogue import ingest_directories
+from lib.survey_catalogue import SurveyCatalogue, CATALOGUE_SOURCES_TABLE, CATALOGUE_CANDIDATES_TABLE
+
+
+def create_sources(n_sources, beam=0, dec=45.):
+    return Table([["S{0}_{1}".format(beam, k) for k in range(n_sources)],
+                  [beam] * n_sources,
+                  ["12:00:{0:04.1f}".format(4. * k) for k in range(n_sources)],
+                  ["+{0:02.0f}:00:00".format(dec)] * n_sources,
+                  -np.arange(n_sources, dtype=float),
+                  np.arange(n_sources, dtype=float)],
+                 names=['Source_ID', 'Beam', 'ra', 'dec', 'Max_Negative_SNR', 'Max_Positive_SNR'])
+
+
+def create_run(run_dir, taskid, cube, src_data):
+    src_data.write(os.path.join(run_dir, "{0}_cube_{1}_master_table.csv".format(
+        taskid, cube)), format="ascii.csv", overwrite=True)
+    src_data[src_data['Max_Negative_SNR'] <= -2].write(os.path.join(run_dir, "{0}_cube_{1}_snr_candidates.csv".format(
+        taskid, cube)), format="ascii.csv", overwrite=True)
+
+
+def test_ingest_cube_again_replaces_rows(tmpdir):
+    run_dir = str(tmpdir.mkdir("run"))
+    catalogue_file = str(tmpdir.join("catalogue.sqlite"))
+    create_run(run_dir, "190101001", 0, create_sources(5))
+    create_run(run_dir, "190101001", 1, create_sources(3))
+
+    assert ingest_directories(catalogue_file, [run_dir]) == 2
+
+    create_run(run_dir, "190101001", 0, create_sources(4))
+    assert ingest_directories(catalogue_file, [run_dir]) == 2
+
+    catalogue = SurveyCatalogue(catalogue_file)
+    src_data = catalogue.query(table_name=CATALOGUE_SOURCES_TABLE)
+    assert len(src_data[src_data['Cube'] == 0]) == 4
+    assert len(src_data[src_data['Cube'] == 1]) == 3
+
+    ingested_cubes = catalogue.get_ingested_cubes()
+    assert len(ingested_cubes) == 4
+    assert list(ingested_cubes[(ingested_cubes['Cube'] == 0) & (
+        ingested_cubes['table_name'] == CATALOGUE_SOURCES_TABLE)]['n_rows']) == [4]
+
+
+def ingest_cube(catalogue_file, cube, start_event, n_ingestions):
+    catalogue = SurveyCatalogue(catalogue_file)
+    start_event.wait(10.)
+    for k in range(n_ingestions):
+        catalogue.ingest_tables("190101001", cube, {
+            CATALOGUE_SOURCES_TABLE: create_sources(20), CATALOGUE_CANDIDATES_TABLE: create_sources(2)})
+
+
+def test_parallel_ingestion(tmpdir):
+    catalogue_file = str(tmpdir.join("catalogue.sqlite"))
+    start_event = mp.Event()
+
+    process_list = [mp.Process(target=ingest_cube, args=(
+        catalogue_file, cube, start_event, 10)) for cube in range(2)]
+    for process in process_list:
+        process.start()
+    start_event.set()
+    for process in process_list:
+        process.join(60.)
+
+    # both processes wait for the lock of the other one instead of failing
+    assert [process.exitcode for process in process_list] == [0, 0]
+
+    src_data = SurveyCatalogue(catalogue_file).query(
+        table_name=CATALOGUE_SOURCES_TABLE)
+    assert len(src_data[src_data['Cube'] == 0]) == 20
+    assert len(src_data[src_data['Cube'] == 1]) == 20
+
+
+def test_query(tmpdir):
+    catalogue = SurveyCatalogue(str(tmpdir.join("catalogue.sqlite")))
+    catalogue.ingest_tables("190101001", 0, {
+        CATALOGUE_CANDIDATES_TABLE: create_sources(5, beam=0, dec=45.)})
+    catalogue.ingest_tables("190101002", 0, {
+        CATALOGUE_CANDIDATES_TABLE: create_sources(5, beam=1, dec=60.)})
+
+    src_data = catalogue.query(taskid="190101002")
+    assert len(src_data) == 5
+    assert np.all(src_data['taskid'] == "190101002")
+
+    src_data = catalogue.query(max_negative_snr=-3)
+    assert sorted(src_data['Source_ID']) == [
+        "S0_3", "S0_4", "S1_3", "S1_4"]
+
+    # the sources are 4s (about 0.7 arcmin at this declination) apart
+    src_data = catalogue.query(ra=180., dec=45., radius=1.5 / 60.)
+    assert list(src_data['Source_ID']) == ["S0_0", "S0_1", "S0_2"]
+    np.testing.assert_allclose(src_data['ra_deg'][1], 180. + 4. / 240.)
+
+    src_data = catalogue.query(
+        ra=180., dec=45., radius=1.5 / 60., max_negative_snr=-1, limit=1)
+    assert list(src_data['Source_ID']) == ["S0_1"]
+
+
+def test_candidate_columns_differ_between_runs(tmpdir):
+    catalogue = SurveyCatalogue(str(tmpdir.join("catalogue.sqlite")))
+    catalogue.ingest_tables("190101001", 0, {
+        CATALOGUE_CANDIDATES_TABLE: create_sources(2)})
+
+    # a later run has an additional column and misses another one
+    src_data = create_sources(3)
+    src_data['Max_Flux'] = [0.1, 0.2, 0.3]
+    src_data.remove_column('Max_Positive_SNR')
+    catalogue.ingest_tables("190101002", 0, {
+        CATALOGUE_CANDIDATES_TABLE: src_data})
+
+    src_data = catalogue.query()
+    assert len(src_data) == 5
+    assert list(src_data['Max_Flux'].mask) == [True, True, False, False, False]
+    assert list(src_data['Max_Positive_SNR'].mask) == [
+        False, False, True, True, True]
+
+    src_data = catalogue.query(where="Max_Flux > 0.15")
+    assert list(src_data['Max_Flux']) == [0.2, 0.3]
@@ -0,0 +1,76 @@
+import os
+from astropy.table import Table
+
+from lib.table_history import TableHistory, write_table_file
+
+
+def read_file(file_path):
+    with open(file_path) as stream:
+        return stream.read()
+
+
+def test_write_after_restore_keeps_snapshot(tmpdir):
+    table_file = str(tmpdir.join("tab.csv"))
+    history = TableHistory(str(tmpdir.join("backup")), table_file)
+
+    write_table_file(Table({'a': [1]}), table_file)
+    history.add_version()
+    history.restore(1)
+    write_table_file(Table({'a': [2]}), table_file)
+
+    assert read_file(history.get_snapshot_file(1)) == "a\n1\n"
+    assert read_file(table_file) == "a\n2\n"
+    assert sorted(os.listdir(str(tmpdir))) == ["backup", "tab.csv"]
+
+
+def test_restore_previous_version(tmpdir):
+    table_file = str(tmpdir.join("tab.csv"))
+    history = TableHistory(str(tmpdir.join("backup")), table_file)
+
+    write_table_file(Table({'a': [1]}), table_file)
+    history.add_version()
+    write_table_file(Table({'a': [2]}), table_file)
+    history.add_version()
+    history.restore(1)
+
+    assert read_file(table_file) == "a\n1\n"
+    assert read_file(history.get_snapshot_file(2)) == "a\n2\n"
+    assert not os.path.exists("{}.tmp".format(table_file))
+
+
+def test_unchanged_table_uses_previous_snapshot(tmpdir):
+    table_file = str(tmpdir.join("tab.csv"))
+    history = TableHistory(str(tmpdir.join("backup")), table_file)
+
+    write_table_file(Table({'a': [1]}), table_file)
+    history.add_version()
+    history.add_version()
+
+    assert [version_entry['file'] for version_entry in history.get_versions()] == [
+        "tab_v0001.csv", "tab_v0001.csv"]
+
+
+def test_all_versions_are_kept_by_default(tmpdir):
+    table_file = str(tmpdir.join("tab.csv"))
+    history = TableHistory(str(tmpdir.join("backup")), table_file)
+
+    for value in range(5):
+        write_table_file(Table({'a': [value]}), table_file)
+        history.add_version()
+
+    assert len(history.get_versions()) == 5
+
+
+def test_old_versions_are_removed(tmpdir):
+    table_file = str(tmpdir.join("tab.csv"))
+    history = TableHistory(
+        str(tmpdir.join("backup")), table_file, max_versions=2)
+
+    for value in range(5):
+        write_table_file(Table({'a': [value]}), table_file)
+        history.add_version()
+
+    assert [version_entry['version']
+            for version_entry in history.get_versions()] == [4, 5]
+    assert sorted(os.listdir(str(tmpdir.join("backup")))) == [
+        "tab_history.json", "tab_history.json.lock", "tab_v0004.csv", "tab_v0005.csv"]
@@ -0,0 +1,70 @@
+import threading
+from time import sleep, time
+
+from lib.resource_budget import ResourceBudget
+from lib.transfer_engine import TransferEngine, TransferJob
+
+
+def test_stop_does_not_start_new_transfers():
+    transfer_engine = TransferEngine(n_transfers=1, retry_wait=60.)
+    started = threading.Event()
+    fetched_jobs = []
+
+    def fetch_function(name):
+        fetched_jobs.append(name)
+        started.set()
+        raise IOError("Transfer of {} failed".format(name))
+
+    for k in range(3):
+        transfer_engine.add_job(TransferJob(
+            "job {}".format(k), lambda k=k: fetch_function(k)))
+
+    transfer_thread = threading.Thread(target=transfer_engine.run)
+    transfer_thread.start()
+
+    started.wait(10.)
+    start_time = time()
+    transfer_engine.stop()
+    transfer_thread.join(10.)
+
+    # the retry of the failed transfer is not waited for
+    assert not transfer_thread.is_alive()
+    assert time() - start_time < 10.
+    assert fetched_jobs == [0]
+    assert transfer_engine.job_list[0].status == "failed"
+
+
+def test_transfers_wait_for_disk_space():
+    disk_budget = ResourceBudget(10.)
+    transfer_engine = TransferEngine(
+        n_transfers=3, retry_wait=0., disk_budget=disk_budget)
+    lock = threading.Lock()
+    running_jobs = []
+    max_running_jobs = []
+
+    def fetch_function(name):
+        with lock:
+            running_jobs.append(name)
+            max_running_jobs.append(len(running_jobs))
+        sleep(0.2)
+        with lock:
+            running_jobs.remove(name)
+        # the space of a finished transfer is released once the data was removed
+        disk_budget.release(6.)
+
+    for k in range(3):
+        transfer_engine.add_job(TransferJob(
+            "job {}".format(k), lambda k=k: fetch_function(k), size=6.))
+
+    def fail_function():
+        raise IOError("Transfer failed")
+
+    # the space of a failed transfer is released by the engine
+    transfer_engine.add_job(TransferJob("failed job", fail_function, size=6.))
+    failed_jobs = transfer_engine.run()
+
+    assert [job.name for job in failed_jobs] == ["failed job"]
+    # only one transfer fits into the budget at a time
+    assert max(max_running_jobs) == 1
+    assert disk_budget.used == 0.
+    assert disk_budget.peak == 6.